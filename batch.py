@@ -0,0 +1,504 @@
+"""Recombination of a cohort of subjects
+
+Lists the subjects to recombine, either from a CSV manifest or from a
+BIDS-style directory, runs them on a pool of worker processes and
+writes a per-subject status and timing summary.
+
+The number of subjects running at the same time can be limited by
+memory and CPU budgets, using the resources estimated for each subject
+from the headers of its inputs (see preflight.py). The estimated and
+measured peak memory of each subject are written to the summary, so
+that the estimates can be calibrated.
+
+Worker processes are started once and process several subjects in
+turn, so that the interpreter start-up, the imports and the caches are
+only paid once per worker instead of once per subject.
+
+"""
+
+import os
+import csv
+import glob
+import re
+import concurrent.futures
+
+
+# columns of the subject manifest, besides the slab columns
+MANIFEST_COLUMNS = ['subject', 'lowres']
+# slab columns of the subject manifest: rep[r]s[s] for slab s of
+# repetition r (e.g., rep1s1, rep1s2, rep2s1, rep2s2 for two repetitions
+# of two slabs)
+SLAB_COLUMN_PATTERN = re.compile(r'^rep([0-9]+)s([0-9]+)$')
+SLAB_COLUMN = 'rep{0}s{1}'
+# optional column of the subject manifest
+MANIFEST_OUTDIR_COLUMN = 'outdir'
+# columns of the batch summary
+SUMMARY_COLUMNS = [
+    'subject', 'status', 'elapsed_seconds', 'estimated_peak_memory_mb',
+    'peak_rss_mb', 'children_peak_rss_mb', 'outdir', 'error']
+# file name of the batch summary (inside the batch output dir)
+SUMMARY_FILENAME = 'batch_summary.csv'
+# BIDS-style file name patterns of the inputs (the run is the
+# repetition, the acquisition label the slab)
+BIDS_SLAB_PATTERN = '*_run-*_acq-slab*_*.nii*'
+BIDS_SLAB_REGEX = re.compile(r'_run-([0-9]+)_acq-slab([0-9]+)_')
+BIDS_LOWRES_PATTERN = '*_acq-lowres_*.nii*'
+
+
+def slabs_from_columns(columns):
+    """Slabs of a subject, from its slab columns
+
+    Args:
+        columns (dict): paths to the slabs, keyed by slab column
+            (rep[r]s[s], see SLAB_COLUMN_PATTERN). Other keys and empty
+            paths are ignored
+
+    Returns:
+        slab_path_list (list of strings): paths to the slabs,
+            repetition after repetition
+        slabs_per_repetition (int): number of interleaved slabs per
+            repetition
+    """
+    grid = {}
+    for column, path in columns.items():
+        match = SLAB_COLUMN_PATTERN.match(column)
+        if match is None or not path:
+            continue
+        grid[(int(match.group(1)), int(match.group(2)))] = path
+    if not grid:
+        raise ValueError('no slab found (columns rep[r]s[s])')
+    repetition_count = max(repetition for repetition, _ in grid)
+    slabs_per_repetition = max(slab for _, slab in grid)
+    missing_columns = [
+        SLAB_COLUMN.format(repetition, slab)
+        for repetition in range(1, repetition_count+1)
+        for slab in range(1, slabs_per_repetition+1)
+        if (repetition, slab) not in grid]
+    if missing_columns:
+        raise ValueError(
+            'missing slabs {0}'.format(', '.join(missing_columns)))
+    slab_path_list = [
+        grid[(repetition, slab)]
+        for repetition in range(1, repetition_count+1)
+        for slab in range(1, slabs_per_repetition+1)]
+
+    return slab_path_list, slabs_per_repetition
+
+
+def subject_slabs(subject):
+    """Slabs of a subject (or of a job)
+
+    Args:
+        subject (dict): subject (see read_manifest). Subjects listed
+            before the support of any number of repetitions and slabs
+            (e.g., jobs already in a work queue) have slab columns
+            (rep[r]s[s]) instead of slabs and slabs_per_repetition
+
+    Returns:
+        slab_path_list (list of strings): paths to the slabs,
+            repetition after repetition
+        slabs_per_repetition (int): number of interleaved slabs per
+            repetition
+    """
+    if 'slabs' not in subject:
+        return slabs_from_columns(subject)
+
+    return list(subject['slabs']), int(subject['slabs_per_repetition'])
+
+
+def read_manifest(manifest_path, outroot_path):
+    """Read a subject manifest
+
+    The manifest is a CSV file with a header line and the columns
+    subject, lowres, one column rep[r]s[s] per slab s of repetition r
+    (e.g., rep1s1, rep1s2, rep2s1, rep2s2 for two repetitions of two
+    slabs) and, optionally, outdir. Each repetition must have the same
+    number of slabs; the slab cells of the extra repetitions or slabs
+    of other subjects are left empty. Relative paths are relative to
+    the folder of the manifest.
+
+    Args:
+        manifest_path (string): path to the CSV manifest
+        outroot_path (string): folder where the output dir of each
+            subject is created ([outroot]/[subject]) if the manifest
+            has no outdir column
+
+    Returns:
+        subject_list (list of dict): one dictionary per subject, with
+            the keys subject, slabs (paths to the slabs, repetition
+            after repetition), slabs_per_repetition, lowres and outdir
+    """
+    manifest_dirpath = os.path.dirname(os.path.abspath(manifest_path))
+    subject_list = []
+    with open(manifest_path, newline='') as manifest_file:
+        reader = csv.DictReader(manifest_file)
+        fieldnames = reader.fieldnames or []
+        missing_columns = [
+            column for column in MANIFEST_COLUMNS
+            if column not in fieldnames]
+        if not any(SLAB_COLUMN_PATTERN.match(column) for column in fieldnames):
+            missing_columns.append('rep[r]s[s]')
+        if missing_columns:
+            raise ValueError(
+                '{0}: missing columns {1}'.format(
+                    manifest_path, ', '.join(missing_columns)))
+        for row in reader:
+            subject = {'subject': row['subject'].strip()}
+            try:
+                slab_path_list, slabs_per_repetition = slabs_from_columns(
+                    dict(
+                        (column, (value or '').strip())
+                        for column, value in row.items()))
+            except ValueError as exc:
+                raise ValueError('{0}: subject {1}: {2}'.format(
+                    manifest_path, subject['subject'], exc))
+            subject['slabs'] = [
+                os.path.join(manifest_dirpath, slab_path)
+                for slab_path in slab_path_list]
+            subject['slabs_per_repetition'] = slabs_per_repetition
+            subject['lowres'] = os.path.join(
+                manifest_dirpath, row['lowres'].strip())
+            if row.get(MANIFEST_OUTDIR_COLUMN):
+                subject['outdir'] = os.path.join(
+                    manifest_dirpath, row[MANIFEST_OUTDIR_COLUMN].strip())
+            else:
+                subject['outdir'] = os.path.join(
+                    outroot_path, subject['subject'])
+            subject_list.append(subject)
+
+    # subject names are used as output folder names
+    subject_names = [subject['subject'] for subject in subject_list]
+    if len(set(subject_names)) != len(subject_names):
+        raise ValueError(
+            '{0}: subject names must be unique'.format(manifest_path))
+
+    return subject_list
+
+
+def find_single_file(dirpath, pattern):
+    """Find the file matching a pattern inside a folder
+
+    Args:
+        dirpath (string): path to folder
+        pattern (string): glob pattern
+
+    Returns:
+        file_path (string): path to the matching file. None if no file
+            matches the pattern.
+    """
+    path_list = sorted(glob.glob(os.path.join(dirpath, pattern)))
+    if not path_list:
+        return None
+    if len(path_list) > 1:
+        raise ValueError(
+            'several files match {0} in {1}'.format(pattern, dirpath))
+
+    return path_list[0]
+
+
+def scan_bids_directory(bids_path, outroot_path):
+    """List the subjects of a BIDS-style directory
+
+    Looks for the inputs in the anat folder of each subject (and
+    session) and expects the following file names:
+        - sub-[label]_(ses-[label]_)run-[r]_acq-slab[s]_[suffix].nii(.gz)
+            for slab s of repetition r (r and s from 1, e.g., run-1 to
+            run-3 and acq-slab1 to acq-slab3 for three repetitions of
+            three slabs)
+        - sub-[label]_(ses-[label]_)acq-lowres_[suffix].nii(.gz)
+            for the low-res volume
+    Folders without a low-res volume or in which a slab of a repetition
+    is missing are skipped.
+
+    Args:
+        bids_path (string): path to the BIDS-style directory
+        outroot_path (string): folder where the output dir of each
+            subject is created ([outroot]/sub-[label](_ses-[label]))
+
+    Returns:
+        subject_list (list of dict): see read_manifest
+    """
+    anatdir_path_list = sorted(
+        glob.glob(os.path.join(bids_path, 'sub-*', 'anat')) +
+        glob.glob(os.path.join(bids_path, 'sub-*', 'ses-*', 'anat')))
+    subject_list = []
+    for anatdir_path in anatdir_path_list:
+        # subject (and session) label
+        relative_path = os.path.relpath(
+            os.path.dirname(anatdir_path), bids_path)
+        subject_name = '_'.join(
+            part for part in relative_path.split(os.sep)
+            if re.match('^(sub|ses)-', part))
+        subject = {'subject': subject_name}
+        columns = {}
+        for slab_path in sorted(glob.glob(
+                os.path.join(anatdir_path, BIDS_SLAB_PATTERN))):
+            match = BIDS_SLAB_REGEX.search(os.path.basename(slab_path))
+            if match is None:
+                continue
+            column = SLAB_COLUMN.format(
+                int(match.group(1)), int(match.group(2)))
+            if column in columns:
+                raise ValueError(
+                    'several files for run {0}, slab {1} in {2}'.format(
+                        match.group(1), match.group(2), anatdir_path))
+            columns[column] = slab_path
+        subject['lowres'] = find_single_file(
+            anatdir_path, BIDS_LOWRES_PATTERN)
+        try:
+            subject['slabs'], subject['slabs_per_repetition'] = \
+                slabs_from_columns(columns)
+        except ValueError as exc:
+            print('Skipping {0}: incomplete set of inputs ({1})'.format(
+                anatdir_path, exc))
+            continue
+        if subject['lowres'] is None:
+            print('Skipping {0}: incomplete set of inputs (no low-res'
+                  ' volume)'.format(anatdir_path))
+            continue
+        subject['outdir'] = os.path.join(outroot_path, subject_name)
+        subject_list.append(subject)
+
+    return subject_list
+
+
+def list_subjects(input_path, outroot_path):
+    """List the subjects of a batch
+
+    Args:
+        input_path (string): path to either a CSV manifest or a
+            BIDS-style directory
+        outroot_path (string): folder where the output dir of each
+            subject is created
+
+    Returns:
+        subject_list (list of dict): see read_manifest
+    """
+    if os.path.isdir(input_path):
+        subject_list = scan_bids_directory(input_path, outroot_path)
+    elif os.path.isfile(input_path):
+        subject_list = read_manifest(input_path, outroot_path)
+    else:
+        raise IOError('{0} does not exist'.format(input_path))
+    if not subject_list:
+        raise ValueError('no subject found in {0}'.format(input_path))
+
+    return subject_list
+
+
+def failed_result(subject, error):
+    """Result of a subject that failed outside of the subject function
+
+    Args:
+        subject (dict): subject (see read_manifest)
+        error (string): error message
+
+    Returns:
+        result (dict): result of the subject
+    """
+    return {
+        'subject': subject['subject'],
+        'status': 'failed',
+        'elapsed_seconds': None,
+        'outdir': subject['outdir'],
+        'error': error}
+
+
+def run_batch(
+        subject_list,
+        subject_function,
+        subject_args_list,
+        workers=1,
+        cost_list=None,
+        memory_budget_bytes=None,
+        cpu_budget=None):
+    """Run a function on each subject of a batch
+
+    Subjects run in turn in the current process if workers is 1, on a
+    pool of worker processes otherwise. The function must not raise,
+    and must return a result dictionary with the columns of the
+    summary.
+
+    Subjects are admitted in the order of the batch, as long as the sum
+    of the estimated peak memory and CPUs of the running subjects stays
+    within the budgets. A subject that does not fit waits for running
+    subjects to complete; the next subjects that fit get admitted in
+    the meantime. Subjects that exceed a budget on their own fail
+    without running.
+
+    A worker process that dies (e.g., killed by the system when out of
+    memory) fails the subjects running at that time; the pool of
+    worker processes is then replaced and the batch goes on.
+
+    Args:
+        subject_list (list of dict): subjects (see read_manifest)
+        subject_function (function): function run for each subject.
+            Must be defined at the top level of a module so that it can
+            be sent to worker processes.
+        subject_args_list (list of tuples): arguments given to
+            subject_function, one tuple per subject
+        workers (int): maximum number of subjects processed at the
+            same time
+        cost_list (list of dict): estimated resources of each subject
+            (peak_memory_bytes, cpus). None (for the list or a subject)
+            if unknown: the subject is then not limited by the budgets
+        memory_budget_bytes (int): memory available to the running
+            subjects, in bytes. None for no limit
+        cpu_budget (float): CPUs available to the running subjects.
+            None for no limit
+
+    Returns:
+        result_list (list of dict): one result per subject, in the
+            order of subject_list
+    """
+    if cost_list is None:
+        cost_list = [None]*len(subject_list)
+    result_list = [None]*len(subject_list)
+    done_count = 0
+
+    # estimated resources of each subject
+    memory_list = []
+    cpus_list = []
+    pending_index_list = []
+    for subject_index, cost in enumerate(cost_list):
+        if cost is None:
+            memory_list.append(0)
+            cpus_list.append(0)
+        else:
+            memory_list.append(cost['peak_memory_bytes'])
+            cpus_list.append(cost['cpus'])
+        # subjects that can never be admitted
+        if memory_budget_bytes is not None and \
+                memory_list[subject_index] > memory_budget_bytes:
+            error = 'estimated peak memory {0:.0f} MB exceeds the memory' \
+                ' budget'.format(memory_list[subject_index]/1024.0**2)
+        elif cpu_budget is not None and cpus_list[subject_index] > cpu_budget:
+            error = 'estimated CPUs {0:g} exceed the CPU budget'.format(
+                cpus_list[subject_index])
+        else:
+            pending_index_list.append(subject_index)
+            continue
+        result_list[subject_index] = failed_result(
+            subject_list[subject_index], error)
+        done_count += 1
+        print_result(result_list[subject_index], done_count, len(subject_list))
+
+    if workers <= 1:
+        for subject_index in pending_index_list:
+            result_list[subject_index] = subject_function(
+                *subject_args_list[subject_index])
+            done_count += 1
+            print_result(
+                result_list[subject_index], done_count, len(subject_list))
+        return result_list
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    # a worker process that dies (e.g., killed by the system when out of
+    # memory) breaks the whole pool: it is replaced once the subjects it
+    # was running have been collected
+    pool_broken = False
+    future_index = {}
+    used_memory = 0
+    used_cpus = 0
+    try:
+        while pending_index_list or future_index:
+            if pool_broken and not future_index:
+                executor.shutdown(wait=True)
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers)
+                pool_broken = False
+
+            # admit the subjects that fit in the budgets
+            for subject_index in list(pending_index_list):
+                if pool_broken or len(future_index) >= workers:
+                    break
+                if memory_budget_bytes is not None and \
+                        used_memory+memory_list[subject_index] > \
+                        memory_budget_bytes:
+                    continue
+                if cpu_budget is not None and \
+                        used_cpus+cpus_list[subject_index] > cpu_budget:
+                    continue
+                try:
+                    future = executor.submit(
+                        subject_function, *subject_args_list[subject_index])
+                except concurrent.futures.process.BrokenProcessPool:
+                    # the subject did not start: it is admitted again
+                    # on the new pool
+                    pool_broken = True
+                    break
+                future_index[future] = subject_index
+                used_memory += memory_list[subject_index]
+                used_cpus += cpus_list[subject_index]
+                pending_index_list.remove(subject_index)
+            if not future_index:
+                continue
+
+            # wait for a subject to complete
+            done_future_set, _ = concurrent.futures.wait(
+                future_index,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done_future_set:
+                subject_index = future_index.pop(future)
+                used_memory -= memory_list[subject_index]
+                used_cpus -= cpus_list[subject_index]
+                try:
+                    result_list[subject_index] = future.result()
+                except concurrent.futures.process.BrokenProcessPool as exc:
+                    # worker process died (e.g., killed by the system),
+                    # taking down the subjects running at the same time
+                    pool_broken = True
+                    result_list[subject_index] = failed_result(
+                        subject_list[subject_index],
+                        'worker process died: {0!r}'.format(exc))
+                except Exception as exc:
+                    result_list[subject_index] = failed_result(
+                        subject_list[subject_index], repr(exc))
+                done_count += 1
+                print_result(
+                    result_list[subject_index], done_count,
+                    len(subject_list))
+    finally:
+        executor.shutdown(wait=True)
+
+    return result_list
+
+
+def print_result(result, done_count, subject_count):
+    """Print the result of a subject
+
+    Args:
+        result (dict): result of the subject
+        done_count (int): number of subjects done so far
+        subject_count (int): number of subjects in the batch
+
+    Returns:
+        N/A
+    """
+    if result['elapsed_seconds'] is None:
+        elapsed = '-'
+    else:
+        elapsed = '{0:.1f} s'.format(result['elapsed_seconds'])
+    print('[{0}/{1}] {2}: {3} ({4})'.format(
+        done_count, subject_count, result['subject'], result['status'],
+        elapsed))
+    if result['error']:
+        print('    {0}'.format(result['error']))
+
+
+def write_summary(result_list, summary_path):
+    """Write the batch summary
+
+    Args:
+        result_list (list of dict): one result per subject
+        summary_path (string): path to the CSV summary
+
+    Returns:
+        N/A
+    """
+    with open(summary_path, 'w', newline='') as summary_file:
+        writer = csv.DictWriter(
+            summary_file, fieldnames=SUMMARY_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for result in result_list:
+            writer.writerow(result)
@@ -0,0 +1,889 @@
+#! /usr/bin/python
+
+"""Benchmarks of the recombination pipeline
+
+Runs the volume operations of recombine.py, or the whole pipeline, on
+synthetic data, so that the effect of a change on their speed and
+memory can be measured without real acquisitions. The synthetic volumes
+are generated deterministically (fixed random seed) at several sizes,
+up to the size of a 7T slab, with int16 or float data, in RAS or
+non-RAS (LPS) orientation.
+
+The pipeline benchmark does not need Matlab: SPM is replaced by a
+deterministic stand-in that undoes a known rigid shift of the synthetic
+slabs. Its results (time and peak memory of every stage) can be stored
+as a baseline, and later results compared to it.
+
+Usage:
+    python benchmark.py volumes (--sizes [SIZE ...]) (--functions
+        [FUNCTION ...]) (--repeat [REPEAT]) (--output [OUTPUT])
+    python benchmark.py pipeline (--size [SIZE]) (--repeat [REPEAT])
+        (--output [OUTPUT]) (processing options of recombine.py, e.g.,
+        --keep-intermediates [KEEP] --outputs [OUTPUTS])
+    python benchmark.py compare [baseline] [results] (--threshold
+        [THRESHOLD]) (--min-seconds [MIN_SECONDS])
+
+"""
+
+import os
+import sys
+import argparse
+import contextlib
+import io
+import json
+import operator
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import nibabel as nib
+
+import instrumentation
+import recombine
+
+
+# shapes of the synthetic slabs (x, y, z). The slabs are thin along y,
+# the axis along which the slabs of a repetition get interleaved. large
+# is the size of a 0.3 mm in-plane 7T slab
+SLAB_SHAPES = {
+    'small': (128, 16, 128),
+    'medium': (256, 24, 256),
+    'large': (512, 32, 512)}
+# voxel size (in mm) of the synthetic slabs
+SLAB_ZOOMS = (0.3, 1.2, 0.3)
+# voxel size (in mm) of the synthetic low-res volumes
+LOWRES_ZOOMS = (1.0, 1.0, 1.0)
+# data types of the synthetic slabs
+DTYPE_CHOICES = ['int16', 'float']
+# orientations of the synthetic volumes
+ORIENTATION_CHOICES = ['RAS', 'LPS']
+# default seed of the synthetic data generator
+DEFAULT_SEED = 0
+# benchmarked volume operations
+VOLUME_FUNCTIONS = [
+    'volume_duplication', 'insert_gap', 'create_phantom', 'int2float',
+    'volume_addition', 'volume_division', 'nii_copy', 'gzip_images']
+# number of images compressed by each gzip_images call
+GZIP_IMAGE_COUNT = 4
+# rigid shift (in mm) of the synthetic slabs with respect to the
+# low-res volume, undone by the registration stand-in
+KNOWN_SHIFT_MM = (1.5, -2.0, 0.9)
+# name of the registration stand-in (see recombine.REGISTRATION_BACKENDS)
+SHIFT_REGISTRATION_BACKEND = 'known_shift'
+# default regression threshold (in percent) of the compare command
+DEFAULT_THRESHOLD = 10.0
+# stages faster than this (in seconds) in the baseline are too noisy to
+# be compared on time
+DEFAULT_MIN_SECONDS = 0.05
+# columns of the result table
+RESULT_COLUMNS = [
+    'function', 'size', 'dtype', 'orientation', 'voxels', 'best_seconds',
+    'median_seconds', 'voxels_per_second', 'peak_memory_mb']
+
+
+def orientation_affine(shape, zooms, orientation='RAS'):
+    """Affine of a synthetic volume centred on the origin
+
+    Args:
+        shape (tuple): shape of the volume
+        zooms (tuple): voxel size, in mm
+        orientation (string): 'RAS' or 'LPS' (x and y axes flipped)
+
+    Returns:
+        affine (numpy.ndarray): 4x4 affine
+    """
+    if orientation not in ORIENTATION_CHOICES:
+        raise ValueError('unknown orientation {0}'.format(orientation))
+    signs = np.ones(3)
+    if orientation == 'LPS':
+        signs[0:2] = -1
+    affine = np.diag(list(signs*np.asarray(zooms, float))+[1.0])
+    # centre of the volume on the origin
+    affine[0:3, 3] = -affine[0:3, 0:3].dot((np.asarray(shape)-1)/2.0)
+
+    return affine
+
+
+def synthetic_data(shape, dtype='int16', seed=DEFAULT_SEED):
+    """Deterministic synthetic image data
+
+    An ellipsoid of tissue-like intensities (smooth contrast plus
+    noise) surrounded by zeros, as in a skull-stripped or masked
+    acquisition, so that the operations that skip empty voxels behave
+    as on real data.
+
+    Args:
+        shape (tuple): shape of the volume
+        dtype (string): 'int16' or 'float' (float64, as in the pipeline)
+        seed (int): seed of the random generator
+
+    Returns:
+        data (numpy.ndarray): image data
+    """
+    if dtype not in DTYPE_CHOICES:
+        raise ValueError('unknown data type {0}'.format(dtype))
+    random_state = np.random.RandomState(seed)
+    grid = np.meshgrid(
+        *[np.linspace(-1, 1, dim_size) for dim_size in shape],
+        indexing='ij', sparse=True)
+    radius2 = grid[0]**2/0.81+grid[1]**2+grid[2]**2/0.81
+    data = 800+300*np.cos(6*grid[0])*np.sin(4*grid[2]) + \
+        random_state.normal(0, 40, shape)
+    data[radius2 > 1] = 0
+    if dtype == 'int16':
+        return np.clip(np.round(data), 0, 32767).astype(np.int16)
+
+    return data.astype(np.float64)
+
+
+def synthetic_slab(
+        size='small',
+        dtype='int16',
+        orientation='RAS',
+        seed=DEFAULT_SEED):
+    """Deterministic synthetic high-resolution slab
+
+    Args:
+        size (string): one of SLAB_SHAPES
+        dtype (string): 'int16' or 'float'
+        orientation (string): 'RAS' or 'LPS'
+        seed (int): seed of the random generator
+
+    Returns:
+        slab (nibabel.Nifti1Image): slab
+    """
+    shape = SLAB_SHAPES[size]
+    data = synthetic_data(shape, dtype, seed)
+    affine = orientation_affine(shape, SLAB_ZOOMS, orientation)
+    if orientation == 'LPS':
+        # same anatomy as the RAS slab, stored in another order
+        data = np.ascontiguousarray(data[::-1, ::-1, :])
+
+    return nib.Nifti1Image(data, affine)
+
+
+def synthetic_phantom(slab):
+    """Phantom (with gap) of a synthetic slab, as built by the pipeline
+
+    Args:
+        slab (nibabel.Nifti1Image): slab
+
+    Returns:
+        phantom (nibabel.Nifti1Image): phantom, in RAS orientation
+    """
+    return recombine.insert_gap(
+        recombine.create_phantom(
+            recombine.insert_gap(
+                recombine.volume_duplication(slab, 2, 'y'), 2, 0, 'y'),
+            1),
+        2, 0, 'y')
+
+
+def synthetic_lowres(
+        size='small',
+        dtype='int16',
+        orientation='RAS',
+        seed=DEFAULT_SEED):
+    """Deterministic synthetic low-resolution volume
+
+    The volume covers the field of view of the slabs (and more), at
+    LOWRES_ZOOMS.
+
+    Args:
+        size (string): size of the slabs it covers (see SLAB_SHAPES)
+        dtype (string): 'int16' or 'float'
+        orientation (string): 'RAS' or 'LPS'
+        seed (int): seed of the random generator
+
+    Returns:
+        lowres (nibabel.Nifti1Image): low-res volume
+    """
+    slab_extent = np.asarray(SLAB_SHAPES[size])*np.asarray(SLAB_ZOOMS)
+    # twice the extent of a slab along y (two slabs per repetition),
+    # plus a margin
+    slab_extent[1] *= 2
+    shape = tuple(
+        int(np.ceil(extent/zoom))+8
+        for extent, zoom in zip(slab_extent, LOWRES_ZOOMS))
+    data = synthetic_data(shape, dtype, seed+1)
+    affine = orientation_affine(shape, LOWRES_ZOOMS, orientation)
+    if orientation == 'LPS':
+        data = np.ascontiguousarray(data[::-1, ::-1, :])
+
+    return nib.Nifti1Image(data, affine)
+
+
+def measure(function, prepare_function, repeat):
+    """Measure the time and peak memory of a function
+
+    The function is timed repeat times, then run once more with memory
+    tracing (tracemalloc also sees numpy arrays) to measure its peak
+    memory. Tracing is off while timing.
+
+    Args:
+        function (function): benchmarked function
+        prepare_function (function): function called before each run,
+            outside of the measures. Returns the arguments of function
+        repeat (int): number of timed runs
+
+    Returns:
+        time_list (list of float): time of each run, in seconds
+        peak_memory (int): peak memory allocated by one run, in bytes
+    """
+    time_list = []
+    for _ in range(repeat):
+        args = prepare_function()
+        start = time.perf_counter()
+        function(*args)
+        time_list.append(time.perf_counter()-start)
+        del args
+    args = prepare_function()
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return time_list, peak_memory
+
+
+def volume_benchmark(function_name, slab, workdir_path):
+    """Function and argument preparation of a volume benchmark
+
+    Args:
+        function_name (string): one of VOLUME_FUNCTIONS
+        slab (nibabel.Nifti1Image): synthetic slab
+        workdir_path (string): folder for the files of the benchmark
+
+    Returns:
+        function (function): benchmarked function
+        prepare_function (function): returns the arguments of function
+        voxels (int): number of input voxels processed per run
+    """
+    voxels = int(np.prod(slab.shape))
+    if function_name == 'volume_duplication':
+        return (
+            recombine.volume_duplication,
+            FixedArguments(slab, 2, 'y'),
+            voxels)
+    if function_name == 'insert_gap':
+        return (
+            recombine.insert_gap,
+            FixedArguments(slab, 2, 0, 'y'),
+            voxels)
+    if function_name == 'create_phantom':
+        return (
+            recombine.create_phantom,
+            FixedArguments(slab, 1),
+            voxels)
+    if function_name == 'int2float':
+        return (
+            recombine.int2float,
+            FixedArguments(slab),
+            voxels)
+    if function_name in ['volume_addition', 'volume_division']:
+        # float slab (with gap) and its phantom, as in part3
+        float_slab = recombine.int2float(recombine.insert_gap(
+            recombine.volume_duplication(slab, 2, 'y'), 2, 0, 'y'))
+        phantom = synthetic_phantom(slab)
+        return (
+            getattr(recombine, function_name),
+            FreshVolumes(float_slab, phantom),
+            int(np.prod(float_slab.shape)))
+    if function_name == 'nii_copy':
+        in_path = os.path.join(workdir_path, 'slab.nii.gz')
+        nib.save(slab, in_path)
+        return (
+            recombine.nii_copy,
+            FixedArguments(
+                in_path, os.path.join(workdir_path, 'slab_copy.nii')),
+            voxels)
+    if function_name == 'gzip_images':
+        return (
+            recombine.gzip_images,
+            GzipInputs(slab, workdir_path),
+            voxels*GZIP_IMAGE_COUNT)
+    raise ValueError('unknown function {0}'.format(function_name))
+
+
+class FixedArguments(object):
+    """Preparation function that returns fixed arguments
+
+    Args:
+        *args: arguments
+    """
+
+    def __init__(self, *args):
+        self.args = args
+
+    def __call__(self):
+        return self.args
+
+
+class FreshVolumes(object):
+    """Preparation function that returns new copies of volumes
+
+    For functions that modify their inputs in place.
+
+    Args:
+        *volumes (nibabel volumes): volumes
+    """
+
+    def __init__(self, *volumes):
+        self.volumes = volumes
+
+    def __call__(self):
+        return tuple(
+            recombine.tag_canonical(nib.Nifti1Image(
+                np.array(volume.dataobj), volume.affine))
+            for volume in self.volumes)
+
+
+class GzipInputs(object):
+    """Preparation function that writes the images to compress
+
+    Args:
+        slab (nibabel volume): image written GZIP_IMAGE_COUNT times
+        workdir_path (string): folder where the images are written
+    """
+
+    def __init__(self, slab, workdir_path):
+        self.slab = slab
+        self.workdir_path = workdir_path
+
+    def __call__(self):
+        impath_list = []
+        for image_index in range(GZIP_IMAGE_COUNT):
+            impath = os.path.join(
+                self.workdir_path, 'gzip_{0}.nii'.format(image_index))
+            for path in [impath, '{0}.gz'.format(impath)]:
+                if os.path.exists(path):
+                    os.remove(path)
+            nib.save(self.slab, impath)
+            impath_list.append(impath)
+
+        return (impath_list, self.workdir_path)
+
+
+def run_volume_benchmarks(
+        size_list,
+        function_list=VOLUME_FUNCTIONS,
+        repeat=3,
+        seed=DEFAULT_SEED):
+    """Benchmark the volume operations on synthetic data
+
+    Every function is run on every combination of size, data type and
+    orientation.
+
+    Args:
+        size_list (list of strings): sizes of the slabs (see
+            SLAB_SHAPES)
+        function_list (list of strings): benchmarked functions (see
+            VOLUME_FUNCTIONS)
+        repeat (int): number of timed runs of each benchmark
+        seed (int): seed of the synthetic data generator
+
+    Returns:
+        result_list (list of dict): one result per benchmark, with the
+            columns of RESULT_COLUMNS
+    """
+    # measure the operations, not the cache
+    recombine.VOLUME_CACHE.set_max_bytes(0)
+    result_list = []
+    workdir_path = tempfile.mkdtemp(prefix='recombine_benchmark_')
+    try:
+        for size in size_list:
+            for dtype in DTYPE_CHOICES:
+                for orientation in ORIENTATION_CHOICES:
+                    slab = synthetic_slab(size, dtype, orientation, seed)
+                    for function_name in function_list:
+                        function, prepare_function, voxels = \
+                            volume_benchmark(
+                                function_name, slab, workdir_path)
+                        time_list, peak_memory = measure(
+                            function, prepare_function, repeat)
+                        result = {
+                            'function': function_name,
+                            'size': size,
+                            'dtype': dtype,
+                            'orientation': orientation,
+                            'voxels': voxels,
+                            'best_seconds': min(time_list),
+                            'median_seconds': float(np.median(time_list)),
+                            'voxels_per_second': voxels/max(
+                                min(time_list), 1e-9),
+                            'peak_memory_mb': peak_memory/1024.0**2}
+                        print_result(result)
+                        result_list.append(result)
+    finally:
+        shutil.rmtree(workdir_path)
+
+    return result_list
+
+
+def translation_mm_affine(shift_mm):
+    """Affine of a translation in world coordinates
+
+    Args:
+        shift_mm (sequence of float): translation along x, y and z, in
+            mm
+
+    Returns:
+        affine (numpy.ndarray): 4x4 affine
+    """
+    affine = np.eye(4)
+    affine[0:3, 3] = shift_mm
+
+    return affine
+
+
+def write_pipeline_inputs(
+        inputdir_path,
+        size='small',
+        dtype='int16',
+        orientation='RAS',
+        seed=DEFAULT_SEED):
+    """Write the synthetic inputs of the pipeline
+
+    The two slabs of a repetition are one slab voxel apart along y (so
+    that they interleave), the two repetitions cover the two halves of
+    the low-res field of view along y. All slabs are shifted by
+    KNOWN_SHIFT_MM.
+
+    Args:
+        inputdir_path (string): folder where the inputs are written
+        size (string): size of the slabs (see SLAB_SHAPES)
+        dtype (string): 'int16' or 'float'
+        orientation (string): 'RAS' or 'LPS'
+        seed (int): seed of the random generator
+
+    Returns:
+        input_path_list (list of strings): paths to the inputs rep1s1,
+            rep1s2, rep2s1, rep2s2 and lowres
+    """
+    shift_affine = translation_mm_affine(KNOWN_SHIFT_MM)
+    slab_extent_y = SLAB_SHAPES[size][1]*SLAB_ZOOMS[1]
+    input_path_list = []
+    for repetition_index, repetition_offset in enumerate(
+            [-slab_extent_y/2.0, slab_extent_y/2.0]):
+        for slab_index in range(2):
+            slab = synthetic_slab(
+                size, dtype, orientation, seed+2*repetition_index+slab_index)
+            offset = np.array([
+                0, repetition_offset+slab_index*SLAB_ZOOMS[1]/2.0, 0])
+            affine = shift_affine.dot(
+                translation_mm_affine(offset)).dot(slab.affine)
+            slab_path = os.path.join(
+                inputdir_path, 'rep{0}s{1}.nii.gz'.format(
+                    repetition_index+1, slab_index+1))
+            nib.save(nib.Nifti1Image(np.asarray(slab.dataobj), affine),
+                     slab_path)
+            input_path_list.append(slab_path)
+    lowres_path = os.path.join(inputdir_path, 'lowres.nii.gz')
+    nib.save(synthetic_lowres(size, dtype, orientation, seed), lowres_path)
+    input_path_list.append(lowres_path)
+
+    return input_path_list
+
+
+class KnownShiftRegistrationBackend(recombine.RegistrationBackend):
+    """Deterministic stand-in of the SPM registration
+
+    Undoes the known rigid shift of the synthetic slabs (KNOWN_SHIFT_MM)
+    instead of estimating it, and reslices the images in Python (see
+    recombine.file_reslice).
+
+    Args:
+        N/A
+    """
+
+    name = SHIFT_REGISTRATION_BACKEND
+
+    def estimate(self, ref_path, source_path, tempdir_path):
+        return translation_mm_affine(-np.asarray(KNOWN_SHIFT_MM))
+
+
+def run_pipeline(input_path_list, outdir_path, scratch_path, options):
+    """Run the whole pipeline (part1, part2, part3) on a subject
+
+    Registrations are done by KnownShiftRegistrationBackend. The messages of
+    the pipeline are not shown.
+
+    Args:
+        input_path_list (list of strings): paths to the inputs rep1s1,
+            rep1s2, rep2s1, rep2s2 and lowres
+        outdir_path (string): output dir of the subject
+        scratch_path (string): folder where the working dir is created
+        options (argparse.Namespace): processing options of the pipeline
+            (see recombine.add_processing_arguments). The registration
+            backend, scratch dir and trace are ignored
+
+    Returns:
+        run_report (dict): run report (see recombine.write_run_report)
+    """
+    args = argparse.Namespace(**vars(options))
+    args.slab_paths = input_path_list[:4]
+    args.slabs_per_repetition = 2
+    args.lowres_path = input_path_list[4]
+    args.outdir_path = outdir_path
+    args.scratch_dir = scratch_path
+    args.no_scratch = False
+    args.registration = SHIFT_REGISTRATION_BACKEND
+    args.preflight_only = False
+    args.trace_path = None
+    recombine.REGISTRATION_BACKENDS[SHIFT_REGISTRATION_BACKEND] = \
+        KnownShiftRegistrationBackend()
+    instrumentation.reset_counters()
+    instrumentation.reset_peak_rss()
+    recombine.VOLUME_CACHE.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        preflight_report = recombine.run_preflight(args)
+        recombine.run_recombination(args, None, preflight_report)
+    with open(os.path.join(
+            outdir_path, recombine.RUN_REPORT_FILENAME)) as run_report_file:
+        return json.load(run_report_file)
+
+
+def run_pipeline_benchmark(options, size='small', repeat=3, seed=DEFAULT_SEED):
+    """Benchmark the whole pipeline on synthetic data
+
+    The pipeline is run repeat times on the same synthetic subject. The
+    time of each stage is the median over the runs, its peak memory the
+    largest over the runs.
+
+    Args:
+        options (argparse.Namespace): processing options of the pipeline
+            (see run_pipeline)
+        size (string): size of the slabs (see SLAB_SHAPES)
+        repeat (int): number of runs
+        seed (int): seed of the synthetic data generator
+
+    Returns:
+        result_list (list of dict): one result per stage, with the
+            columns stage, calls, wall_seconds and peak_rss_mb. The
+            'total' stage is the whole run
+    """
+    workdir_path = tempfile.mkdtemp(prefix='recombine_benchmark_')
+    stage_runs = {}
+    try:
+        inputdir_path = os.path.join(workdir_path, 'inputs')
+        os.makedirs(inputdir_path)
+        input_path_list = write_pipeline_inputs(
+            inputdir_path, size, seed=seed)
+        for run_index in range(repeat):
+            outdir_path = os.path.join(
+                workdir_path, 'run{0}'.format(run_index))
+            run_report = run_pipeline(
+                input_path_list, outdir_path, workdir_path, options)
+            for stage_name, total in run_report['stage_totals'].items():
+                stage_runs.setdefault(stage_name, []).append(total)
+            stage_runs.setdefault('total', []).append({
+                'calls': 1,
+                'wall_seconds': run_report['elapsed_seconds'],
+                'peak_rss_bytes': run_report['peak_rss_bytes']})
+            print('run {0}/{1}: {2:.2f} s'.format(
+                run_index+1, repeat, run_report['elapsed_seconds']))
+            shutil.rmtree(outdir_path)
+    finally:
+        shutil.rmtree(workdir_path)
+
+    result_list = []
+    for stage_name, total_list in stage_runs.items():
+        peak_rss_list = [
+            total['peak_rss_bytes'] for total in total_list
+            if total['peak_rss_bytes'] is not None]
+        result_list.append({
+            'stage': stage_name,
+            'calls': total_list[0]['calls'],
+            'wall_seconds': float(np.median(
+                [total['wall_seconds'] for total in total_list])),
+            'peak_rss_mb': max(peak_rss_list)/1024.0**2
+            if peak_rss_list else None})
+
+    return result_list
+
+
+def result_metrics(results):
+    """Metrics of benchmark results, keyed by benchmark case
+
+    Args:
+        results (dict): content of a results file (see write_results)
+
+    Returns:
+        metrics (dict): per case (stage of the pipeline benchmark, or
+            function, size, data type and orientation of the volume
+            benchmark): time (in seconds) and peak memory (in MB)
+    """
+    metrics = {}
+    for result in results['results']:
+        if results['benchmark'] == 'pipeline':
+            metrics[result['stage']] = (
+                result['wall_seconds'], result['peak_rss_mb'])
+        else:
+            case = '{0} {1} {2} {3}'.format(
+                result['function'], result['size'], result['dtype'],
+                result['orientation'])
+            metrics[case] = (
+                result['best_seconds'], result['peak_memory_mb'])
+
+    return metrics
+
+
+def compare_results(
+        baseline,
+        results,
+        threshold=DEFAULT_THRESHOLD,
+        min_seconds=DEFAULT_MIN_SECONDS):
+    """Compare benchmark results to a baseline
+
+    A case regresses if its time or peak memory grows by more than the
+    threshold. Times of cases shorter than min_seconds in the baseline
+    are shown but not checked, as they are dominated by noise.
+
+    Args:
+        baseline (dict): content of the baseline results file
+        results (dict): content of the results file
+        threshold (float): regression threshold, in percent
+        min_seconds (float): minimum baseline time (in seconds) of the
+            cases whose time is checked
+
+    Returns:
+        regression_list (list of strings): description of each
+            regression
+    """
+    if baseline['benchmark'] != results['benchmark']:
+        raise ValueError('cannot compare {0} results to a {1} baseline'.format(
+            results['benchmark'], baseline['benchmark']))
+    baseline_metrics = result_metrics(baseline)
+    metrics = result_metrics(results)
+    regression_list = []
+    for case in baseline_metrics:
+        if case not in metrics:
+            print('{0:<40} missing'.format(case))
+            continue
+        line = '{0:<40}'.format(case)
+        for metric_index, (metric_name, unit) in enumerate(
+                [('time', 's'), ('peak memory', 'MB')]):
+            baseline_value = baseline_metrics[case][metric_index]
+            value = metrics[case][metric_index]
+            if baseline_value is None or value is None or not baseline_value:
+                continue
+            change = 100.0*(value-baseline_value)/baseline_value
+            line = '{0}  {1} {2:.3f} -> {3:.3f} {4} ({5:+.1f}%)'.format(
+                line, metric_name, baseline_value, value, unit, change)
+            checked = metric_index == 1 or baseline_value >= min_seconds
+            if checked and change > threshold:
+                regression_list.append(
+                    '{0}: {1} {2:+.1f}%'.format(case, metric_name, change))
+        print(line)
+
+    return regression_list
+
+
+def print_result(result):
+    """Print the result of a volume benchmark
+
+    Args:
+        result (dict): result (see run_volume_benchmarks)
+
+    Returns:
+        N/A
+    """
+    print(
+        '{0:<20} {1:<7} {2:<6} {3:<4} {4:>10} voxels  {5:>9.4f} s'
+        '  {6:>8.1f} Mvoxels/s  {7:>8.1f} MB'.format(
+            result['function'], result['size'], result['dtype'],
+            result['orientation'], result['voxels'],
+            result['best_seconds'], result['voxels_per_second']/1e6,
+            result['peak_memory_mb']))
+
+
+def print_stage_result(result):
+    """Print the result of a stage of the pipeline benchmark
+
+    Args:
+        result (dict): result (see run_pipeline_benchmark)
+
+    Returns:
+        N/A
+    """
+    peak_rss = 'n/a'
+    if result['peak_rss_mb'] is not None:
+        peak_rss = '{0:.1f} MB'.format(result['peak_rss_mb'])
+    print('{0:<40} {1:>4} calls  {2:>9.4f} s  {3:>10}'.format(
+        result['stage'], result['calls'], result['wall_seconds'], peak_rss))
+
+
+def write_results(result_list, results_path, benchmark):
+    """Write benchmark results to a JSON file
+
+    Args:
+        result_list (list of dict): results
+        results_path (string): path to the JSON file
+        benchmark (string): name of the benchmark
+
+    Returns:
+        N/A
+    """
+    with open(results_path, 'w') as results_file:
+        json.dump(
+            {
+                'benchmark': benchmark,
+                'python': sys.version.split()[0],
+                'numpy': np.__version__,
+                'nibabel': nib.__version__,
+                'results': result_list},
+            results_file,
+            indent=2)
+
+
+def read_cli_args(argv):
+    """Read command-line interface arguments
+
+    Args:
+        argv (list of strings): command-line arguments, without the
+            program name
+
+    Returns:
+        args (argparse.Namespace): parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog='benchmark.py',
+        description='Benchmarks of the recombination pipeline on'
+        ' synthetic data')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    #-- volume operations
+    volumes_parser = subparsers.add_parser(
+        'volumes',
+        help='throughput and peak memory of the volume operations')
+    volumes_parser.add_argument(
+        '--sizes',
+        nargs='+',
+        choices=sorted(SLAB_SHAPES),
+        default=['small', 'medium'],
+        help='sizes of the synthetic slabs ({0}). Default: small'
+        ' medium'.format(', '.join(
+            '{0}: {1}'.format(size, 'x'.join(str(dim) for dim in shape))
+            for size, shape in sorted(SLAB_SHAPES.items()))))
+    volumes_parser.add_argument(
+        '--functions',
+        nargs='+',
+        choices=VOLUME_FUNCTIONS,
+        default=VOLUME_FUNCTIONS,
+        help='benchmarked functions. Default: all')
+    volumes_parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='number of timed runs of each benchmark (the best one is'
+        ' reported). Default: 3')
+    volumes_parser.add_argument(
+        '--seed',
+        type=int,
+        default=DEFAULT_SEED,
+        help='seed of the synthetic data. Default: {0}'.format(
+            DEFAULT_SEED))
+    volumes_parser.add_argument(
+        '--output',
+        dest='results_path',
+        help='JSON file where the results are written')
+    #-- whole pipeline
+    pipeline_parser = subparsers.add_parser(
+        'pipeline',
+        help='time and peak memory of each stage of the pipeline, with'
+        ' a stand-in for the SPM registration')
+    pipeline_parser.add_argument(
+        '--size',
+        choices=sorted(SLAB_SHAPES),
+        default='small',
+        help='size of the synthetic slabs. Default: small')
+    pipeline_parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='number of runs of the pipeline (the median time of each'
+        ' stage is reported). Default: 3')
+    pipeline_parser.add_argument(
+        '--seed',
+        type=int,
+        default=DEFAULT_SEED,
+        help='seed of the synthetic data. Default: {0}'.format(
+            DEFAULT_SEED))
+    pipeline_parser.add_argument(
+        '--output',
+        dest='results_path',
+        help='JSON file where the results are written (e.g., a'
+        ' baseline)')
+    # same processing options as recombine.py (the registration
+    # backend is always the stand-in)
+    recombine.add_processing_arguments(pipeline_parser)
+    #-- regression gate
+    compare_parser = subparsers.add_parser(
+        'compare',
+        help='compare results to a baseline, fail on regressions')
+    compare_parser.add_argument(
+        'baseline_path',
+        help='JSON file of the baseline results')
+    compare_parser.add_argument(
+        'results_path',
+        help='JSON file of the results to check')
+    compare_parser.add_argument(
+        '--threshold',
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help='largest accepted increase of the time or peak memory of'
+        ' a stage, in percent. Default: {0}'.format(DEFAULT_THRESHOLD))
+    compare_parser.add_argument(
+        '--min-seconds',
+        type=float,
+        default=DEFAULT_MIN_SECONDS,
+        help='stages shorter than this in the baseline (in seconds) are'
+        ' not checked on time. Default: {0}'.format(DEFAULT_MIN_SECONDS))
+
+    return parser.parse_args(argv)
+
+
+def main():
+    """Benchmarks: main function
+
+    Args:
+        N/A
+
+    Returns:
+        N/A
+    """
+    args = read_cli_args(sys.argv[1:])
+    if args.command == 'volumes':
+        result_list = run_volume_benchmarks(
+            args.sizes, args.functions, args.repeat, args.seed)
+        if args.results_path is not None:
+            write_results(result_list, args.results_path, 'volumes')
+            print('Results written to {0}'.format(args.results_path))
+    elif args.command == 'pipeline':
+        result_list = run_pipeline_benchmark(
+            args, args.size, args.repeat, args.seed)
+        for result in sorted(result_list, key=operator.itemgetter('stage')):
+            print_stage_result(result)
+        if args.results_path is not None:
+            write_results(result_list, args.results_path, 'pipeline')
+            print('Results written to {0}'.format(args.results_path))
+    elif args.command == 'compare':
+        with open(args.baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.results_path) as results_file:
+            results = json.load(results_file)
+        regression_list = compare_results(
+            baseline, results, args.threshold, args.min_seconds)
+        if regression_list:
+            print('Regressions (threshold: {0}%):'.format(args.threshold))
+            for regression in regression_list:
+                print('    {0}'.format(regression))
+            sys.exit(1)
+        print('No regression (threshold: {0}%)'.format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
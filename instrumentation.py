@@ -0,0 +1,560 @@
+"""Instrumentation of the recombination pipeline
+
+Keeps track of notable events that happen while recombining slabs
+(e.g., number of reorientation copies) and measures the peak memory of
+the run, so that they can be reported at the end of the run.
+
+Stages of the pipeline (and the file_* operations inside them) are
+timed: each stage records its wall time, CPU time, peak resident memory
+and the change of every counter (e.g., bytes read and written) while it
+ran. Counter changes and CPU time are attributed to the thread that
+runs the stage (and to the stages of the thread that started it, see
+thread_function); the peak memory is process-wide.
+
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import operator
+import os
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+# counters of notable events, keyed by name
+COUNTERS = collections.Counter()
+# counters can be incremented from several threads
+COUNTERS_LOCK = threading.Lock()
+# records of the completed stages, in order of completion
+STAGES = []
+STAGES_LOCK = threading.Lock()
+# stages in progress and run label of each thread
+THREAD_STATE = threading.local()
+# reference time of the stage start times (time.perf_counter)
+RUN_START = time.perf_counter()
+# peak resident memory measured before the last reset by a stage
+PEAK_RSS_BEFORE_RESET = 0
+
+
+def declare_counter(name):
+    """Declare a counter, so that it gets reported even if it stays 0
+
+    Args:
+        name (string): name of the counter
+
+    Returns:
+        N/A
+    """
+    with COUNTERS_LOCK:
+        COUNTERS.setdefault(name, 0)
+
+
+def increment_counter(name, value=1):
+    """Increment a counter
+
+    Args:
+        name (string): name of the counter
+        value (int): value added to the counter
+
+    Returns:
+        N/A
+    """
+    with COUNTERS_LOCK:
+        COUNTERS[name] += value
+        # stages in progress in the current thread
+        for frame in getattr(THREAD_STATE, 'stack', ()):
+            frame['counters'][name] += value
+
+
+def get_counters():
+    """Get the value of all counters
+
+    Args:
+        N/A
+
+    Returns:
+        counters (dict): value of each counter, keyed by name
+    """
+    with COUNTERS_LOCK:
+        return dict(COUNTERS)
+
+
+def reset_counters():
+    """Reset all counters to 0
+
+    Declared counters are kept (with value 0).
+
+    Args:
+        N/A
+
+    Returns:
+        N/A
+    """
+    with COUNTERS_LOCK:
+        for name in COUNTERS:
+            COUNTERS[name] = 0
+
+
+def format_counters():
+    """Format all counters for display
+
+    Args:
+        N/A
+
+    Returns:
+        counters_lines (list of strings): one '[name]: [value]' line per
+            counter, sorted by name
+    """
+    return [
+        '{0}: {1}'.format(name, round(value, 3))
+        for name, value in sorted(get_counters().items())]
+
+
+def clear_peak_rss():
+    """Reset the peak resident memory measured by the kernel
+
+    Only supported on Linux (the kernel then measures the peak from
+    now on).
+
+    Args:
+        N/A
+
+    Returns:
+        reset (Boolean): True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of the current process
+
+    Only supported on Linux (the kernel then measures the peak from
+    now on). Elsewhere, the peak stays the one since the process
+    started.
+
+    Args:
+        N/A
+
+    Returns:
+        reset (Boolean): True if the peak was reset
+    """
+    global PEAK_RSS_BEFORE_RESET
+    PEAK_RSS_BEFORE_RESET = 0
+
+    return clear_peak_rss()
+
+
+def kernel_peak_rss_bytes():
+    """Peak resident memory of the current process, as measured by the
+    kernel
+
+    Args:
+        N/A
+
+    Returns:
+        peak_rss (int): peak resident memory in bytes (since the last
+            call to clear_peak_rss on Linux). None if it cannot be
+            measured on this system.
+    """
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    # kB on Linux, bytes on Mac OS X
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss
+
+    return peak_rss*1024
+
+
+def peak_rss_bytes():
+    """Peak resident memory of the current process
+
+    Args:
+        N/A
+
+    Returns:
+        peak_rss (int): peak resident memory in bytes (since the last
+            call to reset_peak_rss on Linux). None if it cannot be
+            measured on this system.
+    """
+    peak_rss = kernel_peak_rss_bytes()
+    if peak_rss is None:
+        return None
+
+    return max(peak_rss, PEAK_RSS_BEFORE_RESET)
+
+
+def children_peak_rss_bytes():
+    """Peak resident memory of the child processes (e.g., Matlab)
+
+    Args:
+        N/A
+
+    Returns:
+        peak_rss (int): peak resident memory in bytes of the largest
+            child process terminated since the current process started.
+            None if it cannot be measured on this system.
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak_rss
+
+    return peak_rss*1024
+
+
+def set_run_label(label):
+    """Set the run label of the stages of the current thread
+
+    Stages are tagged with the run label of the thread they run in, so
+    that the stages of several runs processed at the same time (e.g.,
+    several subjects) can be told apart.
+
+    Args:
+        label (string): run label. None for no label
+
+    Returns:
+        N/A
+    """
+    THREAD_STATE.label = label
+
+
+def get_run_label():
+    """Run label of the stages of the current thread
+
+    Args:
+        N/A
+
+    Returns:
+        label (string): run label (see set_run_label). None if no label
+            was set
+    """
+    return getattr(THREAD_STATE, 'label', None)
+
+
+def call_with_run_label(label, function, *args):
+    """Call a function with a run label (e.g., in a worker thread)
+
+    Args:
+        label (string): run label (see set_run_label)
+        function (function): function to call
+        *args: arguments given to the function
+
+    Returns:
+        result: value returned by the function
+    """
+    previous_label = get_run_label()
+    set_run_label(label)
+    try:
+        return function(*args)
+    finally:
+        set_run_label(previous_label)
+
+
+@contextlib.contextmanager
+def stage(name, category='stage'):
+    """Measure a stage of the pipeline
+
+    The wall time, CPU time, peak resident memory and counter changes
+    of the stage are recorded when it ends, even if it fails. Stages
+    can be nested; the peak memory is reset at the start of each
+    outermost stage, so that it is the peak of the stage (nested stages
+    report the peak since the start of their outermost stage).
+
+    Args:
+        name (string): name of the stage
+        category (string): category of the stage: 'stage' for
+            processing steps, 'io' for reads and writes
+
+    Returns:
+        N/A
+    """
+    global PEAK_RSS_BEFORE_RESET
+    stack = getattr(THREAD_STATE, 'stack', None)
+    if stack is None:
+        stack = THREAD_STATE.stack = []
+    if not stack:
+        # keep the peak of the run before resetting it for the stage
+        peak_rss = kernel_peak_rss_bytes()
+        if peak_rss is not None:
+            PEAK_RSS_BEFORE_RESET = max(PEAK_RSS_BEFORE_RESET, peak_rss)
+        clear_peak_rss()
+    parent = stack[-1]['name'] if stack else None
+    frame = {
+        'name': name,
+        'counters': collections.Counter(),
+        'thread_cpu_seconds': 0.0}
+    stack.append(frame)
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    status = 'success'
+    try:
+        yield
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        end_cpu = time.thread_time()
+        end_wall = time.perf_counter()
+        stack.pop()
+        with COUNTERS_LOCK:
+            counter_changes = dict(
+                (counter_name, value)
+                for counter_name, value in frame['counters'].items()
+                if value)
+            thread_cpu_seconds = frame['thread_cpu_seconds']
+        record = {
+            'name': name,
+            'category': category,
+            'parent': parent,
+            'depth': len(stack),
+            'label': get_run_label(),
+            'status': status,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'start_seconds': start_wall-RUN_START,
+            'wall_seconds': end_wall-start_wall,
+            'cpu_seconds': end_cpu-start_cpu+thread_cpu_seconds,
+            'peak_rss_bytes': kernel_peak_rss_bytes(),
+            'counters': counter_changes}
+        with STAGES_LOCK:
+            STAGES.append(record)
+
+
+def thread_function(function):
+    """Attribute the work of a function run in another thread to the
+    stages in progress in the current thread
+
+    The returned function is meant to be run in a worker thread (e.g.,
+    by a thread pool): its stages are nested in the stage in progress
+    in the current thread, and its counter changes and CPU time are
+    added to the stages in progress in the current thread.
+
+    Args:
+        function (function): function run in another thread
+
+    Returns:
+        attributed_function (function): same function, attributed to
+            the stages in progress
+    """
+    label = get_run_label()
+    parent_stack = list(getattr(THREAD_STATE, 'stack', []))
+
+    @functools.wraps(function)
+    def attributed_function(*args, **kwargs):
+        previous_label = get_run_label()
+        previous_stack = getattr(THREAD_STATE, 'stack', None)
+        THREAD_STATE.label = label
+        THREAD_STATE.stack = list(parent_stack)
+        start_cpu = time.thread_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            cpu_seconds = time.thread_time()-start_cpu
+            with COUNTERS_LOCK:
+                for frame in parent_stack:
+                    frame['thread_cpu_seconds'] += cpu_seconds
+            THREAD_STATE.label = previous_label
+            THREAD_STATE.stack = previous_stack
+
+    return attributed_function
+
+
+def staged(function):
+    """Decorator measuring each call of a function as a stage
+
+    The stage is named after the function.
+
+    Args:
+        function (function): function to measure
+
+    Returns:
+        staged_function (function): measured function
+    """
+    @functools.wraps(function)
+    def staged_function(*args, **kwargs):
+        with stage(function.__name__):
+            return function(*args, **kwargs)
+
+    return staged_function
+
+
+def run_seconds():
+    """Time elapsed since the run clock was last restarted
+
+    Args:
+        N/A
+
+    Returns:
+        seconds (float): time in seconds, on the same clock as the
+            'start_seconds' of the stage records
+    """
+    return time.perf_counter()-RUN_START
+
+
+def reset_stages():
+    """Forget all the recorded stages and restart the run clock
+
+    Args:
+        N/A
+
+    Returns:
+        N/A
+    """
+    global RUN_START
+    with STAGES_LOCK:
+        del STAGES[:]
+        RUN_START = time.perf_counter()
+
+
+def pop_stages(label=None):
+    """Take the records of the stages of a run
+
+    Args:
+        label (string): run label (see set_run_label). None for the
+            stages of all runs
+
+    Returns:
+        stage_list (list of dict): records of the stages, in order of
+            completion. They are removed from the recorded stages
+    """
+    with STAGES_LOCK:
+        if label is None:
+            stage_list = list(STAGES)
+            del STAGES[:]
+        else:
+            stage_list = [
+                record for record in STAGES if record['label'] == label]
+            STAGES[:] = [
+                record for record in STAGES if record['label'] != label]
+
+    return stage_list
+
+
+def stage_totals(stage_list):
+    """Sum the records of the stages that have the same name
+
+    Args:
+        stage_list (list of dict): records of the stages
+
+    Returns:
+        totals (dict): per stage name: number of calls, wall time, CPU
+            time, maximum peak resident memory and counter changes
+    """
+    totals = collections.OrderedDict()
+    for record in stage_list:
+        total = totals.setdefault(record['name'], {
+            'calls': 0,
+            'wall_seconds': 0.0,
+            'cpu_seconds': 0.0,
+            'peak_rss_bytes': None,
+            'counters': collections.Counter()})
+        total['calls'] += 1
+        total['wall_seconds'] += record['wall_seconds']
+        total['cpu_seconds'] += record['cpu_seconds']
+        if record['peak_rss_bytes'] is not None:
+            total['peak_rss_bytes'] = max(
+                total['peak_rss_bytes'] or 0, record['peak_rss_bytes'])
+        total['counters'].update(record['counters'])
+    for total in totals.values():
+        total['counters'] = dict(total['counters'])
+
+    return totals
+
+
+def trace_events(stage_list):
+    """Convert stage records to Chrome trace events
+
+    Each stage becomes a complete event ('X'), with one lane per thread
+    of each process, named after the thread.
+
+    Args:
+        stage_list (list of dict): records of the stages
+
+    Returns:
+        event_list (list of dict): trace events, in the Chrome trace
+            event format
+    """
+    event_list = []
+    # lane of each (process, thread)
+    tid_dict = {}
+    for record in sorted(
+            stage_list, key=operator.itemgetter('start_seconds')):
+        lane_key = (record['pid'], record['thread'])
+        if lane_key not in tid_dict:
+            tid_dict[lane_key] = len(tid_dict)+1
+            event_list.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': record['pid'],
+                'tid': tid_dict[lane_key],
+                'args': {'name': record['thread']}})
+        event_args = {
+            'status': record['status'],
+            'cpu_seconds': round(record['cpu_seconds'], 6)}
+        if record['label'] is not None:
+            event_args['label'] = record['label']
+        if record['peak_rss_bytes'] is not None:
+            event_args['peak_rss_mb'] = round(
+                record['peak_rss_bytes']/1024.0**2, 1)
+        event_args.update(record['counters'])
+        event_list.append({
+            'name': record['name'],
+            'cat': record['category'],
+            'ph': 'X',
+            'ts': round(record['start_seconds']*1e6, 3),
+            'dur': round(record['wall_seconds']*1e6, 3),
+            'pid': record['pid'],
+            'tid': tid_dict[lane_key],
+            'args': event_args})
+    for pid in sorted(set(pid for pid, _ in tid_dict)):
+        event_list.append({
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': pid,
+            'args': {'name': 'recombine ({0})'.format(pid)}})
+
+    return event_list
+
+
+def write_trace(stage_list, trace_path):
+    """Write stage records to a Chrome trace file
+
+    The file can be opened in Perfetto (https://ui.perfetto.dev) or
+    chrome://tracing.
+
+    Args:
+        stage_list (list of dict): records of the stages
+        trace_path (string): path to the JSON trace file
+
+    Returns:
+        N/A
+    """
+    with open(trace_path, 'w') as trace_file:
+        json.dump(
+            {
+                'traceEvents': trace_events(stage_list),
+                'displayTimeUnit': 'ms'},
+            trace_file)
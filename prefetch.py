@@ -0,0 +1,177 @@
+"""Concurrent prefetch of the input volumes
+
+Reading a .nii.gz input means decompressing the whole volume, on a
+single core, and the first part of the pipeline reads its inputs one
+after another. This module decompresses the inputs in the background,
+in the order the pipeline needs them: an asyncio event loop, running in
+its own thread, hands the decompressions over to a pool of threads
+(zlib releases the GIL, so they run concurrently). While the pipeline
+computes on one input, the next ones get decompressed.
+
+The decompressed bytes of each input are kept until the pipeline takes
+them (see InputPrefetcher.take). The time spent decompressing each
+input and the time the pipeline had to wait for it are counted, so that
+the I/O time hidden behind the computations can be reported:
+- prefetch_io_seconds: decompression time of the inputs taken
+- prefetch_wait_seconds: time the pipeline waited for them
+- prefetch_hidden_seconds: decompression time that overlapped with
+    the computations (or with other decompressions)
+
+"""
+
+import asyncio
+import concurrent.futures
+import gzip
+import os
+import threading
+import time
+
+import instrumentation
+
+
+# default number of inputs decompressed at the same time
+DEFAULT_WORKERS = 4
+
+
+def gunzip_file(path):
+    """Decompress a gzip compressed file into memory
+
+    Args:
+        path (string): path to the .gz file
+
+    Returns:
+        raw (bytes): decompressed content of the file
+        io_seconds (float): time spent reading and decompressing
+    """
+    start_time = time.perf_counter()
+    with gzip.open(path, 'rb') as in_file:
+        raw = in_file.read()
+
+    return raw, time.perf_counter()-start_time
+
+
+class InputPrefetcher(object):
+    """Background decompression of .nii.gz inputs
+
+    Args:
+        workers (int): number of inputs decompressed at the same time
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        if workers < 1:
+            raise ValueError(
+                'the number of prefetch workers must be a positive integer')
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='prefetch')
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name='prefetch-loop', daemon=True)
+        self.thread.start()
+        # pending decompression (concurrent future) of each input, keyed
+        # by real path
+        self.futures = {}
+        self.lock = threading.Lock()
+        instrumentation.declare_counter('prefetch_io_seconds')
+        instrumentation.declare_counter('prefetch_wait_seconds')
+        instrumentation.declare_counter('prefetch_hidden_seconds')
+
+    async def decompress(self, path):
+        """Decompress an input on the thread pool
+
+        Args:
+            path (string): path to the .nii.gz input
+
+        Returns:
+            raw (bytes): decompressed content of the input
+            io_seconds (float): time spent decompressing
+        """
+        return await self.loop.run_in_executor(
+            self.executor, gunzip_file, path)
+
+    def prefetch(self, path_list):
+        """Start decompressing inputs in the background
+
+        Inputs are decompressed in the order of the list. Uncompressed
+        (.nii) inputs are memory-mapped when read, so they are skipped.
+
+        Args:
+            path_list (list of strings): paths to the inputs, in the
+                order they are needed
+
+        Returns:
+            N/A
+        """
+        with self.lock:
+            for path in path_list:
+                key = os.path.realpath(path)
+                if not path.endswith('.gz') or key in self.futures:
+                    continue
+                self.futures[key] = asyncio.run_coroutine_threadsafe(
+                    self.decompress(path), self.loop)
+
+    def take(self, path):
+        """Take the decompressed content of an input
+
+        Waits for the decompression if it is still in progress. The
+        content is only returned once: it is forgotten by the
+        prefetcher afterwards.
+
+        Args:
+            path (string): path to the input
+
+        Returns:
+            raw (bytes): decompressed content of the input. None if the
+                input was not prefetched
+        """
+        with self.lock:
+            future = self.futures.pop(os.path.realpath(path), None)
+        if future is None:
+            return None
+        start_time = time.perf_counter()
+        raw, io_seconds = future.result()
+        wait_seconds = time.perf_counter()-start_time
+        instrumentation.increment_counter('prefetch_io_seconds', io_seconds)
+        instrumentation.increment_counter(
+            'prefetch_wait_seconds', wait_seconds)
+        instrumentation.increment_counter(
+            'prefetch_hidden_seconds', max(io_seconds-wait_seconds, 0.0))
+
+        return raw
+
+    async def cancel_pending(self):
+        """Cancel the decompressions that have not been taken
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        task_list = [
+            task for task in asyncio.all_tasks()
+            if task is not asyncio.current_task()]
+        for task in task_list:
+            task.cancel()
+        await asyncio.gather(*task_list, return_exceptions=True)
+
+    def close(self):
+        """Stop the prefetcher
+
+        Decompressions not started yet are cancelled, and the content
+        not taken is discarded.
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        with self.lock:
+            self.futures.clear()
+        asyncio.run_coroutine_threadsafe(
+            self.cancel_pending(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,518 @@
+"""Header-only checks and resource estimates before recombination
+
+Reads the NIfTI headers of the input volumes (no image data gets
+decompressed), checks that their geometry is consistent and estimates
+the peak memory, disk usage and runtime of the recombination, so that
+the program can fail fast, or switch to a low-memory mode, before any
+processing starts.
+
+The estimates are deliberately coarse (upper bounds for memory and
+disk, order of magnitude for runtime). The figures they rely on are
+defined as module constants so that they can be calibrated.
+
+"""
+
+import os
+import shutil
+
+import numpy as np
+import nibabel as nib
+
+
+# memory used by the Python interpreter and the imported libraries
+BASELINE_MEMORY_BYTES = 300*1024*1024
+# number of float64 volumes of the size of the low-res volume held at
+# the same time during part 3
+PART3_FLOAT_VOLUMES = 10
+# elementwise numpy operations (voxels per second)
+NUMPY_VOXELS_PER_SECOND = 5e7
+# gzip compression (uncompressed bytes per second)
+GZIP_BYTES_PER_SECOND = 2e7
+# fixed cost of one SPM registration (Matlab startup, estimation)
+SPM_REGISTRATION_SECONDS = 60.0
+# SPM estimation and reslicing (voxels per second)
+SPM_VOXELS_PER_SECOND = 2e6
+# number of full passes over an interleaved slab in part 1
+PART1_PASSES_PER_SLAB = 12
+# number of full passes over the low-res grid in part 3
+PART3_PASSES = 20
+# default duplication factor of the slabs along y: number of
+# interleaved slabs per repetition (see process_slab)
+GAP_FACTOR = 2
+# number of CPUs used by a recombination (numpy operations and SPM run
+# in turn, each on a single core most of the time)
+CPUS_PER_SUBJECT = 1.0
+
+
+def read_header_info(impath):
+    """Read the geometry of a volume from its header
+
+    Only the header is read: the image data does not get decompressed.
+
+    Args:
+        impath (string): path to a .nii or .nii.gz volume
+
+    Returns:
+        info (dict): header information:
+            - path (string): path to the volume
+            - shape (tuple of int): shape of the data array
+            - ras_shape (tuple of int): shape of the first three axes
+                once reoriented to RAS
+            - ras_zooms (tuple of float): voxel sizes once reoriented
+                to RAS
+            - axcodes (tuple of string): orientation of the volume
+            - dtype (numpy dtype): on-disk data type
+            - memory_itemsize (int): number of bytes per voxel once
+                read in memory (8 if the data gets scaled)
+    """
+    if not os.path.isfile(impath):
+        raise IOError('{0} does not exist'.format(impath))
+    if not (impath.endswith('.nii') or impath.endswith('.nii.gz')):
+        raise IOError(
+            '{0}: input image must be of type either .nii or .nii.gz'.format(
+                impath))
+    volume = nib.load(impath)
+    header = volume.header
+    shape = tuple(int(dim) for dim in volume.shape)
+    zooms = tuple(float(zoom) for zoom in header.get_zooms()[0:3])
+    # permutation of the axes to RAS
+    ornt = nib.orientations.io_orientation(volume.affine)
+    ras_axes = [int(ornt[dim_index, 0]) for dim_index in range(3)]
+    ras_shape = [0, 0, 0]
+    ras_zooms = [0.0, 0.0, 0.0]
+    for dim_index in range(3):
+        ras_shape[ras_axes[dim_index]] = shape[dim_index]
+        ras_zooms[ras_axes[dim_index]] = zooms[dim_index]
+    dtype = header.get_data_dtype()
+    slope, inter = header.get_slope_inter()
+    scaled = (slope is not None and slope != 1) or \
+        (inter is not None and inter != 0)
+    if scaled:
+        memory_itemsize = 8
+    else:
+        memory_itemsize = dtype.itemsize
+
+    info = {
+        'path': impath,
+        'shape': shape,
+        'ras_shape': tuple(ras_shape),
+        'ras_zooms': tuple(ras_zooms),
+        'axcodes': tuple(nib.aff2axcodes(volume.affine)),
+        'dtype': dtype,
+        'memory_itemsize': memory_itemsize}
+
+    return info
+
+
+def check_geometry(slab_info_list, lowres_info, gap_factor=GAP_FACTOR):
+    """Check the geometry of the input volumes
+
+    Args:
+        slab_info_list (list of dict): header information of the slabs,
+            repetition after repetition (e.g., rep1s1, rep1s2, rep2s1,
+            rep2s2)
+        lowres_info (dict): header information of the low-res volume
+        gap_factor (int): number of interleaved slabs per repetition
+
+    Returns:
+        error_list (list of strings): problems that prevent the
+            recombination
+        warning_list (list of strings): unusual settings that do not
+            prevent the recombination
+    """
+    error_list = []
+    warning_list = []
+
+    # each volume on its own
+    for info in slab_info_list+[lowres_info]:
+        if len(info['shape']) < 3 or int(np.prod(info['shape'][3:])) > 1:
+            error_list.append(
+                '{0}: expected a 3D volume, got shape {1}'.format(
+                    info['path'], info['shape']))
+        if info['dtype'].kind not in 'iuf':
+            error_list.append(
+                '{0}: unsupported data type {1}'.format(
+                    info['path'], info['dtype']))
+        if min(info['ras_zooms']) <= 0:
+            error_list.append(
+                '{0}: invalid voxel size {1}'.format(
+                    info['path'], info['ras_zooms']))
+
+    # slabs of a same repetition get interleaved: same grid
+    if gap_factor < 1 or len(slab_info_list) % gap_factor:
+        error_list.append(
+            '{0} slabs cannot be split into repetitions of {1} slabs'.format(
+                len(slab_info_list), gap_factor))
+    for repetition_index in range(len(slab_info_list)//max(gap_factor, 1)):
+        slab_a_info = slab_info_list[gap_factor*repetition_index]
+        for slab_b_info in slab_info_list[
+                gap_factor*repetition_index+1:
+                gap_factor*(repetition_index+1)]:
+            if slab_a_info['ras_shape'] != slab_b_info['ras_shape']:
+                error_list.append(
+                    'repetition {0}: slabs have different shapes'
+                    ' ({1} vs {2})'.format(
+                        repetition_index+1,
+                        slab_a_info['ras_shape'],
+                        slab_b_info['ras_shape']))
+            if not np.allclose(
+                    slab_a_info['ras_zooms'], slab_b_info['ras_zooms'],
+                    rtol=1e-3):
+                error_list.append(
+                    'repetition {0}: slabs have different voxel sizes'
+                    ' ({1} vs {2})'.format(
+                        repetition_index+1,
+                        slab_a_info['ras_zooms'],
+                        slab_b_info['ras_zooms']))
+
+    # all slabs: usually acquired with the same protocol
+    first_info = slab_info_list[0]
+    for info in slab_info_list[1:]:
+        if info['ras_shape'] != first_info['ras_shape'] or \
+                not np.allclose(
+                    info['ras_zooms'], first_info['ras_zooms'], rtol=1e-3):
+            warning_list.append(
+                '{0}: geometry differs from {1}'.format(
+                    info['path'], first_info['path']))
+        if info['axcodes'] != first_info['axcodes']:
+            warning_list.append(
+                '{0}: orientation {1} differs from {2}'.format(
+                    info['path'],
+                    ''.join(info['axcodes']),
+                    ''.join(first_info['axcodes'])))
+    for info in slab_info_list+[lowres_info]:
+        if info['axcodes'] != ('R', 'A', 'S'):
+            warning_list.append(
+                '{0}: orientation {1}, will be reoriented to RAS'.format(
+                    info['path'], ''.join(info['axcodes'])))
+    # the low-res volume should have larger voxels than the slabs
+    if min(lowres_info['ras_zooms']) < min(first_info['ras_zooms']):
+        warning_list.append(
+            '{0}: low-res voxels are smaller than the slab voxels'.format(
+                lowres_info['path']))
+
+    return error_list, warning_list
+
+
+def estimate_resources(
+        slab_info_list,
+        lowres_info,
+        keep_intermediates='all',
+        cache_size_mb=0,
+        gap_factor=GAP_FACTOR):
+    """Estimate the resources needed by the recombination
+
+    Args:
+        slab_info_list (list of dict): header information of the slabs
+        lowres_info (dict): header information of the low-res volume
+        keep_intermediates (string): intermediate retention policy.
+            'all', 'registered' or 'none'
+        cache_size_mb (int): maximum size of the in-memory volume
+            cache, in MB
+        gap_factor (int): number of interleaved slabs per repetition
+
+    Returns:
+        estimates (dict): resource estimates:
+            - peak_memory_bytes (int): upper bound of the peak memory
+            - disk_bytes (int): upper bound of the disk usage of the
+                working directory (uncompressed images)
+            - output_disk_bytes (int): upper bound of the disk usage of
+                the output directory
+            - runtime_seconds (float): order of magnitude of the
+                runtime
+            - cpus (float): number of CPUs used at the same time
+            - cpu_seconds (float): order of magnitude of the CPU time
+    """
+    slab_voxels = max(
+        int(np.prod(info['ras_shape'])) for info in slab_info_list)
+    slab_itemsize = max(info['memory_itemsize'] for info in slab_info_list)
+    slab_count = len(slab_info_list)
+    repetition_count = max(slab_count//gap_factor, 1)
+    lowres_voxels = int(np.prod(lowres_info['ras_shape']))
+    lowres_itemsize = lowres_info['dtype'].itemsize
+    # interleaved slab (duplicated along y)
+    interleaved_voxels = gap_factor*slab_voxels
+
+    # memory
+    #-- part 1: input slabs and low-res volume (decompressed ahead of
+    # time, see prefetch), duplicated and gap-inserted slabs in the
+    # input type, phantoms and float conversion in float64 (plus the
+    # resampled slab used to compute the duplicated affine)
+    part1_bytes = (
+        slab_count*slab_voxels*slab_itemsize +
+        lowres_voxels*lowres_itemsize +
+        2*2*interleaved_voxels*slab_itemsize +
+        4*interleaved_voxels*8)
+    #-- part 3: float64 volumes on the low-res grid, plus the sums of
+    # each repetition beyond the second one
+    part3_bytes = (
+        PART3_FLOAT_VOLUMES+2*max(repetition_count-2, 0))*lowres_voxels*8
+    #-- volume cache: at most the images saved in part 1 and 3
+    cached_bytes = min(
+        cache_size_mb*1024*1024,
+        slab_count*2*interleaved_voxels*8 +
+        (2*repetition_count+3)*lowres_voxels*8)
+    peak_memory_bytes = (
+        BASELINE_MEMORY_BYTES + max(part1_bytes, part3_bytes) +
+        cached_bytes)
+
+    # disk (uncompressed images)
+    #-- images needed by SPM: float slab and phantom for each slab,
+    # low-res copies
+    spm_bytes = slab_count*2*interleaved_voxels*8
+    if keep_intermediates == 'all':
+        spm_bytes += slab_count*lowres_voxels*lowres_itemsize
+    else:
+        spm_bytes += lowres_voxels*lowres_itemsize
+    #-- SPM temporary folder: copy of each image + registered images
+    temp_bytes = slab_count*(2*interleaved_voxels*8+2*lowres_voxels*8)
+    #-- intermediary images not needed by SPM
+    intermediate_bytes = 0
+    if keep_intermediates == 'all':
+        intermediate_bytes = slab_count*(
+            slab_voxels*slab_itemsize +
+            2*interleaved_voxels*slab_itemsize +
+            interleaved_voxels*8) + (2*repetition_count+2)*lowres_voxels*8
+    #-- final outputs: rs, one per repetition and their sum, plus the
+    # stored accumulators (sums of the slabs and of the phantoms of each
+    # repetition)
+    output_bytes = (3*repetition_count+2)*lowres_voxels*8
+    disk_bytes = spm_bytes+temp_bytes+intermediate_bytes+output_bytes
+    output_disk_bytes = output_bytes
+    if keep_intermediates in ['all', 'registered']:
+        output_disk_bytes += slab_count*2*lowres_voxels*8
+    if keep_intermediates == 'all':
+        output_disk_bytes += intermediate_bytes
+
+    # runtime
+    runtime_seconds = (
+        slab_count*PART1_PASSES_PER_SLAB*interleaved_voxels /
+        NUMPY_VOXELS_PER_SECOND +
+        PART3_PASSES*lowres_voxels/NUMPY_VOXELS_PER_SECOND +
+        output_disk_bytes/GZIP_BYTES_PER_SECOND +
+        slab_count*(
+            SPM_REGISTRATION_SECONDS +
+            (interleaved_voxels+lowres_voxels)/SPM_VOXELS_PER_SECOND))
+
+    estimates = {
+        'peak_memory_bytes': int(peak_memory_bytes),
+        'disk_bytes': int(disk_bytes),
+        'output_disk_bytes': int(output_disk_bytes),
+        'runtime_seconds': float(runtime_seconds),
+        'cpus': CPUS_PER_SUBJECT,
+        'cpu_seconds': float(runtime_seconds*CPUS_PER_SUBJECT)}
+
+    return estimates
+
+
+def available_memory():
+    """Physical memory currently available
+
+    Args:
+        N/A
+
+    Returns:
+        available_bytes (int): available memory in bytes. None if it
+            cannot be determined on this system.
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def free_disk_space(dirpath):
+    """Free space on the file system of a folder
+
+    Args:
+        dirpath (string): path to folder. The closest existing parent
+            folder is used if it does not exist yet.
+
+    Returns:
+        free_bytes (int): free space in bytes
+    """
+    dirpath = os.path.abspath(dirpath)
+    while not os.path.isdir(dirpath):
+        dirpath = os.path.dirname(dirpath)
+
+    return shutil.disk_usage(dirpath).free
+
+
+def plan_memory(
+        slab_info_list,
+        lowres_info,
+        keep_intermediates='all',
+        cache_size_mb=0,
+        memory_limit_bytes=None,
+        gap_factor=GAP_FACTOR):
+    """Estimate the resources and choose the memory mode
+
+    The volume cache is disabled (low-memory mode) if the estimated
+    peak memory exceeds the memory limit with the cache.
+
+    Args:
+        slab_info_list (list of dict): header information of the slabs
+        lowres_info (dict): header information of the low-res volume
+        keep_intermediates (string): intermediate retention policy
+        cache_size_mb (int): maximum size of the in-memory volume
+            cache, in MB
+        memory_limit_bytes (int): memory available to the
+            recombination, in bytes. None if unknown
+        gap_factor (int): number of interleaved slabs per repetition
+
+    Returns:
+        estimates (dict): resource estimates with the chosen mode (see
+            estimate_resources). The peak memory may still exceed the
+            limit.
+        cache_size_mb (int): cache size to use
+        low_memory (Boolean): True if the low-memory mode was chosen
+    """
+    estimates = estimate_resources(
+        slab_info_list, lowres_info, keep_intermediates, cache_size_mb,
+        gap_factor)
+    if memory_limit_bytes is None or \
+            estimates['peak_memory_bytes'] <= memory_limit_bytes or \
+            cache_size_mb == 0:
+        return estimates, cache_size_mb, False
+    # try without the volume cache
+    estimates = estimate_resources(
+        slab_info_list, lowres_info, keep_intermediates, 0, gap_factor)
+
+    return estimates, 0, True
+
+
+def run_preflight(
+        slab_path_list,
+        lowres_path,
+        outdir_path,
+        workdir_parent_path,
+        keep_intermediates='all',
+        cache_size_mb=0,
+        memory_limit_mb=None,
+        gap_factor=GAP_FACTOR):
+    """Check the inputs and plan the recombination
+
+    Raise an error if the inputs are inconsistent or if the resources
+    are not sufficient. If the estimated peak memory exceeds the
+    memory limit, switch to a low-memory mode (volume cache disabled,
+    intermediary images memory-mapped) if that is enough.
+
+    Args:
+        slab_path_list (list of strings): paths to the slabs,
+            repetition after repetition (e.g., rep1s1, rep1s2, rep2s1,
+            rep2s2)
+        lowres_path (string): path to the low-res volume
+        outdir_path (string): path to output dir
+        workdir_parent_path (string): folder where the working
+            directory gets created (scratch folder or output dir)
+        keep_intermediates (string): intermediate retention policy
+        cache_size_mb (int): maximum size of the in-memory volume
+            cache, in MB
+        memory_limit_mb (int): memory available to the recombination,
+            in MB. Defaults to the physical memory currently available
+        gap_factor (int): number of interleaved slabs per repetition
+
+    Returns:
+        report (dict): preflight report:
+            - slabs (list of dict), lowres (dict): header information
+            - warnings (list of strings)
+            - estimates (dict): see estimate_resources
+            - memory_limit_bytes (int): None if unknown
+            - low_memory (Boolean): True if the low-memory mode was
+                chosen
+            - cache_size_mb (int): cache size to use
+    """
+    slab_info_list = [read_header_info(path) for path in slab_path_list]
+    lowres_info = read_header_info(lowres_path)
+
+    # geometry
+    error_list, warning_list = check_geometry(
+        slab_info_list, lowres_info, gap_factor)
+    if error_list:
+        error_msg = 'Preflight check failed:\n- {0}'.format(
+            '\n- '.join(error_list))
+        raise ValueError(error_msg)
+
+    # memory
+    if memory_limit_mb is None:
+        memory_limit_bytes = available_memory()
+    else:
+        memory_limit_bytes = memory_limit_mb*1024*1024
+    estimates, cache_size_mb, low_memory = plan_memory(
+        slab_info_list, lowres_info, keep_intermediates, cache_size_mb,
+        memory_limit_bytes, gap_factor)
+    if memory_limit_bytes is not None and \
+            estimates['peak_memory_bytes'] > memory_limit_bytes:
+        raise MemoryError(
+            'Preflight check failed: estimated peak memory'
+            ' {0:.0f} MB exceeds the limit of {1:.0f} MB'.format(
+                estimates['peak_memory_bytes']/1024.0**2,
+                memory_limit_bytes/1024.0**2))
+    if low_memory:
+        warning_list.append(
+            'estimated peak memory exceeds the limit with the volume'
+            ' cache: switching to low-memory mode')
+
+    # disk
+    free_bytes = free_disk_space(workdir_parent_path)
+    if estimates['disk_bytes'] > free_bytes:
+        raise IOError(
+            'Preflight check failed: {0} has {1:.0f} MB free, the'
+            ' recombination may need up to {2:.0f} MB'.format(
+                workdir_parent_path,
+                free_bytes/1024.0**2,
+                estimates['disk_bytes']/1024.0**2))
+    free_bytes = free_disk_space(outdir_path)
+    if estimates['output_disk_bytes'] > free_bytes:
+        raise IOError(
+            'Preflight check failed: {0} has {1:.0f} MB free, the'
+            ' outputs may need up to {2:.0f} MB'.format(
+                outdir_path,
+                free_bytes/1024.0**2,
+                estimates['output_disk_bytes']/1024.0**2))
+
+    report = {
+        'slabs': slab_info_list,
+        'lowres': lowres_info,
+        'warnings': warning_list,
+        'estimates': estimates,
+        'memory_limit_bytes': memory_limit_bytes,
+        'low_memory': low_memory,
+        'cache_size_mb': cache_size_mb}
+
+    return report
+
+
+def print_report(report):
+    """Print the preflight report
+
+    Args:
+        report (dict): preflight report (see run_preflight)
+
+    Returns:
+        N/A
+    """
+    print('Preflight check')
+    for info in report['slabs']+[report['lowres']]:
+        print('  {0}: shape {1}, voxel size {2}, {3}, {4}'.format(
+            info['path'],
+            'x'.join(str(dim) for dim in info['shape']),
+            'x'.join('{0:g}'.format(zoom) for zoom in info['ras_zooms']),
+            ''.join(info['axcodes']),
+            info['dtype']))
+    for warning in report['warnings']:
+        print('  Warning: {0}'.format(warning))
+    estimates = report['estimates']
+    print('  Estimated peak memory: {0:.0f} MB'.format(
+        estimates['peak_memory_bytes']/1024.0**2))
+    if report['memory_limit_bytes'] is not None:
+        print('  Memory limit: {0:.0f} MB'.format(
+            report['memory_limit_bytes']/1024.0**2))
+    print('  Estimated disk usage (working dir): {0:.0f} MB'.format(
+        estimates['disk_bytes']/1024.0**2))
+    print('  Estimated disk usage (output dir): {0:.0f} MB'.format(
+        estimates['output_disk_bytes']/1024.0**2))
+    print('  Estimated runtime: {0:.0f} s'.format(
+        estimates['runtime_seconds']))
+    if report['low_memory']:
+        print('  Low-memory mode: volume cache disabled')
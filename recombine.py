@@ -15,19 +15,396 @@
 """
 
 import os
+import re
+import sys
 import shutil
+import signal
+import string
 import argparse
 import io
 import contextlib
 import gzip
+import hashlib
+import json
+import struct
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+import concurrent.futures
 import numpy as np
 import nibabel as nib
+from nibabel.fileholders import FileHolder
 import nilearn as nil
 import nilearn.image
 import nipype.interfaces.spm as spm
 import nipype.interfaces.matlab as mlab
 
+import batch
 import check_spm
+import instrumentation
+import preflight
+import prefetch
+import registration_qc
+import service
+import volume_cache
+import watch_folder
+import work_queue
+
+
+# size of the blocks (in bytes) processed by the sparse gzip writer.
+# Blocks that only contain zeros are not compressed again but replaced by
+# a pre-compressed copy
+GZIP_BLOCK_SIZE = 1 << 20
+# default gzip compression level (same as gzip and nibabel)
+GZIP_COMPRESSLEVEL = 9
+# key of the NIfTI header extension storing where a cropped volume
+# lies within its full grid
+CROP_EXTENSION_KEY = 'recombine_crop'
+# NIfTI header extension code used to store the crop information
+# (NIFTI_ECODE_COMMENT)
+CROP_EXTENSION_CODE = 6
+# key of the nibabel 'extra' dictionary that tags volumes already in
+# canonical ('RAS') orientation
+CANONICAL_TAG = 'canonical'
+# number of times a volume had to be copied to be reoriented
+instrumentation.declare_counter('reorientation_copies')
+# number of bytes written to disk by the pipeline (SPM included)
+instrumentation.declare_counter('bytes_written')
+# number of bytes read from disk by the pipeline (SPM included), and
+# size of the data decompressed from the .nii.gz files read
+instrumentation.declare_counter('bytes_read')
+instrumentation.declare_counter('bytes_decompressed')
+# time (in seconds) spent waiting for Matlab (SPM registrations)
+instrumentation.declare_counter('matlab_wait_seconds')
+# intermediate retention policies
+#-- all: all intermediary images are kept in the debug subfolder
+#-- registered: only the SPM registered slabs and phantoms are kept
+#-- none: only the images needed by SPM are written, and removed as
+# soon as they have been used
+KEEP_INTERMEDIATES_CHOICES = ['all', 'registered', 'none']
+# file format of the intermediary images that are only read by Python
+# (i.e., not by SPM)
+#-- nii: uncompressed, memory-mapped when read back. Kept images get
+# gzip compressed at the end of the run
+#-- nii.gz: gzip compressed when written
+INTERMEDIATE_FORMAT_CHOICES = ['nii', 'nii.gz']
+INTERMEDIATE_FORMAT = 'nii'
+# encoding of the final outputs
+#-- data type: float64 (as computed), float32, or int16 scaled by the
+# scl_slope/scl_inter of the header
+OUTPUT_DTYPE_CHOICES = ['float64', 'float32', 'int16']
+OUTPUT_DTYPE = 'float64'
+#-- file format: gzip compressed (nii.gz) or uncompressed (nii)
+OUTPUT_FORMAT_CHOICES = ['nii.gz', 'nii']
+OUTPUT_FORMAT = 'nii.gz'
+#-- gzip compression level (nii.gz only)
+OUTPUT_COMPRESSLEVEL = GZIP_COMPRESSLEVEL
+# default maximum size of the in-memory volume cache, in megabytes
+DEFAULT_CACHE_SIZE_MB = 2048
+# registration backends (see REGISTRATION_BACKENDS): SPM (through
+# Matlab), identity (reslices the slabs onto the low-res grid without
+# moving them; no Matlab needed, for benchmarks and tests), replay
+# (applies the transforms of an earlier run; no Matlab needed). stub is
+# the former name of identity
+REGISTRATION_BACKEND_CHOICES = ['spm', 'identity', 'replay', 'stub']
+REGISTRATION_BACKEND = 'spm'
+# SPM co-registration settings: sampling distances (mm) of the
+# coarse-to-fine estimation, and accuracy of each rigid parameter
+SPM_SEPARATION = [4.0, 2.0]
+SPM_TOLERANCE = [
+    0.02, 0.02, 0.02, 0.001,
+    0.001, 0.001, 0.01, 0.01,
+    0.01, 0.001, 0.001, 0.001]
+# preview mode (see prepare_preview): default downsampling factor,
+# coarser SPM sampling and looser SPM tolerances
+DEFAULT_PREVIEW_FACTOR = 4
+PREVIEW_SEPARATION = [8.0, 4.0]
+PREVIEW_TOLERANCE_SCALE = 10.0
+# downsampling factor of the current run. None if not a preview
+PREVIEW_FACTOR = None
+# label of the preview outputs (file name prefix and NIfTI description)
+PREVIEW_PREFIX = 'preview_'
+PREVIEW_DESCRIPTION = 'PREVIEW - NOT FOR DIAGNOSTIC USE'
+# repetition and slab of each slab input (see batch.MANIFEST_COLUMNS)
+SLAB_ROLES = {
+    'rep1s1': ['1', 'a'],
+    'rep1s2': ['1', 'b'],
+    'rep2s1': ['2', 'a'],
+    'rep2s2': ['2', 'b']}
+# default number of interleaved slabs per repetition (gap factor)
+DEFAULT_SLABS_PER_REPETITION = 2
+# final outputs: weighted average of all the repetitions (rs), of each
+# repetition (rs1, rs2, ...), and sum of the weighted averages of the
+# repetitions (rs_1_2, rs_1_2_3, ...). See output_names
+OUTPUT_NAME_PATTERN = r'^rs(\d+|(_\d+)+)?$'
+# file name of the run report (inside the output dir)
+RUN_REPORT_FILENAME = 'run_report.json'
+# per-repetition accumulators (sums of the registered slabs and of
+# their phantoms) stored by part3, so that a later run can reuse the
+# repetitions whose inputs have not changed (see --incremental):
+# subfolder of the output dir, manifest file name and gzip compression
+# level (float64 sums barely compress further at higher levels)
+ACCUMULATORS_DIRNAME = 'accumulators'
+ACCUMULATORS_MANIFEST_FILENAME = 'accumulators.json'
+ACCUMULATORS_COMPRESSLEVEL = 1
+# size (in bytes) of the chunks read to compute the signature of an
+# input (see input_signature)
+INPUT_SIGNATURE_CHUNK_SIZE = 1024*1024
+# in-memory cache of the volumes read and written by the pipeline
+VOLUME_CACHE = volume_cache.VolumeCache(DEFAULT_CACHE_SIZE_MB*1024*1024)
+# background decompression of the inputs of the current run (see
+# prefetch_inputs). None if the inputs are read when needed
+INPUT_PREFETCHER = None
+# peak disk usage (in bytes) of the working directories of the runs in
+# progress, keyed by real path, sampled after each write (see
+# sample_disk_usage)
+DISK_USAGE_PEAKS = {}
+DISK_USAGE_LOCK = threading.Lock()
+
+
+def add_processing_arguments(parser):
+    """Add the optional processing arguments to a parser
+
+    These arguments are shared by the single-subject and batch
+    command-line interfaces.
+
+    Args:
+        parser (argparse.ArgumentParser): parser
+
+    Returns:
+        N/A
+    """
+    parser.add_argument(
+        '-spm',
+        '--spm_path',
+        help='path to SPM folder (i.e., where spm.m is located)')
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=DEFAULT_CACHE_SIZE_MB,
+        help='maximum size (in MB) of the in-memory cache of volumes read'
+        ' and written by the pipeline: volumes read back after being'
+        ' written (.nii or .nii.gz) are taken from memory. 0 disables the'
+        ' cache (uncompressed intermediary images are then'
+        ' memory-mapped when read back).'
+        ' Default: {0}'.format(DEFAULT_CACHE_SIZE_MB))
+    parser.add_argument(
+        '--prefetch-workers',
+        type=int,
+        default=prefetch.DEFAULT_WORKERS,
+        help='number of compressed (.nii.gz) inputs decompressed at the'
+        ' same time, in the background, while the first part of the'
+        ' pipeline processes the previous ones. 0 reads each input when'
+        ' needed. Default: {0}'.format(prefetch.DEFAULT_WORKERS))
+    parser.add_argument(
+        '--scratch-dir',
+        default=default_scratch_path(),
+        help='folder (e.g., local disk or /dev/shm) where the temporary'
+        ' and intermediary images are processed. Final outputs and kept'
+        ' intermediary images are moved to the output dir at the end.'
+        ' Default: $TMPDIR ({0})'.format(default_scratch_path()))
+    parser.add_argument(
+        '--no-scratch',
+        action='store_true',
+        help='process the images directly inside the output dir')
+    parser.add_argument(
+        '--intermediate-format',
+        choices=INTERMEDIATE_FORMAT_CHOICES,
+        default=INTERMEDIATE_FORMAT,
+        help='file format of the intermediary images not read by SPM:'
+        ' uncompressed and memory-mapped (nii, compressed at the end of'
+        ' the run if kept) or compressed when written (nii.gz).'
+        ' Default: {0}'.format(INTERMEDIATE_FORMAT))
+    parser.add_argument(
+        '--keep-intermediates',
+        choices=KEEP_INTERMEDIATES_CHOICES,
+        default='all',
+        help='intermediary images to keep in the debug subfolder: all of'
+        ' them, only the SPM registered slabs and phantoms, or none'
+        ' (only the images needed by SPM are written, and they are'
+        ' removed as soon as they have been used). Default: all')
+    parser.add_argument(
+        '--output-dtype',
+        choices=OUTPUT_DTYPE_CHOICES,
+        default=OUTPUT_DTYPE,
+        help='data type of the final outputs: float64 (as computed),'
+        ' float32, or int16 with a scaling factor (scl_slope/scl_inter;'
+        ' the quantisation error is reported). Default: {0}'.format(
+            OUTPUT_DTYPE))
+    parser.add_argument(
+        '--output-format',
+        choices=OUTPUT_FORMAT_CHOICES,
+        default=OUTPUT_FORMAT,
+        help='file format of the final outputs: compressed (nii.gz) or'
+        ' uncompressed (nii). Default: {0}'.format(OUTPUT_FORMAT))
+    parser.add_argument(
+        '--output-compression',
+        type=int,
+        choices=range(1, 10),
+        default=OUTPUT_COMPRESSLEVEL,
+        help='gzip compression level of the final outputs, from 1'
+        ' (fastest) to 9 (smallest). Default: {0}'.format(
+            OUTPUT_COMPRESSLEVEL))
+    parser.add_argument(
+        '--registration',
+        choices=REGISTRATION_BACKEND_CHOICES,
+        default=REGISTRATION_BACKEND,
+        help='registration backend: SPM, identity (reslices the slabs'
+        ' onto the low-res grid without registering them; does not need'
+        ' Matlab, for benchmarks and tests only; stub is its former'
+        ' name, still accepted) or replay (applies the transforms'
+        ' estimated by an earlier run, see --registration-transforms;'
+        ' does not need Matlab). Default: {0}'.format(REGISTRATION_BACKEND))
+    parser.add_argument(
+        '--registration-transforms',
+        help='registration transforms replayed by the replay backend:'
+        ' {0} file of an earlier run, or its output dir'.format(
+            REGISTRATION_TRANSFORMS_FILENAME))
+    parser.add_argument(
+        '--outputs',
+        type=parse_outputs,
+        help='comma-separated list of the final outputs to compute'
+        ' (rs, rs1, rs2, ..., rs_1_2...: see output_names). The images'
+        ' and registrations only needed by other outputs are skipped.'
+        ' Default: all')
+    parser.add_argument(
+        '--no-accumulators',
+        action='store_true',
+        help='do not store the per-repetition accumulators (sums of the'
+        ' registered slabs and of their phantoms) in the {0}/ subfolder'
+        ' of the output dir. They let a later run only process the'
+        ' repetitions that changed (see --incremental)'.format(
+            ACCUMULATORS_DIRNAME))
+    parser.add_argument(
+        '--qc-subsample',
+        type=int,
+        default=registration_qc.DEFAULT_SUBSAMPLE,
+        help='subsampling step (along each axis) of the voxels compared'
+        ' by the registration QC. 1 compares all the voxels.'
+        ' Default: {0}'.format(registration_qc.DEFAULT_SUBSAMPLE))
+    parser.add_argument(
+        '--no-qc',
+        action='store_true',
+        help='do not check the registrations (NMI and correlation of'
+        ' each registered slab with the low-res volume, and between'
+        ' repetitions)')
+    parser.add_argument(
+        '--memory-limit',
+        type=int,
+        help='memory (in MB) available to the recombination. If the'
+        ' estimated peak memory exceeds it, the volume cache is disabled,'
+        ' or the program stops if that is not enough.'
+        ' Default: physical memory currently available')
+    parser.add_argument(
+        '--preflight-only',
+        action='store_true',
+        help='only check the input headers and show the resource'
+        ' estimates, without processing the images')
+
+
+def parse_outputs(outputs_string):
+    """Parse the list of final outputs to compute
+
+    Only the syntax of the names is checked here, as the outputs
+    available depend on the number of repetitions (see resolve_outputs).
+
+    Args:
+        outputs_string (string): comma-separated list of outputs (see
+            output_names)
+
+    Returns:
+        output_list (list of strings): outputs, without duplicates
+    """
+    output_list = []
+    for output in outputs_string.split(','):
+        output = output.strip()
+        if not output or output in output_list:
+            continue
+        if re.match(OUTPUT_NAME_PATTERN, output) is None:
+            raise argparse.ArgumentTypeError(
+                'invalid output {0} (e.g., rs, rs1, rs_1_2)'.format(output))
+        output_list.append(output)
+    if not output_list:
+        raise argparse.ArgumentTypeError(
+            'invalid outputs {0}'.format(outputs_string))
+
+    return output_list
+
+
+def output_names(repetition_list):
+    """Final outputs available for a number of repetitions
+
+    Args:
+        repetition_list (list of strings): repetitions ('1', '2', ...)
+
+    Returns:
+        output_list (list of strings): weighted average of all the
+            repetitions (rs), of each repetition (rs1, rs2, ...), and
+            sum of the weighted averages of the repetitions (rs_1_2...,
+            only if there are several repetitions)
+    """
+    output_list = ['rs']
+    output_list.extend(
+        'rs{0}'.format(repetition) for repetition in repetition_list)
+    if len(repetition_list) > 1:
+        output_list.append('rs_{0}'.format('_'.join(repetition_list)))
+
+    return output_list
+
+
+def resolve_outputs(output_list, repetition_list):
+    """Check the final outputs requested for a number of repetitions
+
+    Args:
+        output_list (list of strings): requested outputs (see
+            parse_outputs). None for all the outputs
+        repetition_list (list of strings): repetitions ('1', '2', ...)
+
+    Returns:
+        output_list (list of strings): outputs, in the order of
+            output_names
+    """
+    available_list = output_names(repetition_list)
+    if output_list is None:
+        return available_list
+    unknown_list = [
+        output for output in output_list if output not in available_list]
+    if unknown_list:
+        raise ValueError(
+            'unknown outputs {0} for {1} repetition(s) (choose from'
+            ' {2})'.format(
+                ', '.join(unknown_list), len(repetition_list),
+                ', '.join(available_list)))
+
+    return [output for output in available_list if output in output_list]
+
+
+def output_repetitions(output_list, repetition_list):
+    """Repetitions needed to compute final outputs
+
+    Args:
+        output_list (list of strings): final outputs (see
+            resolve_outputs)
+        repetition_list (list of strings): repetitions ('1', '2', ...)
+
+    Returns:
+        repetition_list (list of strings): repetitions needed, in the
+            same order
+    """
+    needed_set = set()
+    for output in output_list:
+        if output[2:] in repetition_list:
+            # weighted average of a single repetition
+            needed_set.add(output[2:])
+        else:
+            # rs and sum of the weighted averages: all the repetitions
+            needed_set.update(repetition_list)
+
+    return [
+        repetition for repetition in repetition_list
+        if repetition in needed_set]
 
 
 def read_cli_args():
@@ -48,26 +425,14 @@ def read_cli_args():
     parser = argparse.ArgumentParser(description=cli_description)
     # add arguments
     #-- mandatory arguments
-    #---- first slab of first repetition
-    parser.add_argument(
-        'rep1s1_path',
-        metavar='rep1s1',
-        help='.nii(.gz) first slab of first repetition')
-    #---- second slab of first repetition
-    parser.add_argument(
-        'rep1s2_path',
-        metavar='rep1s2',
-        help='.nii(.gz) second slab of first repetition')
-    #---- first slab of first repetition
+    #---- slabs of all repetitions
     parser.add_argument(
-        'rep2s1_path',
-        metavar='rep2s1',
-        help='.nii(.gz) first slab of second repetition')
-    #---- second slab of first repetition
-    parser.add_argument(
-        'rep2s2_path',
-        metavar='rep2s2',
-        help='.nii(.gz) second slab of second repetition')
+        'slab_paths',
+        metavar='slab',
+        nargs='+',
+        help='.nii(.gz) slabs, repetition after repetition (e.g., rep1s1'
+        ' rep1s2 rep2s1 rep2s2), with --slabs-per-repetition interleaved'
+        ' slabs per repetition')
     #---- low resolution volume
     parser.add_argument(
         'lowres_path',
@@ -80,11 +445,61 @@ def read_cli_args():
         help='path where output files will be stored')
     #-- optional arguments
     parser.add_argument(
-        '-spm',
-        '--spm_path',
-        help='path to SPM folder (i.e., where spm.m is located)')
+        '--slabs-per-repetition',
+        type=int,
+        default=DEFAULT_SLABS_PER_REPETITION,
+        help='number of interleaved slabs per repetition (i.e., gap'
+        ' factor along y). Default: {0}'.format(
+            DEFAULT_SLABS_PER_REPETITION))
+    parser.add_argument(
+        '--preview',
+        action='store_true',
+        help='quick-look preview, NOT FOR DIAGNOSTIC USE: the slabs and'
+        ' low-res volume are downsampled (see --preview-factor) and'
+        ' registered with coarse settings, only rs is computed (unless'
+        ' --outputs is given), no intermediary image is kept and the'
+        ' registration QC compares all the voxels')
+    parser.add_argument(
+        '--preview-factor',
+        type=int,
+        default=DEFAULT_PREVIEW_FACTOR,
+        help='downsampling factor of the preview (slabs: within the'
+        ' slab planes only, so that they still interleave; low-res'
+        ' volume: along each axis). Default: {0}'.format(
+            DEFAULT_PREVIEW_FACTOR))
+    parser.add_argument(
+        '--incremental',
+        metavar='PREVIOUS_OUT_DIR',
+        help='output dir of an earlier run of the same subject (e.g.,'
+        ' before a repetition was re-acquired): the repetitions whose'
+        ' slabs have not changed are not processed again, their stored'
+        ' accumulators ({0}/ subfolder) are reused'.format(
+            ACCUMULATORS_DIRNAME))
+    parser.add_argument(
+        '--trace',
+        dest='trace_path',
+        help='write a timeline of the pipeline stages to this file, in the'
+        ' Chrome trace event format (opens in Perfetto or'
+        ' chrome://tracing)')
+    add_processing_arguments(parser)
     # parse all arguments
     args = parser.parse_args()
+    if args.preview:
+        if args.preview_factor < 1:
+            parser.error('the preview factor must be a positive integer')
+        if args.outputs is None:
+            args.outputs = ['rs']
+        args.keep_intermediates = 'none'
+        # the preview volumes are already downsampled
+        args.qc_subsample = 1
+        if args.incremental is not None:
+            parser.error('--incremental cannot be used with --preview')
+    try:
+        slab_grid = slab_grid_from_args(args)
+        check_slab_grid(slab_grid)
+        resolve_outputs(args.outputs, grid_repetitions(slab_grid))
+    except ValueError as exc:
+        parser.error(str(exc))
 
     # store usage message in string
     cli_usage = None
@@ -97,6 +512,259 @@ def read_cli_args():
     return args, cli_usage
 
 
+def read_batch_cli_args(argv):
+    """Read batch command-line interface arguments
+
+    Parse the arguments given after 'recombine.py batch'.
+
+    Args:
+        argv (list of strings): command-line arguments, without the
+            program name and the 'batch' command
+
+    Returns:
+        args (argparse.Namespace): parsed arguments
+        cli_usage (string): command-line interface usage message
+    """
+    cli_description = 'Recombine the slabs of several subjects'
+    parser = argparse.ArgumentParser(
+        prog='recombine.py batch', description=cli_description)
+    # add arguments
+    #-- mandatory arguments
+    #---- subjects
+    parser.add_argument(
+        'input_path',
+        metavar='input',
+        help='CSV manifest (columns subject, lowres, rep[r]s[s] for slab s'
+        ' of repetition r, e.g. rep1s1, rep1s2, rep2s1, rep2s2, and'
+        ' optionally outdir) or BIDS-style directory')
+    #---- output dir
+    parser.add_argument(
+        'outdir_path',
+        metavar='out_dir',
+        help='path where the output dir of each subject ([out_dir]/'
+        '[subject]), the subject logs and the batch summary are stored')
+    #-- optional arguments
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='maximum number of subjects processed in parallel.'
+        ' Default: 1')
+    parser.add_argument(
+        '--memory-budget',
+        type=int,
+        help='memory (in MB) available to the subjects running at the same'
+        ' time. Subjects are only started if the sum of their estimated'
+        ' peak memory fits. Default: no limit')
+    parser.add_argument(
+        '--cpu-budget',
+        type=float,
+        help='number of CPUs available to the subjects running at the'
+        ' same time. Default: no limit')
+    add_processing_arguments(parser)
+    # parse all arguments
+    args = parser.parse_args(argv)
+
+    # store usage message in string
+    cli_usage = parser.format_usage()
+
+    return args, cli_usage
+
+
+def read_submit_cli_args(argv):
+    """Read queue submission command-line interface arguments
+
+    Parse the arguments given after 'recombine.py submit'.
+
+    Args:
+        argv (list of strings): command-line arguments, without the
+            program name and the 'submit' command
+
+    Returns:
+        args (argparse.Namespace): parsed arguments
+    """
+    cli_description = 'Add subjects to a work queue on a shared file system'
+    parser = argparse.ArgumentParser(
+        prog='recombine.py submit', description=cli_description)
+    parser.add_argument(
+        'queue_path',
+        metavar='queue_dir',
+        help='work queue folder, shared by the workers')
+    parser.add_argument(
+        'input_path',
+        metavar='input',
+        help='CSV manifest or BIDS-style directory (see recombine.py'
+        ' batch)')
+    parser.add_argument(
+        'outdir_path',
+        metavar='out_dir',
+        help='path where the output dir of each subject ([out_dir]/'
+        '[subject]) is stored')
+
+    return parser.parse_args(argv)
+
+
+def read_worker_cli_args(argv):
+    """Read queue worker command-line interface arguments
+
+    Parse the arguments given after 'recombine.py worker'.
+
+    Args:
+        argv (list of strings): command-line arguments, without the
+            program name and the 'worker' command
+
+    Returns:
+        args (argparse.Namespace): parsed arguments
+        cli_usage (string): command-line interface usage message
+    """
+    cli_description = 'Recombine the subjects of a work queue on a shared'
+    cli_description = '{0} file system'.format(cli_description)
+    parser = argparse.ArgumentParser(
+        prog='recombine.py worker', description=cli_description)
+    parser.add_argument(
+        'queue_path',
+        metavar='queue_dir',
+        help='work queue folder, shared by the workers')
+    parser.add_argument(
+        '--lease-timeout',
+        type=float,
+        default=work_queue.DEFAULT_LEASE_TIMEOUT,
+        help='time (in seconds) after which the job of a silent worker'
+        ' goes back to the queue. Default: {0}'.format(
+            work_queue.DEFAULT_LEASE_TIMEOUT))
+    parser.add_argument(
+        '--max-attempts',
+        type=int,
+        default=work_queue.DEFAULT_MAX_ATTEMPTS,
+        help='number of times a job is started before it is considered'
+        ' failed. Default: {0}'.format(work_queue.DEFAULT_MAX_ATTEMPTS))
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=work_queue.DEFAULT_POLL_INTERVAL,
+        help='time (in seconds) between two polls of the queue when no'
+        ' job is pending. Default: {0}'.format(
+            work_queue.DEFAULT_POLL_INTERVAL))
+    parser.add_argument(
+        '--wait',
+        action='store_true',
+        help='keep waiting for new jobs once the queue is empty')
+    add_processing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    return args, parser.format_usage()
+
+
+def read_serve_cli_args(argv):
+    """Read service command-line interface arguments
+
+    Parse the arguments given after 'recombine.py serve'.
+
+    Args:
+        argv (list of strings): command-line arguments, without the
+            program name and the 'serve' command
+
+    Returns:
+        args (argparse.Namespace): parsed arguments
+        cli_usage (string): command-line interface usage message
+    """
+    cli_description = 'Recombination service: accept recombination jobs over'
+    cli_description = '{0} HTTP and run them on warm worker processes'.format(
+        cli_description)
+    parser = argparse.ArgumentParser(
+        prog='recombine.py serve', description=cli_description)
+    parser.add_argument(
+        'logdir_path',
+        metavar='log_dir',
+        help='path where the log of each job is stored')
+    parser.add_argument(
+        '--host',
+        default=service.DEFAULT_HOST,
+        help='address to listen on. Default: {0}'.format(
+            service.DEFAULT_HOST))
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=service.DEFAULT_PORT,
+        help='TCP port to listen on. Default: {0}'.format(
+            service.DEFAULT_PORT))
+    parser.add_argument(
+        '--socket',
+        dest='socket_path',
+        help='Unix socket to listen on instead of a TCP port')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of jobs processed in parallel. Default: 1')
+    add_processing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    return args, parser.format_usage()
+
+
+def read_watch_cli_args(argv):
+    """Read watch folder command-line interface arguments
+
+    Parse the arguments given after 'recombine.py watch'.
+
+    Args:
+        argv (list of strings): command-line arguments, without the
+            program name and the 'watch' command
+
+    Returns:
+        args (argparse.Namespace): parsed arguments
+        cli_usage (string): command-line interface usage message
+    """
+    cli_description = 'Watch a folder and recombine the slabs of each'
+    cli_description = '{0} subject as they land'.format(cli_description)
+    parser = argparse.ArgumentParser(
+        prog='recombine.py watch', description=cli_description)
+    parser.add_argument(
+        'watch_path',
+        metavar='watch_dir',
+        help='folder where the inputs land')
+    parser.add_argument(
+        'outdir_path',
+        metavar='out_dir',
+        help='path where the output dir of each subject ([out_dir]/'
+        '[subject]) is stored')
+    parser.add_argument(
+        '--pattern',
+        default=watch_folder.DEFAULT_NAME_PATTERN,
+        help='regular expression matched against the file names, with'
+        ' the named groups subject and role (rep1s1, rep1s2, rep2s1,'
+        ' rep2s2 or lowres). Default: {0}'.format(
+            watch_folder.DEFAULT_NAME_PATTERN.replace('%', '%%')))
+    parser.add_argument(
+        '--stable-seconds',
+        type=float,
+        default=watch_folder.DEFAULT_STABLE_SECONDS,
+        help='time (in seconds) during which a file must not change'
+        ' before it is processed. Default: {0}'.format(
+            watch_folder.DEFAULT_STABLE_SECONDS))
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=watch_folder.DEFAULT_POLL_INTERVAL,
+        help='time (in seconds) between two polls of the watched folder.'
+        ' Default: {0}'.format(watch_folder.DEFAULT_POLL_INTERVAL))
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=2,
+        help='number of inputs pre-processed in parallel. Default: 2')
+    parser.add_argument(
+        '--idle-timeout',
+        type=float,
+        help='stop once no subject is in progress and no input has'
+        ' landed for this time (in seconds). Default: watch forever')
+    add_processing_arguments(parser)
+    args = parser.parse_args(argv)
+
+    return args, parser.format_usage()
+
+
 def check_spm_available(args, cli_usage):
     """Check SPM can be found by Matlab
 
@@ -200,22 +868,62 @@ def check_spm_available(args, cli_usage):
     return spm_path
 
 
-def prepare_folders(outdir_path):
+def prepare_registration(args, cli_usage):
+    """Check the registration backend can be used
+
+    Args:
+        args (argparse.Namespace): parsed arguments
+        cli_usage (string): command-line interface usage message
+
+    Returns:
+        spm_path (string): path to SPM folder (see
+            check_spm_available). None if the backend does not use SPM.
+    """
+    if args.registration == 'replay':
+        # fail early if the transforms cannot be read
+        read_registration_transforms(args.registration_transforms)
+    if REGISTRATION_BACKENDS[args.registration].needs_spm:
+        return check_spm_available(args, cli_usage)
+
+    return None
+
+def default_scratch_path():
+    """Default scratch folder
+
+    Args:
+        N/A
+
+    Returns:
+        scratch_path (string): $TMPDIR if defined, system temporary
+            folder otherwise
+    """
+    return os.environ.get('TMPDIR') or tempfile.gettempdir()
+
+
+def prepare_folders(outdir_path, scratch_path=None):
     """Create temporary folders
 
-    Will create two subfolders inside the output directory:
+    Will create a working directory, and two subfolders inside it:
     1. 'debug' subfolder: contains all intermediary images generated
         prior to te output recombined images
     2. 'temp' subfolder: contains all temporary data generated for SPM
         processing (SPM modifies the header of the images which it is
         working on, so we duplicate the image to be SPM-processed
         before feeding them to SPM).
+    The working directory is a new folder inside the scratch folder if
+    one is provided, or the output directory otherwise. Results stored
+    in a scratch working directory get moved to the output directory by
+    commit_outputs once the recombination is complete.
 
     Args:
         outdir_path (string): absolute path to output dir, where
             results will get stored
+        scratch_path (string): path to a scratch folder (e.g., local
+            disk or /dev/shm) where the working directory gets created.
+            None to work directly inside the output directory.
 
     Returns:
+        workdir_path (string): path to working directory
         debugdir_path (string): path to 'debug' subfolder where all
             intermediary images are stored
         tempdir_path (string): path to temporary subfolder where images
@@ -231,9 +939,18 @@ def prepare_folders(outdir_path):
         # create the output directory
         os.makedirs(outdir_path)
 
+    # working directory
+    if scratch_path is None:
+        workdir_path = outdir_path
+    else:
+        if not os.path.isdir(scratch_path):
+            raise IOError(
+                'scratch folder {0} does not exist'.format(scratch_path))
+        workdir_path = tempfile.mkdtemp(prefix='recombine_', dir=scratch_path)
+
     # define paths
-    debugdir_path = "{0}/debug/".format(outdir_path)
-    tempdir_path = "{0}/temp/".format(outdir_path)
+    debugdir_path = "{0}/debug/".format(workdir_path)
+    tempdir_path = "{0}/temp/".format(workdir_path)
 
     # create subfolders if do not exist already
     #-- debug
@@ -249,7 +966,70 @@ def prepare_folders(outdir_path):
         if not os.path.isdir(tempdir_path):
             raise
 
-    return [debugdir_path, tempdir_path]
+    return [workdir_path, debugdir_path, tempdir_path]
+
+
+@instrumentation.staged
+def commit_outputs(workdir_path, outdir_path):
+    """Move results from the working directory to the output directory
+
+    Every file and folder of the working directory is moved to the
+    output directory and the working directory is removed. Each result
+    appears atomically in the output directory: it is first copied to a
+    hidden staging path next to its destination (if the working
+    directory is on another file system), then renamed.
+
+    Args:
+        workdir_path (string): path to working directory
+        outdir_path (string): absolute path to output dir, where
+            results will get stored
+
+    Returns:
+        N/A
+    """
+    if os.path.realpath(workdir_path) == os.path.realpath(outdir_path):
+        # results already in the output directory
+        return
+    for name in sorted(os.listdir(workdir_path)):
+        work_path = os.path.join(workdir_path, name)
+        out_path = os.path.join(outdir_path, name)
+        if os.path.exists(out_path):
+            raise IOError('{0} already exists'.format(out_path))
+        try:
+            # same file system: atomic rename
+            os.rename(work_path, out_path)
+        except OSError:
+            # other file system: copy next to the destination, then
+            # rename
+            staging_path = os.path.join(
+                outdir_path, '.{0}.partial'.format(name))
+            # left behind by a previous run that failed while copying
+            remove_staging_path(staging_path)
+            try:
+                if os.path.isdir(work_path):
+                    shutil.copytree(work_path, staging_path)
+                else:
+                    shutil.copyfile(work_path, staging_path)
+                os.rename(staging_path, out_path)
+            except Exception:
+                remove_staging_path(staging_path)
+                raise
+    shutil.rmtree(workdir_path)
+
+
+def remove_staging_path(staging_path):
+    """Remove a staging file or folder, if it exists
+
+    Args:
+        staging_path (string): path to the staging file or folder
+
+    Returns:
+        N/A
+    """
+    if os.path.isdir(staging_path) and not os.path.islink(staging_path):
+        shutil.rmtree(staging_path)
+    elif os.path.lexists(staging_path):
+        os.remove(staging_path)
 
 
 def spm_path_filestore(debugdir_path, spm_path):
@@ -286,6 +1066,42 @@ def spm_path_filestore(debugdir_path, spm_path):
         spm_path_store_file.write(spm_path)
 
 
+def take_prefetched(im_inpath):
+    """Take the decompressed content of a prefetched input
+
+    Args:
+        im_inpath (string): path to the input image
+
+    Returns:
+        raw (bytes): decompressed content of the image (see
+            prefetch.InputPrefetcher.take). None if the inputs are not
+            prefetched, or if this one was not
+    """
+    if INPUT_PREFETCHER is None:
+        return None
+
+    return INPUT_PREFETCHER.take(im_inpath)
+
+
+def volume_from_bytes(raw):
+    """Decode a NIfTI volume from the content of a .nii file
+
+    Args:
+        raw (bytes): content of a NIfTI-1 or NIfTI-2 .nii file
+
+    Returns:
+        volume (nibabel volume): volume, with its data read from raw
+    """
+    # the header size tells NIfTI-1 and NIfTI-2 apart, in either byte
+    # order
+    for volume_class in [nib.Nifti1Image, nib.Nifti2Image]:
+        sizeof_hdr = volume_class.header_class.sizeof_hdr
+        if raw[:4] in [
+                struct.pack('<i', sizeof_hdr), struct.pack('>i', sizeof_hdr)]:
+            return volume_class.from_bytes(raw)
+    raise IOError('input image must be a NIfTI volume')
+
+
 def nii_copy(im_inpath, im_outpath):
     """Copy from input to output path with output in .nii
 
@@ -316,58 +1132,641 @@ def nii_copy(im_inpath, im_outpath):
         imfilename_start_ext = os.path.splitext(imfilename_start)[1]
         if imfilename_start_ext == '.nii':
             # extension is .nii.gz
-            with gzip.open(im_inpath, 'rb') as im_infile:
-                with open(im_outpath, 'wb') as im_outfile:
-                    shutil.copyfileobj(im_infile, im_outfile)
+            raw = take_prefetched(im_inpath)
+            if raw is not None:
+                # already decompressed in the background
+                with instrumentation.stage('write', 'io'):
+                    with open(im_outpath, 'wb') as im_outfile:
+                        im_outfile.write(raw)
+            else:
+                with instrumentation.stage('gunzip', 'io'):
+                    with gzip.open(im_inpath, 'rb') as im_infile:
+                        with open(im_outpath, 'wb') as im_outfile:
+                            shutil.copyfileobj(im_infile, im_outfile)
         else:
             raise IOError(error_msg)
     else:
         raise IOError(error_msg)
+    if imfilename_ext == '.gz':
+        count_bytes_read(im_inpath, os.path.getsize(im_outpath))
+    else:
+        count_bytes_read(im_inpath)
+    count_bytes_written(im_outpath)
 
 
-def safe_remove(impath, dirpath):
-    """Check if image is in right folder before removing
+def canonical_volume(in_volume):
+    """Get volume in canonical orientation
 
-    Make sure the image to be removed is located somewhere within the
-    subfolder hierarchy of a defined folder (i.e., temporary folder or
-    folder containing the intermediary results).
-    This is mostly to ensure avoiding any accidental deletion anywhere
-    outside the working directory.
+    Reorient the volume to the closest canonical orientation ('RAS')
+    unless it has already been tagged as canonical. Volumes that are
+    already in RAS orientation are tagged and returned as is. Every
+    reorientation copy is counted in the instrumentation counter
+    'reorientation_copies'.
 
     Args:
-        impath (string): path to the image to delete.
-        dirpath (string): path to folder containing the image to be
-            deleted
+        in_volume (nibabel volume): data will be a [m,n,o] array
 
     Returns:
-        N/A
+        out_volume (nibabel volume): volume in RAS orientation, tagged
+            as canonical
     """
-    # get absolute path + real (i.e., actual path for symlinks)
-    impath_real = os.path.realpath(impath)
-    dirpath_real = os.path.realpath(dirpath)
-    dirpath_real_sep = "{0}{1}".format(dirpath_real, os.sep)
-
-    # check if the path to image encompasses the path to folder
-    if not impath_real.startswith(dirpath_real_sep):
-        error_msg = 'impath {0}'.format(impath)
-        error_msg = '{0} does not belong to dirpath {1}.'.format(
-            error_msg, dirpath)
-        error_msg = '{0} Cannot safely remove.'.format(error_msg)
-        raise IOError(error_msg)
-
-    # remove the image file
-    if os.path.isfile(impath_real):
-        os.remove(impath_real)
+    if in_volume.extra.get(CANONICAL_TAG):
+        return in_volume
+    if nib.aff2axcodes(in_volume.affine) == ('R', 'A', 'S'):
+        out_volume = in_volume
     else:
-        error_msg = 'Error: file {0} does not exist'.format(impath)
-        raise IOError(error_msg)
+        out_volume = nib.as_closest_canonical(in_volume)
+        instrumentation.increment_counter('reorientation_copies')
 
+    return tag_canonical(out_volume)
 
-def volume_duplication(in_volume, duplication_factor, axis):
-    """Replicate voxels along a chosen axis
 
-    Will replicate voxels a certain number of times
-    (duplication_factor) along any of the 'x', 'y' or 'z' axis.
+def tag_canonical(volume):
+    """Tag volume as being in canonical orientation
+
+    The volume itself is left untouched, since it may be shared (e.g.,
+    by the volume cache): the tag is set on a new volume sharing its
+    data, affine and header.
+
+    Args:
+        volume (nibabel volume): volume in RAS orientation
+
+    Returns:
+        tagged_volume (nibabel volume): copy of the volume, tagged as
+            canonical
+    """
+    tagged_volume = volume.__class__(
+        volume.dataobj, volume.affine, volume.header,
+        extra=dict(volume.extra))
+    tagged_volume.extra[CANONICAL_TAG] = True
+
+    return tagged_volume
+
+
+def nii_canonical_copy(im_inpath, im_outpath):
+    """Copy from input to output path in canonical orientation
+
+    Same as nii_copy, but the copied image is reoriented to the closest
+    canonical orientation ('RAS') if needed. This way, images only get
+    reoriented once, when they enter the pipeline.
+
+    Args:
+        im_inpath (string): path to the input image. The file can be
+            either of type .nii or of type .nii.gz
+        im_outpath (string): path to the output copied image. The file
+            is of type .nii
+
+    Returns:
+        N/A
+    """
+    # only the header is read to check the orientation
+    in_volume = nib.load(im_inpath)
+    if nib.aff2axcodes(in_volume.affine) == ('R', 'A', 'S'):
+        # already canonical: plain copy
+        nii_copy(im_inpath, im_outpath)
+    else:
+        raw = take_prefetched(im_inpath)
+        if raw is not None:
+            in_volume = volume_from_bytes(raw)
+        out_volume = canonical_volume(in_volume)
+        with instrumentation.stage('nib.save', 'io'):
+            nib.save(out_volume, im_outpath)
+        if im_inpath.endswith('.gz'):
+            count_bytes_read(im_inpath, os.path.getsize(im_outpath))
+        else:
+            count_bytes_read(im_inpath)
+        count_bytes_written(im_outpath)
+
+
+def safe_remove(impath, dirpath):
+    """Check if image is in right folder before removing
+
+    Make sure the image to be removed is located somewhere within the
+    subfolder hierarchy of a defined folder (i.e., temporary folder or
+    folder containing the intermediary results).
+    This is mostly to ensure avoiding any accidental deletion anywhere
+    outside the working directory.
+
+    Args:
+        impath (string): path to the image to delete.
+        dirpath (string): path to folder containing the image to be
+            deleted
+
+    Returns:
+        N/A
+    """
+    # get absolute path + real (i.e., actual path for symlinks)
+    impath_real = os.path.realpath(impath)
+    dirpath_real = os.path.realpath(dirpath)
+    dirpath_real_sep = "{0}{1}".format(dirpath_real, os.sep)
+
+    # check if the path to image encompasses the path to folder
+    if not impath_real.startswith(dirpath_real_sep):
+        error_msg = 'impath {0}'.format(impath)
+        error_msg = '{0} does not belong to dirpath {1}.'.format(
+            error_msg, dirpath)
+        error_msg = '{0} Cannot safely remove.'.format(error_msg)
+        raise IOError(error_msg)
+
+    # remove the image file
+    if os.path.isfile(impath_real):
+        os.remove(impath_real)
+        VOLUME_CACHE.invalidate(impath_real)
+    else:
+        error_msg = 'Error: file {0} does not exist'.format(impath)
+        raise IOError(error_msg)
+
+
+def remove_images(impath_list, dirpath):
+    """Remove all images in a list
+
+    Used to remove intermediary images as soon as they are no longer
+    needed, when they are not to be kept.
+
+    Args:
+        impath_list (list of strings): list of paths to the images that
+            will be removed
+        dirpath (string): path to folder containing the images to be
+            deleted (see safe_remove)
+
+    Returns:
+        N/A
+    """
+    for impath in impath_list:
+        safe_remove(impath, dirpath)
+
+
+def count_bytes_written(impath):
+    """Add the size of a file that has just been written to the
+    'bytes_written' instrumentation counter
+
+    Args:
+        impath (string): path to the written file
+
+    Returns:
+        N/A
+    """
+    instrumentation.increment_counter(
+        'bytes_written', os.path.getsize(impath))
+    sample_disk_usage(impath)
+
+
+def track_disk_usage(workdir_path):
+    """Start measuring the peak disk usage of a working directory
+
+    The size of the working directory is then sampled after each write
+    of a file it contains (see count_bytes_written), so that the peak
+    reached within each part of the algorithm is measured.
+
+    Args:
+        workdir_path (string): path to the working directory
+
+    Returns:
+        N/A
+    """
+    with DISK_USAGE_LOCK:
+        DISK_USAGE_PEAKS[os.path.realpath(workdir_path)] = \
+            directory_size(workdir_path)
+
+
+def sample_disk_usage(impath):
+    """Update the peak disk usage of the working directory of a file
+
+    Args:
+        impath (string): path to a file that has just been written
+
+    Returns:
+        N/A
+    """
+    impath_real = os.path.realpath(impath)
+    with DISK_USAGE_LOCK:
+        for workdir_real in DISK_USAGE_PEAKS:
+            if impath_real.startswith('{0}{1}'.format(workdir_real, os.sep)):
+                DISK_USAGE_PEAKS[workdir_real] = max(
+                    DISK_USAGE_PEAKS[workdir_real],
+                    directory_size(workdir_real))
+
+
+def pop_disk_usage_peak(workdir_path):
+    """Stop measuring the peak disk usage of a working directory
+
+    Args:
+        workdir_path (string): path to the working directory
+
+    Returns:
+        disk_usage_peak (int): peak disk usage measured since
+            track_disk_usage was called (current disk usage if it was
+            not), in bytes
+    """
+    with DISK_USAGE_LOCK:
+        disk_usage_peak = DISK_USAGE_PEAKS.pop(
+            os.path.realpath(workdir_path), 0)
+        if os.path.isdir(workdir_path):
+            disk_usage_peak = max(
+                disk_usage_peak, directory_size(workdir_path))
+
+    return disk_usage_peak
+
+
+def count_bytes_read(impath, decompressed_bytes=0):
+    """Add the size of a file that has just been read to the
+    'bytes_read' instrumentation counter
+
+    Args:
+        impath (string): path to the read file
+        decompressed_bytes (int): size of the data decompressed from
+            the file (.nii.gz files), added to the 'bytes_decompressed'
+            instrumentation counter
+
+    Returns:
+        N/A
+    """
+    instrumentation.increment_counter('bytes_read', os.path.getsize(impath))
+    if decompressed_bytes:
+        instrumentation.increment_counter(
+            'bytes_decompressed', decompressed_bytes)
+
+
+def directory_size(dirpath):
+    """Total size of the files in a folder and its subfolders
+
+    Args:
+        dirpath (string): path to folder
+
+    Returns:
+        size (int): size in bytes
+    """
+    size = 0
+    for root, dummy, filename_list in os.walk(dirpath):
+        for filename in filename_list:
+            filepath = os.path.join(root, filename)
+            if os.path.isfile(filepath):
+                size += os.path.getsize(filepath)
+
+    return size
+
+
+class SparseGzipFile(io.RawIOBase):
+    """Write-only gzip file that skips compressing empty blocks
+
+    Registered slabs and phantoms are mostly made of zeros. Data written
+    to this file is cut into blocks of GZIP_BLOCK_SIZE bytes. Blocks
+    that only contain zeros are replaced by a pre-compressed copy of an
+    empty block instead of being compressed again. The compressor is
+    fully flushed before each empty block, so the result is a standard
+    gzip file that can be read by gzip, nibabel or any other tool.
+
+    Args:
+        path (string): path to the output .gz file
+        compresslevel (int): gzip compression level (1-9)
+        block_size (int): size of the blocks, in bytes
+    """
+
+    # pre-compressed empty blocks, keyed by (block size, level)
+    zero_block_cache = {}
+
+    def __init__(
+            self,
+            path,
+            compresslevel=GZIP_COMPRESSLEVEL,
+            block_size=GZIP_BLOCK_SIZE):
+        super(SparseGzipFile, self).__init__()
+        self.name = path
+        self.block_size = block_size
+        self.zero_block = bytes(block_size)
+        self.zero_block_compressed = self.get_zero_block_compressed(
+            block_size, compresslevel)
+        self.compressor = zlib.compressobj(
+            compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.pending = bytearray()
+        self.crc = 0
+        self.size = 0
+        self.flushed = True
+        self.fileobj = None
+        self.fileobj = open(path, 'wb')
+        # gzip header: magic, deflate, no flags, mtime, no extra flags,
+        # unknown OS
+        self.fileobj.write(b'\x1f\x8b\x08\x00')
+        self.fileobj.write(struct.pack('<I', int(time.time())))
+        self.fileobj.write(b'\x00\xff')
+
+    @classmethod
+    def get_zero_block_compressed(cls, block_size, compresslevel):
+        """Compress an empty block once and cache the result
+
+        The compressed stream ends with a full flush, so it does not
+        refer to any previous data and can be inserted anywhere between
+        two fully flushed blocks.
+
+        Args:
+            block_size (int): size of the empty block, in bytes
+            compresslevel (int): gzip compression level (1-9)
+
+        Returns:
+            zero_block_compressed (bytes): raw deflate data
+        """
+        key = (block_size, compresslevel)
+        if key not in cls.zero_block_cache:
+            compressor = zlib.compressobj(
+                compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+            zero_block_compressed = compressor.compress(bytes(block_size))
+            zero_block_compressed += compressor.flush(zlib.Z_FULL_FLUSH)
+            cls.zero_block_cache[key] = zero_block_compressed
+        return cls.zero_block_cache[key]
+
+    def write_block(self, block):
+        """Compress a block and write it to the output file
+
+        Args:
+            block (bytes): block of uncompressed data
+
+        Returns:
+            N/A
+        """
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        if len(block) == self.block_size and block == self.zero_block:
+            # empty block: reset the compressor and reuse the
+            # pre-compressed empty block
+            if not self.flushed:
+                self.fileobj.write(self.compressor.flush(zlib.Z_FULL_FLUSH))
+                self.flushed = True
+            self.fileobj.write(self.zero_block_compressed)
+        else:
+            self.fileobj.write(self.compressor.compress(block))
+            self.flushed = False
+
+    def write(self, data):
+        """Write uncompressed data
+
+        Args:
+            data (bytes-like): uncompressed data
+
+        Returns:
+            length (int): number of bytes written
+        """
+        data = memoryview(data).cast('B')
+        length = len(data)
+        start = 0
+        if self.pending:
+            # complete the pending block first
+            start = min(self.block_size-len(self.pending), length)
+            self.pending += data[:start]
+            if len(self.pending) < self.block_size:
+                return length
+            self.write_block(bytes(self.pending))
+            self.pending = bytearray()
+        while length-start >= self.block_size:
+            self.write_block(data[start:start+self.block_size].tobytes())
+            start += self.block_size
+        self.pending += data[start:]
+        return length
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        """Current position in the uncompressed stream"""
+        return self.size+len(self.pending)
+
+    def seek(self, offset, whence=0):
+        """Seek forward in the uncompressed stream
+
+        Only forward seeks are supported. The gap is filled with zeros.
+
+        Args:
+            offset (int): position to seek to
+            whence (int): only 0 (absolute position) is supported
+
+        Returns:
+            position (int): new position in the uncompressed stream
+        """
+        position = self.tell()
+        if whence != 0 or offset < position:
+            raise IOError('SparseGzipFile can only seek forward')
+        if offset > position:
+            self.write(bytes(offset-position))
+        return offset
+
+    def close(self):
+        """Write the last block and the gzip trailer, and close the file
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        if self.closed or self.fileobj is None:
+            return
+        try:
+            if self.pending:
+                self.write_block(bytes(self.pending))
+                self.pending = bytearray()
+            self.fileobj.write(self.compressor.flush(zlib.Z_FINISH))
+            self.fileobj.write(struct.pack(
+                '<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.fileobj.close()
+            super(SparseGzipFile, self).close()
+
+
+def set_intermediate_format(intermediate_format):
+    """Set the file format of the intermediary images
+
+    Args:
+        intermediate_format (string): 'nii' or 'nii.gz' (see
+            INTERMEDIATE_FORMAT_CHOICES)
+
+    Returns:
+        N/A
+    """
+    global INTERMEDIATE_FORMAT
+    if intermediate_format not in INTERMEDIATE_FORMAT_CHOICES:
+        raise ValueError(
+            'unknown intermediate format {0}'.format(intermediate_format))
+    INTERMEDIATE_FORMAT = intermediate_format
+
+
+def set_output_encoding(output_dtype, output_format, compresslevel):
+    """Set the encoding of the final outputs
+
+    Args:
+        output_dtype (string): data type (see OUTPUT_DTYPE_CHOICES)
+        output_format (string): file format (see OUTPUT_FORMAT_CHOICES)
+        compresslevel (int): gzip compression level (1-9)
+
+    Returns:
+        N/A
+    """
+    global OUTPUT_DTYPE, OUTPUT_FORMAT, OUTPUT_COMPRESSLEVEL
+    if output_dtype not in OUTPUT_DTYPE_CHOICES:
+        raise ValueError('unknown output data type {0}'.format(output_dtype))
+    if output_format not in OUTPUT_FORMAT_CHOICES:
+        raise ValueError('unknown output format {0}'.format(output_format))
+    if compresslevel not in range(1, 10):
+        raise ValueError(
+            'invalid compression level {0}'.format(compresslevel))
+    OUTPUT_DTYPE = output_dtype
+    OUTPUT_FORMAT = output_format
+    OUTPUT_COMPRESSLEVEL = compresslevel
+
+
+def set_preview(preview_factor):
+    """Set the preview mode
+
+    Args:
+        preview_factor (int): downsampling factor of the inputs (see
+            prepare_preview). None for a full resolution run
+
+    Returns:
+        N/A
+    """
+    global PREVIEW_FACTOR
+    if preview_factor is not None and preview_factor < 1:
+        raise ValueError(
+            'invalid preview factor {0}'.format(preview_factor))
+    PREVIEW_FACTOR = preview_factor
+
+
+def intermediate_path(dirpath, name):
+    """Path to an intermediary image
+
+    The extension depends on the intermediate format, so that the
+    processing steps do not need to know which format is used.
+    load_volume and save_volume handle both formats.
+
+    Args:
+        dirpath (string): folder where the image is stored
+        name (string): name of the image, without extension
+
+    Returns:
+        impath (string): path to the image
+    """
+    return os.path.join(dirpath, '{0}.{1}'.format(name, INTERMEDIATE_FORMAT))
+
+
+@instrumentation.staged
+def load_volume(in_volume_path):
+    """Load volume from file
+
+    Same as nib.load, except that:
+    - volumes kept in the in-memory volume cache (e.g., written shortly
+        before by save_volume, whatever their format) are returned
+        without reading the file
+    - otherwise, uncompressed .nii files are memory-mapped read-only,
+        so that the data is read from the page cache without any copy.
+        They are not added to the cache (the page cache already holds
+        them)
+    - otherwise, the data array of .nii.gz files is read at once (or
+        taken from the input prefetcher, if it was decompressed in the
+        background) and the volume is kept in the in-memory volume
+        cache, so that reading the same file again does not decompress
+        it again.
+
+    Args:
+        in_volume_path (string): path to input volume
+
+    Returns:
+        in_volume (nibabel volume): volume, with its data in memory or
+            memory-mapped. Must not be modified in place, as it may be
+            shared with other readers of the same file.
+    """
+    # cache entries are dropped if the file has been modified since
+    # (e.g., overwritten by SPM)
+    in_volume = VOLUME_CACHE.get(in_volume_path)
+    if in_volume is not None:
+        return in_volume
+    if in_volume_path.endswith('.nii'):
+        # no decompression needed: memory map
+        count_bytes_read(in_volume_path)
+        return nib.load(in_volume_path, mmap='r')
+    raw = take_prefetched(in_volume_path)
+    with instrumentation.stage('gunzip', 'io'):
+        if raw is None:
+            in_volume = nib.load(in_volume_path)
+        else:
+            # already decompressed in the background
+            in_volume = volume_from_bytes(raw)
+        in_volume.get_data()
+    count_bytes_read(
+        in_volume_path,
+        int(in_volume.header.get_data_offset()) +
+        int(np.prod(in_volume.shape)) *
+        in_volume.get_data_dtype().itemsize)
+    VOLUME_CACHE.put(in_volume_path, in_volume)
+
+    return in_volume
+
+
+@instrumentation.staged
+def save_volume(out_volume, out_volume_path, compresslevel=GZIP_COMPRESSLEVEL):
+    """Save volume to file
+
+    Same as nib.save, except that .nii.gz files are written with the
+    sparse gzip writer so that empty blocks are not compressed again.
+    The saved volume (.nii or .nii.gz) is kept in the in-memory volume
+    cache, with the affine stored in the file (see written_volume), so
+    that reading it back (see load_volume) does not touch the file.
+
+    Args:
+        out_volume (nibabel volume): volume to save
+        out_volume_path (string): path to output volume. .nii or .nii.gz
+        compresslevel (int): gzip compression level (1-9) of .nii.gz
+            files
+
+    Returns:
+        N/A
+    """
+    if out_volume_path.endswith('.nii.gz'):
+        with instrumentation.stage('gzip', 'io'), \
+                SparseGzipFile(
+                    out_volume_path, compresslevel) as out_volume_file:
+            out_volume.to_file_map(
+                {'image': FileHolder(fileobj=out_volume_file)})
+    else:
+        with instrumentation.stage('nib.save', 'io'):
+            nib.save(out_volume, out_volume_path)
+    count_bytes_written(out_volume_path)
+    # only cache the volume if reading the file back gives the same
+    # data array (i.e., no type conversion or scaling on save)
+    if out_volume.get_data_dtype() == out_volume.get_data().dtype and \
+            out_volume.header.get_slope_inter()[0] in [None, 1.0]:
+        VOLUME_CACHE.put(out_volume_path, written_volume(out_volume))
+    else:
+        VOLUME_CACHE.invalidate(out_volume_path)
+
+
+def written_volume(out_volume):
+    """Volume as read back from the file it was saved to
+
+    The header of a file stores the affine in single precision: reading
+    the file back gives a slightly different affine than the one of the
+    volume in memory. The volume kept in the cache must have the
+    geometry of the file, so that using the cache does not change the
+    results.
+
+    Args:
+        out_volume (nibabel volume): saved volume
+
+    Returns:
+        written_volume (nibabel volume): volume sharing the data of
+            out_volume, with the affine stored in its header
+    """
+    out_volume.update_header()
+    header = out_volume.header
+
+    return out_volume.__class__(
+        out_volume.dataobj, header.get_best_affine(), header,
+        extra=dict(out_volume.extra))
+
+
+@instrumentation.staged
+def volume_duplication(in_volume, duplication_factor, axis):
+    """Replicate voxels along a chosen axis
+
+    Will replicate voxels a certain number of times
+    (duplication_factor) along any of the 'x', 'y' or 'z' axis.
 
     Args:
         in_volume (nibabel volume): data will be a [m,n,o] array
@@ -383,9 +1782,9 @@ def volume_duplication(in_volume, duplication_factor, axis):
     """
     # read input volume
     #-- convert to RAS orientation
-    in_volume_ras = nib.as_closest_canonical(in_volume)
+    in_volume_ras = canonical_volume(in_volume)
     in_volume_data = in_volume_ras.get_data()
-    in_volume_affine = in_volume_ras.affine.copy()
+    in_volume_affine = in_volume_ras.affine
 
     # get output matrix affine
     #-- define upsampling factor for all directions
@@ -407,7 +1806,7 @@ def volume_duplication(in_volume, duplication_factor, axis):
         in_volume_ras,
         target_affine=out_volume_affine3x3,
         interpolation='nearest')
-    out_volume_affine = volume_upsampled.affine.copy()
+    out_volume_affine = volume_upsampled.affine
 
     # data array: duplicate according to direction
     if axis == 'x':
@@ -418,11 +1817,63 @@ def volume_duplication(in_volume, duplication_factor, axis):
         out_volume_data = np.repeat(in_volume_data, duplication_factor, axis=2)
 
     # save output volume
-    out_volume = nib.Nifti1Image(out_volume_data, out_volume_affine)
+    out_volume = tag_canonical(
+        nib.Nifti1Image(out_volume_data, out_volume_affine))
+
+    return out_volume
+
+
+@instrumentation.staged
+def downsample_volume(in_volume, factor_list):
+    """Downsample a volume by averaging blocks of voxels
+
+    Voxels that do not fill a whole block at the end of an axis are
+    dropped. The affine is adjusted so that the downsampled volume
+    still overlays on the input volume.
+
+    Args:
+        in_volume (nibabel volume): data will be a [m,n,o] array
+        factor_list (list of ints): downsampling factor along x, y and
+            z (1 keeps the axis as is)
+
+    Returns:
+        out_volume (nibabel volume): data will be a
+            [m/fx,n/fy,o/fz] float64 array, in RAS orientation
+    """
+    # read input volume
+    #-- convert to RAS orientation
+    in_volume_ras = canonical_volume(in_volume)
+    in_volume_data = in_volume_ras.get_data()
+    in_volume_affine = in_volume_ras.affine
+    #-- sanity checks
+    factor_array = np.asarray(factor_list, dtype=int)
+    if factor_array.shape != (3,) or np.any(factor_array < 1):
+        error_msg = 'downsampling factors must be 3 positive integers'
+        raise ValueError(error_msg)
+    out_shape = np.asarray(in_volume_data.shape[:3])//factor_array
+    if np.any(out_shape == 0):
+        error_msg = 'volume of shape {0} too small to be downsampled by' \
+            ' {1}'.format(in_volume_data.shape, list(factor_list))
+        raise ValueError(error_msg)
+
+    # average blocks
+    in_stop = out_shape*factor_array
+    out_volume_data = np.asarray(
+        in_volume_data[:in_stop[0], :in_stop[1], :in_stop[2]],
+        dtype=np.float64).reshape(
+            out_shape[0], factor_array[0],
+            out_shape[1], factor_array[1],
+            out_shape[2], factor_array[2]).mean(axis=(1, 3, 5))
+    #-- a downsampled voxel is centred on the block it averages
+    block_affine = np.diag(np.append(factor_array, 1).astype(np.float64))
+    block_affine[:3, 3] = (factor_array-1)/2.0
+    out_volume = tag_canonical(nib.Nifti1Image(
+        out_volume_data, in_volume_affine.dot(block_affine)))
 
     return out_volume
 
 
+@instrumentation.staged
 def file_volume_duplication(
         in_volume_path,
         duplication_factor,
@@ -444,13 +1895,14 @@ def file_volume_duplication(
         N/A
     """
     # read input volume
-    in_volume = nib.load(in_volume_path)
+    in_volume = load_volume(in_volume_path)
     # duplicate volume
     out_volume = volume_duplication(in_volume, duplication_factor, axis)
     # save output volume
-    nib.save(out_volume, out_volume_path)
+    save_volume(out_volume, out_volume_path)
 
 
+@instrumentation.staged
 def insert_gap(in_volume, gap_factor, gap_position, axis):
     """Insert empty voxels at regular intervals
 
@@ -461,7 +1913,9 @@ def insert_gap(in_volume, gap_factor, gap_position, axis):
         in_volume (nibabel volume): data will be a [m,n,o] array
         gap_factor (int): positive integer value, interval between empty
             voxels
-        gap_position (int): positive integer value, offset
+        gap_position (int or list of ints): positive integer value(s),
+            offset(s). Several offsets empty several voxels out of every
+            [gap_factor] voxels
         axis (string): 'x', 'y' or 'z'
 
     Returns:
@@ -469,17 +1923,18 @@ def insert_gap(in_volume, gap_factor, gap_position, axis):
     """
     # read input volume
     #-- convert to RAS orientation
-    in_volume_ras = nib.as_closest_canonical(in_volume)
+    in_volume_ras = canonical_volume(in_volume)
     in_volume_data = in_volume_ras.get_data()
-    in_volume_affine = in_volume_ras.affine.copy()
+    in_volume_affine = in_volume_ras.affine
     #-- sanity checks
-    if gap_position < 0:
+    gap_position_list = np.atleast_1d(gap_position)
+    if np.any(gap_position_list < 0):
         error_msg = 'gap position must be a positive integer'
         raise ValueError(error_msg)
     if gap_factor < 0:
         error_msg = 'gap factor must be a positive integer'
         raise ValueError(error_msg)
-    if gap_position >= gap_factor:
+    if np.any(gap_position_list >= gap_factor):
         error_msg = 'gap position must be lower than gap factor'
         raise ValueError(error_msg)
 
@@ -489,25 +1944,26 @@ def insert_gap(in_volume, gap_factor, gap_position, axis):
     out_dim_y = out_volume_data.shape[1]
     out_dim_z = out_volume_data.shape[2]
     if axis == 'x':
-        gap_position_array = np.mod(
-            np.r_[0:out_dim_x], gap_factor) == gap_position
+        gap_position_array = np.isin(
+            np.mod(np.r_[0:out_dim_x], gap_factor), gap_position_list)
         out_volume_data[gap_position_array, :, :] = 0
     if axis == 'y':
-        gap_position_array = np.mod(
-            np.r_[0:out_dim_y], gap_factor) == gap_position
+        gap_position_array = np.isin(
+            np.mod(np.r_[0:out_dim_y], gap_factor), gap_position_list)
         out_volume_data[:, gap_position_array, :] = 0
     if axis == 'z':
-        gap_position_array = np.mod(
-            np.r_[0:out_dim_z], gap_factor) == gap_position
+        gap_position_array = np.isin(
+            np.mod(np.r_[0:out_dim_z], gap_factor), gap_position_list)
         out_volume_data[:, :, gap_position_array] = 0
-    out_volume_affine = in_volume_affine.copy()
 
     # save output volume
-    out_volume = nib.Nifti1Image(out_volume_data, out_volume_affine)
+    out_volume = tag_canonical(
+        nib.Nifti1Image(out_volume_data, in_volume_affine))
 
     return out_volume
 
 
+@instrumentation.staged
 def file_insert_gap(
         in_volume_path,
         gap_factor,
@@ -531,13 +1987,14 @@ def file_insert_gap(
         N/A
     """
     # read input volume
-    in_volume = nib.load(in_volume_path)
+    in_volume = load_volume(in_volume_path)
     # insert gap
     out_volume = insert_gap(in_volume, gap_factor, gap_position, axis)
     # save output volume
-    nib.save(out_volume, out_volume_path)
+    save_volume(out_volume, out_volume_path)
 
 
+@instrumentation.staged
 def create_phantom(in_volume, value):
     """Create constant-valued phantom
 
@@ -553,18 +2010,19 @@ def create_phantom(in_volume, value):
             [m,n,o] array
     """
     # read input volume - convert to RAS orientation
-    in_volume_ras = nib.as_closest_canonical(in_volume)
+    in_volume_ras = canonical_volume(in_volume)
     in_volume_data = in_volume_ras.get_data()
-    in_volume_affine = in_volume_ras.affine.copy()
+    in_volume_affine = in_volume_ras.affine
 
     # generate output volume
     out_volume_data = value*np.ones_like(in_volume_data, np.float)
-    out_volume_affine = in_volume_affine.copy()
-    out_volume = nib.Nifti1Image(out_volume_data, out_volume_affine)
+    out_volume = tag_canonical(
+        nib.Nifti1Image(out_volume_data, in_volume_affine))
 
     return out_volume
 
 
+@instrumentation.staged
 def file_create_phantom(in_volume_path, value, out_volume_path):
     """Create constant-valued phantom and save file
 
@@ -579,13 +2037,14 @@ def file_create_phantom(in_volume_path, value, out_volume_path):
         N/A
     """
     # read input volume
-    in_volume = nib.load(in_volume_path)
+    in_volume = load_volume(in_volume_path)
     # create phantom volume
     out_volume = create_phantom(in_volume, value)
     # save output volume
-    nib.save(out_volume, out_volume_path)
+    save_volume(out_volume, out_volume_path)
 
 
+@instrumentation.staged
 def int2float(in_volume):
     """int to float conversion
 
@@ -599,18 +2058,19 @@ def int2float(in_volume):
             [m,n,o] array
     """
     # read input volume - convert to RAS orientation
-    in_volume_ras = nib.as_closest_canonical(in_volume)
+    in_volume_ras = canonical_volume(in_volume)
     in_volume_data = in_volume_ras.get_data()
-    in_volume_affine = in_volume_ras.affine.copy()
+    in_volume_affine = in_volume_ras.affine
 
     # generate output volume - convert data to float
     out_volume_data = in_volume_data.astype(np.float)
-    out_volume_affine = in_volume_affine.copy()
-    out_volume = nib.Nifti1Image(out_volume_data, out_volume_affine)
+    out_volume = tag_canonical(
+        nib.Nifti1Image(out_volume_data, in_volume_affine))
 
     return out_volume
 
 
+@instrumentation.staged
 def file_int2float(in_volume_path, out_volume_path):
     """Convert from int to float and save volume
 
@@ -624,686 +2084,3619 @@ def file_int2float(in_volume_path, out_volume_path):
         N/A
     """
     # read input volume
-    in_volume = nib.load(in_volume_path)
+    in_volume = load_volume(in_volume_path)
     # convert from int to float
     out_volume = int2float(in_volume)
     # save output volume
-    nib.save(out_volume, out_volume_path)
+    save_volume(out_volume, out_volume_path)
 
 
-def process_repetition(repetition, sa_path, sb_path, outdir_path):
-    """Process repetition
-
-    Process any of the first ('s1a/b_[...]' files) or second
-    ('s2a/b_[...]' files) repetitions.
-    Create a series of intermediate results in the output directory
+def ordinal(number):
+    """Ordinal of a number, in words
 
     Args:
-        repetition (string): '1' (first repetition) or '2' (second
-            repetition)
-        sa_path (string): path to first slab of either first or second
-            repetition. Should match argument 'repetition'.
-        sb_path (string): path to second slab of either first or second
-            repetition. Should match argument 'repetition'.
-        outdir_path (string): absolute path to output dir, where
-            results will get stored
-    Returns:
-        sa_float_path (string): path to first slab of first/second
-            repetition converted to float
-        sb_float_path (string): path to second slab of first/second
-            repetition converted to float
-        sa_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to first slab of first/second repetition
-        sb_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to second slab of first/second repetition
-    """
-    if repetition == '1':
-        repetition_string = 'first'
-    if repetition == '2':
-        repetition_string = 'second'
-
-    print('processing {0} repetition'.format(repetition_string))
-    #-- process first block
-    print('processing {0} repetition - first block'.format(repetition_string))
-    #---- volume duplication
-    sa_duplicated_path = os.path.join(
-        outdir_path, 's{0}a_duplicated.nii.gz'.format(repetition))
-    file_volume_duplication(sa_path, 2, 'y', sa_duplicated_path)
-    #---- insert gaps
-    sa_gap_path = os.path.join(
-        outdir_path, 's{0}a_with_gap.nii.gz'.format(repetition))
-    file_insert_gap(sa_duplicated_path, 2, 0, 'y', sa_gap_path)
-    #-- process second block
-    print('processing {0} repetition - second block'.format(repetition_string))
-    #---- volume duplication
-    sb_duplicated_path = os.path.join(
-        outdir_path, 's{0}b_duplicated.nii.gz'.format(repetition))
-    file_volume_duplication(sb_path, 2, 'y', sb_duplicated_path)
-    #---- insert gaps
-    sb_gap_path = os.path.join(
-        outdir_path, 's{0}b_with_gap.nii.gz'.format(repetition))
-    file_insert_gap(sb_duplicated_path, 2, 1, 'y', sb_gap_path)
-    #-- process first block
-    print('processing {0} repetition - phantom for first block'.format(
-        repetition_string))
-    #---- phantom creation
-    sa_phantom_path = os.path.join(
-        outdir_path, 'phantom_one_s{0}a.nii.gz'.format(repetition))
-    file_create_phantom(sa_gap_path, 1, sa_phantom_path)
-    #---- phantom gap insertion
-    # stored as uncompressed .nii because will get used by SPM
-    sa_phantom_gap_path = os.path.join(
-        outdir_path, 'phantom_one_gap_s{0}a.nii'.format(repetition))
-    file_insert_gap(sa_phantom_path, 2, 0, 'y', sa_phantom_gap_path)
-    print('processing {0} repetition - phantom for second block'.format(
-        repetition_string))
-    #---- phantom creation
-    sb_phantom_path = os.path.join(
-        outdir_path, 'phantom_one_s{0}b.nii.gz'.format(repetition))
-    file_create_phantom(sb_gap_path, 1, sb_phantom_path)
-    #---- phantom gap insertion
-    # stored as uncompressed .nii because will get used by SPM
-    sb_phantom_gap_path = os.path.join(
-        outdir_path, 'phantom_one_gap_s{0}b.nii'.format(repetition))
-    file_insert_gap(sb_phantom_path, 2, 1, 'y', sb_phantom_gap_path)
-    #---- convert data to float
-    #------ s1a
-    # stored as uncompressed .nii because will get used by SPM
-    sa_float_path = os.path.join(
-        outdir_path, 's{0}a_float.nii'.format(repetition))
-    file_int2float(sa_gap_path, sa_float_path)
-    #------ s1b
-    # stored as uncompressed .nii because will get used by SPM
-    sb_float_path = os.path.join(
-        outdir_path, 's{0}b_float.nii'.format(repetition))
-    file_int2float(sb_gap_path, sb_float_path)
+        number (int): positive integer value
 
-    return [
-        sa_float_path, sb_float_path,
-        sa_phantom_gap_path, sb_phantom_gap_path]
+    Returns:
+        ordinal (string): 'first', 'second', ... ('11th' and above)
+    """
+    ordinal_list = [
+        'first', 'second', 'third', 'fourth', 'fifth', 'sixth',
+        'seventh', 'eighth', 'ninth', 'tenth']
+    if 1 <= number <= len(ordinal_list):
+        return ordinal_list[number-1]
 
+    return '{0}th'.format(number)
 
-def create_coregister(ref_path, source_path, other_path, register_prefix):
-    """Initialise SPM co-registration
 
-    This initialises the SPM co-registration nipype object with a set of
-    pre-defined values (with the exception of input volumes which are
-    user-defined).
+def repetition_name(repetition_index):
+    """Name of a repetition
 
     Args:
-        ref_path (string): path to reference (target) image
-        source_path (string): path to the image that will get
-            registered to the reference
-        other_path (string): path to any other images that will get
-            registered to the reference
-        register_prefix (string): co-registered output prefix
+        repetition_index (int): index of the repetition, from 0
 
     Returns:
-        coreg (nipype co-registered object): Instance of the
-            co-register nipype class
+        repetition (string): '1' (first repetition), '2', ...
     """
-    coreg = spm.Coregister()
-    coreg.inputs.target = ref_path
-    coreg.inputs.source = source_path
-    coreg.inputs.apply_to_files = [other_path]
-    coreg.inputs.cost_function = 'nmi'
-    coreg.inputs.separation = [4.0, 2.0]
-    coreg.inputs.tolerance = [
-        0.02, 0.02, 0.02, 0.001,
-        0.001, 0.001, 0.01, 0.01,
-        0.01, 0.001, 0.001, 0.001]
-    coreg.inputs.fwhm = [7.0, 7.0]
-    coreg.inputs.write_interp = 1
-    coreg.inputs.write_wrap = [0, 0, 0]
-    coreg.inputs.write_mask = False
-    coreg.inputs.out_prefix = register_prefix
+    return str(repetition_index+1)
 
-    return coreg
 
+def slab_letter(slab_index):
+    """Name of a slab within its repetition
 
-def file_spm_registration(ref_path, source_path, other_path, tempdir_path):
+    Args:
+        slab_index (int): index of the slab in its repetition, from 0
+
+    Returns:
+        slab (string): 'a' (first slab), 'b', ...
+    """
+    if not 0 <= slab_index < len(string.ascii_lowercase):
+        raise ValueError('at most {0} slabs per repetition'.format(
+            len(string.ascii_lowercase)))
+
+    return string.ascii_lowercase[slab_index]
+
+
+def slab_names(repetition_list, slab_count):
+    """Names of all the slabs, repetition after repetition
+
+    Args:
+        repetition_list (list of strings): repetitions ('1', '2', ...)
+        slab_count (int): number of interleaved slabs per repetition
+
+    Returns:
+        slab_name_list (list of strings): '1a', '1b', '2a', ...
+    """
+    return [
+        '{0}{1}'.format(repetition, slab_letter(slab_index))
+        for repetition in repetition_list
+        for slab_index in range(slab_count)]
+
+
+def slab_index(slab):
+    """Index of a slab within its repetition
+
+    Args:
+        slab (string): 'a' (first slab), 'b', ... (see slab_letter)
+
+    Returns:
+        slab_index (int): index of the slab, from 0
+    """
+    return string.ascii_lowercase.index(slab)
+
+
+@instrumentation.staged
+def process_slab(
+        repetition,
+        slab,
+        slab_path,
+        outdir_path,
+        keep_intermediates='all',
+        slab_count=2):
+    """Process a slab
+
+    Process any slab ('s1a', 's1b', 's2a', 's2b', ... files). Slabs can
+    be processed independently of each other (e.g., as soon as they are
+    acquired).
+    Create a series of intermediate results in the output directory.
+    Intermediate results that are not fed to SPM are only written if
+    all intermediates are kept.
+
+    Args:
+        repetition (string): '1' (first repetition), '2' (second
+            repetition), ...
+        slab (string): 'a' (first slab), 'b' (second slab), ...
+        slab_path (string): path to the slab. Should match arguments
+            'repetition' and 'slab'.
+        outdir_path (string): absolute path to output dir, where
+            results will get stored
+        keep_intermediates (string): intermediate retention policy.
+            'all', 'registered' or 'none'
+        slab_count (int): number of interleaved slabs per repetition.
+            The slab is duplicated as many times along y, and only
+            keeps one plane out of [slab_count]
+    Returns:
+        s_float_path (string): path to the slab converted to float
+        s_phantom_gap_path (string): path to phantom (with gap)
+            corresponding to the slab
+    """
+    repetition_string = ordinal(int(repetition))
+    slab_string = ordinal(slab_index(slab)+1)
+    # the first slab keeps the last plane of each group of
+    # [slab_count] planes, the last slab keeps the first one
+    kept_position = slab_count-1-slab_index(slab)
+    gap_position_list = [
+        gap_position for gap_position in range(slab_count)
+        if gap_position != kept_position]
+    # volumes only used by the next step are not written unless all
+    # intermediates are kept
+    keep_all = keep_intermediates == 'all'
+    name = 's{0}{1}'.format(repetition, slab)
+
+    print('processing {0} repetition - {1} block'.format(
+        repetition_string, slab_string))
+    #---- volume duplication
+    s_duplicated_path = intermediate_path(
+        outdir_path, '{0}_duplicated'.format(name))
+    s_duplicated = volume_duplication(
+        load_volume(slab_path), slab_count, 'y')
+    if keep_all:
+        save_volume(s_duplicated, s_duplicated_path)
+    #---- insert gaps
+    s_gap_path = intermediate_path(outdir_path, '{0}_with_gap'.format(name))
+    s_gap = insert_gap(s_duplicated, slab_count, gap_position_list, 'y')
+    del s_duplicated
+    if keep_all:
+        save_volume(s_gap, s_gap_path)
+    print('processing {0} repetition - phantom for {1} block'.format(
+        repetition_string, slab_string))
+    #---- phantom creation
+    s_phantom_path = intermediate_path(
+        outdir_path, 'phantom_one_{0}'.format(name))
+    s_phantom = create_phantom(s_gap, 1)
+    if keep_all:
+        save_volume(s_phantom, s_phantom_path)
+    #---- phantom gap insertion
+    # stored as uncompressed .nii because will get used by SPM
+    s_phantom_gap_path = os.path.join(
+        outdir_path, 'phantom_one_gap_{0}.nii'.format(name))
+    save_volume(
+        insert_gap(s_phantom, slab_count, gap_position_list, 'y'),
+        s_phantom_gap_path)
+    del s_phantom
+    #---- convert data to float
+    # stored as uncompressed .nii because will get used by SPM
+    s_float_path = os.path.join(outdir_path, '{0}_float.nii'.format(name))
+    save_volume(int2float(s_gap), s_float_path)
+
+    return [s_float_path, s_phantom_gap_path]
+
+
+@instrumentation.staged
+def process_repetition(
+        repetition,
+        slab_path_list,
+        outdir_path,
+        keep_intermediates='all'):
+    """Process repetition
+
+    Process any of the repetitions ('s1a/b_[...]', 's2a/b_[...]', ...
+    files), one slab after the other (see process_slab). The number of
+    slabs is the number of interleaved slabs of the repetition.
+
+    Args:
+        repetition (string): '1' (first repetition), '2' (second
+            repetition), ...
+        slab_path_list (list of strings): paths to the slabs of the
+            repetition, in order. Should match argument 'repetition'.
+        outdir_path (string): absolute path to output dir, where
+            results will get stored
+        keep_intermediates (string): intermediate retention policy.
+            'all', 'registered' or 'none'
+    Returns:
+        processed_path_list (list of lists of strings): for each slab,
+            path to the slab converted to float and path to the
+            phantom (with gap) corresponding to the slab
+    """
+    print('processing {0} repetition'.format(ordinal(int(repetition))))
+    processed_path_list = []
+    for index, slab_path in enumerate(slab_path_list):
+        processed_path_list.append(process_slab(
+            repetition, slab_letter(index), slab_path, outdir_path,
+            keep_intermediates, len(slab_path_list)))
+
+    return processed_path_list
+
+
+def create_coregister(
+        ref_path,
+        source_path,
+        other_path_list,
+        register_prefix,
+        jobtype='estwrite',
+        separation=SPM_SEPARATION,
+        tolerance=SPM_TOLERANCE):
+    """Initialise SPM co-registration
+
+    This initialises the SPM co-registration nipype object with a set of
+    pre-defined values (with the exception of input volumes which are
+    user-defined).
+
+    Args:
+        ref_path (string): path to reference (target) image
+        source_path (string): path to the image that will get
+            registered to the reference
+        other_path_list (list of strings): paths to any other images
+            that will get registered to the reference
+        register_prefix (string): co-registered output prefix
+        jobtype (string): 'estwrite' (estimate and reslice), 'estimate'
+            (only modify the header of the source and other images) or
+            'write' (only reslice according to the current headers)
+        separation (list of floats): sampling distances (mm) of the
+            estimation, coarse to fine
+        tolerance (list of floats): accuracy of each of the 12
+            parameters of the estimation
+
+    Returns:
+        coreg (nipype co-registered object): Instance of the
+            co-register nipype class
+    """
+    coreg = spm.Coregister()
+    coreg.inputs.jobtype = jobtype
+    coreg.inputs.target = ref_path
+    coreg.inputs.source = source_path
+    if other_path_list:
+        coreg.inputs.apply_to_files = other_path_list
+    coreg.inputs.cost_function = 'nmi'
+    coreg.inputs.separation = list(separation)
+    coreg.inputs.tolerance = list(tolerance)
+    coreg.inputs.fwhm = [7.0, 7.0]
+    coreg.inputs.write_interp = 1
+    coreg.inputs.write_wrap = [0, 0, 0]
+    coreg.inputs.write_mask = False
+    coreg.inputs.out_prefix = register_prefix
+
+    return coreg
+
+
+def copy_to_tempdir(impath, tempdir_path):
+    """Duplicate an image in the temporary subfolder
+
+    Args:
+        impath (string): path to the image
+        tempdir_path (string): path to temporary subfolder
+
+    Returns:
+        temp_path (string): path to the copy
+    """
+    temp_path = os.path.join(tempdir_path, os.path.basename(impath))
+    shutil.copyfile(impath, temp_path)
+    count_bytes_read(impath)
+    count_bytes_written(temp_path)
+
+    return temp_path
+
+
+def copy_from_tempdir(temp_path, impath):
+    """Copy an image of the temporary subfolder over a pipeline image
+
+    Args:
+        temp_path (string): path to the image in the temporary subfolder
+        impath (string): path to the pipeline image (will be erased)
+
+    Returns:
+        N/A
+    """
+    count_bytes_written(temp_path)
+    shutil.copyfile(temp_path, impath)
+    count_bytes_read(temp_path)
+    count_bytes_written(impath)
+    VOLUME_CACHE.invalidate(impath)
+
+
+def run_coregister(coreg):
+    """Run an SPM co-registration, measuring the time spent in Matlab
+
+    Args:
+        coreg (nipype co-registered object): co-registration (see
+            create_coregister)
+
+    Returns:
+        N/A
+    """
+    matlab_start = time.perf_counter()
+    coreg.run()
+    instrumentation.increment_counter(
+        'matlab_wait_seconds', time.perf_counter()-matlab_start)
+
+
+def header_transform(original_path, moved_path):
+    """World-space transform between two headers of the same image
+
+    Args:
+        original_path (string): path to the image before registration
+        moved_path (string): path to the image after SPM modified its
+            header
+
+    Returns:
+        transform (numpy.ndarray): 4x4 world-space transform such that
+            moved affine = transform x original affine
+    """
+    return nib.load(moved_path).affine.dot(
+        np.linalg.inv(nib.load(original_path).affine))
+
+
+@instrumentation.staged
+def file_spm_registration(
+        ref_path,
+        source_path,
+        other_path,
+        tempdir_path,
+        separation=SPM_SEPARATION,
+        tolerance=SPM_TOLERANCE):
     """Rigid registration using SPM
 
-    This code is based on the SPM registration originally written in
-    Matlab by Ludovic Fillon.
+    This code is based on the SPM registration originally written in
+    Matlab by Ludovic Fillon.
+
+    Args:
+        ref_path (String): path to reference (target) image.
+        source_path (String): path to source image. Will get modified
+            (registered) by the function.
+        other_path (String): path to any other image to be transformed
+            according to the affine transformation from source to ref.
+            Will get modified (affine transformed) by the function
+        tempdir_path (string): path to temporary subfolder where images
+            to be processed with SPM are duplicated and stored
+        separation (list of floats): sampling distances of the
+            estimation (see create_coregister)
+        tolerance (list of floats): accuracy of the estimation (see
+            create_coregister)
+
+    Returns:
+        transform (numpy.ndarray): estimated 4x4 world-space transform
+            (see header_transform)
+    """
+    # duplicate source as SPM co-registration modifies the header
+    #-- duplicate source
+    source_temp_path = copy_to_tempdir(source_path, tempdir_path)
+    #-- duplicate other image
+    other_temp_path = copy_to_tempdir(other_path, tempdir_path)
+
+    # co-register using SPM
+    #-- create SPM co-register object
+    register_prefix = 'r'
+    coreg = create_coregister(
+        ref_path, source_temp_path, [other_temp_path], register_prefix,
+        'estwrite', separation, tolerance)
+    #-- run SPM co-registration
+    run_coregister(coreg)
+    for impath in [ref_path, source_temp_path, other_temp_path]:
+        count_bytes_read(impath)
+    #-- the header of the duplicated source holds the estimated transform
+    transform = header_transform(source_path, source_temp_path)
+
+    # copy the output registered file to input (will erase original file)
+    for impath, temp_path in [
+            (source_path, source_temp_path), (other_path, other_temp_path)]:
+        copy_from_tempdir(
+            os.path.join(
+                tempdir_path, '{0}{1}'.format(
+                    register_prefix, os.path.basename(temp_path))),
+            impath)
+
+    return transform
+
+
+@instrumentation.staged
+def file_spm_estimate(
+        ref_path,
+        source_path,
+        tempdir_path,
+        separation=SPM_SEPARATION,
+        tolerance=SPM_TOLERANCE):
+    """Estimate a rigid registration using SPM, without reslicing
+
+    Args:
+        ref_path (String): path to reference (target) image.
+        source_path (String): path to source image (not modified)
+        tempdir_path (string): path to temporary subfolder where images
+            to be processed with SPM are duplicated and stored
+        separation (list of floats): sampling distances of the
+            estimation (see create_coregister)
+        tolerance (list of floats): accuracy of the estimation (see
+            create_coregister)
+
+    Returns:
+        transform (numpy.ndarray): estimated 4x4 world-space transform
+            (see header_transform)
+    """
+    source_temp_path = copy_to_tempdir(source_path, tempdir_path)
+    run_coregister(create_coregister(
+        ref_path, source_temp_path, [], 'r', 'estimate', separation,
+        tolerance))
+    count_bytes_read(ref_path)
+    count_bytes_read(source_temp_path)
+    transform = header_transform(source_path, source_temp_path)
+    os.remove(source_temp_path)
+
+    return transform
+
+
+@instrumentation.staged
+def file_spm_reslice(transform, ref_path, impath_list, tempdir_path):
+    """Apply a rigid transform and reslice images using SPM
+
+    Args:
+        transform (numpy.ndarray): 4x4 world-space transform (see
+            header_transform)
+        ref_path (String): path to reference (target) image, whose grid
+            the images are resliced onto
+        impath_list (list of strings): paths to the images. Will get
+            modified by the function
+        tempdir_path (string): path to temporary subfolder where images
+            to be processed with SPM are duplicated and stored
+
+    Returns:
+        N/A
+    """
+    # move the duplicated images by changing their header
+    register_prefix = 'r'
+    temp_path_list = []
+    for impath in impath_list:
+        in_volume = nib.load(impath)
+        temp_path = os.path.join(tempdir_path, os.path.basename(impath))
+        nib.save(
+            nib.Nifti1Image(
+                np.asarray(in_volume.dataobj),
+                transform.dot(in_volume.affine)),
+            temp_path)
+        count_bytes_read(impath)
+        count_bytes_written(temp_path)
+        temp_path_list.append(temp_path)
+
+    # reslice according to the headers
+    run_coregister(create_coregister(
+        ref_path, temp_path_list[0], temp_path_list[1:], register_prefix,
+        'write'))
+
+    for impath, temp_path in zip(impath_list, temp_path_list):
+        copy_from_tempdir(
+            os.path.join(
+                tempdir_path, '{0}{1}'.format(
+                    register_prefix, os.path.basename(temp_path))),
+            impath)
+
+
+@instrumentation.staged
+def file_reslice(transform, ref_path, impath_list):
+    """Apply a rigid transform and reslice images in Python
+
+    The images are resliced onto the grid of the reference image with
+    trilinear interpolation (as the SPM reslicing does). Does not need
+    Matlab.
+
+    Args:
+        transform (numpy.ndarray): 4x4 world-space transform (see
+            header_transform)
+        ref_path (String): path to reference (target) image, whose grid
+            the images are resliced onto
+        impath_list (list of strings): paths to the images. Will get
+            modified by the function
+
+    Returns:
+        N/A
+    """
+    ref_volume = nib.load(ref_path)
+    for in_volume_path in impath_list:
+        in_volume = load_volume(in_volume_path)
+        resliced_volume = nil.image.resample_to_img(
+            nib.Nifti1Image(
+                np.asarray(in_volume.dataobj),
+                transform.dot(in_volume.affine)),
+            ref_volume,
+            interpolation='linear')
+        out_volume = nib.Nifti1Image(
+            np.asarray(resliced_volume.dataobj, dtype=np.float64),
+            resliced_volume.affine)
+        # the memory-mapped input must not be overwritten while in use
+        del in_volume
+        os.remove(in_volume_path)
+        VOLUME_CACHE.invalidate(in_volume_path)
+        save_volume(out_volume, in_volume_path)
+
+
+def image_key(impath):
+    """Name of a pipeline image, without folder and extension
+
+    Used to identify the registrations of a run (e.g., 's1a_float').
+
+    Args:
+        impath (string): path to the image
+
+    Returns:
+        key (string): name of the image
+    """
+    filename = os.path.basename(impath)
+    for extension in ['.nii.gz', '.nii']:
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+
+    return filename
+
+
+class RegistrationBackend(object):
+    """Interface of the registration backends
+
+    A registration moves a source image (and other images, e.g., its
+    phantom) onto a reference image, in two steps: estimate a rigid
+    transform, then apply it (reslice the images onto the grid of the
+    reference). Transforms are 4x4 world-space matrices: the registered
+    image has the affine transform x original affine.
+
+    Backends implement estimate and, if they do not reslice in Python,
+    apply. register (estimate then apply) and batch (several
+    registrations) can be overridden when the backend does it in a
+    better way (e.g., a single call to Matlab).
+
+    Args:
+        N/A
+    """
+
+    # name of the backend (see REGISTRATION_BACKENDS)
+    name = None
+    # whether the backend needs Matlab and SPM
+    needs_spm = False
+
+    def configure(self, args):
+        """Set the options of the backend
+
+        Args:
+            args (argparse.Namespace): parsed arguments
+
+        Returns:
+            N/A
+        """
+        pass
+
+    def estimate(self, ref_path, source_path, tempdir_path):
+        """Estimate the transform of a source image onto a reference
+
+        Args:
+            ref_path (string): path to reference (target) image
+            source_path (string): path to source image (not modified)
+            tempdir_path (string): path to temporary subfolder
+
+        Returns:
+            transform (numpy.ndarray): 4x4 world-space transform
+        """
+        raise NotImplementedError
+
+    def apply(self, transform, ref_path, impath_list, tempdir_path):
+        """Apply a transform and reslice images onto the reference grid
+
+        Args:
+            transform (numpy.ndarray): 4x4 world-space transform
+            ref_path (string): path to reference (target) image
+            impath_list (list of strings): paths to the images. Will
+                get modified
+            tempdir_path (string): path to temporary subfolder
+
+        Returns:
+            N/A
+        """
+        file_reslice(transform, ref_path, impath_list)
+
+    def register(self, ref_path, source_path, other_path, tempdir_path):
+        """Register a source image (and another image) to a reference
+
+        Args:
+            ref_path (string): path to reference (target) image
+            source_path (string): path to source image. Will get
+                modified (registered)
+            other_path (string): path to another image to be moved with
+                the source. Will get modified
+            tempdir_path (string): path to temporary subfolder
+
+        Returns:
+            transform (numpy.ndarray): 4x4 world-space transform
+        """
+        transform = self.estimate(ref_path, source_path, tempdir_path)
+        self.apply(
+            transform, ref_path, [source_path, other_path], tempdir_path)
+
+        return transform
+
+    def batch(self, job_list, tempdir_path):
+        """Run several registrations
+
+        Args:
+            job_list (list of lists): [ref_path, source_path,
+                other_path] of each registration (see register)
+            tempdir_path (string): path to temporary subfolder
+
+        Returns:
+            transform_list (list of numpy.ndarray): transform of each
+                registration
+        """
+        transform_list = []
+        for ref_path, source_path, other_path in job_list:
+            print('{0} register - {1}'.format(
+                self.name, image_key(source_path)))
+            transform_list.append(file_registration(
+                ref_path, source_path, other_path, tempdir_path))
+
+        return transform_list
+
+
+class SpmRegistrationBackend(RegistrationBackend):
+    """SPM registration (normalised mutual information), through Matlab
+
+    Previews (see prepare_preview) are registered with coarser settings
+    (see PREVIEW_SEPARATION and PREVIEW_TOLERANCE_SCALE).
+
+    Args:
+        N/A
+    """
+
+    name = 'spm'
+    needs_spm = True
+
+    def __init__(self):
+        self.separation = SPM_SEPARATION
+        self.tolerance = SPM_TOLERANCE
+
+    def configure(self, args):
+        if getattr(args, 'preview', False):
+            self.separation = PREVIEW_SEPARATION
+            self.tolerance = [
+                tolerance*PREVIEW_TOLERANCE_SCALE
+                for tolerance in SPM_TOLERANCE]
+        else:
+            self.separation = SPM_SEPARATION
+            self.tolerance = SPM_TOLERANCE
+
+    def estimate(self, ref_path, source_path, tempdir_path):
+        return file_spm_estimate(
+            ref_path, source_path, tempdir_path, self.separation,
+            self.tolerance)
+
+    def apply(self, transform, ref_path, impath_list, tempdir_path):
+        file_spm_reslice(transform, ref_path, impath_list, tempdir_path)
+
+    def register(self, ref_path, source_path, other_path, tempdir_path):
+        # estimate and reslice in a single Matlab call
+        return file_spm_registration(
+            ref_path, source_path, other_path, tempdir_path,
+            self.separation, self.tolerance)
+
+
+class IdentityRegistrationBackend(RegistrationBackend):
+    """Identity registration: reslicing without moving the images
+
+    Reslices the images onto the grid of the reference image, without
+    estimating any transformation. Does not need Matlab; used to
+    benchmark the other stages of the pipeline, for tests and
+    demonstrations.
+
+    Args:
+        N/A
+    """
+
+    name = 'identity'
+
+    def estimate(self, ref_path, source_path, tempdir_path):
+        return np.eye(4)
+
+
+class ReplayRegistrationBackend(RegistrationBackend):
+    """Replay of the transforms estimated by an earlier run
+
+    The transforms are read from the registration transforms file of
+    the earlier run (see write_registration_transforms), and applied in
+    Python (see file_reslice). Does not need Matlab.
+
+    Args:
+        N/A
+    """
+
+    name = 'replay'
+
+    def __init__(self):
+        # image name (see image_key) -> transform
+        self.transforms = {}
+
+    def configure(self, args):
+        self.transforms = read_registration_transforms(
+            args.registration_transforms)
+
+    def estimate(self, ref_path, source_path, tempdir_path):
+        key = image_key(source_path)
+        if key not in self.transforms:
+            raise ValueError(
+                'no registration transform to replay for {0}'.format(key))
+
+        return self.transforms[key]
+
+
+# registration backends. 'stub' is the former name of the identity
+# backend. Other backends (e.g., the stand-in of the benchmarks) can be
+# added
+REGISTRATION_BACKENDS = {
+    'spm': SpmRegistrationBackend(),
+    'identity': IdentityRegistrationBackend(),
+    'stub': IdentityRegistrationBackend(),
+    'replay': ReplayRegistrationBackend()}
+# file name of the registration transforms of a run (inside the output
+# dir)
+REGISTRATION_TRANSFORMS_FILENAME = 'registration_transforms.json'
+
+
+def registration_backend():
+    """Registration backend in use
+
+    Args:
+        N/A
+
+    Returns:
+        backend (RegistrationBackend): backend
+    """
+    return REGISTRATION_BACKENDS[REGISTRATION_BACKEND]
+
+
+def set_registration_backend(registration_backend_name, args=None):
+    """Set the registration backend
+
+    Args:
+        registration_backend_name (string): name of a backend of
+            REGISTRATION_BACKENDS
+        args (argparse.Namespace): parsed arguments, holding the options
+            of the backend. None to keep its current options
+
+    Returns:
+        N/A
+    """
+    global REGISTRATION_BACKEND
+    if registration_backend_name not in REGISTRATION_BACKENDS:
+        raise ValueError('unknown registration backend {0}'.format(
+            registration_backend_name))
+    REGISTRATION_BACKEND = registration_backend_name
+    if args is not None:
+        registration_backend().configure(args)
+
+
+def read_registration_transforms(transforms_path):
+    """Read the registration transforms of an earlier run
+
+    Args:
+        transforms_path (string): path to the registration transforms
+            file, or to the output dir of the run
+
+    Returns:
+        transforms (dict): 4x4 world-space transform of each registered
+            image (see image_key)
+    """
+    if transforms_path is None:
+        raise ValueError(
+            'the replay registration needs --registration-transforms')
+    if os.path.isdir(transforms_path):
+        transforms_path = os.path.join(
+            transforms_path, REGISTRATION_TRANSFORMS_FILENAME)
+    if not os.path.isfile(transforms_path):
+        raise IOError('{0} does not exist'.format(transforms_path))
+    with open(transforms_path) as transforms_file:
+        transforms = json.load(transforms_file)['transforms']
+
+    return dict(
+        (key, np.array(transform, dtype=np.float64))
+        for key, transform in transforms.items())
+
+
+def write_registration_transforms(transforms, transforms_path):
+    """Write the registration transforms of a run
+
+    Args:
+        transforms (dict): 4x4 world-space transform of each registered
+            image (see image_key)
+        transforms_path (string): path to the registration transforms
+            file
+
+    Returns:
+        N/A
+    """
+    with open(transforms_path, 'w') as transforms_file:
+        json.dump(
+            {
+                'backend': REGISTRATION_BACKEND,
+                'transforms': dict(
+                    (key, np.asarray(transform).tolist())
+                    for key, transform in sorted(transforms.items()))},
+            transforms_file,
+            indent=2)
+
+
+def input_signature(impath):
+    """Identify the content of an input file
+
+    The signature only depends on the content of the file, so that an
+    input copied or moved to another folder is still recognised.
+
+    Args:
+        impath (string): path to the input file
+
+    Returns:
+        signature (dict): size and SHA-256 digest of the file
+    """
+    digest = hashlib.sha256()
+    with open(impath, 'rb') as in_file:
+        for chunk in iter(
+                lambda: in_file.read(INPUT_SIGNATURE_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return {
+        'size': os.path.getsize(impath),
+        'sha256': digest.hexdigest()}
+
+
+def accumulator_paths(accumulators_path, repetition):
+    """Paths to the stored accumulators of a repetition
+
+    Args:
+        accumulators_path (string): path to the accumulators folder
+        repetition (string): repetition ('1', '2', ...)
+
+    Returns:
+        float_sum_path (string): path to the sum of the registered
+            slabs of the repetition
+        phantom_sum_path (string): path to the sum of their phantoms
+    """
+    return [
+        os.path.join(
+            accumulators_path,
+            'rep{0}_{1}_sum.nii.gz'.format(repetition, kind))
+        for kind in ['float', 'phantom']]
+
+
+def write_accumulators_manifest(
+        accumulators_path,
+        slab_grid,
+        lowres_path,
+        repetition_list,
+        transforms):
+    """Describe the accumulators stored by a run
+
+    The manifest records the inputs each repetition was computed from,
+    so that a later run only reuses the accumulators of the repetitions
+    whose inputs have not changed (see reusable_accumulators).
+
+    Args:
+        accumulators_path (string): path to the accumulators folder
+            (see part3)
+        slab_grid (list of lists of strings): paths to the slabs of
+            each repetition (see slab_grid_from_args)
+        lowres_path (string): path to the low-res volume
+        repetition_list (list of strings): repetitions whose
+            accumulators are stored
+        transforms (dict): registration transforms of the run (see
+            image_key), stored with the repetitions they belong to
+
+    Returns:
+        N/A
+    """
+    repetitions = {}
+    for repetition_index, slab_path_list in enumerate(slab_grid):
+        repetition = repetition_name(repetition_index)
+        if repetition not in repetition_list:
+            continue
+        slab_key_list = [
+            's{0}{1}_float'.format(repetition, slab_letter(slab_index))
+            for slab_index in range(len(slab_path_list))]
+        repetitions[repetition] = {
+            'slabs': [
+                input_signature(slab_path) for slab_path in slab_path_list],
+            'transforms': dict(
+                (key, np.asarray(transforms[key]).tolist())
+                for key in slab_key_list if key in transforms)}
+    with open(
+            os.path.join(accumulators_path, ACCUMULATORS_MANIFEST_FILENAME),
+            'w') as manifest_file:
+        json.dump(
+            {
+                'registration': REGISTRATION_BACKEND,
+                'slabs_per_repetition': len(slab_grid[0]),
+                'lowres': input_signature(lowres_path),
+                'repetitions': repetitions},
+            manifest_file,
+            indent=2)
+
+
+def reusable_accumulators(previous_outdir_path, slab_grid, lowres_path):
+    """Find the accumulators of an earlier run that can be reused
+
+    The accumulators of a repetition are reused if the run had the same
+    registration backend, number of slabs per repetition and low-res
+    volume, and if the slabs of the repetition have not changed (same
+    size and content, wherever the files are).
+
+    Args:
+        previous_outdir_path (string): output dir of the earlier run,
+            or its accumulators folder
+        slab_grid (list of lists of strings): paths to the slabs of
+            each repetition (see slab_grid_from_args)
+        lowres_path (string): path to the low-res volume
+
+    Returns:
+        stored_accumulators (dict): accumulators of each reusable
+            repetition, keyed by repetition:
+            - sum_path_list (list of strings): paths to the stored sums
+                of the slabs and of their phantoms (see
+                accumulator_paths)
+            - transforms (dict): registration transforms of its slabs
+    """
+    accumulators_path = previous_outdir_path
+    if not os.path.isfile(os.path.join(
+            accumulators_path, ACCUMULATORS_MANIFEST_FILENAME)):
+        accumulators_path = os.path.join(
+            previous_outdir_path, ACCUMULATORS_DIRNAME)
+    manifest_path = os.path.join(
+        accumulators_path, ACCUMULATORS_MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        raise IOError('{0} does not exist'.format(manifest_path))
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    # settings the accumulators depend on
+    mismatch = None
+    if manifest['registration'] != REGISTRATION_BACKEND:
+        mismatch = 'registration backend'
+    elif manifest['slabs_per_repetition'] != len(slab_grid[0]):
+        mismatch = 'number of slabs per repetition'
+    elif manifest['lowres'] != input_signature(lowres_path):
+        mismatch = 'low-res volume'
+    if mismatch is not None:
+        print('Incremental run: the {0} has changed, all the repetitions'
+              ' are processed'.format(mismatch))
+        return {}
+
+    stored_accumulators = {}
+    for repetition_index, slab_path_list in enumerate(slab_grid):
+        repetition = repetition_name(repetition_index)
+        entry = manifest['repetitions'].get(repetition)
+        if entry is None or entry['slabs'] != [
+                input_signature(slab_path) for slab_path in slab_path_list]:
+            continue
+        stored_accumulators[repetition] = {
+            'sum_path_list': accumulator_paths(accumulators_path, repetition),
+            'transforms': dict(
+                (key, np.array(transform, dtype=np.float64))
+                for key, transform in entry['transforms'].items())}
+    print('Incremental run: repetition(s) {0} reused, {1} processed'.format(
+        ', '.join(sorted(stored_accumulators, key=int)) or 'none',
+        ', '.join(
+            repetition for repetition in grid_repetitions(slab_grid)
+            if repetition not in stored_accumulators) or 'none'))
+
+    return stored_accumulators
+
+
+@instrumentation.staged
+def file_registration(ref_path, source_path, other_path, tempdir_path):
+    """Rigid registration with the chosen backend
+
+    Args:
+        ref_path (String): path to reference (target) image.
+        source_path (String): path to source image. Will get modified
+            (registered) by the function.
+        other_path (String): path to any other image to be transformed
+            according to the affine transformation from source to ref.
+            Will get modified (affine transformed) by the function
+        tempdir_path (string): path to temporary subfolder where images
+            to be processed with SPM are duplicated and stored
+
+    Returns:
+        transform (numpy.ndarray): 4x4 world-space transform
+    """
+    return registration_backend().register(
+        ref_path, source_path, other_path, tempdir_path)
+
+
+def translation_affine(offset):
+    """Affine matrix of a translation by a number of voxels
+
+    Args:
+        offset (sequence of int): translation along x, y and z, in
+            voxels
+
+    Returns:
+        translation (numpy array): 4x4 affine matrix
+    """
+    translation = np.eye(4)
+    translation[0:3, 3] = offset
+
+    return translation
+
+
+def volume_nonzero_bbox(in_volume_data):
+    """Bounding box of the non-zero voxels of a data array
+
+    NaN voxels are considered as non-zero, so that they get processed
+    (and set to 0) by the arithmetic operations.
+
+    Args:
+        in_volume_data (numpy array): [m,n,o] array
+
+    Returns:
+        bbox_start (tuple of int): first voxel of the bounding box
+        bbox_stop (tuple of int): voxel following the last voxel of the
+            bounding box. If the array is empty, the bounding box is
+            reduced to the first voxel of the array
+    """
+    occupied = in_volume_data != 0
+    bbox_start = []
+    bbox_stop = []
+    # restrict the search to the bounding box found along the previous
+    # axes to avoid going through the whole array three times
+    for dim_index in range(3):
+        other_axes = tuple(
+            other_index for other_index in range(3)
+            if other_index != dim_index)
+        occupied_axis = np.flatnonzero(occupied.any(axis=other_axes))
+        if occupied_axis.size == 0:
+            return (0, 0, 0), (1, 1, 1)
+        bbox_start.append(int(occupied_axis[0]))
+        bbox_stop.append(int(occupied_axis[-1])+1)
+        occupied_slices = [slice(None)]*3
+        occupied_slices[dim_index] = slice(
+            bbox_start[dim_index], bbox_stop[dim_index])
+        occupied = occupied[tuple(occupied_slices)]
+
+    return tuple(bbox_start), tuple(bbox_stop)
+
+
+def volume_crop_info(in_volume):
+    """Get the position of a volume within its full grid
+
+    Cropped volumes carry a NIfTI header extension that gives the offset
+    of their first voxel and the shape of the full grid they have been
+    cropped from. Volumes without this extension are their own full
+    grid.
+
+    Args:
+        in_volume (nibabel volume): data will be a [m,n,o] array
+
+    Returns:
+        offset (tuple of int): offset of the first voxel in the full
+            grid
+        full_shape (tuple of int): shape of the full grid
+    """
+    for extension in in_volume.header.extensions:
+        if extension.get_code() != CROP_EXTENSION_CODE:
+            continue
+        try:
+            content = json.loads(extension.get_content().decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            continue
+        if isinstance(content, dict) and CROP_EXTENSION_KEY in content:
+            crop_info = content[CROP_EXTENSION_KEY]
+            return (
+                tuple(crop_info['offset']),
+                tuple(crop_info['full_shape']))
+
+    return (0, 0, 0), tuple(in_volume.shape[0:3])
+
+
+def cropped_volume(out_volume_data, full_affine, offset, full_shape):
+    """Create a cropped volume
+
+    Args:
+        out_volume_data (numpy array): data of the cropped volume
+        full_affine (numpy array): affine of the full grid
+        offset (sequence of int): offset of the first voxel of the
+            cropped volume in the full grid
+        full_shape (sequence of int): shape of the full grid
+
+    Returns:
+        out_volume (nibabel volume): cropped volume. Its affine is such
+            that each voxel keeps its world coordinates, so that the
+            volume can be displayed as is.
+    """
+    out_volume_affine = full_affine.dot(translation_affine(offset))
+    out_volume = tag_canonical(
+        nib.Nifti1Image(out_volume_data, out_volume_affine))
+    if tuple(offset) != (0, 0, 0) or \
+            tuple(full_shape) != tuple(out_volume_data.shape[0:3]):
+        crop_info = {
+            CROP_EXTENSION_KEY: {
+                'offset': [int(value) for value in offset],
+                'full_shape': [int(value) for value in full_shape]}}
+        out_volume.header.extensions.append(nib.nifti1.Nifti1Extension(
+            CROP_EXTENSION_CODE, json.dumps(crop_info).encode('utf-8')))
+
+    return out_volume
+
+
+def crop_volume(in_volume):
+    """Crop volume to the bounding box of its non-zero voxels
+
+    Args:
+        in_volume (nibabel volume): RAS volume, cropped or not
+
+    Returns:
+        out_volume (nibabel volume): volume cropped to its non-zero
+            voxels. Carries the position of the bounding box within
+            the full grid.
+    """
+    in_volume_data = in_volume.get_data()
+    offset, full_shape = volume_crop_info(in_volume)
+    full_affine = in_volume.affine.dot(translation_affine(
+        -np.asarray(offset)))
+    bbox_start, bbox_stop = volume_nonzero_bbox(in_volume_data)
+    # copy the bounding box so that the full array can be released
+    out_volume_data = in_volume_data[
+        bbox_start[0]:bbox_stop[0],
+        bbox_start[1]:bbox_stop[1],
+        bbox_start[2]:bbox_stop[2]].copy()
+    out_offset = np.asarray(offset)+np.asarray(bbox_start)
+
+    return cropped_volume(
+        out_volume_data, full_affine, out_offset, full_shape)
+
+
+def expand_volume(in_volume):
+    """Expand a cropped volume to its full grid
+
+    Args:
+        in_volume (nibabel volume): cropped volume
+
+    Returns:
+        out_volume (nibabel volume): volume with the shape of the full
+            grid, zero outside of the cropped area. in_volume is
+            returned as is if it is not cropped.
+    """
+    offset, full_shape = volume_crop_info(in_volume)
+    if tuple(offset) == (0, 0, 0) and \
+            tuple(full_shape) == tuple(in_volume.shape[0:3]):
+        return in_volume
+    in_volume_data = in_volume.get_data()
+    out_volume_data = np.zeros(full_shape, in_volume_data.dtype)
+    out_volume_data[
+        offset[0]:offset[0]+in_volume_data.shape[0],
+        offset[1]:offset[1]+in_volume_data.shape[1],
+        offset[2]:offset[2]+in_volume_data.shape[2]] = in_volume_data
+    out_volume_affine = in_volume.affine.dot(translation_affine(
+        -np.asarray(offset)))
+    out_volume = tag_canonical(
+        nib.Nifti1Image(out_volume_data, out_volume_affine))
+
+    return out_volume
+
+
+@instrumentation.staged
+def volume_addition(in_volume1, in_volume2):
+    """Add two volumes together
+
+    Both volumes are cropped to their non-zero voxels, so that only the
+    union of their bounding boxes gets processed.
+
+    Args:
+        in_volume1 (nibabel volume): data will be a [m,n,o] array
+        in_volume2 (nibabel volume): data will be a [m,n,o] array
+
+    Returns:
+        out_volume (nibabel volume): sum of in_volume1[array] and
+            in_volume2[array], where both in_volume1[array] and
+            in_volume2[array] have been reoriented to a canonical
+            orientation ('RAS'). Cropped to the union of the bounding
+            boxes of the input volumes. Use expand_volume to get the
+            [m,n,o] array.
+    """
+    # initialise data and affine matrices from input volumes
+    #-- convert both volumes to RAS orientation and crop them
+    in_volume1_crop = crop_volume(canonical_volume(in_volume1))
+    in_volume2_crop = crop_volume(canonical_volume(in_volume2))
+    #-- volumes data, affine and position in the full grid
+    in_volume1_data = in_volume1_crop.get_data()
+    in_volume1_offset, in_volume1_full_shape = volume_crop_info(
+        in_volume1_crop)
+    in_volume1_full_affine = in_volume1_crop.affine.dot(translation_affine(
+        -np.asarray(in_volume1_offset)))
+    in_volume2_data = in_volume2_crop.get_data()
+    in_volume2_offset, in_volume2_full_shape = volume_crop_info(
+        in_volume2_crop)
+    #-- sanity check
+    if in_volume1_full_shape != in_volume2_full_shape:
+        raise ValueError('the input volumes must have the same size')
+    #-- remove NaN values
+    in_volume1_data[np.isnan(in_volume1_data)] = 0
+    in_volume2_data[np.isnan(in_volume2_data)] = 0
+
+    # add volumes together over the union of their bounding boxes
+    out_offset = np.minimum(in_volume1_offset, in_volume2_offset)
+    out_stop = np.maximum(
+        np.asarray(in_volume1_offset)+in_volume1_data.shape,
+        np.asarray(in_volume2_offset)+in_volume2_data.shape)
+    out_volume_data = np.zeros(
+        out_stop-out_offset,
+        np.result_type(in_volume1_data, in_volume2_data))
+    for in_volume_data, in_volume_offset in [
+            (in_volume1_data, in_volume1_offset),
+            (in_volume2_data, in_volume2_offset)]:
+        start = np.asarray(in_volume_offset)-out_offset
+        stop = start+in_volume_data.shape
+        out_volume_data[
+            start[0]:stop[0],
+            start[1]:stop[1],
+            start[2]:stop[2]] += in_volume_data
+    out_volume = cropped_volume(
+        out_volume_data,
+        in_volume1_full_affine,
+        out_offset,
+        in_volume1_full_shape)
+
+    return out_volume
+
+
+def accumulate_volume(sum_volume, in_volume):
+    """Add a volume to a running sum
+
+    Args:
+        sum_volume (nibabel volume): sum so far. None if in_volume is
+            the first volume of the sum
+        in_volume (nibabel volume): volume to add
+
+    Returns:
+        sum_volume (nibabel volume): in_volume if it is the first volume
+            of the sum, otherwise sum of sum_volume and in_volume (see
+            volume_addition)
+    """
+    if sum_volume is None:
+        return in_volume
+
+    return volume_addition(sum_volume, in_volume)
+
+
+@instrumentation.staged
+def file_volume_addition(
+        in_volume1_path,
+        in_volume2_path,
+        out_volume_path,
+        keep_cropped=False):
+    """Add two volumes from files and save
+
+    Read input volumes from files, add and save.
+
+    Args:
+        in_volume1_path (string): path to input volume 1
+        in_volume2_path (string): path to input volume 2
+        out_volume_path (string): path to output volume
+        keep_cropped (Boolean): if True, the output volume is saved
+            cropped to its non-zero voxels (intermediary images).
+            Otherwise it is expanded to the full grid (final outputs)
+
+    Returns:
+        N/A
+    """
+    # read input volumes
+    in_volume1 = load_volume(in_volume1_path)
+    in_volume2 = load_volume(in_volume2_path)
+    # add volumes
+    out_volume = volume_addition(in_volume1, in_volume2)
+    if not keep_cropped:
+        out_volume = expand_volume(out_volume)
+    # save output volume
+    save_volume(out_volume, out_volume_path)
+
+
+@instrumentation.staged
+def volume_division(in_volume1, in_volume2):
+    """Divide a volume by another one
+
+    Both volumes are cropped to their non-zero voxels, so that only the
+    intersection of their bounding boxes gets processed (the division
+    is 0 everywhere else).
+
+    Args:
+        in_volume1 (nibabel volume): data will be a [m,n,o] array
+        in_volume2 (nibabel volume): data will be a [m,n,o] array
+
+    Returns:
+        out_volume (nibabel volume): division of in_volume1[array] by
+            in_volume2[array], where both in_volume1[array] and
+            in_volume2[array] have been reoriented to a canonical
+            orientation ('RAS'). Cropped to the intersection of the
+            bounding boxes of the input volumes. Use expand_volume to
+            get the [m,n,o] array.
+    """
+    # read input volumes
+    #-- convert both volumes to RAS orientation and crop them
+    in_volume1_crop = crop_volume(canonical_volume(in_volume1))
+    in_volume2_crop = crop_volume(canonical_volume(in_volume2))
+    #-- volumes data, affine and position in the full grid
+    in_volume1_data = in_volume1_crop.get_data()
+    in_volume1_offset, in_volume1_full_shape = volume_crop_info(
+        in_volume1_crop)
+    in_volume1_full_affine = in_volume1_crop.affine.dot(translation_affine(
+        -np.asarray(in_volume1_offset)))
+    in_volume2_data = in_volume2_crop.get_data()
+    in_volume2_offset, in_volume2_full_shape = volume_crop_info(
+        in_volume2_crop)
+    #-- sanity check
+    if in_volume1_full_shape != in_volume2_full_shape:
+        raise ValueError('the input volumes must have the same size')
+    #-- restrict both volumes to the intersection of their bounding
+    # boxes
+    out_offset = np.maximum(in_volume1_offset, in_volume2_offset)
+    out_stop = np.maximum(out_offset, np.minimum(
+        np.asarray(in_volume1_offset)+in_volume1_data.shape,
+        np.asarray(in_volume2_offset)+in_volume2_data.shape))
+    if np.any(out_stop == out_offset):
+        # empty intersection: the division is 0 everywhere
+        out_volume_dtype = (
+            in_volume1_data[0:0]/in_volume2_data[0:0]).dtype
+        out_volume = cropped_volume(
+            np.zeros((1, 1, 1), out_volume_dtype),
+            in_volume1_full_affine,
+            (0, 0, 0),
+            in_volume1_full_shape)
+        return out_volume
+    in_volume_data_list = []
+    for in_volume_data, in_volume_offset in [
+            (in_volume1_data, in_volume1_offset),
+            (in_volume2_data, in_volume2_offset)]:
+        start = out_offset-np.asarray(in_volume_offset)
+        stop = out_stop-np.asarray(in_volume_offset)
+        in_volume_data_list.append(in_volume_data[
+            start[0]:stop[0],
+            start[1]:stop[1],
+            start[2]:stop[2]])
+    in_volume1_data, in_volume2_data = in_volume_data_list
+    #-- get rid of NaN values
+    in_volume1_data[np.isnan(in_volume1_data)] = 0
+    in_volume2_data[np.isnan(in_volume2_data)] = 0
+
+    # divide the two volumes
+    #-- check volume 2 pixels 0-intensities
+    volume2_0_x, volume2_0_y, volume2_0_z = np.where(in_volume2_data == 0)
+    in_volume2_data[in_volume2_data == 0] = 1
+    #-- main division
+    out_volume_data = in_volume1_data/in_volume2_data
+    #-- re-process volume 2 0-intensity pixels
+    out_volume_data[volume2_0_x, volume2_0_y, volume2_0_z] = 0
+
+    # save output
+    out_volume = cropped_volume(
+        out_volume_data,
+        in_volume1_full_affine,
+        out_offset,
+        in_volume1_full_shape)
+
+    return out_volume
+
+
+@instrumentation.staged
+def file_volume_division(
+        in_volume1_path,
+        in_volume2_path,
+        out_volume_path,
+        keep_cropped=False):
+    """Divide two volumes from files and save
+
+    Read input volumes from files, divide and save.
+
+    Args:
+        in_volume1_path (string): path to input volume 1
+        in_volume2_path (string): path to input volume 2
+        out_volume_path (string): path to output volume
+        keep_cropped (Boolean): if True, the output volume is saved
+            cropped to its non-zero voxels (intermediary images).
+            Otherwise it is expanded to the full grid (final outputs)
+
+    Returns:
+        N/A
+    """
+    # read input volumes
+    in_volume1 = load_volume(in_volume1_path)
+    in_volume2 = load_volume(in_volume2_path)
+    # add volumes
+    out_volume = volume_division(in_volume1, in_volume2)
+    if not keep_cropped:
+        out_volume = expand_volume(out_volume)
+    # save output volume
+    save_volume(out_volume, out_volume_path)
+
+
+@instrumentation.staged
+def gzip_image(impath, dirpath):
+    """Gzip compress an image
+
+    Will copy the image to a compressed file and remove the
+    (non-compressed) original file. Blocks of the image that only
+    contain zeros are not compressed again (see SparseGzipFile).
+
+    Args:
+        impath (string): path to the .nii image that will be compressed
+        dirpath (string): path to folder containing the image to be
+            deleted. Used to perform a 'safe' deletion of the
+            original uncompressed image after we have copied it to a
+            compressed version.
+
+    Returns:
+        N/A
+    """
+    # check if exists
+    if not os.path.isfile(impath):
+        error_msg = 'Error: impath {0} does not exist.'.format(impath)
+        raise IOError(error_msg)
+    # get foldername and filename associated with path to image
+    imfoldername = os.path.dirname(impath)
+    imfilename = os.path.basename(impath)
+    # separate extension in filename
+    imfilename_main = os.path.splitext(imfilename)[0]
+    imfilename_ext = os.path.splitext(imfilename)[1]
+    # check if the image is of type .nii
+    if imfilename_ext != '.nii':
+        error_msg = 'Error: image extension should be .nii'
+        raise IOError(error_msg)
+    # compress with gzip (empty blocks are not compressed again)
+    imgzpath = "{0}/{1}.nii.gz".format(imfoldername, imfilename_main)
+    with instrumentation.stage('gzip', 'io'):
+        with open(impath, 'rb') as imfile:
+            with SparseGzipFile(imgzpath) as imgzfile:
+                shutil.copyfileobj(imfile, imgzfile, GZIP_BLOCK_SIZE)
+    count_bytes_read(impath)
+    count_bytes_written(imgzpath)
+    # remove original non-compressed image
+    safe_remove(impath, dirpath)
+
+
+@instrumentation.staged
+def gzip_images(impath_list, dirpath, workers=None):
+    """Gzip compress all images in a list
+
+    Will copy each image in the list to a compressed file and remove the
+    (non-compressed) original file. Images are compressed in parallel
+    (zlib does not hold the Python global interpreter lock).
+
+    Args:
+        impath_list (list of strings): list of paths to the images that
+            will be compressed
+        dirpath (string): path to folder containing the images to be
+            deleted. Used to perform a 'safe' deletion of the
+            original uncompressed images after we have copied them to a
+            compressed version.
+        workers (int): number of images compressed at the same time.
+            Defaults to the number of CPUs
+
+    Returns:
+        N/A
+    """
+    if not impath_list:
+        return
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(impath_list)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        # consume the results to raise any exception
+        list(executor.map(
+            instrumentation.thread_function(gzip_image),
+            impath_list, [dirpath]*len(impath_list)))
+
+
+def int16_scaling(in_data):
+    """Scaling factors of data stored as int16
+
+    The range of the data is mapped onto the int16 range, with an
+    intercept that is a multiple of the slope so that zero (e.g., the
+    background) is stored exactly. Both factors are exactly
+    representable in the float32 fields of the NIfTI header.
+
+    Args:
+        in_data (numpy.ndarray): data
+
+    Returns:
+        slope (float): scl_slope (value = stored*slope+inter)
+        inter (float): scl_inter
+    """
+    data_min = min(float(in_data.min()), 0.0)
+    data_max = max(float(in_data.max()), 0.0)
+    if data_max == data_min:
+        return 1.0, 0.0
+    # one step of margin for the rounding of the intercept
+    slope = (data_max-data_min)/(2**16-2)
+    # round the slope up to 8 significant bits: the intercept (at most
+    # 2**16 times the slope) then fits in the 24 bits of a float32
+    mantissa, exponent = np.frexp(slope)
+    slope = float(np.ldexp(np.ceil(mantissa*2**8)/2**8, exponent))
+    inter = float((np.floor(data_min/slope)+2**15)*slope)
+
+    return slope, inter
+
+
+def encode_output(out_volume, output_dtype):
+    """Encode a final output in the chosen data type
+
+    Args:
+        out_volume (nibabel volume): final output, as computed (float64)
+        output_dtype (string): data type (see OUTPUT_DTYPE_CHOICES)
+
+    Returns:
+        encoded_volume (nibabel volume): volume to save
+        encoding (dict): data type, scl_slope and scl_inter of the
+            saved volume, and quantisation error (largest and root mean
+            square difference between the saved and computed values)
+    """
+    encoding = {
+        'dtype': output_dtype,
+        'scl_slope': None,
+        'scl_inter': None,
+        'max_abs_error': 0.0,
+        'rms_error': 0.0}
+    if output_dtype == 'float64':
+        return out_volume, encoding
+    out_data = np.asarray(out_volume.get_data(), dtype=np.float64)
+    if output_dtype == 'float32':
+        encoded_data = out_data.astype(np.float32)
+        decoded_data = encoded_data.astype(np.float64)
+        encoded_volume = nib.Nifti1Image(encoded_data, out_volume.affine)
+    else:
+        slope, inter = int16_scaling(out_data)
+        encoded_data = np.clip(
+            np.rint((out_data-inter)/slope), -2**15, 2**15-1).astype(np.int16)
+        decoded_data = encoded_data*slope+inter
+        encoded_volume = nib.Nifti1Image(encoded_data, out_volume.affine)
+        encoded_volume.header.set_slope_inter(slope, inter)
+        encoding['scl_slope'] = slope
+        encoding['scl_inter'] = inter
+    error = np.abs(decoded_data-out_data)
+    encoding['max_abs_error'] = float(error.max()) if error.size else 0.0
+    encoding['rms_error'] = float(np.sqrt(np.mean(error**2))) \
+        if error.size else 0.0
+
+    return encoded_volume, encoding
+
+
+@instrumentation.staged
+def save_output(out_volume, outdir_path, name):
+    """Save a final output with the chosen encoding
+
+    See OUTPUT_DTYPE, OUTPUT_FORMAT and OUTPUT_COMPRESSLEVEL. Preview
+    outputs are labelled as such, in their file name and NIfTI
+    description (see PREVIEW_PREFIX and PREVIEW_DESCRIPTION).
+
+    Args:
+        out_volume (nibabel volume): final output, as computed
+        outdir_path (string): path to output dir
+        name (string): name of the output, without extension
+
+    Returns:
+        output_record (dict): file name, encoding (see encode_output),
+            file format, compression level, size (bytes) and write time
+            (seconds) of the output
+    """
+    if PREVIEW_FACTOR is not None:
+        name = '{0}{1}'.format(PREVIEW_PREFIX, name)
+    filename = '{0}.{1}'.format(name, OUTPUT_FORMAT)
+    out_volume_path = os.path.join(outdir_path, filename)
+    encoded_volume, output_record = encode_output(out_volume, OUTPUT_DTYPE)
+    if PREVIEW_FACTOR is not None:
+        encoded_volume.header['descrip'] = PREVIEW_DESCRIPTION
+    write_start = time.perf_counter()
+    save_volume(encoded_volume, out_volume_path, OUTPUT_COMPRESSLEVEL)
+    output_record['write_seconds'] = time.perf_counter()-write_start
+    output_record['filename'] = filename
+    output_record['format'] = OUTPUT_FORMAT
+    output_record['compresslevel'] = None
+    if OUTPUT_FORMAT == 'nii.gz':
+        output_record['compresslevel'] = OUTPUT_COMPRESSLEVEL
+    output_record['bytes'] = os.path.getsize(out_volume_path)
+
+    return output_record
+
+
+def format_output_record(output_record):
+    """Describe the size, write time and error of a final output
+
+    Args:
+        output_record (dict): output record (see save_output)
+
+    Returns:
+        line (string): description
+    """
+    line = '{0}: {1:.1f} MB, written in {2:.2f} s'.format(
+        output_record['filename'], output_record['bytes']/1024.0**2,
+        output_record['write_seconds'])
+    if output_record['dtype'] != 'float64':
+        line = '{0}, quantisation error {1:.3g} max, {2:.3g} rms'.format(
+            line, output_record['max_abs_error'],
+            output_record['rms_error'])
+
+    return line
+
+
+def list_uncompressed_images(dirpath):
+    """List the uncompressed (.nii) images in a folder
+
+    Subfolders are not searched.
+
+    Args:
+        dirpath (string): path to folder
+
+    Returns:
+        impath_list (list of strings): sorted list of paths to the .nii
+            images
+    """
+    return [
+        os.path.join(dirpath, filename)
+        for filename in sorted(os.listdir(dirpath))
+        if filename.endswith('.nii') and
+        os.path.isfile(os.path.join(dirpath, filename))]
+
+
+def slab_grid_from_args(args):
+    """Slabs of each repetition, from the parsed arguments
+
+    Args:
+        args (argparse.Namespace): parsed arguments. Either slab_paths
+            (all the slabs, repetition after repetition) and
+            slabs_per_repetition, or rep1s1_path, rep1s2_path,
+            rep2s1_path and rep2s2_path (two repetitions of two slabs,
+            watch folder mode)
+
+    Returns:
+        slab_grid (list of lists of strings): paths to the slabs of
+            each repetition
+    """
+    slab_path_list = getattr(args, 'slab_paths', None)
+    if slab_path_list is None:
+        return [
+            [args.rep1s1_path, args.rep1s2_path],
+            [args.rep2s1_path, args.rep2s2_path]]
+    slab_count = args.slabs_per_repetition
+    if slab_count < 1 or len(slab_path_list) % slab_count:
+        raise ValueError(
+            '{0} slabs cannot be split into repetitions of {1}'
+            ' slabs'.format(len(slab_path_list), slab_count))
+
+    return [
+        list(slab_path_list[index:index+slab_count])
+        for index in range(0, len(slab_path_list), slab_count)]
+
+
+def set_subject_slabs(subject_args, subject):
+    """Set the slabs of a subject in its arguments
+
+    Args:
+        subject_args (argparse.Namespace): arguments of the subject.
+            slab_paths and slabs_per_repetition are set
+        subject (dict): subject of a batch, job of the work queue or of
+            the recombination service (see batch.subject_slabs)
+
+    Returns:
+        N/A
+    """
+    subject_args.slab_paths, subject_args.slabs_per_repetition = \
+        batch.subject_slabs(subject)
+
+
+def check_slab_grid(slab_grid):
+    """Check that all repetitions have the same number of slabs
+
+    Args:
+        slab_grid (list of lists of strings): paths to the slabs of
+            each repetition (see slab_grid_from_args)
+
+    Returns:
+        slab_count (int): number of interleaved slabs per repetition
+    """
+    if not slab_grid or not slab_grid[0]:
+        raise ValueError('at least one repetition of one slab is needed')
+    slab_count = len(slab_grid[0])
+    if any(len(slab_path_list) != slab_count for slab_path_list in slab_grid):
+        raise ValueError(
+            'all repetitions must have the same number of slabs')
+    # check the number of slabs can be named
+    slab_letter(slab_count-1)
+
+    return slab_count
+
+
+def grid_repetitions(slab_grid):
+    """Names of the repetitions of a set of slabs
+
+    Args:
+        slab_grid (list of lists of strings): paths to the slabs of
+            each repetition (see slab_grid_from_args)
+
+    Returns:
+        repetition_list (list of strings): '1', '2', ...
+    """
+    return [
+        repetition_name(repetition_index)
+        for repetition_index in range(len(slab_grid))]
+
+
+def slab_input_dict(slab_grid):
+    """Input slabs, keyed by role
+
+    Args:
+        slab_grid (list of lists of strings): paths to the slabs of
+            each repetition (see slab_grid_from_args)
+
+    Returns:
+        slab_inputs (dict): path to each slab, keyed by
+            'rep[repetition]s[slab]' (e.g., 'rep1s1', 'rep2s3')
+    """
+    return dict(
+        ('rep{0}s{1}'.format(repetition_index+1, slab_index+1), slab_path)
+        for repetition_index, slab_path_list in enumerate(slab_grid)
+        for slab_index, slab_path in enumerate(slab_path_list))
+
+
+def slab_record(
+        repetition,
+        slab,
+        lowres_path,
+        float_path,
+        phantom_gap_path):
+    """Pre-processed slab, as passed between the parts of the pipeline
+
+    Args:
+        repetition (string): repetition of the slab ('1', '2', ...)
+        slab (string): slab within its repetition ('a', 'b', ...)
+        lowres_path (string): path to the low-res volume the slab gets
+            registered to
+        float_path (string): path to the slab converted to float
+        phantom_gap_path (string): path to phantom (with gap)
+            corresponding to the slab
+
+    Returns:
+        record (dict): slab record
+    """
+    return {
+        'repetition': repetition,
+        'slab': slab,
+        'lowres_path': lowres_path,
+        'float_path': float_path,
+        'phantom_gap_path': phantom_gap_path}
+
+
+def record_repetitions(slab_record_list):
+    """Repetitions of a list of slab records
+
+    Args:
+        slab_record_list (list of dict): slab records (see slab_record)
+
+    Returns:
+        repetition_list (list of strings): repetitions, in order of
+            appearance
+    """
+    repetition_list = []
+    for record in slab_record_list:
+        if record['repetition'] not in repetition_list:
+            repetition_list.append(record['repetition'])
+
+    return repetition_list
+
+
+@instrumentation.staged
+def copy_slab(
+        repetition,
+        slab,
+        slab_input_path,
+        debugdir_path,
+        keep_intermediates='all'):
+    """Copy a slab into the output folder
+
+    The copy is reoriented to the closest canonical orientation ('RAS'),
+    so that the next steps do not have to. The slab is only copied if
+    all intermediates are kept; otherwise it is read from the input file
+    and reoriented in memory.
+
+    Args:
+        repetition (string): '1' (first repetition), '2' (second
+            repetition), ...
+        slab (string): 'a' (first slab), 'b' (second slab), ...
+        slab_input_path (string): path to the input slab
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary images are stored
+        keep_intermediates (string): intermediate retention policy
+
+    Returns:
+        slab_path (string): path to the slab to process (copy or input)
+    """
+    if keep_intermediates != 'all':
+        return slab_input_path
+    slab_path = os.path.join(
+        debugdir_path, 's{0}{1}.nii'.format(repetition, slab))
+    nii_canonical_copy(slab_input_path, slab_path)
+
+    return slab_path
+
+
+@instrumentation.staged
+def prepare_lowres(
+        lowres_path,
+        debugdir_path,
+        keep_intermediates='all',
+        slab_name_list=('1a', '1b', '2a', '2b')):
+    """Copy the low-res volume into the output folder
+
+    The low-res volume is copied (and reoriented to 'RAS') once per slab
+    registration (later used as initialisation to a slab registration),
+    if all intermediates are kept. Otherwise, SPM only needs a single
+    uncompressed copy, shared by all the registrations.
+
+    Args:
+        lowres_path (string): path to low resolution volume
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary images are stored
+        keep_intermediates (string): intermediate retention policy
+        slab_name_list (list of strings): slabs registered to the
+            low-res volume (see slab_names)
+
+    Returns:
+        lr_path_list (list of strings): low res repeated - one per slab
+            (e.g., 'lr_1a', 'lr_1b', 'lr_2a', 'lr_2b'), in the order of
+            slab_name_list
+    """
+    if keep_intermediates != 'all':
+        lr_path = os.path.join(debugdir_path, 'lr.nii')
+        nii_canonical_copy(lowres_path, lr_path)
+        return [lr_path]*len(slab_name_list)
+
+    # The low-res volume is only reoriented for the first copy.
+    lr_path_list = []
+    for slab_name in slab_name_list:
+        lr_path = os.path.join(debugdir_path, 'lr_{0}.nii'.format(slab_name))
+        if lr_path_list:
+            nii_copy(lr_path_list[0], lr_path)
+        else:
+            nii_canonical_copy(lowres_path, lr_path)
+        lr_path_list.append(lr_path)
+
+    return lr_path_list
+
+
+@instrumentation.staged
+def prepare_slab(
+        repetition,
+        slab,
+        slab_input_path,
+        debugdir_path,
+        keep_intermediates='all',
+        slab_count=2):
+    """Pre-processing of a single slab prior to SPM registration
+
+    Same processing as part1, for one slab only, so that slabs can be
+    processed as soon as they are available.
+
+    Args:
+        repetition (string): '1' (first repetition), '2' (second
+            repetition), ...
+        slab (string): 'a' (first slab), 'b' (second slab), ...
+        slab_input_path (string): path to the input slab
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary images are stored
+        keep_intermediates (string): intermediate retention policy
+        slab_count (int): number of interleaved slabs per repetition
+
+    Returns:
+        s_float_path (string): path to the slab converted to float
+        s_phantom_gap_path (string): path to phantom (with gap)
+            corresponding to the slab
+    """
+    slab_path = copy_slab(
+        repetition, slab, slab_input_path, debugdir_path, keep_intermediates)
+    [s_float_path, s_phantom_gap_path] = process_slab(
+        repetition, slab, slab_path, debugdir_path, keep_intermediates,
+        slab_count)
+    if keep_intermediates == 'all':
+        gzip_image(slab_path, debugdir_path)
+
+    return [s_float_path, s_phantom_gap_path]
+
+
+@instrumentation.staged
+def prepare_preview(slab_grid, lowres_path, debugdir_path, preview_factor):
+    """Downsample the inputs of a preview
+
+    The slabs are only downsampled within the slab planes (x and z), so
+    that the slabs of a repetition still interleave along y. The low-res
+    volume, whose grid the slabs get registered and combined onto, is
+    downsampled along each axis. The downsampled inputs are stored in
+    the debug subfolder ('preview_rep[r]s[s]', 'preview_lowres').
+
+    Args:
+        slab_grid (list of lists of strings): paths to the slabs of
+            each repetition (see slab_grid_from_args)
+        lowres_path (string): path to low resolution volume
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary images are stored
+        preview_factor (int): downsampling factor
+
+    Returns:
+        preview_slab_grid (list of lists of strings): paths to the
+            downsampled slabs
+        preview_lowres_path (string): path to the downsampled low-res
+            volume
+    """
+    print('Preview: downsample the inputs by {0}'.format(preview_factor))
+    preview_slab_grid = []
+    for repetition_index, slab_path_list in enumerate(slab_grid):
+        preview_slab_path_list = []
+        for slab_index, slab_path in enumerate(slab_path_list):
+            preview_slab_path = os.path.join(
+                debugdir_path, 'preview_rep{0}s{1}.nii'.format(
+                    repetition_index+1, slab_index+1))
+            save_volume(
+                downsample_volume(
+                    load_volume(slab_path),
+                    [preview_factor, 1, preview_factor]),
+                preview_slab_path)
+            preview_slab_path_list.append(preview_slab_path)
+        preview_slab_grid.append(preview_slab_path_list)
+    preview_lowres_path = os.path.join(debugdir_path, 'preview_lowres.nii')
+    save_volume(
+        downsample_volume(load_volume(lowres_path), [preview_factor]*3),
+        preview_lowres_path)
+
+    return preview_slab_grid, preview_lowres_path
+
+
+@instrumentation.staged
+def part1(
+        slab_grid,
+        lowres_path,
+        debugdir_path,
+        keep_intermediates='all',
+        repetition_list=None):
+    """Pre-processing prior to SPM registration
+
+    The function will process each slab as follows:
+    - duplicate slices of the volume along the y axis (as many times as
+        there are interleaved slabs per repetition)
+    - fill corresponding slices with the gaps that represent the real
+        acquisition
+    - create a phantom corresponding to each slab
+
+    Args:
+        slab_grid (list of lists of strings): paths to the slabs of
+            each repetition (see slab_grid_from_args). All repetitions
+            must have the same number of interleaved slabs
+        lowres_path (string): path to low resolution volume
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary images are stored
+        keep_intermediates (string): intermediate retention policy.
+            'all' (all intermediary images are kept in the debug
+            subfolder), 'registered' (only the SPM registered slabs
+            and phantoms are kept) or 'none' (only the images needed by
+            SPM are written, and removed once used)
+        repetition_list (list of strings): names of the repetitions of
+            slab_grid (e.g., ['2'] if only the second repetition is
+            processed). Defaults to '1', '2', ...
+
+    Returns:
+        slab_record_list (list of dict): pre-processed slabs, one per
+            slab, in acquisition order (see slab_record)
+    """
+    slab_count = check_slab_grid(slab_grid)
+    if repetition_list is None:
+        repetition_list = grid_repetitions(slab_grid)
+
+    # copy files into the output folder (debug subfolder)
+    # All volumes get reoriented to the closest canonical orientation
+    # ('RAS') once here, so that the next steps do not have to.
+    if keep_intermediates == 'all':
+        print('copy files into the output folder')
+    else:
+        print('copy low-res volume into the output folder')
+    slab_path_grid = [
+        [
+            copy_slab(
+                repetition, slab_letter(slab_index),
+                slab_input_path, debugdir_path, keep_intermediates)
+            for slab_index, slab_input_path in enumerate(slab_path_list)]
+        for repetition, slab_path_list in zip(repetition_list, slab_grid)]
+    lr_path_list = prepare_lowres(
+        lowres_path, debugdir_path, keep_intermediates,
+        slab_names(repetition_list, slab_count))
+
+    # process repetitions
+    slab_record_list = []
+    for repetition, slab_path_list in zip(repetition_list, slab_path_grid):
+        processed_path_list = process_repetition(
+            repetition, slab_path_list, debugdir_path, keep_intermediates)
+        for slab_index, [s_float_path, s_phantom_gap_path] in enumerate(
+                processed_path_list):
+            slab_record_list.append(slab_record(
+                repetition, slab_letter(slab_index),
+                lr_path_list[len(slab_record_list)],
+                s_float_path, s_phantom_gap_path))
+
+    # gzip all the images that will not be fed to SPM in the second
+    # part or the recombination pipeline (SPM cannot read .gz
+    # compressed images)
+    if keep_intermediates == 'all':
+        gzip_images(
+            [
+                slab_path for slab_path_list in slab_path_grid
+                for slab_path in slab_path_list],
+            debugdir_path)
+
+    return slab_record_list
+
+
+@instrumentation.staged
+def part2(
+        slab_record_list,
+        debugdir_path,
+        tempdir_path,
+        keep_intermediates='all',
+        repetition_list=None):
+    """Registration
+
+    Launch the registrations of all the slabs with the chosen backend
+    (see REGISTRATION_BACKENDS), as a single batch.
+    The function will modify the low-res, float and phantom images of
+    the slab records.
+
+    Args:
+        slab_record_list (list of dict): pre-processed slabs (see part1)
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary iamges are stored
+        tempdir_path (string): path to temporary subfolder where images
+            to be processed with SPM are duplicated and stored
+        keep_intermediates (string): intermediate retention policy.
+            'all', 'registered' or 'none'. The low-res volumes are only
+            kept if 'all'.
+        repetition_list (list of strings): repetitions to register. The
+            slabs and phantoms of the other repetitions are removed, as
+            no final output needs them (see output_repetitions). None
+            to register all repetitions
+
+    Returns:
+        transforms (dict): 4x4 world-space transform of each registered
+            slab (see image_key)
+    """
+    # register the slabs of the needed repetitions
+    job_list = []
+    skipped_repetition_list = []
+    for record in slab_record_list:
+        if repetition_list is None or \
+                record['repetition'] in repetition_list:
+            job_list.append([
+                record['lowres_path'], record['float_path'],
+                record['phantom_gap_path']])
+            continue
+        if record['repetition'] not in skipped_repetition_list:
+            print('Repetition {0} not needed by the outputs: not'
+                  ' registered'.format(record['repetition']))
+            skipped_repetition_list.append(record['repetition'])
+        remove_images(
+            [record['float_path'], record['phantom_gap_path']],
+            debugdir_path)
+    transform_list = registration_backend().batch(job_list, tempdir_path)
+    transforms = dict(
+        (image_key(source_path), transform)
+        for (_, source_path, _), transform in zip(job_list, transform_list))
+
+    # gzip all the images that are not given as input to part 3 of
+    # the recombination algorithm
+    lr_path_list = [record['lowres_path'] for record in slab_record_list]
+    if keep_intermediates == 'all':
+        gzip_images(lr_path_list, debugdir_path)
+    else:
+        # low-res volume(s) no longer needed
+        for lr_path in sorted(set(lr_path_list)):
+            safe_remove(lr_path, debugdir_path)
+
+    return transforms
+
+
+@instrumentation.staged
+def registration_quality(
+        slab_record_list,
+        lowres_path,
+        subsample=registration_qc.DEFAULT_SUBSAMPLE):
+    """Quality control of the registrations
+
+    Compare each registered slab (normalised by its phantom) to the
+    low-res volume, and the weighted average of each repetition to the
+    one of the first repetition, inside the phantom support (see
+    registration_qc). Failed registrations are reported, but do not
+    stop the recombination.
+
+    Args:
+        slab_record_list (list of dict): registered slabs (see part1
+            and part2). The registered slabs are on the low-res grid
+        lowres_path (string): path to low resolution volume
+        subsample (int): subsampling step along each axis (see
+            registration_qc.subsample)
+
+    Returns:
+        qc_report (dict): QC report:
+            - subsample (int), bins (int), min_nmi (float),
+                min_correlation (float): settings of the QC
+            - slabs (list of dict): metrics of each slab against the
+                low-res volume (see registration_qc.compare_images)
+            - repetitions (list of dict): metrics of each repetition
+                against the first one, over the voxels both cover
+                (passed: None if they do not overlap enough to be
+                compared)
+            - passed (Boolean): True if no comparison failed
+    """
+    lowres_data = registration_qc.subsample(
+        canonical_volume(load_volume(lowres_path)).get_data(), subsample)
+
+    # registered slabs vs low-res volume
+    print('Registration QC')
+    slab_qc_list = []
+    float_sums = {}
+    phantom_sums = {}
+    for record in slab_record_list:
+        s_float_data = registration_qc.subsample(
+            load_volume(record['float_path']).get_data(), subsample)
+        s_phantom_data = registration_qc.subsample(
+            load_volume(record['phantom_gap_path']).get_data(), subsample)
+        s_float_data = np.where(np.isfinite(s_float_data), s_float_data, 0)
+        s_phantom_data = np.where(
+            np.isfinite(s_phantom_data), s_phantom_data, 0)
+        support = s_phantom_data >= registration_qc.PHANTOM_THRESHOLD
+        s_normalised_data = np.zeros(s_float_data.shape)
+        np.divide(
+            s_float_data, s_phantom_data, out=s_normalised_data,
+            where=support)
+        metrics = registration_qc.compare_images(
+            s_normalised_data, lowres_data, support)
+        metrics['slab'] = '{0}{1}'.format(record['repetition'], record['slab'])
+        print('    {0}'.format(registration_qc.format_metrics(
+            's{0} vs low-res'.format(metrics['slab']), metrics)))
+        slab_qc_list.append(metrics)
+        #-- sums of the repetition
+        repetition = record['repetition']
+        if repetition in float_sums:
+            float_sums[repetition] += s_float_data
+            phantom_sums[repetition] += s_phantom_data
+        else:
+            float_sums[repetition] = s_float_data
+            phantom_sums[repetition] = s_phantom_data
+
+    # weighted average of each repetition vs first repetition
+    repetition_qc_list = []
+    repetition_list = record_repetitions(slab_record_list)
+    average_dict = {}
+    support_dict = {}
+    for repetition in repetition_list:
+        support_dict[repetition] = phantom_sums[repetition] >= \
+            registration_qc.PHANTOM_THRESHOLD
+        average_dict[repetition] = np.zeros(float_sums[repetition].shape)
+        np.divide(
+            float_sums.pop(repetition), phantom_sums.pop(repetition),
+            out=average_dict[repetition], where=support_dict[repetition])
+    for repetition in repetition_list[1:]:
+        reference = repetition_list[0]
+        metrics = registration_qc.compare_images(
+            average_dict[repetition], average_dict[reference],
+            support_dict[repetition] & support_dict[reference])
+        metrics['repetition'] = repetition
+        metrics['reference'] = reference
+        if metrics['nmi'] is None:
+            # repetitions that cover different parts of the head
+            metrics['passed'] = None
+        print('    {0}'.format(registration_qc.format_metrics(
+            'rs{0} vs rs{1}'.format(repetition, reference), metrics)))
+        repetition_qc_list.append(metrics)
+
+    qc_report = {
+        'subsample': subsample,
+        'bins': registration_qc.HISTOGRAM_BINS,
+        'min_nmi': registration_qc.MIN_NMI,
+        'min_correlation': registration_qc.MIN_CORRELATION,
+        'slabs': slab_qc_list,
+        'repetitions': repetition_qc_list,
+        'passed': all(
+            metrics['passed'] is not False
+            for metrics in slab_qc_list+repetition_qc_list)}
+    if not qc_report['passed']:
+        print('Warning: registration QC failed, please check the'
+              ' registered slabs')
+
+    return qc_report
+
+
+@instrumentation.staged
+def part3(
+        slab_record_list,
+        debugdir_path,
+        tempdir_path,
+        outdir_path,
+        keep_intermediates='all',
+        output_list=None,
+        accumulators_path=None,
+        stored_accumulators=None):
+    """Combine volumes after SPM registration
+
+    The function will combine, in a single pass over the registered
+    slabs, the slabs of each repetition, then the repetitions together,
+    using volumes registered with SPM: the registered slabs and
+    phantoms of each repetition are added to per-repetition
+    accumulators, from which all the weighted averages are computed.
+    The accumulators can be stored, so that a later run only has to
+    process the repetitions that changed, and reuse the stored
+    accumulators of the others.
+
+    Args:
+        slab_record_list (list of dict): registered slabs (see part1
+            and part2)
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary iamges are stored
+        tempdir_path (string): path to temporary subfolder where images
+            to be processed with SPM are duplicated and stored
+            Used here to know what files to delete
+        outdir_path (string): path to output dir, where results will
+            get stored
+        keep_intermediates (string): intermediate retention policy.
+            'all' (the sums of slabs/phantoms are written and the
+            registered slabs/phantoms are kept), 'registered' (only the
+            registered slabs/phantoms are kept) or 'none' (the
+            registered slabs/phantoms are removed as soon as they have
+            been added)
+        output_list (list of strings): final outputs to compute (see
+            output_names). The sums, phantom sums and divisions only
+            needed by other outputs are skipped. The registered slabs
+            and phantoms of a repetition no output needs are not read
+            (see part2). None to compute all the outputs
+        accumulators_path (string): path to the folder where the
+            accumulators of the repetitions get stored (see
+            accumulator_paths). None not to store them
+        stored_accumulators (dict): accumulators of an earlier run,
+            for the repetitions that are not in slab_record_list (see
+            reusable_accumulators). None if all the repetitions are
+            processed
+
+    Returns:
+        output_record_list (list of dict): file name, encoding, size
+            and write time of each final output (see save_output)
+    """
+    keep_all = keep_intermediates == 'all'
+    keep_registered = keep_intermediates in ['all', 'registered']
+    if stored_accumulators is None:
+        stored_accumulators = {}
+    repetition_list = sorted(
+        set(record_repetitions(slab_record_list)) | set(stored_accumulators),
+        key=int)
+    output_list = resolve_outputs(output_list, repetition_list)
+    # prune the computation to the requested outputs: the weighted
+    # average of a repetition is needed by its own output and by the
+    # sum of the averages, the sums of a repetition by its weighted
+    # average and by rs
+    sum_output = output_names(repetition_list)[-1]
+    need_rs = 'rs' in output_list
+    need_average_list = [
+        repetition for repetition in repetition_list
+        if 'rs{0}'.format(repetition) in output_list or
+        (len(repetition_list) > 1 and sum_output in output_list)]
+    need_repetition_list = [
+        repetition for repetition in repetition_list
+        if need_rs or repetition in need_average_list]
+
+    # Add blocks
+    # Only the non-zero bounding box of each volume is processed. The
+    # phantom sums stored in the debug folder are kept cropped, while
+    # images stored in the output folder are expanded to the full grid.
+    # The sums are computed in memory and only written if all
+    # intermediates are kept.
+    print('Add blocks/repetitions')
+    #-- accumulate the slabs and phantoms of each repetition
+    float_sums = {}
+    phantom_sums = {}
+    for repetition in need_repetition_list:
+        if repetition in stored_accumulators:
+            print('{0} repetition - reuse the stored sums'.format(
+                ordinal(int(repetition)).capitalize()))
+            [float_sum_path, phantom_sum_path] = stored_accumulators[
+                repetition]['sum_path_list']
+            float_sums[repetition] = load_volume(float_sum_path)
+            phantom_sums[repetition] = load_volume(phantom_sum_path)
+            continue
+        repetition_record_list = [
+            record for record in slab_record_list
+            if record['repetition'] == repetition]
+        print('{0} repetition - add slabs'.format(
+            ordinal(int(repetition)).capitalize()))
+        for record in repetition_record_list:
+            float_sums[repetition] = accumulate_volume(
+                float_sums.get(repetition),
+                load_volume(record['float_path']))
+            phantom_sums[repetition] = accumulate_volume(
+                phantom_sums.get(repetition),
+                load_volume(record['phantom_gap_path']))
+        if not keep_registered:
+            remove_images(
+                [
+                    impath for record in repetition_record_list
+                    for impath in [
+                        record['float_path'], record['phantom_gap_path']]],
+                debugdir_path)
+    if keep_all:
+        for repetition in need_repetition_list:
+            save_volume(
+                expand_volume(float_sums[repetition]),
+                intermediate_path(
+                    outdir_path, 'rs{0}_float'.format(repetition)))
+            save_volume(
+                phantom_sums[repetition],
+                intermediate_path(
+                    debugdir_path,
+                    'phantom_one_gap_s{0}'.format(repetition)))
+    #-- store the accumulators (cropped), for later incremental runs
+    if accumulators_path is not None:
+        os.makedirs(accumulators_path, exist_ok=True)
+        for repetition in need_repetition_list:
+            sum_path_list = accumulator_paths(accumulators_path, repetition)
+            if repetition in stored_accumulators:
+                # unchanged: copy the stored files
+                for stored_path, sum_path in zip(
+                        stored_accumulators[repetition]['sum_path_list'],
+                        sum_path_list):
+                    shutil.copyfile(stored_path, sum_path)
+                    count_bytes_written(sum_path)
+                continue
+            for sum_volume, sum_path in zip(
+                    [float_sums[repetition], phantom_sums[repetition]],
+                    sum_path_list):
+                save_volume(
+                    sum_volume, sum_path, ACCUMULATORS_COMPRESSLEVEL)
+    #-- add repetitions
+    if need_rs:
+        print('Add repetitions')
+        rs_float = None
+        s_phantom_gap = None
+        for repetition in repetition_list:
+            rs_float = accumulate_volume(rs_float, float_sums[repetition])
+            s_phantom_gap = accumulate_volume(
+                s_phantom_gap, phantom_sums[repetition])
+        if keep_all:
+            save_volume(
+                expand_volume(rs_float),
+                intermediate_path(outdir_path, 'rs_float'))
+            save_volume(
+                s_phantom_gap,
+                intermediate_path(debugdir_path, 'phantom_one_gap_s'))
+
+    # Normalise blocks using phantoms
+    # The final outputs are saved with the chosen encoding (see
+    # save_output)
+    print('Normalise blocks using phantoms')
+    output_record_list = []
+    #-- 'rs'
+    if need_rs:
+        print('Normalise \'rs\'')
+        rs_float_ponderated = volume_division(rs_float, s_phantom_gap)
+        del rs_float, s_phantom_gap
+        output_record_list.append(save_output(
+            expand_volume(rs_float_ponderated), outdir_path,
+            'rs_float_ponderated'))
+        del rs_float_ponderated
+    #-- 'rs1', 'rs2', ...
+    ponderated_list = []
+    for repetition in need_average_list:
+        print('Normalise \'rs{0}\''.format(repetition))
+        rsn_float_ponderated = volume_division(
+            float_sums.pop(repetition), phantom_sums.pop(repetition))
+        if 'rs{0}'.format(repetition) in output_list:
+            output_record_list.append(save_output(
+                expand_volume(rsn_float_ponderated), outdir_path,
+                'rs{0}_float_ponderated'.format(repetition)))
+        ponderated_list.append(rsn_float_ponderated)
+    #-- 'rs_1_2' -> add 'rs1', 'rs2', ...
+    if len(repetition_list) > 1 and sum_output in output_list:
+        print('\'{0}\': {1}'.format(sum_output, ' + '.join(
+            '\'rs{0}\''.format(repetition) for repetition in repetition_list)))
+        rs_sum_float_ponderated = None
+        for rsn_float_ponderated in ponderated_list:
+            rs_sum_float_ponderated = accumulate_volume(
+                rs_sum_float_ponderated, rsn_float_ponderated)
+        output_record_list.append(save_output(
+            expand_volume(rs_sum_float_ponderated), outdir_path,
+            '{0}_float_ponderated'.format(sum_output)))
+    del ponderated_list
+
+    # gzip all images that have not been gzipped yet: kept registered
+    # images, and kept intermediary images if stored uncompressed (see
+    # INTERMEDIATE_FORMAT). Final outputs keep their chosen format.
+    output_path_list = [
+        os.path.join(outdir_path, output_record['filename'])
+        for output_record in output_record_list]
+    gzip_images(list_uncompressed_images(debugdir_path), debugdir_path)
+    gzip_images(
+        [
+            impath for impath in list_uncompressed_images(outdir_path)
+            if impath not in output_path_list],
+        outdir_path)
+
+    # remove temporary folder
+    if os.path.isdir(tempdir_path):
+        shutil.rmtree(tempdir_path)
+    else:
+        error_msg = 'Error: folder {0} does not exist'.format(tempdir_path)
+        raise IOError(error_msg)
+
+    return output_record_list
+
+
+def show_completion_message(
+        outdir_path,
+        debugdir_path,
+        keep_intermediates='all',
+        disk_usage_peak=None,
+        estimated_peak_memory=None,
+        run_report_path=None,
+        output_record_list=None,
+        qc_report=None):
+    """Show message to indicate successfull completion
+
+    Show the list of files that have been created and give the path to
+    intermediary ('debug') and temporary ('temp') folders that can be
+    removed to save space. Also show the disk usage and the amount of
+    data written with the chosen intermediate retention policy.
+
+    Args:
+        outdir_path (string): absolute path to output dir, where
+            results will get stored
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary images are stored
+        keep_intermediates (string): intermediate retention policy
+        disk_usage_peak (int): largest size of the working dir, sampled
+            after each write to it, in bytes
+        estimated_peak_memory (int): peak memory estimated by the
+            preflight check, in bytes, shown next to the measured one
+        run_report_path (string): path to the run report
+        output_record_list (list of dict): size, write time and
+            quantisation error of the final outputs (see save_output)
+        qc_report (dict): registration QC report (see
+            registration_quality). None if the QC was not run
+
+    Returns:
+        N/A
+    """
+    print('Recombination code successfully run.')
+    print('')
+    print('Temporary data stored in:')
+    print(debugdir_path)
+    print('Please remove the above folders to save storage space.')
+    print('')
+    print('Output data to be found in:')
+    print(outdir_path)
+    print('')
+    print('Intermediate retention policy: {0}'.format(keep_intermediates))
+    if output_record_list:
+        encoding = '{0}, {1}'.format(
+            output_record_list[0]['dtype'], output_record_list[0]['format'])
+        if output_record_list[0]['compresslevel'] is not None:
+            encoding = '{0}, gzip level {1}'.format(
+                encoding, output_record_list[0]['compresslevel'])
+        print('Final outputs ({0}):'.format(encoding))
+        for output_record in output_record_list:
+            print('    {0}'.format(format_output_record(output_record)))
+    if qc_report is not None:
+        print('Registration QC: {0}'.format(
+            'passed' if qc_report['passed'] else
+            'FAILED (see the run report)'))
+    print('Disk usage of output folder: {0:.1f} MB'.format(
+        directory_size(outdir_path)/1024.0**2))
+    if disk_usage_peak is not None:
+        print('Disk usage of working folder (peak): {0:.1f} MB'.format(
+            disk_usage_peak/1024.0**2))
+    print('Data written: {0:.1f} MB'.format(
+        instrumentation.get_counters()['bytes_written']/1024.0**2))
+    counters = instrumentation.get_counters()
+    if counters.get('prefetch_io_seconds'):
+        print('Input decompression: {0:.2f} s, of which {1:.2f} s hidden'
+              ' behind the computations (prefetch)'.format(
+                  counters['prefetch_io_seconds'],
+                  counters['prefetch_hidden_seconds']))
+    if estimated_peak_memory is not None:
+        print('Peak memory (estimated): {0:.1f} MB'.format(
+            estimated_peak_memory/1024.0**2))
+    peak_rss = instrumentation.peak_rss_bytes()
+    if peak_rss is not None:
+        print('Peak memory (measured): {0:.1f} MB'.format(
+            peak_rss/1024.0**2))
+    counters_lines = instrumentation.format_counters()
+    if counters_lines:
+        print('')
+        print('Instrumentation counters:')
+        for counters_line in counters_lines:
+            print(counters_line)
+    if run_report_path is not None:
+        print('')
+        print('Run report (per-stage timing, memory and I/O):')
+        print(run_report_path)
+
+
+def write_run_report(
+        args,
+        preflight_report,
+        disk_usage_peak,
+        stage_list,
+        run_report_path,
+        output_record_list=None,
+        qc_report=None,
+        reused_repetition_list=None):
+    """Write the run report of a recombination
+
+    The report contains the inputs and settings of the run, its
+    resource usage (time, memory, I/O, time spent waiting for Matlab)
+    and the records of all its stages (see instrumentation.stage), so
+    that runs can be compared to find regressions or slow storage.
+
+    Args:
+        args (argparse.Namespace): parsed arguments
+        preflight_report (dict): preflight report (see
+            preflight.run_preflight)
+        disk_usage_peak (int): peak disk usage of the working dir, in
+            bytes
+        stage_list (list of dict): records of the stages of the run
+        run_report_path (string): path to the JSON run report
+        output_record_list (list of dict): encoding, size, write time
+            and quantisation error of the final outputs (see
+            save_output)
+        qc_report (dict): registration QC metrics and pass/fail flags
+            (see registration_quality). None if the QC was not run
+        reused_repetition_list (list of strings): repetitions whose
+            accumulators were reused from an earlier run (see
+            reusable_accumulators)
+
+    Returns:
+        N/A
+    """
+    # run totals: sum of the outermost stages
+    outer_stage_list = [
+        record for record in stage_list if record['depth'] == 0]
+    counters = {}
+    for total in instrumentation.stage_totals(outer_stage_list).values():
+        for name, value in total['counters'].items():
+            counters[name] = counters.get(name, 0)+value
+    slab_grid = slab_grid_from_args(args)
+    input_dict = slab_input_dict(slab_grid)
+    input_dict['lowres'] = args.lowres_path
+    run_report = {
+        'outdir': args.outdir_path,
+        'inputs': input_dict,
+        'settings': {
+            'keep_intermediates': args.keep_intermediates,
+            'intermediate_format': INTERMEDIATE_FORMAT,
+            'registration': REGISTRATION_BACKEND,
+            'repetitions': len(slab_grid),
+            'slabs_per_repetition': len(slab_grid[0]),
+            'outputs': resolve_outputs(
+                args.outputs, grid_repetitions(slab_grid)),
+            'output_dtype': OUTPUT_DTYPE,
+            'output_format': OUTPUT_FORMAT,
+            'output_compression': OUTPUT_COMPRESSLEVEL,
+            'qc_subsample': None if args.no_qc else args.qc_subsample,
+            'preview': None,
+            'incremental': None,
+            'accumulators': (
+                not args.no_accumulators and PREVIEW_FACTOR is None),
+            'cache_size_mb': VOLUME_CACHE.max_bytes//(1024*1024),
+            'prefetch_workers': args.prefetch_workers},
+        'elapsed_seconds': run_elapsed_seconds(stage_list),
+        'cpu_seconds': sum(
+            record['cpu_seconds'] for record in outer_stage_list),
+        'peak_rss_bytes': instrumentation.peak_rss_bytes(),
+        'children_peak_rss_bytes': instrumentation.children_peak_rss_bytes(),
+        'estimated_peak_memory_bytes':
+            preflight_report['estimates']['peak_memory_bytes'],
+        'disk_usage_peak_bytes': disk_usage_peak,
+        'output_bytes': directory_size(args.outdir_path),
+        'output_files': output_record_list or [],
+        'registration_qc': qc_report,
+        'counters': counters,
+        'stage_totals': instrumentation.stage_totals(stage_list),
+        'stages': stage_list}
+    if PREVIEW_FACTOR is not None:
+        run_report['settings']['preview'] = {
+            'factor': PREVIEW_FACTOR,
+            'separation': PREVIEW_SEPARATION,
+            'tolerance_scale': PREVIEW_TOLERANCE_SCALE,
+            'non_diagnostic': True}
+    if getattr(args, 'incremental', None) is not None:
+        run_report['settings']['incremental'] = {
+            'previous': args.incremental,
+            'reused_repetitions': reused_repetition_list or []}
+    with open(run_report_path, 'w') as run_report_file:
+        json.dump(run_report, run_report_file, indent=2)
+
+
+def run_elapsed_seconds(stage_list):
+    """Elapsed time of a run
+
+    Args:
+        stage_list (list of dict): records of the stages of the run
+
+    Returns:
+        elapsed_seconds (float): time since the first stage of the run
+            started. None if the run has no stage
+    """
+    if not stage_list:
+        return None
+
+    return instrumentation.run_seconds()-min(
+        record['start_seconds'] for record in stage_list)
+
+
+def write_run_trace(args, stage_list):
+    """Write the timeline of a recombination, if one was requested
+
+    Args:
+        args (argparse.Namespace): parsed arguments (trace_path: path
+            to the Chrome trace file, None for no trace)
+        stage_list (list of dict): records of the stages of the run
+
+    Returns:
+        N/A
+    """
+    trace_path = getattr(args, 'trace_path', None)
+    if trace_path is None:
+        return
+    instrumentation.write_trace(stage_list, trace_path)
+    print('Timeline of the run written to {0}'.format(trace_path))
+
+
+def run_preflight(args):
+    """Run the preflight check of a subject and show its report
+
+    Args:
+        args (argparse.Namespace): parsed arguments
+
+    Returns:
+        preflight_report (dict): preflight report (see
+            preflight.run_preflight)
+    """
+    if args.no_scratch:
+        workdir_parent_path = args.outdir_path
+    else:
+        workdir_parent_path = args.scratch_dir
+    slab_grid = slab_grid_from_args(args)
+    slab_count = check_slab_grid(slab_grid)
+    resolve_outputs(args.outputs, grid_repetitions(slab_grid))
+    if not args.no_qc and args.qc_subsample < 1:
+        raise ValueError('the QC subsampling step must be a positive integer')
+    if args.prefetch_workers < 0:
+        raise ValueError('the number of prefetch workers cannot be negative')
+    preflight_report = preflight.run_preflight(
+        [
+            slab_path for slab_path_list in slab_grid
+            for slab_path in slab_path_list],
+        args.lowres_path,
+        args.outdir_path,
+        workdir_parent_path,
+        args.keep_intermediates,
+        args.cache_size,
+        args.memory_limit,
+        slab_count)
+    preflight.print_report(preflight_report)
+
+    return preflight_report
+
+
+def configure_pipeline(args, cache_size_mb):
+    """Set the module-level settings of the pipeline
+
+    Args:
+        args (argparse.Namespace): parsed arguments
+        cache_size_mb (int): size (in MB) of the in-memory volume cache
+
+    Returns:
+        N/A
+    """
+    # set the size of the in-memory volume cache
+    VOLUME_CACHE.set_max_bytes(cache_size_mb*1024*1024)
+    # set the file format of intermediary images
+    set_intermediate_format(args.intermediate_format)
+    # set the encoding of the final outputs
+    set_output_encoding(
+        args.output_dtype, args.output_format, args.output_compression)
+    # set the preview mode
+    if getattr(args, 'preview', False):
+        set_preview(args.preview_factor)
+    else:
+        set_preview(None)
+    # set the registration backend
+    set_registration_backend(args.registration, args)
+
+
+def start_prefetch(slab_grid, lowres_path, keep_intermediates, workers):
+    """Start decompressing the inputs of a run in the background
+
+    The inputs are decompressed in the order part1 (or prepare_preview)
+    reads them, so that the next inputs get decompressed while the
+    current ones are processed.
 
     Args:
-        ref_path (String): path to reference (target) image.
-        source_path (String): path to source image. Will get modified
-            (registered) by the function.
-        other_path (String): path to any other image to be transformed
-            according to the affine transformation from source to ref.
-            Will get modified (affine transformed) by the function
-        tempdir_path (string): path to temporary subfolder where images
-            to be processed with SPM are duplicated and stored
+        slab_grid (list of lists of strings): paths to the slabs of
+            each repetition (see slab_grid_from_args)
+        lowres_path (string): path to low resolution volume
+        keep_intermediates (string): intermediate retention policy
+        workers (int): number of inputs decompressed at the same time.
+            0 disables the prefetch
 
     Returns:
         N/A
     """
-    # duplicate source as SPM co-registration modifies the header
-    #-- duplicate source
-    source_filename = os.path.basename(source_path)
-    source_temp_path = os.path.join(tempdir_path, source_filename)
-    shutil.copyfile(source_path, source_temp_path)
-    #-- duplicate other image
-    other_filename = os.path.basename(other_path)
-    other_temp_path = os.path.join(tempdir_path, other_filename)
-    shutil.copyfile(other_path, other_temp_path)
+    global INPUT_PREFETCHER
+
+    stop_prefetch()
+    if workers < 1:
+        return
+    input_path_list = [
+        slab_path for slab_path_list in slab_grid
+        for slab_path in slab_path_list]
+    if PREVIEW_FACTOR is None and keep_intermediates != 'all':
+        # the low-res volume is copied before the slabs are read
+        input_path_list.insert(0, lowres_path)
+    else:
+        input_path_list.append(lowres_path)
+    INPUT_PREFETCHER = prefetch.InputPrefetcher(workers)
+    INPUT_PREFETCHER.prefetch(input_path_list)
 
-    # co-register using SPM
-    #-- create SPM co-register object
-    register_prefix = 'r'
-    coreg = create_coregister(
-        ref_path, source_temp_path, other_temp_path, register_prefix)
-    #-- run SPM co-registration
-    coreg.run()
 
-    # copy the output registered file to input (will erase original file)
-    #-- source
-    source_registered_path = os.path.join(
-        tempdir_path, '{0}{1}'.format(register_prefix, source_filename))
-    shutil.copyfile(source_registered_path, source_path)
-    #-- other
-    other_registered_path = os.path.join(
-        tempdir_path, '{0}{1}'.format(register_prefix, other_filename))
-    shutil.copyfile(other_registered_path, other_path)
+def stop_prefetch():
+    """Stop decompressing the inputs in the background
 
+    Inputs not taken by the pipeline are discarded.
+
+    Args:
+        N/A
+
+    Returns:
+        N/A
+    """
+    global INPUT_PREFETCHER
+
+    if INPUT_PREFETCHER is None:
+        return
+    INPUT_PREFETCHER.close()
+    INPUT_PREFETCHER = None
 
-def volume_addition(in_volume1, in_volume2):
-    """Add two volumes together
+
+def start_recombination(args, spm_path):
+    """Prepare the folders of a recombination
 
     Args:
-        in_volume1 (nibabel volume): data will be a [m,n,o] array
-        in_volume2 (nibabel volume): data will be a [m,n,o] array
+        args (argparse.Namespace): parsed arguments
+        spm_path (string): path to SPM folder (None if SPM is not used)
 
     Returns:
-        out_volume (nibabel volume): data will be a [m,n,o] array, sum
-            of in_volume1[array] and in_volume2[array], where both
-            in_volume1[array] and in_volume2[array] have been reoriented
-            to a canonical orientation ('RAS')
+        workdir_path (string): path to the working directory
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary images are stored
+        tempdir_path (string): path to 'temp' subfolder
     """
-    # initialise data and affine matrices from input volumes
-    #-- convert both volumes to RAS orientation
-    in_volume1_ras = nib.as_closest_canonical(in_volume1)
-    in_volume2_ras = nib.as_closest_canonical(in_volume2)
-    #-- volumes data and affine
-    in_volume1_data = in_volume1_ras.get_data()
-    in_volume1_affine = in_volume1_ras.affine.copy()
-    in_volume2_data = in_volume2_ras.get_data()
-    #-- remove NaN values
-    in_volume1_data[np.isnan(in_volume1_data)] = 0
-    in_volume2_data[np.isnan(in_volume2_data)] = 0
-    #-- sanity check
-    if in_volume1_data.shape != in_volume2_data.shape:
-        raise ValueError('the input volumes must have the same size')
-    # add volumes together
-    out_volume_data = in_volume1_data+in_volume2_data
-    out_volume_affine = in_volume1_affine.copy()
-    out_volume = nib.Nifti1Image(out_volume_data, out_volume_affine)
+    if args.no_scratch:
+        scratch_path = None
+    else:
+        scratch_path = args.scratch_dir
 
-    return out_volume
+    # prepare folders
+    [workdir_path, debugdir_path, tempdir_path] = prepare_folders(
+        args.outdir_path, scratch_path)
+    track_disk_usage(workdir_path)
+
+    try:
+        # store [spm path] location in file
+        if spm_path is not None:
+            spm_path_filestore(debugdir_path, spm_path)
+    except Exception:
+        pop_disk_usage_peak(workdir_path)
+        show_failure_message(workdir_path, args.outdir_path)
+        raise
 
+    return [workdir_path, debugdir_path, tempdir_path]
 
-def file_volume_addition(in_volume1_path, in_volume2_path, out_volume_path):
-    """Add two volumes from files and save
 
-    Read input volumes from files, add and save.
+def show_failure_message(workdir_path, outdir_path):
+    """Show where the working directory of a failed recombination is
 
     Args:
-        in_volume1_path (string): path to input volume 1
-        in_volume2_path (string): path to input volume 2
-        out_volume_path (string): path to output volume
+        workdir_path (string): path to the working directory
+        outdir_path (string): path to the output directory
 
     Returns:
         N/A
     """
-    # read input volumes
-    in_volume1 = nib.load(in_volume1_path)
-    in_volume2 = nib.load(in_volume2_path)
-    # add volumes
-    out_volume = volume_addition(in_volume1, in_volume2)
-    # save output volume
-    nib.save(out_volume, out_volume_path)
+    if workdir_path != outdir_path:
+        print('Recombination failed. Working directory left in:')
+        print(workdir_path)
 
 
-def volume_division(in_volume1, in_volume2):
-    """Divide a volume by another one
+def finish_recombination(
+        args,
+        preflight_report,
+        workdir_path,
+        debugdir_path,
+        tempdir_path,
+        slab_record_list,
+        lowres_path=None,
+        stored_accumulators=None):
+    """Register and combine the pre-processed slabs of a subject
+
+    Launch in turn the last two parts of the recombination algorithm
+    and move the results to the output directory.
 
     Args:
-        in_volume1 (nibabel volume): data will be a [m,n,o] array
-        in_volume2 (nibabel volume): data will be a [m,n,o] array
+        args (argparse.Namespace): parsed arguments
+        preflight_report (dict): preflight report (see
+            preflight.run_preflight)
+        workdir_path (string): path to the working directory
+        debugdir_path (string): path to 'debug' subfolder where all
+            intermediary images are stored
+        tempdir_path (string): path to 'temp' subfolder
+        slab_record_list (list of dict): pre-processed slabs returned
+            by part1
+        lowres_path (string): path to the low-res volume the slabs get
+            registered to (e.g., downsampled for a preview). Defaults to
+            the input low-res volume
+        stored_accumulators (dict): accumulators of an earlier run,
+            reused for the repetitions that are not in slab_record_list
+            (see reusable_accumulators). None if all the repetitions
+            are processed
 
     Returns:
-        out_volume (nibabel volume): data will be a [m,n,o] array,
-            division of in_volume1[array] by in_volume2[array], where
-            both in_volume1[array] and in_volume2[array] have been
-            reoriented to a canonical orientation ('RAS')
+        N/A
     """
-    # read input volumes
-    #-- convert both volumes to RAS orientation
-    in_volume1_ras = nib.as_closest_canonical(in_volume1)
-    in_volume2_ras = nib.as_closest_canonical(in_volume2)
-    #-- volumes data and affine
-    in_volume1_data = in_volume1_ras.get_data()
-    in_volume1_affine = in_volume1_ras.affine.copy()
-    in_volume2_data = in_volume2_ras.get_data()
-    #-- sanity check
-    if in_volume1_data.shape != in_volume2_data.shape:
-        raise ValueError('the input volumes must have the same size')
-    #-- get rid of NaN values
-    in_volume1_data[np.isnan(in_volume1_data)] = 0
-    in_volume2_data[np.isnan(in_volume2_data)] = 0
+    if stored_accumulators is None:
+        stored_accumulators = {}
+    repetition_list = sorted(
+        set(record_repetitions(slab_record_list)) | set(stored_accumulators),
+        key=int)
+    if lowres_path is None:
+        lowres_path = args.lowres_path
+    # the accumulators of a preview (downsampled) are not reusable
+    accumulators_path = None
+    if not args.no_accumulators and PREVIEW_FACTOR is None:
+        accumulators_path = os.path.join(workdir_path, ACCUMULATORS_DIRNAME)
 
-    # divide the two volumes
-    #-- check volume 2 pixels 0-intensities
-    volume2_0_x, volume2_0_y, volume2_0_z = np.where(in_volume2_data == 0)
-    in_volume2_data[in_volume2_data == 0] = 1
-    #-- main division
-    out_volume_data = in_volume1_data/in_volume2_data
-    #-- re-process volume 2 0-intensity pixels
-    out_volume_data[volume2_0_x, volume2_0_y, volume2_0_z] = 0
+    try:
+        output_list = resolve_outputs(args.outputs, repetition_list)
+
+        # part 2 - register (the transforms of the reused repetitions
+        # are kept)
+        transforms = {}
+        for repetition in sorted(stored_accumulators, key=int):
+            transforms.update(stored_accumulators[repetition]['transforms'])
+        if slab_record_list:
+            transforms.update(part2(
+                slab_record_list,
+                debugdir_path,
+                tempdir_path,
+                args.keep_intermediates,
+                output_repetitions(output_list, repetition_list)))
+        write_registration_transforms(
+            transforms,
+            os.path.join(workdir_path, REGISTRATION_TRANSFORMS_FILENAME))
+
+        # registration QC (registered slabs only)
+        qc_report = None
+        if not args.no_qc and slab_record_list:
+            qc_report = registration_quality(
+                [
+                    record for record in slab_record_list
+                    if image_key(record['float_path']) in transforms],
+                lowres_path,
+                args.qc_subsample)
+
+        # part 3 - combine volumes
+        output_record_list = part3(
+            slab_record_list,
+            debugdir_path,
+            tempdir_path,
+            workdir_path,
+            args.keep_intermediates,
+            output_list,
+            accumulators_path,
+            stored_accumulators)
+        if accumulators_path is not None:
+            write_accumulators_manifest(
+                accumulators_path,
+                slab_grid_from_args(args),
+                args.lowres_path,
+                output_repetitions(output_list, repetition_list),
+                transforms)
+    except Exception:
+        pop_disk_usage_peak(workdir_path)
+        show_failure_message(workdir_path, args.outdir_path)
+        write_run_trace(
+            args,
+            instrumentation.pop_stages(instrumentation.get_run_label()))
+        raise
+
+    # peak disk usage, sampled after each write to the working directory
+    disk_usage_peak = pop_disk_usage_peak(workdir_path)
+
+    # move results to the output directory
+    commit_outputs(workdir_path, args.outdir_path)
+
+    # write the run report next to the outputs
+    stage_list = instrumentation.pop_stages(instrumentation.get_run_label())
+    run_report_path = os.path.join(args.outdir_path, RUN_REPORT_FILENAME)
+    write_run_report(
+        args, preflight_report, disk_usage_peak, stage_list,
+        run_report_path, output_record_list, qc_report,
+        sorted(stored_accumulators, key=int))
+    write_run_trace(args, stage_list)
 
-    # save output
-    out_volume_affine = in_volume1_affine.copy()
-    out_volume = nib.Nifti1Image(out_volume_data, out_volume_affine)
+    # show completion_message
+    show_completion_message(
+        args.outdir_path,
+        os.path.join(args.outdir_path, 'debug'),
+        args.keep_intermediates,
+        disk_usage_peak,
+        preflight_report['estimates']['peak_memory_bytes'],
+        run_report_path,
+        output_record_list,
+        qc_report)
+    if PREVIEW_FACTOR is not None:
+        print('')
+        print('Preview (downsampled by {0}, coarse registration) computed'
+              ' in {1:.1f} s: {2}'.format(
+                  PREVIEW_FACTOR, run_elapsed_seconds(stage_list),
+                  PREVIEW_DESCRIPTION))
+
+
+def run_recombination(args, spm_path, preflight_report):
+    """Recombine the slabs of a subject
+
+    Launch in turn the three parts of the recombination algorithm and
+    move the results to the output directory.
 
-    return out_volume
+    Args:
+        args (argparse.Namespace): parsed arguments
+        spm_path (string): path to SPM folder
+        preflight_report (dict): preflight report (see
+            preflight.run_preflight)
 
+    Returns:
+        N/A
+    """
+    instrumentation.reset_stages()
+    configure_pipeline(args, preflight_report['cache_size_mb'])
+    [workdir_path, debugdir_path, tempdir_path] = start_recombination(
+        args, spm_path)
 
-def file_volume_division(in_volume1_path, in_volume2_path, out_volume_path):
-    """Divide two volumes from files and save
+    try:
+        slab_grid = slab_grid_from_args(args)
+        lowres_path = args.lowres_path
+        # incremental run - only process the repetitions whose inputs
+        # changed since the earlier run
+        stored_accumulators = {}
+        if getattr(args, 'incremental', None) is not None:
+            stored_accumulators = reusable_accumulators(
+                args.incremental, slab_grid, lowres_path)
+        repetition_list = [
+            repetition for repetition in grid_repetitions(slab_grid)
+            if repetition not in stored_accumulators]
+        slab_grid = [
+            slab_path_list for repetition, slab_path_list in zip(
+                grid_repetitions(slab_grid), slab_grid)
+            if repetition in repetition_list]
+        # decompress the inputs in the background
+        start_prefetch(
+            slab_grid, lowres_path, args.keep_intermediates,
+            args.prefetch_workers)
+        # preview - downsample the inputs
+        if PREVIEW_FACTOR is not None:
+            slab_grid, lowres_path = prepare_preview(
+                slab_grid, lowres_path, debugdir_path, PREVIEW_FACTOR)
+        # part 1 - prepare input to SPM
+        slab_record_list = []
+        if slab_grid:
+            slab_record_list = part1(
+                slab_grid,
+                lowres_path,
+                debugdir_path,
+                args.keep_intermediates,
+                repetition_list)
+    except Exception:
+        pop_disk_usage_peak(workdir_path)
+        show_failure_message(workdir_path, args.outdir_path)
+        write_run_trace(args, instrumentation.pop_stages())
+        raise
+    finally:
+        # all the inputs have been read
+        stop_prefetch()
+
+    # part 2 and part 3 - register and combine volumes
+    finish_recombination(
+        args, preflight_report, workdir_path, debugdir_path, tempdir_path,
+        slab_record_list, lowres_path=lowres_path,
+        stored_accumulators=stored_accumulators)
+
+
+def recombine_subject(
+        subject,
+        args,
+        spm_path,
+        log_path,
+        progress_queue=None,
+        progress_key=None):
+    """Recombine the slabs of a subject of a batch
+
+    Run the preflight check and the recombination of a subject, with
+    all messages written to a log file. Errors do not propagate: they
+    are reported in the result, so that the other subjects of the batch
+    keep running.
 
-    Read input volumes from files, divide and save.
+    Args:
+        subject (string): subject name
+        args (argparse.Namespace): parsed arguments of the subject
+        spm_path (string): path to SPM folder (None if only the
+            preflight check is run)
+        log_path (string): path to the log file of the subject
+        progress_queue (multiprocessing queue): queue where the messages
+            of the subject are also put, as (progress_key, line) tuples.
+            None to only write them to the log file
+        progress_key (string): identifier of the subject in the
+            progress queue
+
+    Returns:
+        result (dict): status ('success', 'checked' or 'failed'),
+            elapsed time, estimated and measured peak memory (of this
+            process, and of the largest child process, e.g. Matlab,
+            since the worker started), output dir and error message of
+            the subject
+    """
+    result = {
+        'subject': subject,
+        'status': 'success',
+        'elapsed_seconds': None,
+        'estimated_peak_memory_mb': None,
+        'peak_rss_mb': None,
+        'children_peak_rss_mb': None,
+        'outdir': args.outdir_path,
+        'error': ''}
+    start_time = time.time()
+    # counters and peak memory are reported per subject
+    instrumentation.reset_counters()
+    instrumentation.reset_peak_rss()
+    if args.spm_path:
+        # worker processes do not necessarily inherit the Matlab paths
+        mlab.MatlabCommand.set_default_paths(args.spm_path)
+    with open(log_path, 'w') as log_file:
+        if progress_queue is None:
+            out_stream = log_file
+        else:
+            out_stream = service.ProgressStream(
+                log_file, progress_queue, progress_key)
+        with contextlib.redirect_stdout(out_stream):
+            try:
+                preflight_report = run_preflight(args)
+                result['estimated_peak_memory_mb'] = round(
+                    preflight_report['estimates']['peak_memory_bytes'] /
+                    1024.0**2, 1)
+                if args.preflight_only:
+                    result['status'] = 'checked'
+                else:
+                    run_recombination(args, spm_path, preflight_report)
+            except Exception as exc:
+                traceback.print_exc(file=log_file)
+                result['status'] = 'failed'
+                result['error'] = '{0}: {1}'.format(type(exc).__name__, exc)
+    # cached volumes belong to the working dir of this subject
+    VOLUME_CACHE.clear()
+    result['elapsed_seconds'] = round(time.time()-start_time, 3)
+    peak_rss = instrumentation.peak_rss_bytes()
+    if peak_rss is not None:
+        result['peak_rss_mb'] = round(peak_rss/1024.0**2, 1)
+    children_peak_rss = instrumentation.children_peak_rss_bytes()
+    if children_peak_rss is not None:
+        result['children_peak_rss_mb'] = round(
+            children_peak_rss/1024.0**2, 1)
+
+    return result
+
+
+def batch_main(argv):
+    """Recombine code: batch mode
+
+    Recombine the slabs of every subject listed in a CSV manifest or
+    found in a BIDS-style directory, on a pool of worker processes. SPM
+    is looked for once for the whole batch. The number of subjects
+    running at the same time is limited by the memory and CPU budgets,
+    using the resources estimated from the input headers. The log of
+    each subject is written to [out_dir]/logs/[subject].log and the
+    status and elapsed time of each subject to
+    [out_dir]/batch_summary.csv.
 
     Args:
-        in_volume1_path (string): path to input volume 1
-        in_volume2_path (string): path to input volume 2
-        out_volume_path (string): path to output volume
+        argv (list of strings): command-line arguments, without the
+            program name and the 'batch' command
 
     Returns:
         N/A
     """
-    # read input volumes
-    in_volume1 = nib.load(in_volume1_path)
-    in_volume2 = nib.load(in_volume2_path)
-    # add volumes
-    out_volume = volume_division(in_volume1, in_volume2)
-    # save output volume
-    nib.save(out_volume, out_volume_path)
+    # parse command-line arguments
+    args, cli_usage = read_batch_cli_args(argv)
 
+    # list subjects
+    subject_list = batch.list_subjects(args.input_path, args.outdir_path)
 
-def gzip_images(impath_list, dirpath):
-    """Gzip compress all images in a list
+    # check SPM available (once for all subjects)
+    spm_path = None
+    if not args.preflight_only:
+        spm_path = prepare_registration(args, cli_usage)
 
-    Will copy each image in the list to a compressed file and remove the
-    (non-compressed) original file
+    # prepare folders
+    logdir_path = os.path.join(args.outdir_path, 'logs')
+    if not os.path.isdir(logdir_path):
+        os.makedirs(logdir_path)
+
+    # memory budget of the batch and memory available to each subject
+    memory_budget_bytes = None
+    if args.memory_budget is not None:
+        memory_budget_bytes = args.memory_budget*1024*1024
+    memory_limit_bytes = memory_budget_bytes
+    if args.memory_limit is not None:
+        memory_limit_bytes = args.memory_limit*1024*1024
+        if memory_budget_bytes is not None:
+            memory_limit_bytes = min(memory_limit_bytes, memory_budget_bytes)
+
+    # arguments and estimated resources of each subject
+    subject_args_list = []
+    cost_list = []
+    for subject in subject_list:
+        subject_args = argparse.Namespace(**vars(args))
+        set_subject_slabs(subject_args, subject)
+        subject_args.lowres_path = subject['lowres']
+        subject_args.outdir_path = subject['outdir']
+        try:
+            slab_info_list = [
+                preflight.read_header_info(slab_path)
+                for slab_path in subject_args.slab_paths]
+            lowres_info = preflight.read_header_info(subject['lowres'])
+        except Exception:
+            # the preflight check of the subject will report the error
+            cost_list.append(None)
+        else:
+            estimates, cache_size_mb, _ = preflight.plan_memory(
+                slab_info_list, lowres_info, args.keep_intermediates,
+                args.cache_size, memory_limit_bytes,
+                subject_args.slabs_per_repetition)
+            # run the subject in the memory mode that was estimated
+            subject_args.cache_size = cache_size_mb
+            cost_list.append(estimates)
+        log_path = os.path.join(
+            logdir_path, '{0}.log'.format(subject['subject']))
+        subject_args_list.append(
+            (subject['subject'], subject_args, spm_path, log_path))
+
+    # recombine
+    print('Recombining {0} subjects with {1} worker(s)'.format(
+        len(subject_list), args.workers))
+    result_list = batch.run_batch(
+        subject_list, recombine_subject, subject_args_list, args.workers,
+        cost_list, memory_budget_bytes, args.cpu_budget)
+
+    # summary
+    summary_path = os.path.join(args.outdir_path, batch.SUMMARY_FILENAME)
+    batch.write_summary(result_list, summary_path)
+    failed_count = len([
+        result for result in result_list if result['status'] == 'failed'])
+    print('')
+    print('{0} subject(s) processed, {1} failed.'.format(
+        len(result_list), failed_count))
+    print('Summary written to {0}'.format(summary_path))
+    if failed_count:
+        sys.exit(1)
+
+
+def recombine_queue_job(job, staging_path, args, spm_path, logdir_path):
+    """Recombine the slabs of a subject of the work queue
 
     Args:
-        impath_list (list of strings): list of paths to the images that
-            will be compressed
-        dirpath (string): path to folder containing the images to be
-            deleted. Used to perform a 'safe' deletion of the
-            original uncompressed images after we have copied them to a
-            compressed version.
+        job (dict): claimed job (subject, slabs, slabs_per_repetition,
+            lowres, outdir, attempts)
+        staging_path (string): folder where the outputs get written
+            before being committed to the output dir of the subject
+        args (argparse.Namespace): parsed arguments of the worker
+        spm_path (string): path to SPM folder
+        logdir_path (string): folder where the subject logs are stored
 
     Returns:
-        N/A
+        result (dict): see recombine_subject
     """
-    for impath in impath_list:
-        # check if exists
-        if not os.path.isfile(impath):
-            error_msg = 'Error: impath {0} does not exist.'.format(impath)
-            raise IOError(error_msg)
-        # get foldername and filename associated with path to image
-        imfoldername = os.path.dirname(impath)
-        imfilename = os.path.basename(impath)
-        # separate extension in filename
-        imfilename_main = os.path.splitext(imfilename)[0]
-        imfilename_ext = os.path.splitext(imfilename)[1]
-        # check if the image is of type .nii
-        if imfilename_ext != '.nii':
-            error_msg = 'Error: image extension should be .nii'
-            raise IOError(error_msg)
-        # compress with gzip
-        imgzpath = "{0}/{1}.nii.gz".format(imfoldername, imfilename_main)
-        with open(impath, 'rb') as imfile:
-            with gzip.open(imgzpath, 'wb') as imgzfile:
-                shutil.copyfileobj(imfile, imgzfile)
-        # remove original non-compressed image
-        safe_remove(impath, dirpath)
+    subject_args = argparse.Namespace(**vars(args))
+    set_subject_slabs(subject_args, job)
+    subject_args.lowres_path = job['lowres']
+    subject_args.outdir_path = staging_path
+    subject_args.preflight_only = False
+    log_path = os.path.join(
+        logdir_path,
+        '{0}.{1}.{2}.log'.format(
+            job['subject'], job['attempts'], work_queue.worker_token()))
 
+    return recombine_subject(job['subject'], subject_args, spm_path, log_path)
 
-def part1(
-        highres_r1s1_path,
-        highres_r1s2_path,
-        highres_r2s1_path,
-        highres_r2s2_path,
-        lowres_path,
-        debugdir_path):
-    """Pre-processing prior to SPM registration
 
-    The function will process each slab as follows:
-    - duplicate slices of the volume along the y axis
-    - fill corresponding slices with the gaps that represent the real
-        acquisition
-    - create a phantom corresponding to each slab
+def submit_main(argv):
+    """Recombine code: add subjects to a work queue
 
     Args:
-        highres_r1s1_path (string): path to first repetition, first slab
-        highres_r1s2_path (string): path to first repetition, second
-            slab
-        highres_r2s1_path (string): path to second repetition, first
-            slab
-        highres_r2s2_path (string): path to first repetition, second
-            slab
-        lowres_path (string): path to low resolution volume
-        debugdir_path (string): path to 'debug' subfolder where all
-            intermediary images are stored
+        argv (list of strings): command-line arguments, without the
+            program name and the 'submit' command
 
     Returns:
-        lr1a_path (string): low res repeated - first repetion, first
-            slab
-        s1a_float_path (string): path to first slab of first repetition
-            converted to float
-        s1a_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to first slab of first repetition
-        lr1b_path (string): low res repeated - first repetion, second
-            slab
-        s1b_float_path (string): path to second slab of first repetition
-            converted to float
-        s1b_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to second slab of first repetition
-        lr2a_path (string): low res repeated - second repetion, first
-            slab
-        s2a_float_path (string): path to first slab of second repetition
-            converted to float
-        s2a_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to first slab of second repetition
-        lr2b_path (string): low res repeated - second repetion, second
-            slab
-        s2b_float_path (string): path to second slab of second
-            repetition converted to float
-        s2b_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to second slab of second repetition
+        N/A
     """
-    # copy files into the output folder (debug subfolder)
-    print('copy files into the output folder')
-    #-- copy of high-res and low-res volumes
-    #---- first (1) repetition, first slab (a)
-    s1a_path = os.path.join(debugdir_path, 's1a.nii')
-    nii_copy(highres_r1s1_path, s1a_path)
-    #---- first (1) repetition, second slab (b)
-    s1b_path = os.path.join(debugdir_path, 's1b.nii')
-    nii_copy(highres_r1s2_path, s1b_path)
-    #---- second (1) repetition, first slab (a)
-    s2a_path = os.path.join(debugdir_path, 's2a.nii')
-    nii_copy(highres_r2s1_path, s2a_path)
-    #---- second (1) repetition, second slab (b)
-    s2b_path = os.path.join(debugdir_path, 's2b.nii')
-    nii_copy(highres_r2s2_path, s2b_path)
-    #-- copy the low-res volumes four times (later used as
-    # initialisation to a slab registration)
-    #---- first (1) repetition, first slab (a)
-    lr1a_path = os.path.join(debugdir_path, 'lr_1a.nii')
-    nii_copy(lowres_path, lr1a_path)
-    #---- first (1) repetition, second slab (b)
-    lr1b_path = os.path.join(debugdir_path, 'lr_1b.nii')
-    nii_copy(lowres_path, lr1b_path)
-    #---- second (2) repetition, first slab (a)
-    lr2a_path = os.path.join(debugdir_path, 'lr_2a.nii')
-    nii_copy(lowres_path, lr2a_path)
-    #---- second (2) repetition, second slab (b)
-    lr2b_path = os.path.join(debugdir_path, 'lr_2b.nii')
-    nii_copy(lowres_path, lr2b_path)
-
-    # process repetitions
-    #-- first repetition
-    [
-        s1a_float_path, s1b_float_path,
-        s1a_phantom_gap_path, s1b_phantom_gap_path] = process_repetition(
-            '1', s1a_path, s1b_path, debugdir_path)
-    #-- second repetition
-    [
-        s2a_float_path, s2b_float_path,
-        s2a_phantom_gap_path, s2b_phantom_gap_path] = process_repetition(
-            '2', s2a_path, s2b_path, debugdir_path)
+    args = read_submit_cli_args(argv)
+    subject_list = batch.list_subjects(
+        args.input_path, os.path.abspath(args.outdir_path))
+    submitted_count = work_queue.submit_jobs(args.queue_path, subject_list)
+    print('{0} subject(s) added to {1} ({2} already in the queue)'.format(
+        submitted_count, args.queue_path,
+        len(subject_list)-submitted_count))
 
-    # gzip all the images that will not be fed to SPM in the second
-    # part or the recombination pipeline (SPM cannot read .gz
-    # compressed images)
-    gzip_images([s1a_path, s1b_path, s2a_path, s2b_path], debugdir_path)
 
-    return [
-        lr1a_path, s1a_float_path, s1a_phantom_gap_path,
-        lr1b_path, s1b_float_path, s1b_phantom_gap_path,
-        lr2a_path, s2a_float_path, s2a_phantom_gap_path,
-        lr2b_path, s2b_float_path, s2b_phantom_gap_path]
+def worker_main(argv):
+    """Recombine code: work queue worker
 
+    Process the subjects of a work queue until it is empty. Several
+    workers, on one or several nodes sharing the queue folder, can run
+    at the same time. Subject logs are written to [queue_dir]/logs/.
 
-def part2(
-        lr1a_path, s1a_float_path, s1a_phantom_gap_path,
-        lr1b_path, s1b_float_path, s1b_phantom_gap_path,
-        lr2a_path, s2a_float_path, s2a_phantom_gap_path,
-        lr2b_path, s2b_float_path, s2b_phantom_gap_path,
-        debugdir_path,
-        tempdir_path):
-    """SPM registration
-
-    Launch the SPM registrations.
-    The function will modify the all the input lr[]_path and
-    s[]_phantom_path images.
-
-    Args:
-        lr1a_path (string): low res repeated - first repetion, first
-            slab
-        s1a_float_path (string): path to first slab of first repetition
-            converted to float
-        s1a_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to first slab of first repetition
-        lr1b_path (string): low res repeated - first repetion, second
-            slab
-        s1b_float_path (string): path to second slab of first repetition
-            converted to float
-        s1b_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to second slab of first repetition
-        lr2a_path (string): low res repeated - second repetion, first
-            slab
-        s2a_float_path (string): path to first slab of second repetition
-            converted to float
-        s2a_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to first slab of second repetition
-        lr2b_path (string): low res repeated - second repetion, second
-            slab
-        s2b_float_path (string): path to second slab of second
-            repetition converted to float
-        s2b_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to second slab of second repetition
-        debugdir_path (string): path to 'debug' subfolder where all
-            intermediary iamges are stored
-        tempdir_path (string): path to temporary subfolder where images
-            to be processed with SPM are duplicated and stored
+    Args:
+        argv (list of strings): command-line arguments, without the
+            program name and the 'worker' command
 
     Returns:
         N/A
     """
-    # register first repetition, first slab
-    print('SPM register - first repetition, first slab')
-    file_spm_registration(
-        lr1a_path, s1a_float_path, s1a_phantom_gap_path, tempdir_path)
+    args, cli_usage = read_worker_cli_args(argv)
+
+    # check SPM available (once for all jobs of this worker)
+    spm_path = prepare_registration(args, cli_usage)
+
+    # prepare folders
+    work_queue.prepare_queue(args.queue_path)
+    logdir_path = os.path.join(args.queue_path, 'logs')
+    try:
+        os.makedirs(logdir_path)
+    except OSError:
+        if not os.path.isdir(logdir_path):
+            raise
 
-    # register first repetition, second slab
-    print('SPM register - first repetition, second slab')
-    file_spm_registration(
-        lr1b_path, s1b_float_path, s1b_phantom_gap_path, tempdir_path)
+    processed_count = work_queue.run_worker(
+        args.queue_path,
+        recombine_queue_job,
+        (args, spm_path, logdir_path),
+        args.lease_timeout,
+        args.max_attempts,
+        args.poll_interval,
+        args.wait)
+    counts = work_queue.queue_status(args.queue_path)
+    print('Worker {0}: {1} job(s) processed. Queue: {2}'.format(
+        work_queue.worker_token(), processed_count,
+        ', '.join(
+            '{0} {1}'.format(counts[state], state)
+            for state in work_queue.QUEUE_SUBFOLDERS)))
+
+
+def recombine_service_job(job, progress_queue, args, spm_path, logdir_path):
+    """Recombine the slabs of a job of the recombination service
 
-    # register second repetition, first slab
-    print('SPM register - second repetition, first slab')
-    file_spm_registration(
-        lr2a_path, s2a_float_path, s2a_phantom_gap_path, tempdir_path)
+    Args:
+        job (dict): job (id, subject, slabs, slabs_per_repetition,
+            lowres, outdir)
+        progress_queue (multiprocessing queue): queue where the messages
+            of the job are put
+        args (argparse.Namespace): parsed arguments of the service
+        spm_path (string): path to SPM folder
+        logdir_path (string): folder where the job logs are stored
 
-    # register second repetition, second slab
-    print('SPM register - second repetition, second slab')
-    file_spm_registration(
-        lr2b_path, s2b_float_path, s2b_phantom_gap_path, tempdir_path)
+    Returns:
+        result (dict): see recombine_subject
+    """
+    subject_args = argparse.Namespace(**vars(args))
+    set_subject_slabs(subject_args, job)
+    subject_args.lowres_path = job['lowres']
+    subject_args.outdir_path = job['outdir']
+    subject_args.preflight_only = False
+    log_path = os.path.join(logdir_path, '{0}.log'.format(job['id']))
 
-    # gzip all the images that are not given as input to part 3 of
-    # the recombination algorithm
-    gzip_images([lr1a_path, lr1b_path, lr2a_path, lr2b_path], debugdir_path)
+    return recombine_subject(
+        job['subject'], subject_args, spm_path, log_path, progress_queue,
+        job['id'])
 
 
-def part3(
-        s1a_float_path, s1a_phantom_gap_path,
-        s1b_float_path, s1b_phantom_gap_path,
-        s2a_float_path, s2a_phantom_gap_path,
-        s2b_float_path, s2b_phantom_gap_path,
-        debugdir_path,
-        tempdir_path,
-        outdir_path):
-    """Combine volumes after SPM registration
+def serve_main(argv):
+    """Recombine code: recombination service
 
-    The function will combine for each repetition the first and second
-    block, then will combine the two repetitions together, using
-    volumes registered with SPM.
-
-    Args:
-        s1a_float_path (string): path to first slab of first repetition
-            converted to float - SPM registered to low-res volume
-        s1a_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to first slab of first repetition
-            - SPM aligned to low-res volume
-        s1b_float_path (string): path to second slab of first repetition
-            converted to float - SPM registered to low-res volume
-        s1b_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to second slab of first repetition
-            - SPM aligned to low-res volume
-        s2a_float_path (string): path to first slab of second repetition
-            converted to float - SPM registered to low-res volume
-        s2a_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to first slab of second repetition
-            - SPM aligned to low-res volume
-        s2b_float_path (string): path to second slab of second
-            repetition converted to float - SPM registered to low-res
-            volume
-        s2b_phantom_gap_path (string): path to phantom (with gap)
-            corresponding to second slab of second repetition
-            - SPM aligned to low-res volume
-        debugdir_path (string): path to 'debug' subfolder where all
-            intermediary iamges are stored
-        tempdir_path (string): path to temporary subfolder where images
-            to be processed with SPM are duplicated and stored
-            Used here to know what files to delete
-        outdir_path (string): path to output dir, where results will
-            get stored
+    Accept recombination jobs over HTTP and run them on a pool of
+    worker processes started once, with the registration backend
+    checked once (see service.py for the HTTP interface). Runs until
+    interrupted.
+
+    Args:
+        argv (list of strings): command-line arguments, without the
+            program name and the 'serve' command
 
     Returns:
         N/A
     """
-    # Add blocks
-    print('Add blocks/repetitions')
-    #-- main slabs
-    #---- First repetition: add slabs
-    print('First repetition - add slabs')
-    rs1_float_path = os.path.join(outdir_path, 'rs1_float.nii.gz')
-    file_volume_addition(s1a_float_path, s1b_float_path, rs1_float_path)
-    #---- Second repetition: add slabs
-    print('Second repetition - add slabs')
-    rs2_float_path = os.path.join(outdir_path, 'rs2_float.nii.gz')
-    file_volume_addition(s2a_float_path, s2b_float_path, rs2_float_path)
-    #---- Add repetitions
-    print('Add repetitions')
-    rs_float_path = os.path.join(outdir_path, 'rs_float.nii.gz')
-    file_volume_addition(rs1_float_path, rs2_float_path, rs_float_path)
-    #-- phantoms
-    #---- First repetition: add slabs
-    print('Phantoms: first repetition - add slabs')
-    s1_phantom_gap_path = os.path.join(
-        debugdir_path, 'phantom_one_gap_s1.nii.gz')
-    file_volume_addition(
-        s1a_phantom_gap_path, s1b_phantom_gap_path, s1_phantom_gap_path)
-    #---- Second repetition: add slabs
-    print('Phantoms: second repetition - add slabs')
-    s2_phantom_gap_path = os.path.join(
-        debugdir_path, 'phantom_one_gap_s2.nii.gz')
-    file_volume_addition(
-        s2a_phantom_gap_path, s2b_phantom_gap_path, s2_phantom_gap_path)
-    #---- Add repetitions
-    print('Phantoms: add repetitions')
-    s_phantom_gap_path = os.path.join(debugdir_path, 'phantom_one_gap_s.nii.gz')
-    file_volume_addition(
-        s1_phantom_gap_path, s2_phantom_gap_path, s_phantom_gap_path)
+    args, cli_usage = read_serve_cli_args(argv)
 
-    # Normalise blocks using phantoms
-    print('Normalise blocks using phantoms')
-    #-- 'rs'
-    print('Normalise \'rs\'')
-    rs_float_ponderated_path = os.path.join(
-        outdir_path, 'rs_float_ponderated.nii.gz')
-    file_volume_division(
-        rs_float_path, s_phantom_gap_path, rs_float_ponderated_path)
-    #-- 'rs1'
-    print('Normalise \'rs1\'')
-    rs1_float_ponderated_path = os.path.join(
-        outdir_path, 'rs1_float_ponderated.nii.gz')
-    file_volume_division(
-        rs1_float_path, s1_phantom_gap_path, rs1_float_ponderated_path)
-    #-- 'rs2'
-    print('Normalise \'rs2\'')
-    rs2_float_ponderated_path = os.path.join(
-        outdir_path, 'rs2_float_ponderated.nii.gz')
-    file_volume_division(
-        rs2_float_path, s2_phantom_gap_path, rs2_float_ponderated_path)
-    #-- 'rs12' -> add 'rs1' and 'rs2'
-    print('\'rs_1_2\': \'rs1\' + \'rs2\'')
-    rs12_float_ponderated_path = os.path.join(
-        outdir_path, 'rs_1_2_float_ponderated.nii.gz')
-    file_volume_addition(
-        rs1_float_ponderated_path,
-        rs2_float_ponderated_path,
-        rs12_float_ponderated_path)
-
-    # gzip all images that have not been gzipped yet
-    gzip_images(
-        [
-            s1a_float_path, s1a_phantom_gap_path,
-            s1b_float_path, s1b_phantom_gap_path,
-            s2a_float_path, s2a_phantom_gap_path,
-            s2b_float_path, s2b_phantom_gap_path],
-        debugdir_path)
+    # check the registration backend (once for all jobs)
+    spm_path = prepare_registration(args, cli_usage)
 
-    # remove temporary folder
-    if os.path.isdir(tempdir_path):
-        shutil.rmtree(tempdir_path)
+    # prepare folders
+    if not os.path.isdir(args.logdir_path):
+        os.makedirs(args.logdir_path)
+
+    # start the workers, then the server
+    recombination_service = service.RecombinationService(
+        recombine_service_job,
+        (args, spm_path, os.path.abspath(args.logdir_path)),
+        args.workers)
+    recombination_service.start()
+    # stop cleanly when terminated (e.g., by a service manager)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server = service.create_server(
+        recombination_service, args.host, args.port, args.socket_path)
+    if args.socket_path is None:
+        print('Recombination service listening on http://{0}:{1}'.format(
+            args.host, args.port))
     else:
-        error_msg = 'Error: folder {0} does not exist'.format(tempdir_path)
-        raise IOError(error_msg)
+        print('Recombination service listening on {0}'.format(
+            args.socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping the recombination service')
+    finally:
+        server.server_close()
+        recombination_service.shutdown()
+
+def watch_input_landed(
+        subject_dict,
+        subject_name,
+        role,
+        input_path,
+        args,
+        spm_path,
+        executor):
+    """Start processing an input that landed in the watched folder
+
+    The folders of a subject are prepared when its first input lands.
+    Each slab (and the low-res volume) is then pre-processed as soon as
+    it lands, without waiting for the other inputs of the subject.
 
+    Args:
+        subject_dict (dict): state of each subject seen so far, keyed
+            by subject name. Updated in place
+        subject_name (string): subject of the input
+        role (string): role of the input (see watch_folder.INPUT_ROLES)
+        input_path (string): path to the input
+        args (argparse.Namespace): parsed arguments
+        spm_path (string): path to SPM folder
+        executor (concurrent.futures.Executor): executor running the
+            pre-processing
 
-def show_completion_message(outdir_path, debugdir_path):
-    """Show message to indicate successfull completion
+    Returns:
+        N/A
+    """
+    subject = subject_dict.get(subject_name)
+    if subject is None:
+        subject_args = argparse.Namespace(**vars(args))
+        subject_args.outdir_path = os.path.join(
+            args.outdir_path, subject_name)
+        for input_role in watch_folder.INPUT_ROLES:
+            setattr(subject_args, '{0}_path'.format(input_role), None)
+        subject = {
+            'subject': subject_name,
+            'args': subject_args,
+            'status': 'waiting',
+            'folders': None,
+            'futures': {}}
+        subject_dict[subject_name] = subject
+        if os.path.isdir(subject_args.outdir_path) and \
+                os.listdir(subject_args.outdir_path):
+            print('Skipping {0}: {1} is not empty'.format(
+                subject_name, subject_args.outdir_path))
+            subject['status'] = 'skipped'
+        elif not args.preflight_only:
+            try:
+                subject['folders'] = start_recombination(
+                    subject_args, spm_path)
+            except Exception:
+                traceback.print_exc()
+                subject['status'] = 'failed'
+    if subject['status'] != 'waiting':
+        return
+
+    input_attribute = '{0}_path'.format(role)
+    if getattr(subject['args'], input_attribute) is not None:
+        print('{0}: ignoring {1} ({2} already landed)'.format(
+            subject_name, input_path, role))
+        return
+    setattr(subject['args'], input_attribute, input_path)
+    print('{0}: {1} landed ({2})'.format(subject_name, role, input_path))
+    if args.preflight_only:
+        return
+
+    # pre-process the input
+    debugdir_path = subject['folders'][1]
+    # (stages tagged with the output dir, see write_run_report)
+    run_label = subject['args'].outdir_path
+    if role == 'lowres':
+        future = executor.submit(
+            instrumentation.call_with_run_label, run_label,
+            prepare_lowres, input_path, debugdir_path,
+            args.keep_intermediates)
+    else:
+        [repetition, slab] = SLAB_ROLES[role]
+        future = executor.submit(
+            instrumentation.call_with_run_label, run_label,
+            prepare_slab, repetition, slab, input_path, debugdir_path,
+            args.keep_intermediates)
+    subject['futures'][role] = future
 
-    Show the list of files that have been created and give the path to
-    intermediary ('debug') and temporary ('temp') folders that can be
-    removed to save space.
+
+def watch_subject_ready(subject):
+    """Check whether all the inputs of a subject are pre-processed
 
     Args:
-        outdir_path (string): absolute path to output dir, where
-            results will get stored
-        debugdir_path (string): path to 'debug' subfolder where all
-            intermediary images are stored
-        tempdir_path (string): path to temporary subfolder where images
-            to be processed with SPM are duplicated and stored
+        subject (dict): state of the subject (see watch_input_landed)
+
+    Returns:
+        ready (bool): True if the subject can be registered and combined
+    """
+    if subject['status'] != 'waiting':
+        return False
+    for role in watch_folder.INPUT_ROLES:
+        if getattr(subject['args'], '{0}_path'.format(role)) is None:
+            return False
+
+    return all(future.done() for future in subject['futures'].values())
+
+
+def watch_subject_busy(subject):
+    """Check whether a subject is being processed
+
+    Args:
+        subject (dict): state of the subject (see watch_input_landed)
+
+    Returns:
+        busy (bool): True if the subject is being registered and
+            combined, or if some of its inputs are being pre-processed
+    """
+    if subject['status'] == 'running':
+        return True
+    if subject['status'] != 'waiting':
+        return False
+
+    return not all(future.done() for future in subject['futures'].values())
+
+
+def watch_recombine_subject(subject):
+    """Register and combine the pre-processed inputs of a subject
+
+    Run the preflight check on the complete set of inputs, then the
+    last two parts of the recombination algorithm. Errors do not
+    propagate: they are reported in the status of the subject, so that
+    the other subjects keep being processed.
+
+    Args:
+        subject (dict): state of the subject (see watch_input_landed).
+            Its status is updated in place
 
     Returns:
         N/A
     """
-    print('Recombination code successfully run.')
-    print('')
-    print('Temporary data stored in:')
-    print(debugdir_path)
-    print('Please remove the above folders to save storage space.')
+    subject_args = subject['args']
+    print('{0}: all inputs landed'.format(subject['subject']))
+    instrumentation.set_run_label(subject_args.outdir_path)
+    try:
+        preflight_report = run_preflight(subject_args)
+        if subject_args.preflight_only:
+            subject['status'] = 'done'
+            return
+        path_dict = dict(
+            (role, future.result())
+            for role, future in subject['futures'].items())
+    except Exception:
+        traceback.print_exc()
+        if subject['folders'] is not None:
+            pop_disk_usage_peak(subject['folders'][0])
+            show_failure_message(
+                subject['folders'][0], subject_args.outdir_path)
+        subject['status'] = 'failed'
+        instrumentation.pop_stages(subject_args.outdir_path)
+        return
+
+    # same records as the ones returned by part1 (the low-res copies
+    # are in the order of the slab roles)
+    slab_record_list = []
+    for role, lr_path in zip(sorted(SLAB_ROLES), path_dict['lowres']):
+        [repetition, slab] = SLAB_ROLES[role]
+        [s_float_path, s_phantom_gap_path] = path_dict[role]
+        slab_record_list.append(slab_record(
+            repetition, slab, lr_path, s_float_path, s_phantom_gap_path))
+    [workdir_path, debugdir_path, tempdir_path] = subject['folders']
+    try:
+        finish_recombination(
+            subject_args, preflight_report, workdir_path, debugdir_path,
+            tempdir_path, slab_record_list)
+    except Exception:
+        traceback.print_exc()
+        subject['status'] = 'failed'
+        # forget the stages of the failed run
+        instrumentation.pop_stages(subject_args.outdir_path)
+        return
+    subject['status'] = 'done'
+
+
+def watch_main(argv):
+    """Recombine code: watch folder mode
+
+    Watch a folder where the inputs of the subjects land (e.g., exported
+    by the scanner) and recombine each subject as soon as its inputs
+    are complete. Inputs are matched to their subject and role with a
+    naming pattern, and only processed once they have stopped changing.
+    Each slab is pre-processed as soon as it lands, on a pool of
+    threads; complete sets are then registered and combined one at a
+    time, while the pre-processing of the next inputs goes on.
+
+    Args:
+        argv (list of strings): command-line arguments, without the
+            program name and the 'watch' command
+
+    Returns:
+        N/A
+    """
+    # parse command-line arguments
+    args, cli_usage = read_watch_cli_args(argv)
+    watcher = watch_folder.FolderWatcher(
+        args.watch_path, args.pattern, args.stable_seconds)
+
+    # check SPM available (once for all subjects)
+    spm_path = None
+    if not args.preflight_only:
+        spm_path = prepare_registration(args, cli_usage)
+    configure_pipeline(args, args.cache_size)
+
+    print('Watching {0}'.format(args.watch_path))
+    subject_dict = {}
+    last_landing_time = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.workers) as executor, \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=1) as pipeline_executor:
+        while True:
+            # start pre-processing the inputs that landed
+            for subject_name, role, input_path in watcher.poll():
+                last_landing_time = time.monotonic()
+                watch_input_landed(
+                    subject_dict, subject_name, role, input_path, args,
+                    spm_path, executor)
+
+            # hand complete sets to the rest of the pipeline
+            for subject in subject_dict.values():
+                if watch_subject_ready(subject):
+                    subject['status'] = 'running'
+                    pipeline_executor.submit(
+                        watch_recombine_subject, subject)
+
+            # stop once idle
+            if args.idle_timeout is not None and \
+                    not watcher.pending_count() and \
+                    not any(
+                        watch_subject_busy(subject)
+                        for subject in subject_dict.values()) and \
+                    time.monotonic()-last_landing_time >= args.idle_timeout:
+                break
+            time.sleep(args.poll_interval)
+
+    # summary
     print('')
-    print('Output data to be found in:')
-    print(outdir_path)
+    for status in ['done', 'failed', 'skipped']:
+        subject_name_list = sorted(
+            subject['subject'] for subject in subject_dict.values()
+            if subject['status'] == status)
+        if subject_name_list:
+            print('{0}: {1}'.format(status, ', '.join(subject_name_list)))
+    for subject in subject_dict.values():
+        if subject['status'] == 'waiting':
+            print('{0}: incomplete set of inputs'.format(
+                subject['subject']))
+            if subject['folders'] is not None:
+                print('    working directory left in {0}'.format(
+                    subject['folders'][0]))
+    if any(
+            subject['status'] == 'failed'
+            for subject in subject_dict.values()):
+        sys.exit(1)
 
 
 def main():
@@ -1311,18 +5704,26 @@ def main():
 
     Launch in turn the three parts of the recombination algorithm.
     Takes the following input:
-        - rep1s1_path: path to first slab of the first repetition
-        - rep1s2_path: path to second slab of the first repetition
-        - rep2s1_path: path to first slab of the second repetition
-        - rep2s2_path: path to second slab of the second repetition
+        - slab_paths: paths to the slabs, repetition after repetition
+            (e.g., rep1s1, rep1s2, rep2s1, rep2s2), with
+            --slabs-per-repetition interleaved slabs per repetition
         - lowres_path: path to low-resolution volume
         - outdir_path: path to folder where results will be stored
     Will output the following recombined file in the output directory
         - rs_float_ponderated.nii.gz: whole recombined
         - rs1_float_ponderated.nii.gz: first repetition recombined
         - rs2_float_ponderated.nii.gz: second repetition recombined
+            (and so on for each repetition)
         - rs_1_2_float_ponderated.nii.gz: first repetition recombined
-            + second repetition recombined
+            + second repetition recombined (+ ... for each repetition)
+        - accumulators/: sums of each repetition, reused by a later
+            incremental run (see reusable_accumulators)
+    Run 'recombine.py batch' to recombine several subjects (see
+    batch_main), 'recombine.py submit' and 'recombine.py worker' to
+    distribute them across nodes (see submit_main and worker_main),
+    'recombine.py serve' to start a recombination service (see
+    serve_main), 'recombine.py watch' to recombine subjects as their
+    inputs land in a folder (see watch_main).
 
     Args:
         N/A
@@ -1330,52 +5731,39 @@ def main():
     Returns:
         N/A
     """
+    # batch and work queue modes
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'submit':
+        submit_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        worker_main(sys.argv[2:])
+        return
+    # service mode
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve_main(sys.argv[2:])
+        return
+    # watch folder mode
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        watch_main(sys.argv[2:])
+        return
+
     # parse command-line arguments
     args, cli_usage = read_cli_args()
 
-    # check SPM available
-    spm_path = check_spm_available(args, cli_usage)
-
-    # prepare folders
-    [debugdir_path, tempdir_path] = prepare_folders(args.outdir_path)
-
-    # store [spm path] location in file
-    spm_path_filestore(debugdir_path, spm_path)
-
-    # part 1 - prepare input to SPM
-    [
-        lr1a_path, s1a_float_path, s1a_phantom_gap_path,
-        lr1b_path, s1b_float_path, s1b_phantom_gap_path,
-        lr2a_path, s2a_float_path, s2a_phantom_gap_path,
-        lr2b_path, s2b_float_path, s2b_phantom_gap_path] = part1(
-            args.rep1s1_path,
-            args.rep1s2_path,
-            args.rep2s1_path,
-            args.rep2s2_path,
-            args.lowres_path,
-            debugdir_path)
+    # check the input headers and estimate resources before any image
+    # data gets read
+    preflight_report = run_preflight(args)
+    if args.preflight_only:
+        return
 
-    # part 2 - register with SPM
-    part2(
-        lr1a_path, s1a_float_path, s1a_phantom_gap_path,
-        lr1b_path, s1b_float_path, s1b_phantom_gap_path,
-        lr2a_path, s2a_float_path, s2a_phantom_gap_path,
-        lr2b_path, s2b_float_path, s2b_phantom_gap_path,
-        debugdir_path,
-        tempdir_path)
-
-    # part 3 - combine volumes
-    part3(
-        s1a_float_path, s1a_phantom_gap_path,
-        s1b_float_path, s1b_phantom_gap_path,
-        s2a_float_path, s2a_phantom_gap_path,
-        s2b_float_path, s2b_phantom_gap_path,
-        debugdir_path,
-        tempdir_path,
-        args.outdir_path)
+    # check SPM available
+    spm_path = prepare_registration(args, cli_usage)
 
-    # show completion_message
-    show_completion_message(args.outdir_path, debugdir_path)
+    # recombine
+    run_recombination(args, spm_path, preflight_report)
 
 
 if __name__ == "__main__":
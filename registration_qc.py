@@ -0,0 +1,213 @@
+"""Quality control of the registrations
+
+Measures how well each registered slab matches the low-res volume, and
+how well the repetitions match each other, so that failed registrations
+are reported at the end of the run instead of being found by opening
+the images in a viewer.
+
+Two similarity metrics are computed over the voxels covered by the
+slabs (phantom support):
+- the normalised mutual information (NMI, (H(A)+H(B))/H(A,B)), from 1
+    (independent intensities) to 2 (one intensity determines the
+    other). It does not assume a linear relation between the
+    intensities, which suits images with different contrasts
+- the Pearson correlation of the intensities, from -1 to 1
+
+The joint histogram is computed with a single np.bincount over the
+voxels, and the volumes can be subsampled (one voxel out of
+[subsample] along each axis) so that the metrics only take a fraction
+of the runtime of the pipeline.
+
+"""
+
+import numpy as np
+
+
+# number of intensity bins of the joint histogram, along each axis
+HISTOGRAM_BINS = 32
+# default subsampling step, along each axis
+DEFAULT_SUBSAMPLE = 2
+# minimum phantom value of the voxels compared (voxels mostly covered
+# by the slab)
+PHANTOM_THRESHOLD = 0.5
+# minimum number of voxels compared for the metrics to be meaningful
+MIN_VOXELS = 100
+# thresholds below which a registration is flagged as failed
+MIN_NMI = 1.05
+MIN_CORRELATION = 0.5
+
+
+def subsample(in_data, step):
+    """Keep one voxel out of [step] along each axis
+
+    Args:
+        in_data (numpy.ndarray): [m,n,o] array
+        step (int): subsampling step. 1 keeps all the voxels
+
+    Returns:
+        out_data (numpy.ndarray): subsampled array (view of in_data)
+    """
+    if step < 1:
+        raise ValueError('the subsampling step must be a positive integer')
+
+    return in_data[::step, ::step, ::step]
+
+
+def intensity_bins(values, bins=HISTOGRAM_BINS):
+    """Bin index of each intensity
+
+    The intensity range is split into [bins] bins of equal width.
+
+    Args:
+        values (numpy.ndarray): 1D array of intensities
+        bins (int): number of bins
+
+    Returns:
+        bin_indices (numpy.ndarray): 1D array of bin indices, from 0 to
+            bins-1
+    """
+    vmin = values.min()
+    vmax = values.max()
+    if vmax <= vmin:
+        return np.zeros(values.shape, dtype=np.intp)
+    bin_indices = ((values-vmin)*(bins/(vmax-vmin))).astype(np.intp)
+    # the maximum falls in the last bin
+    np.minimum(bin_indices, bins-1, out=bin_indices)
+
+    return bin_indices
+
+
+def joint_histogram(values1, values2, bins=HISTOGRAM_BINS):
+    """Joint histogram of two sets of intensities
+
+    Args:
+        values1 (numpy.ndarray): 1D array of intensities
+        values2 (numpy.ndarray): 1D array of intensities, same size
+        bins (int): number of bins along each axis
+
+    Returns:
+        histogram (numpy.ndarray): [bins,bins] array of voxel counts
+    """
+    joint_indices = intensity_bins(values1, bins)*bins
+    joint_indices += intensity_bins(values2, bins)
+
+    return np.bincount(
+        joint_indices, minlength=bins*bins).reshape((bins, bins))
+
+
+def entropy(histogram):
+    """Shannon entropy of a histogram
+
+    Args:
+        histogram (numpy.ndarray): array of counts
+
+    Returns:
+        entropy (float): entropy, in nats
+    """
+    probabilities = histogram[histogram > 0]/float(histogram.sum())
+
+    return float(-np.sum(probabilities*np.log(probabilities)))
+
+
+def normalized_mutual_information(values1, values2, bins=HISTOGRAM_BINS):
+    """Normalised mutual information of two sets of intensities
+
+    Args:
+        values1 (numpy.ndarray): 1D array of intensities
+        values2 (numpy.ndarray): 1D array of intensities, same size
+        bins (int): number of bins along each axis
+
+    Returns:
+        nmi (float): (H(values1)+H(values2))/H(values1, values2), from
+            1 to 2
+    """
+    histogram = joint_histogram(values1, values2, bins)
+    joint_entropy = entropy(histogram)
+    if joint_entropy == 0:
+        # both images constant
+        return 2.0
+
+    return (entropy(histogram.sum(axis=1)) +
+            entropy(histogram.sum(axis=0)))/joint_entropy
+
+
+def correlation(values1, values2):
+    """Pearson correlation of two sets of intensities
+
+    Args:
+        values1 (numpy.ndarray): 1D array of intensities
+        values2 (numpy.ndarray): 1D array of intensities, same size
+
+    Returns:
+        correlation (float): correlation coefficient. 0 if either set
+            is constant
+    """
+    centred1 = values1-values1.mean()
+    centred2 = values2-values2.mean()
+    norm = np.sqrt(np.dot(centred1, centred1)*np.dot(centred2, centred2))
+    if norm == 0:
+        return 0.0
+
+    return float(np.dot(centred1, centred2)/norm)
+
+
+def compare_images(data1, data2, mask, bins=HISTOGRAM_BINS):
+    """Similarity of two images over a mask
+
+    Args:
+        data1 (numpy.ndarray): [m,n,o] array
+        data2 (numpy.ndarray): [m,n,o] array
+        mask (numpy.ndarray): [m,n,o] boolean array of the voxels to
+            compare
+        bins (int): number of bins of the joint histogram
+
+    Returns:
+        metrics (dict): similarity metrics:
+            - voxels (int): number of voxels compared
+            - nmi (float): normalised mutual information. None if too
+                few voxels are compared (see MIN_VOXELS)
+            - correlation (float): Pearson correlation. None if too few
+                voxels are compared
+            - passed (Boolean): True if both metrics reach their
+                thresholds (see MIN_NMI and MIN_CORRELATION)
+    """
+    if data1.shape != data2.shape or data1.shape != mask.shape:
+        raise ValueError('the images must have the same size')
+    # NaN values (e.g., outside the field of view) are not compared
+    mask = mask & np.isfinite(data1) & np.isfinite(data2)
+    values1 = np.asarray(data1[mask], dtype=np.float64)
+    values2 = np.asarray(data2[mask], dtype=np.float64)
+    metrics = {
+        'voxels': int(values1.size),
+        'nmi': None,
+        'correlation': None,
+        'passed': False}
+    if values1.size < MIN_VOXELS:
+        return metrics
+    metrics['nmi'] = normalized_mutual_information(values1, values2, bins)
+    metrics['correlation'] = correlation(values1, values2)
+    metrics['passed'] = bool(
+        metrics['nmi'] >= MIN_NMI and
+        metrics['correlation'] >= MIN_CORRELATION)
+
+    return metrics
+
+
+def format_metrics(name, metrics):
+    """One-line summary of the similarity of two images
+
+    Args:
+        name (string): name of the comparison (e.g., 's1a vs low-res')
+        metrics (dict): similarity metrics (see compare_images)
+
+    Returns:
+        line (string): summary
+    """
+    if metrics['nmi'] is None:
+        return '{0}: {1} (only {2} voxels overlap)'.format(
+            name, 'not compared' if metrics['passed'] is None else 'FAILED',
+            metrics['voxels'])
+
+    return '{0}: NMI {1:.3f}, correlation {2:.3f}, {3} voxels{4}'.format(
+        name, metrics['nmi'], metrics['correlation'], metrics['voxels'],
+        '' if metrics['passed'] else ' - FAILED')
@@ -0,0 +1,577 @@
+"""Long-running recombination service
+
+Accepts recombination jobs over HTTP (on a TCP port or a Unix socket)
+and runs them on a pool of worker processes that stay alive between
+jobs, so that the imports and the registration backend discovery are
+only paid once, when the service starts.
+
+Jobs wait in a priority queue (highest priority first, then first
+submitted). The messages printed by a job are streamed back to the
+clients that follow its progress.
+
+HTTP interface:
+    - POST /jobs: submit a job. JSON body with the keys slabs (paths
+        to the slabs, repetition after repetition), lowres, outdir and,
+        optionally, slabs_per_repetition (default 2), subject and
+        priority (integer, default 0). The slabs can also be given with
+        one key rep[r]s[s] per slab s of repetition r (e.g., rep1s1,
+        rep1s2, rep2s1, rep2s2). Returns the job.
+    - GET /jobs: list all jobs (without their progress messages).
+    - GET /jobs/[id]: get a job, with its progress messages.
+    - GET /jobs/[id]/progress: stream the progress messages of a job,
+        one per line, until the job completes.
+
+"""
+
+import os
+import io
+import functools
+import json
+import heapq
+import itertools
+import multiprocessing
+import multiprocessing.managers
+import signal
+import socketserver
+import threading
+import time
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import batch
+
+# keys of a job request, besides its slabs (see RecombinationService.submit)
+JOB_REQUEST_KEYS = ['lowres', 'outdir']
+# number of interleaved slabs per repetition of a job request that does
+# not give it
+DEFAULT_SLABS_PER_REPETITION = 2
+# default address of the service
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+
+class ProgressStream(io.TextIOBase):
+    """Text stream that writes to a log file and to a progress queue
+
+    Used as standard output of a job: every complete line is also put
+    in the progress queue, tagged with the job identifier.
+
+    Args:
+        log_file (file object): log file of the job
+        progress_queue (multiprocessing queue): queue of (job identifier,
+            line) tuples
+        job_id (string): job identifier
+    """
+
+    def __init__(self, log_file, progress_queue, job_id):
+        super(ProgressStream, self).__init__()
+        self.log_file = log_file
+        self.progress_queue = progress_queue
+        self.job_id = job_id
+        self.line_buffer = ''
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.log_file.write(text)
+        line_list = (self.line_buffer+text).split('\n')
+        # incomplete last line
+        self.line_buffer = line_list.pop()
+        for line in line_list:
+            self.progress_queue.put((self.job_id, line))
+        return len(text)
+
+    def flush(self):
+        self.log_file.flush()
+
+
+def ignore_interrupt():
+    """Initialiser of the worker processes
+
+    Workers ignore Ctrl+C and keep the default termination signal
+    handler: the service stops them once the running jobs are complete.
+
+    Args:
+        N/A
+
+    Returns:
+        N/A
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def warm_up_worker(delay):
+    """Start-up task of a worker process
+
+    Args:
+        delay (float): time (in seconds) the task lasts, so that each
+            start-up task gets its own worker process
+
+    Returns:
+        pid (int): process identifier of the worker
+    """
+    time.sleep(delay)
+
+    return os.getpid()
+
+
+class RecombinationService(object):
+    """Queue of recombination jobs run on a pool of worker processes
+
+    Args:
+        job_function (function): function run for each job, called as
+            job_function(job, progress_queue, *job_function_args). Must
+            be defined at the top level of a module, must not raise and
+            must return a result dictionary with at least a status
+            ('success' or 'failed') and an error message
+        job_function_args (tuple): other arguments of job_function
+        workers (int): number of worker processes
+    """
+
+    def __init__(self, job_function, job_function_args=(), workers=1):
+        self.job_function = job_function
+        self.job_function_args = job_function_args
+        self.workers = workers
+        self.jobs = {}
+        # results of the jobs whose progress messages are being collected
+        self.job_results = {}
+        self.job_heap = []
+        self.job_counter = itertools.count(1)
+        self.running_count = 0
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.manager = multiprocessing.managers.SyncManager()
+        self.manager.start(ignore_interrupt)
+        self.progress_queue = self.manager.Queue()
+        self.executor = None
+        self.threads = []
+
+    def start(self):
+        """Start the worker processes and the service threads
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        self.executor = self.create_executor()
+        for target in [self.dispatch_jobs, self.collect_progress]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def create_executor(self):
+        """Create the pool of worker processes and start them
+
+        Args:
+            N/A
+
+        Returns:
+            executor (concurrent.futures.ProcessPoolExecutor): pool of
+                worker processes
+        """
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=ignore_interrupt)
+        # start all workers now rather than on the first jobs
+        list(executor.map(warm_up_worker, [0.2]*self.workers))
+
+        return executor
+
+    def shutdown(self):
+        """Stop dispatching jobs and wait for the running ones
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.executor.shutdown(wait=True)
+        self.progress_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.manager.shutdown()
+
+    def submit(self, request):
+        """Add a job to the queue
+
+        Args:
+            request (dict): job request (see JOB_REQUEST_KEYS), with its
+                slabs (either slabs and optional slabs_per_repetition,
+                or one key rep[r]s[s] per slab, see
+                batch.slabs_from_columns) and optional subject and
+                priority
+
+        Returns:
+            job (dict): job summary (see job_summary)
+        """
+        missing_keys = [key for key in JOB_REQUEST_KEYS if key not in request]
+        if missing_keys:
+            raise ValueError(
+                'missing job keys: {0}'.format(', '.join(missing_keys)))
+        if 'slabs' in request:
+            if not isinstance(request['slabs'], list) or \
+                    not request['slabs']:
+                raise ValueError('slabs must be a non-empty list of paths')
+            slab_path_list = [str(path) for path in request['slabs']]
+            slabs_per_repetition = int(request.get(
+                'slabs_per_repetition', DEFAULT_SLABS_PER_REPETITION))
+        else:
+            slab_path_list, slabs_per_repetition = batch.slabs_from_columns(
+                dict((key, str(value)) for key, value in request.items()))
+        if slabs_per_repetition < 1 or \
+                len(slab_path_list) % slabs_per_repetition:
+            raise ValueError(
+                '{0} slabs cannot be split into repetitions of {1}'
+                ' slabs'.format(len(slab_path_list), slabs_per_repetition))
+        priority = int(request.get('priority', 0))
+        with self.condition:
+            sequence = next(self.job_counter)
+            job_id = 'job-{0:05d}'.format(sequence)
+            job = {
+                'id': job_id,
+                'subject': str(request.get('subject', job_id)),
+                'priority': priority,
+                'status': 'queued',
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'elapsed_seconds': None,
+                'error': '',
+                'progress': []}
+            job['slabs'] = slab_path_list
+            job['slabs_per_repetition'] = slabs_per_repetition
+            for key in JOB_REQUEST_KEYS:
+                job[key] = str(request[key])
+            self.jobs[job_id] = job
+            # highest priority first, then first submitted
+            heapq.heappush(self.job_heap, (-priority, sequence, job_id))
+            self.condition.notify_all()
+
+            return self.job_summary(job_id)
+
+    def job_summary(self, job_id, with_progress=False):
+        """Copy of a job, safe to serialise
+
+        Args:
+            job_id (string): job identifier
+            with_progress (Boolean): include the progress messages
+
+        Returns:
+            job (dict): copy of the job. None if the job does not exist.
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job, slabs=list(job['slabs']))
+            if with_progress:
+                job['progress'] = list(job['progress'])
+            else:
+                del job['progress']
+
+            return job
+
+    def list_jobs(self):
+        """Summary of all jobs
+
+        Args:
+            N/A
+
+        Returns:
+            job_list (list of dict): jobs, in submission order
+        """
+        with self.condition:
+            return [self.job_summary(job_id) for job_id in sorted(self.jobs)]
+
+    def wait_progress(self, job_id, start_index, timeout=1.0):
+        """Wait for new progress messages of a job
+
+        Args:
+            job_id (string): job identifier
+            start_index (int): number of messages already received
+            timeout (float): maximum waiting time, in seconds
+
+        Returns:
+            line_list (list of strings): new messages
+            finished (Boolean): True if the job is complete
+        """
+        with self.condition:
+            job = self.jobs[job_id]
+            if len(job['progress']) <= start_index and \
+                    job['status'] in ['queued', 'running']:
+                self.condition.wait(timeout)
+            line_list = job['progress'][start_index:]
+            finished = job['status'] in ['success', 'failed']
+
+            return line_list, finished
+
+    def add_progress(self, job_id, line):
+        """Add a progress message to a job
+
+        Args:
+            job_id (string): job identifier
+            line (string): message
+
+        Returns:
+            N/A
+        """
+        with self.condition:
+            self.jobs[job_id]['progress'].append(line)
+            self.condition.notify_all()
+
+    def dispatch_jobs(self):
+        """Send queued jobs to the workers (service thread)
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        while True:
+            with self.condition:
+                while not self.stopping and (
+                        not self.job_heap or
+                        self.running_count >= self.workers):
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                _, _, job_id = heapq.heappop(self.job_heap)
+                job = self.jobs[job_id]
+                job['status'] = 'running'
+                job['started'] = time.time()
+                self.running_count += 1
+                job_request = dict(
+                    (key, job[key]) for key in
+                    ['id', 'subject', 'slabs', 'slabs_per_repetition'] +
+                    JOB_REQUEST_KEYS)
+            self.add_progress(job_id, '[service] job started')
+            try:
+                future = self.submit_job(job_request)
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died since the last job was sent: restart the
+                # pool and send the job (which did not run) to the new
+                # workers
+                self.executor.shutdown(wait=False)
+                self.executor = self.create_executor()
+                try:
+                    future = self.submit_job(job_request)
+                except concurrent.futures.process.BrokenProcessPool as exc:
+                    self.complete_job(job_id, None, exc)
+                    continue
+            future.add_done_callback(functools.partial(self.job_done, job_id))
+
+    def submit_job(self, job_request):
+        """Send a job to the pool of worker processes
+
+        Args:
+            job_request (dict): job request (see JOB_REQUEST_KEYS), with
+                its id and subject
+
+        Returns:
+            future (concurrent.futures.Future): future of the job
+        """
+        return self.executor.submit(
+            self.job_function, job_request, self.progress_queue,
+            *self.job_function_args)
+
+    def job_done(self, job_id, future):
+        """Record the result of a job (called when its future completes)
+
+        Args:
+            job_id (string): job identifier
+            future (concurrent.futures.Future): future of the job
+
+        Returns:
+            N/A
+        """
+        error = None
+        try:
+            result = future.result()
+        except Exception as exc:
+            # worker process died (e.g., killed by the system)
+            result = None
+            error = exc
+        # the worker sent its progress messages before returning: complete
+        # the job once they have all been collected (see collect_progress)
+        with self.condition:
+            self.job_results[job_id] = (result, error)
+        self.progress_queue.put((job_id, None))
+
+    def complete_job(self, job_id, result, exc):
+        """Mark a job as complete
+
+        Args:
+            job_id (string): job identifier
+            result (dict): result of the job function. None if it did
+                not return
+            exc (Exception): error raised while running the job. None if
+                the job function returned
+
+        Returns:
+            N/A
+        """
+        with self.condition:
+            job = self.jobs[job_id]
+            if result is None:
+                job['status'] = 'failed'
+                job['error'] = repr(exc)
+            else:
+                job['status'] = result['status']
+                job['error'] = result.get('error', '')
+            job['finished'] = time.time()
+            job['elapsed_seconds'] = round(
+                job['finished']-job['started'], 3)
+            job['progress'].append('[service] job {0}'.format(job['status']))
+            self.running_count -= 1
+            self.condition.notify_all()
+
+    def collect_progress(self):
+        """Collect the progress messages of the workers and complete the
+        jobs whose messages have all been collected (service thread)
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        while True:
+            message = self.progress_queue.get()
+            if message is None:
+                return
+            job_id, line = message
+            if line is None:
+                with self.condition:
+                    result, exc = self.job_results.pop(job_id)
+                self.complete_job(job_id, result, exc)
+            else:
+                self.add_progress(job_id, line)
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP request handler of the recombination service
+
+    The service is found in the service attribute of the server.
+    """
+
+    def send_json(self, data, status=200):
+        """Send a JSON response
+
+        Args:
+            data (dict or list): response content
+            status (int): HTTP status code
+
+        Returns:
+            N/A
+        """
+        body = json.dumps(data, indent=2, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        path_parts = [part for part in self.path.split('/') if part]
+        if path_parts == ['jobs']:
+            self.send_json(service.list_jobs())
+            return
+        if len(path_parts) < 2 or path_parts[0] != 'jobs' or \
+                service.job_summary(path_parts[1]) is None:
+            self.send_json({'error': 'not found'}, 404)
+            return
+        job_id = path_parts[1]
+        if len(path_parts) == 2:
+            self.send_json(service.job_summary(job_id, with_progress=True))
+        elif path_parts[2:] == ['progress']:
+            self.stream_progress(job_id)
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json({'error': 'not found'}, 404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            job = service.submit(request)
+        except (ValueError, TypeError) as exc:
+            self.send_json({'error': str(exc)}, 400)
+            return
+        self.send_json(job, 201)
+
+    def stream_progress(self, job_id):
+        """Stream the progress messages of a job until it completes
+
+        Args:
+            job_id (string): job identifier
+
+        Returns:
+            N/A
+        """
+        service = self.server.service
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.end_headers()
+        sent_count = 0
+        finished = False
+        while not finished:
+            line_list, finished = service.wait_progress(job_id, sent_count)
+            for line in line_list:
+                self.wfile.write('{0}\n'.format(line).encode('utf-8'))
+            self.wfile.flush()
+            sent_count += len(line_list)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTP server on a TCP port, one thread per request"""
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(
+        socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket, one thread per request"""
+    daemon_threads = True
+
+
+def create_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                  socket_path=None):
+    """Create the HTTP server of a service
+
+    Args:
+        service (RecombinationService): service
+        host (string): host name or address to listen on
+        port (int): TCP port to listen on
+        socket_path (string): path to a Unix socket to listen on instead
+            of a TCP port. None to use the TCP port
+
+    Returns:
+        server (socketserver.BaseServer): HTTP server
+    """
+    if socket_path is None:
+        server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    else:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, ServiceRequestHandler)
+    server.service = service
+
+    return server
@@ -0,0 +1,307 @@
+"""Zero-copy transport of volumes between processes
+
+Passes NIfTI volumes (data array, affine and header) between worker
+processes through shared memory segments
+(multiprocessing.shared_memory), instead of pickling the voxel data or
+writing it to disk. Only a small handle (segment name, shape, dtype,
+affine and header) is sent to the other process, which maps the same
+memory: the voxel data is neither copied nor serialised.
+
+Segments are owned by a single process (usually the parent), through a
+SharedVolumePool. Each segment is registered with the number of
+consumers that will read it, and is freed when the last consumer has
+released it. Workers only map segments: they never free them. Volumes
+produced by a worker are written to a new segment created by the
+worker, whose ownership is handed to the pool of the parent with the
+handle.
+
+Typical use:
+    parent: handle = pool.put(volume, consumer_count=1)
+            future = executor.submit(task, handle)
+    worker: with attached_volume(handle) as volume:
+                out_handle, out_shm, out_data = create_shared_volume(
+                    volume.shape, np.float32, volume.affine)
+                out_data[...] = volume.get_fdata()
+                del out_data
+                out_shm.close()
+            return out_handle
+    parent: pool.release(handle)
+            out_handle = pool.adopt(future.result(), consumer_count=1)
+            ...
+
+"""
+
+import contextlib
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import nibabel as nib
+
+
+class SharedVolumeHandle(object):
+    """Picklable description of a volume stored in shared memory
+
+    Args:
+        name (string): name of the shared memory segment
+        shape (tuple): shape of the data array
+        dtype (string): data type of the data array (numpy dtype string)
+        affine (numpy.ndarray): 4x4 affine of the volume
+        header (bytes): binary NIfTI-1 header of the volume. None to
+            build a default header
+    """
+
+    def __init__(self, name, shape, dtype, affine, header=None):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.affine = np.array(affine, dtype=np.float64)
+        self.header = header
+
+    def nbytes(self):
+        """Size of the data array
+
+        Args:
+            N/A
+
+        Returns:
+            nbytes (int): size of the data array, in bytes
+        """
+        return int(np.prod(self.shape))*np.dtype(self.dtype).itemsize
+
+    def __repr__(self):
+        return 'SharedVolumeHandle({0}, {1}, {2})'.format(
+            self.name, self.shape, self.dtype)
+
+
+def create_shared_volume(shape, dtype, affine, header=None):
+    """Create a shared memory segment for a new volume
+
+    The data array is mapped on the segment, so that a producer can
+    write its result in place. The caller must delete the array and
+    close the segment (not unlink it) once done, and hand the handle to
+    the owner of the segment (see SharedVolumePool.adopt).
+
+    Args:
+        shape (tuple): shape of the data array
+        dtype (numpy dtype): data type of the data array
+        affine (numpy.ndarray): 4x4 affine of the volume
+        header (nibabel.Nifti1Header): header of the volume. None to
+            build a default header
+
+    Returns:
+        handle (SharedVolumeHandle): handle of the volume
+        shm (multiprocessing.shared_memory.SharedMemory): segment
+        data (numpy.ndarray): data array, mapped on the segment
+    """
+    header_bytes = None
+    if header is not None:
+        header = nib.Nifti1Header.from_header(header)
+        header.set_data_dtype(dtype)
+        header.set_data_shape(shape)
+        header_bytes = header.binaryblock
+    nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+    # segments cannot be empty
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    handle = SharedVolumeHandle(shm.name, shape, dtype, affine, header_bytes)
+    data = np.ndarray(handle.shape, dtype=handle.dtype, buffer=shm.buf)
+
+    return handle, shm, data
+
+
+def attach_volume(handle):
+    """Map a volume stored in shared memory
+
+    The data array of the returned volume is mapped on the segment (no
+    copy). The caller must drop all references to the volume and its
+    data before closing the segment.
+
+    Args:
+        handle (SharedVolumeHandle): handle of the volume
+
+    Returns:
+        volume (nibabel.Nifti1Image): volume
+        shm (multiprocessing.shared_memory.SharedMemory): segment
+    """
+    shm = shared_memory.SharedMemory(name=handle.name)
+    data = np.ndarray(handle.shape, dtype=handle.dtype, buffer=shm.buf)
+    header = None
+    if handle.header is not None:
+        header = nib.Nifti1Header(binaryblock=handle.header)
+    volume = nib.Nifti1Image(data, handle.affine, header)
+
+    return volume, shm
+
+
+@contextlib.contextmanager
+def attached_volume(handle):
+    """Map a volume stored in shared memory for the duration of a block
+
+    References to the volume and its data must not outlive the block:
+    the segment is closed (not freed) at the end of the block.
+
+    Args:
+        handle (SharedVolumeHandle): handle of the volume
+
+    Returns:
+        volume (nibabel.Nifti1Image): volume (see attach_volume)
+    """
+    volume, shm = attach_volume(handle)
+    try:
+        yield volume
+    finally:
+        del volume
+        shm.close()
+
+
+class SharedVolumePool(object):
+    """Owner of the shared memory segments of a run
+
+    Each segment is registered with its number of consumers and freed
+    when the last consumer releases it. All the remaining segments are
+    freed when the pool is closed (e.g., when a run fails), so that no
+    segment outlives the run. The pool can be used from several
+    threads.
+
+    Args:
+        N/A
+    """
+
+    def __init__(self):
+        # segment name -> [segment, number of consumers left]
+        self.segments = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def put(self, volume, consumer_count=1):
+        """Copy a volume into a new segment owned by the pool
+
+        This is the only copy of the voxel data: consumers map the
+        segment.
+
+        Args:
+            volume (nibabel image): volume
+            consumer_count (int): number of consumers of the volume
+
+        Returns:
+            handle (SharedVolumeHandle): handle of the volume
+        """
+        in_data = np.asanyarray(volume.dataobj)
+        handle, shm, data = create_shared_volume(
+            in_data.shape, in_data.dtype, volume.affine, volume.header)
+        data[...] = in_data
+        del data
+        self.register(handle, shm, consumer_count)
+
+        return handle
+
+    def adopt(self, handle, consumer_count=1):
+        """Take ownership of a segment created by another process
+
+        Args:
+            handle (SharedVolumeHandle): handle returned by the producer
+                (see create_shared_volume)
+            consumer_count (int): number of consumers of the volume
+
+        Returns:
+            handle (SharedVolumeHandle): same handle
+        """
+        shm = shared_memory.SharedMemory(name=handle.name)
+        self.register(handle, shm, consumer_count)
+
+        return handle
+
+    def register(self, handle, shm, consumer_count):
+        """Register a segment owned by the pool
+
+        Args:
+            handle (SharedVolumeHandle): handle of the volume
+            shm (multiprocessing.shared_memory.SharedMemory): segment
+            consumer_count (int): number of consumers of the volume. 0
+                frees the segment right away
+
+        Returns:
+            N/A
+        """
+        with self.lock:
+            self.segments[handle.name] = [shm, consumer_count]
+        if consumer_count <= 0:
+            self.free(handle.name)
+
+    def acquire(self, handle, consumer_count=1):
+        """Add consumers to a volume
+
+        Args:
+            handle (SharedVolumeHandle): handle of the volume
+            consumer_count (int): number of consumers to add
+
+        Returns:
+            N/A
+        """
+        with self.lock:
+            if handle.name not in self.segments:
+                raise ValueError('{0} is not in the pool'.format(handle))
+            self.segments[handle.name][1] += consumer_count
+
+    def release(self, handle):
+        """Release a volume once a consumer is done with it
+
+        The segment is freed when its last consumer releases it.
+
+        Args:
+            handle (SharedVolumeHandle): handle of the volume
+
+        Returns:
+            N/A
+        """
+        with self.lock:
+            if handle.name not in self.segments:
+                raise ValueError('{0} is not in the pool'.format(handle))
+            self.segments[handle.name][1] -= 1
+            if self.segments[handle.name][1] > 0:
+                return
+        self.free(handle.name)
+
+    def free(self, name):
+        """Free a segment
+
+        Args:
+            name (string): name of the segment
+
+        Returns:
+            N/A
+        """
+        with self.lock:
+            shm = self.segments.pop(name)[0]
+        shm.close()
+        shm.unlink()
+
+    def nbytes(self):
+        """Size of the segments owned by the pool
+
+        Args:
+            N/A
+
+        Returns:
+            nbytes (int): size of the segments, in bytes
+        """
+        with self.lock:
+            return sum(shm.size for shm, _ in self.segments.values())
+
+    def close(self):
+        """Free all the segments owned by the pool
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        with self.lock:
+            name_list = list(self.segments)
+        for name in name_list:
+            self.free(name)
@@ -0,0 +1,12 @@
+"""Test configuration
+
+The modules of the recombination code live at the top level of the
+repository: make them importable from the tests.
+
+"""
+
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
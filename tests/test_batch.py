@@ -0,0 +1,178 @@
+"""Tests of the batch runner (see batch.run_batch)"""
+
+import os
+import time
+
+import pytest
+
+import batch
+
+
+def sleeping_subject(subject_name):
+    """Subject function: sleep, or kill the worker process
+
+    Args:
+        subject_name (string): name of the subject. The worker process
+            running subject 'killed' exits abruptly
+
+    Returns:
+        result (dict): result of the subject
+    """
+    if subject_name == 'killed':
+        time.sleep(0.2)
+        os._exit(9)
+    time.sleep(0.5)
+
+    return {
+        'subject': subject_name,
+        'status': 'success',
+        'elapsed_seconds': 0.5,
+        'outdir': subject_name,
+        'error': ''}
+
+
+def test_dead_worker_does_not_stop_the_batch(tmp_path):
+    """A worker process that dies only fails the subjects it was
+    running: the next subjects run on a new pool, and all of them are
+    in the summary
+    """
+    subject_name_list = ['a', 'killed', 'c', 'd', 'e']
+    subject_list = [
+        {'subject': subject_name, 'outdir': subject_name}
+        for subject_name in subject_name_list]
+
+    result_list = batch.run_batch(
+        subject_list,
+        sleeping_subject,
+        [(subject_name,) for subject_name in subject_name_list],
+        workers=2)
+
+    status = dict(
+        (result['subject'], result['status']) for result in result_list)
+    assert status['killed'] == 'failed'
+    # subjects admitted after the worker died run on a new pool
+    for subject_name in ['c', 'd', 'e']:
+        assert status[subject_name] == 'success'
+    summary_path = str(tmp_path / batch.SUMMARY_FILENAME)
+    batch.write_summary(result_list, summary_path)
+    with open(summary_path) as summary_file:
+        assert len(summary_file.readlines()) == len(subject_name_list)+1
+
+
+def write_grid_manifest(tmp_path, repetition_count, slabs_per_repetition):
+    """Write a manifest of one subject with a grid of slab columns
+
+    Args:
+        tmp_path (pathlib.Path): temporary folder of the test
+        repetition_count (int): number of repetitions
+        slabs_per_repetition (int): number of slabs per repetition
+
+    Returns:
+        manifest_path (string): path to the CSV manifest
+    """
+    column_list = [
+        batch.SLAB_COLUMN.format(repetition, slab)
+        for repetition in range(1, repetition_count+1)
+        for slab in range(1, slabs_per_repetition+1)]
+    manifest_path = str(tmp_path / 'subjects.csv')
+    with open(manifest_path, 'w') as manifest_file:
+        # columns out of order: the grid comes from the column names
+        manifest_file.write(
+            ','.join(['subject', 'lowres'] + column_list[::-1]) + '\n')
+        manifest_file.write(','.join(
+            ['sub-01', 'lowres.nii.gz'] +
+            ['{0}.nii.gz'.format(column) for column in column_list[::-1]])
+            + '\n')
+
+    return manifest_path
+
+
+def test_manifest_with_any_grid_of_slabs(tmp_path):
+    """The manifest lists any number of repetitions and slabs, in
+    repetition order, and two repetitions of two slabs as before
+    """
+    for repetition_count, slabs_per_repetition in [(3, 3), (2, 2), (4, 1)]:
+        manifest_path = write_grid_manifest(
+            tmp_path, repetition_count, slabs_per_repetition)
+        subject_list = batch.read_manifest(
+            manifest_path, str(tmp_path / 'out'))
+
+        assert len(subject_list) == 1
+        subject = subject_list[0]
+        assert subject['slabs_per_repetition'] == slabs_per_repetition
+        assert subject['slabs'] == [
+            str(tmp_path / 'rep{0}s{1}.nii.gz'.format(repetition, slab))
+            for repetition in range(1, repetition_count+1)
+            for slab in range(1, slabs_per_repetition+1)]
+        assert subject['lowres'] == str(tmp_path / 'lowres.nii.gz')
+        assert batch.subject_slabs(subject) == (
+            subject['slabs'], slabs_per_repetition)
+
+
+def test_manifest_with_missing_slab_is_rejected(tmp_path):
+    """A subject missing a slab of its grid is an error"""
+    manifest_path = str(tmp_path / 'subjects.csv')
+    with open(manifest_path, 'w') as manifest_file:
+        manifest_file.write('subject,rep1s1,rep1s2,rep2s1,rep2s2,lowres\n')
+        manifest_file.write('sub-01,a.nii,b.nii,c.nii,,lowres.nii\n')
+
+    with pytest.raises(ValueError, match='sub-01.*rep2s2'):
+        batch.read_manifest(manifest_path, str(tmp_path / 'out'))
+
+
+def test_legacy_job_slabs():
+    """Jobs with slab columns instead of a list of slabs still run"""
+    job = {
+        'subject': 'sub-01', 'rep1s1': 'a', 'rep1s2': 'b', 'rep2s1': 'c',
+        'rep2s2': 'd', 'lowres': 'e', 'outdir': 'f'}
+
+    assert batch.subject_slabs(job) == (['a', 'b', 'c', 'd'], 2)
+
+
+def write_bids_inputs(anatdir_path, run_slab_list, lowres=True):
+    """Write empty inputs with BIDS-style names
+
+    Args:
+        anatdir_path (pathlib.Path): anat folder of the subject
+        run_slab_list (list of tuples): (run, slab) of each slab
+        lowres (Boolean): write a low-res volume
+
+    Returns:
+        N/A
+    """
+    anatdir_path.mkdir(parents=True)
+    subject_name = anatdir_path.parent.name
+    for run, slab in run_slab_list:
+        (anatdir_path / '{0}_run-{1}_acq-slab{2}_T2w.nii.gz'.format(
+            subject_name, run, slab)).touch()
+    if lowres:
+        (anatdir_path / '{0}_acq-lowres_T2w.nii.gz'.format(
+            subject_name)).touch()
+
+
+def test_bids_scan_finds_any_grid_of_slabs(tmp_path):
+    """Every run and slab of a subject is found; subjects with an
+    incomplete grid or without a low-res volume are skipped
+    """
+    bids_path = tmp_path / 'bids'
+    grid = [(run, slab) for run in range(1, 4) for slab in range(1, 4)]
+    write_bids_inputs(bids_path / 'sub-01' / 'anat', grid)
+    write_bids_inputs(bids_path / 'sub-02' / 'anat', grid[:-1])
+    write_bids_inputs(bids_path / 'sub-03' / 'anat', grid, lowres=False)
+    write_bids_inputs(
+        bids_path / 'sub-04' / 'anat',
+        [(run, slab) for run in range(1, 3) for slab in range(1, 3)])
+
+    subject_list = batch.scan_bids_directory(
+        str(bids_path), str(tmp_path / 'out'))
+
+    assert [subject['subject'] for subject in subject_list] == [
+        'sub-01', 'sub-04']
+    assert subject_list[0]['slabs_per_repetition'] == 3
+    assert [
+        os.path.basename(slab_path)
+        for slab_path in subject_list[0]['slabs']] == [
+            'sub-01_run-{0}_acq-slab{1}_T2w.nii.gz'.format(run, slab)
+            for run, slab in grid]
+    assert subject_list[1]['slabs_per_repetition'] == 2
+    assert len(subject_list[1]['slabs']) == 4
@@ -0,0 +1,735 @@
+"""Tests of the image operations of the recombination code (see
+recombine.py)"""
+
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+pytest.importorskip('nipype')
+
+import recombine
+
+
+RECOMBINE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'recombine.py')
+FINAL_OUTPUT_FILENAMES = [
+    '{0}_float_ponderated.nii.gz'.format(output)
+    for output in ['rs', 'rs1', 'rs2', 'rs_1_2']]
+
+
+def test_tag_canonical_leaves_volume_untouched():
+    """Tagging a volume returns a tagged copy sharing its data"""
+    data = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+    volume = nib.Nifti1Image(data, np.eye(4))
+
+    tagged_volume = recombine.tag_canonical(volume)
+
+    assert tagged_volume.extra[recombine.CANONICAL_TAG]
+    assert recombine.CANONICAL_TAG not in volume.extra
+    assert tagged_volume.dataobj is volume.dataobj
+    assert np.array_equal(tagged_volume.affine, volume.affine)
+    # a tagged volume is not reoriented again
+    assert recombine.canonical_volume(tagged_volume) is tagged_volume
+
+
+def sparse_volume_data():
+    """Volume data with non-zero voxels in a corner of a larger grid
+
+    Args:
+        N/A
+
+    Returns:
+        data (np.array): [20,30,12] float32 array
+    """
+    data = np.zeros((20, 30, 12), dtype=np.float32)
+    data[3:9, 11:25, 5:7] = np.arange(168, dtype=np.float32).reshape(
+        (6, 14, 2)) + 1
+    data[10, 12, 6] = -2.5
+
+    return data
+
+
+def test_crop_then_expand_restores_volume(tmp_path):
+    """A cropped volume expanded back has the shape, affine and data of
+    the original volume, also once saved and read back and when cropped
+    twice
+    """
+    data = sparse_volume_data()
+    affine = rotation_affine(0.3).dot(np.diag([0.3, 0.3, 1.2, 1.0]))
+    affine[0:3, 3] = [-12.5, 40.0, 7.25]
+    volume = nib.Nifti1Image(data, affine)
+
+    cropped_volume = recombine.crop_volume(volume)
+    assert cropped_volume.shape == (8, 14, 2)
+    # the voxels keep their world coordinates
+    assert np.allclose(
+        cropped_volume.affine,
+        affine.dot(recombine.translation_affine((3, 11, 5))))
+    recombine.save_volume(cropped_volume, str(tmp_path / 'cropped.nii.gz'))
+    read_volume = nib.load(str(tmp_path / 'cropped.nii.gz'))
+    for cropped in [
+            cropped_volume, read_volume,
+            recombine.crop_volume(recombine.volume_addition(
+                cropped_volume, cropped_volume))]:
+        expanded_volume = recombine.expand_volume(cropped)
+        assert expanded_volume.shape == data.shape
+        assert np.allclose(expanded_volume.affine, affine)
+    expanded_volume = recombine.expand_volume(cropped_volume)
+    assert np.array_equal(expanded_volume.affine, affine)
+    assert np.array_equal(np.asarray(expanded_volume.dataobj), data)
+    assert np.array_equal(
+        np.asarray(recombine.expand_volume(read_volume).dataobj), data)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 16, 1000])
+def test_sparse_gzip_file_matches_gzip(tmp_path, chunk_size):
+    """A file written with SparseGzipFile decompresses to the data
+    written, as with plain gzip, whatever the size of the writes and
+    including data ending with a partial empty block
+    """
+    block_size = 16
+    rng = np.random.RandomState(0)
+    data = b''.join([
+        rng.bytes(5), bytes(40), rng.bytes(block_size), bytes(block_size),
+        rng.bytes(3), bytes(block_size*3), bytes(block_size//2)])
+    sparse_path = str(tmp_path / 'sparse.gz')
+    with recombine.SparseGzipFile(
+            sparse_path, block_size=block_size) as sparse_file:
+        for start in range(0, len(data), chunk_size):
+            sparse_file.write(data[start:start+chunk_size])
+    plain_path = str(tmp_path / 'plain.gz')
+    with gzip.open(plain_path, 'wb') as plain_file:
+        plain_file.write(data)
+
+    for path in [sparse_path, plain_path]:
+        with gzip.open(path, 'rb') as in_file:
+            assert in_file.read() == data
+    # only zeros, ending with a partial block
+    with recombine.SparseGzipFile(
+            sparse_path, block_size=block_size) as sparse_file:
+        sparse_file.seek(block_size*2+5)
+    with gzip.open(sparse_path, 'rb') as in_file:
+        assert in_file.read() == bytes(block_size*2+5)
+
+
+def test_sparse_gzip_volume_reads_as_nib_save(tmp_path):
+    """A volume saved as .nii.gz with the sparse gzip writer
+    decompresses to the same file as one saved by nibabel
+    """
+    volume = nib.Nifti1Image(sparse_volume_data(), np.eye(4))
+    sparse_path = str(tmp_path / 'sparse.nii.gz')
+    recombine.save_volume(volume, sparse_path)
+    plain_path = str(tmp_path / 'plain.nii.gz')
+    nib.save(volume, plain_path)
+
+    with gzip.open(sparse_path, 'rb') as sparse_file, \
+            gzip.open(plain_path, 'rb') as plain_file:
+        assert sparse_file.read() == plain_file.read()
+
+
+def rotation_affine(angle):
+    """Rotation around the z axis
+
+    Args:
+        angle (float): rotation angle, in radians
+
+    Returns:
+        affine (np.array): [4,4] affine
+    """
+    affine = np.eye(4)
+    affine[0:2, 0:2] = [
+        [np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+
+    return affine
+
+
+def write_oblique_inputs(inputdir_path, orientation='LPS'):
+    """Write synthetic float inputs with an oblique affine
+
+    The affine of the inputs cannot be stored exactly in single
+    precision in the header of a file.
+
+    Args:
+        inputdir_path (pathlib.Path): folder where the inputs are written
+        orientation (string): 'RAS' or 'LPS'
+
+    Returns:
+        input_path_list (list of strings): paths to the inputs rep1s1,
+            rep1s2, rep2s1, rep2s2 and lowres
+    """
+    benchmark = pytest.importorskip('benchmark')
+    inputdir_path.mkdir()
+    input_path_list = benchmark.write_pipeline_inputs(
+        str(inputdir_path), dtype='float', orientation=orientation)
+    for input_path in input_path_list:
+        volume = nib.load(input_path)
+        nib.save(
+            nib.Nifti1Image(
+                np.asarray(volume.dataobj),
+                rotation_affine(0.0123).dot(volume.affine)),
+            input_path)
+
+    return input_path_list
+
+
+def run_pipeline(input_path_list, outdir_path, option_list=()):
+    """Run the recombination code with the stub registration backend
+
+    Args:
+        input_path_list (list of strings): paths to the inputs rep1s1,
+            rep1s2, rep2s1, rep2s2 and lowres
+        outdir_path (string): output folder
+        option_list (list of strings): other command-line arguments
+
+    Returns:
+        output (string): standard output of the run
+    """
+    return subprocess.check_output(
+        [sys.executable, RECOMBINE_PATH] + list(input_path_list) +
+        [outdir_path, '--registration', 'stub'] + list(option_list),
+        universal_newlines=True)
+
+
+def assert_same_outputs(outdir_path, other_outdir_path, filename_list):
+    """Check that two runs wrote the same volumes
+
+    Args:
+        outdir_path (string): output folder of the first run
+        other_outdir_path (string): output folder of the second run
+        filename_list (list of strings): names of the volumes to compare
+
+    Returns:
+        N/A
+    """
+    for filename in filename_list:
+        volume = nib.load(os.path.join(outdir_path, filename))
+        other_volume = nib.load(os.path.join(other_outdir_path, filename))
+        assert np.array_equal(volume.affine, other_volume.affine), filename
+        assert np.array_equal(
+            np.asarray(volume.dataobj), np.asarray(other_volume.dataobj)), \
+            filename
+
+
+def test_cached_volume_has_geometry_of_file(tmp_path):
+    """A saved volume read back from the cache has the affine stored in
+    its file, not the double precision affine it was saved with
+    """
+    volume = nib.Nifti1Image(
+        np.ones((4, 5, 6), dtype=np.float32),
+        rotation_affine(0.0123).dot(np.diag([0.3, 0.3, 1.2, 1.0])))
+    volume_path = str(tmp_path / 'volume.nii')
+    recombine.save_volume(volume, volume_path)
+
+    cached_volume = recombine.VOLUME_CACHE.get(volume_path)
+    assert cached_volume is not None
+    assert np.array_equal(cached_volume.affine, nib.load(volume_path).affine)
+    assert not np.array_equal(cached_volume.affine, volume.affine)
+
+
+@pytest.mark.parametrize('keep_intermediates', ['registered', 'none'])
+def test_cache_does_not_change_outputs(tmp_path, keep_intermediates):
+    """A run with the volume cache and a run without it give identical
+    outputs (LPS float inputs with an oblique affine)
+    """
+    input_path_list = write_oblique_inputs(tmp_path / 'inputs')
+    outdir_path_list = []
+    for cache_size in ['256', '0']:
+        outdir_path = str(tmp_path / 'out-{0}'.format(cache_size))
+        run_pipeline(
+            input_path_list, outdir_path,
+            ['--keep-intermediates', keep_intermediates,
+             '--cache-size', cache_size])
+        outdir_path_list.append(outdir_path)
+
+    assert_same_outputs(
+        outdir_path_list[0], outdir_path_list[1], FINAL_OUTPUT_FILENAMES)
+
+
+@pytest.fixture
+def cross_device_rename(monkeypatch, tmp_path):
+    """Make renames out of the working directory fail, as if it was on
+    another file system
+
+    Args:
+        monkeypatch (pytest fixture): patches os.rename
+        tmp_path (pathlib.Path): temporary folder of the test
+
+    Returns:
+        workdir_path (string): path to the working directory
+    """
+    workdir_path = str(tmp_path / 'work')
+    rename = os.rename
+
+    def cross_device_rename(src, dst):
+        if os.path.dirname(src) == workdir_path:
+            raise OSError('Invalid cross-device link')
+        rename(src, dst)
+
+    monkeypatch.setattr(os, 'rename', cross_device_rename)
+
+    return workdir_path
+
+
+def test_commit_outputs_replaces_stale_staging(tmp_path, cross_device_rename):
+    """Staging paths left by a failed run do not stop the next one"""
+    workdir_path = cross_device_rename
+    outdir_path = str(tmp_path / 'out')
+    os.makedirs(os.path.join(workdir_path, 'debug'))
+    os.makedirs(outdir_path)
+    for path in [
+            os.path.join(workdir_path, 'rs.nii.gz'),
+            os.path.join(workdir_path, 'debug', 's1a.nii.gz')]:
+        with open(path, 'w') as out_file:
+            out_file.write(os.path.basename(path))
+    # staging paths of a previous run that failed while copying
+    os.makedirs(os.path.join(outdir_path, '.debug.partial'))
+    with open(os.path.join(outdir_path, '.rs.nii.gz.partial'), 'w'):
+        pass
+
+    recombine.commit_outputs(workdir_path, outdir_path)
+
+    assert sorted(os.listdir(outdir_path)) == ['debug', 'rs.nii.gz']
+    with open(os.path.join(outdir_path, 'debug', 's1a.nii.gz')) as in_file:
+        assert in_file.read() == 's1a.nii.gz'
+    assert not os.path.exists(workdir_path)
+
+
+def test_commit_outputs_removes_staging_on_error(
+        tmp_path, monkeypatch, cross_device_rename):
+    """A failed copy does not leave its staging path behind"""
+    workdir_path = cross_device_rename
+    outdir_path = str(tmp_path / 'out')
+    os.makedirs(workdir_path)
+    os.makedirs(outdir_path)
+    with open(os.path.join(workdir_path, 'rs.nii.gz'), 'w') as out_file:
+        out_file.write('rs')
+
+    def failing_copyfile(src, dst):
+        with open(dst, 'w') as out_file:
+            out_file.write('r')
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(recombine.shutil, 'copyfile', failing_copyfile)
+    with pytest.raises(OSError):
+        recombine.commit_outputs(workdir_path, outdir_path)
+
+    assert os.listdir(outdir_path) == []
+    assert os.listdir(workdir_path) == ['rs.nii.gz']
+
+
+def test_disk_usage_peak_sampled_after_each_write(tmp_path):
+    """The peak disk usage of the working directory includes files
+    removed before the end of a part of the algorithm
+    """
+    workdir_path = str(tmp_path / 'work')
+    os.makedirs(os.path.join(workdir_path, 'temp'))
+    recombine.track_disk_usage(workdir_path)
+    impath = os.path.join(workdir_path, 'temp', 'image.nii')
+    with open(impath, 'wb') as out_file:
+        out_file.write(b'\0'*4096)
+    recombine.count_bytes_written(impath)
+    # files outside the working directory are not counted
+    with open(str(tmp_path / 'other.nii'), 'wb') as out_file:
+        out_file.write(b'\0'*8192)
+    recombine.count_bytes_written(str(tmp_path / 'other.nii'))
+    recombine.safe_remove(impath, workdir_path)
+
+    assert recombine.pop_disk_usage_peak(workdir_path) == 4096
+    # no longer measured
+    assert recombine.pop_disk_usage_peak(workdir_path) == 0
+
+
+def test_incremental_run_reuses_moved_inputs(tmp_path):
+    """An incremental run reuses the repetitions whose slabs have not
+    changed, even if they were copied to another folder, and gives the
+    same outputs as a full run
+    """
+    benchmark = pytest.importorskip('benchmark')
+    (tmp_path / 'inputs').mkdir()
+    input_path_list = benchmark.write_pipeline_inputs(
+        str(tmp_path / 'inputs'))
+    previous_outdir_path = str(tmp_path / 'previous')
+    run_pipeline(input_path_list, previous_outdir_path)
+
+    # same rep1 slabs and low-res volume, in another folder; rep2
+    # re-acquired
+    (tmp_path / 'reacquired').mkdir()
+    reacquired_path_list = benchmark.write_pipeline_inputs(
+        str(tmp_path / 'reacquired'), seed=benchmark.DEFAULT_SEED+10)
+    (tmp_path / 'moved').mkdir()
+    moved_path_list = []
+    for input_path in input_path_list[0:2] + input_path_list[4:5]:
+        moved_path = str(tmp_path / 'moved' / os.path.basename(input_path))
+        shutil.copyfile(input_path, moved_path)
+        moved_path_list.append(moved_path)
+    moved_path_list[2:2] = reacquired_path_list[2:4]
+
+    output = run_pipeline(
+        moved_path_list, str(tmp_path / 'incremental'),
+        ['--incremental', previous_outdir_path])
+    assert 'repetition(s) 1 reused, 2 processed' in output
+    run_pipeline(moved_path_list, str(tmp_path / 'full'))
+    assert_same_outputs(
+        str(tmp_path / 'incremental'), str(tmp_path / 'full'),
+        FINAL_OUTPUT_FILENAMES)
+
+
+def write_registered_slabs(debugdir_path, repetition_count, slab_count):
+    """Write synthetic registered slabs and phantoms (with gap)
+
+    The slabs of a repetition interleave along y, the repetitions
+    overlap along y.
+
+    Args:
+        debugdir_path (string): folder where the volumes are written
+        repetition_count (int): number of repetitions
+        slab_count (int): number of interleaved slabs per repetition
+
+    Returns:
+        slab_record_list (list of dict): slab records (see
+            recombine.slab_record)
+        float_data_list (list of lists of np.array): data of the slabs
+            of each repetition
+        phantom_data_list (list of lists of np.array): data of the
+            phantoms of each repetition
+    """
+    rng = np.random.RandomState(0)
+    shape = (6, 8*repetition_count+4, 5)
+    slab_record_list = []
+    float_data_list = []
+    phantom_data_list = []
+    for repetition_index in range(repetition_count):
+        repetition = str(repetition_index+1)
+        float_data_list.append([])
+        phantom_data_list.append([])
+        for slab_index in range(slab_count):
+            slab = recombine.slab_letter(slab_index)
+            phantom_data = np.zeros(shape, dtype=np.float32)
+            phantom_data[
+                1:5,
+                8*repetition_index+slab_index:8*repetition_index+12:
+                slab_count,
+                1:4] = 1
+            float_data = phantom_data*rng.uniform(
+                1, 100, shape).astype(np.float32)
+            # registered slabs also have values out of their phantom
+            float_data[0, 8*repetition_index+1, 0] = 3
+            record = recombine.slab_record(
+                repetition, slab, None,
+                os.path.join(
+                    debugdir_path, 's{0}{1}.nii'.format(repetition, slab)),
+                os.path.join(
+                    debugdir_path,
+                    'phantom_s{0}{1}.nii'.format(repetition, slab)))
+            nib.save(
+                nib.Nifti1Image(float_data, np.eye(4)), record['float_path'])
+            nib.save(
+                nib.Nifti1Image(phantom_data, np.eye(4)),
+                record['phantom_gap_path'])
+            slab_record_list.append(record)
+            float_data_list[-1].append(float_data)
+            phantom_data_list[-1].append(phantom_data)
+
+    return slab_record_list, float_data_list, phantom_data_list
+
+
+def run_part3(tmp_path, slab_record_list):
+    """Combine registered slabs and read the final outputs
+
+    Args:
+        tmp_path (pathlib.Path): temporary folder of the test
+        slab_record_list (list of dict): registered slabs
+
+    Returns:
+        output_data (dict): data of each final output, keyed by output
+            name (e.g., rs, rs1, rs_1_2)
+    """
+    outdir_path = str(tmp_path / 'out')
+    recombine.part3(
+        slab_record_list, str(tmp_path / 'debug'),
+        str(tmp_path / 'temp'), outdir_path, keep_intermediates='registered')
+    output_data = {}
+    for filename in os.listdir(outdir_path):
+        output_data[filename.split('_float_ponderated')[0]] = np.asarray(
+            nib.load(os.path.join(outdir_path, filename)).dataobj)
+
+    return output_data
+
+
+def weighted_average(float_data_list, phantom_data_list):
+    """Sum of slabs divided by the sum of their phantoms, 0 where the
+    sum of the phantoms is 0
+
+    Args:
+        float_data_list (list of np.array): data of the slabs
+        phantom_data_list (list of np.array): data of their phantoms
+
+    Returns:
+        average_data (np.array): weighted average
+    """
+    float_sum = np.sum(float_data_list, axis=0, dtype=np.float64)
+    phantom_sum = np.sum(phantom_data_list, axis=0, dtype=np.float64)
+
+    nonzero = phantom_sum != 0
+    average_data = np.zeros(float_sum.shape)
+    average_data[nonzero] = float_sum[nonzero]/phantom_sum[nonzero]
+
+    return average_data
+
+
+@pytest.fixture
+def part3_folders(tmp_path):
+    """Debug, temp and output folders of part3
+
+    Args:
+        tmp_path (pathlib.Path): temporary folder of the test
+
+    Returns:
+        debugdir_path (string): path to the debug folder
+    """
+    for dirname in ['debug', 'temp', 'out']:
+        (tmp_path / dirname).mkdir()
+
+    return str(tmp_path / 'debug')
+
+
+def test_part3_grid_matches_weighted_averages(tmp_path, part3_folders):
+    """Three repetitions of three slabs give the weighted average of all
+    slabs (rs), of each repetition (rs1, rs2, rs3) and the sum of the
+    latter (rs_1_2_3)
+    """
+    slab_record_list, float_data_list, phantom_data_list = \
+        write_registered_slabs(part3_folders, 3, 3)
+
+    output_data = run_part3(tmp_path, slab_record_list)
+
+    assert sorted(output_data) == ['rs', 'rs1', 'rs2', 'rs3', 'rs_1_2_3']
+    assert np.allclose(
+        output_data['rs'],
+        weighted_average(
+            sum(float_data_list, []), sum(phantom_data_list, [])),
+        rtol=1e-6, atol=0)
+    average_list = [
+        weighted_average(float_data, phantom_data)
+        for float_data, phantom_data in zip(
+            float_data_list, phantom_data_list)]
+    for repetition_index, average_data in enumerate(average_list):
+        assert np.allclose(
+            output_data['rs{0}'.format(repetition_index+1)], average_data,
+            rtol=1e-6, atol=0)
+    assert np.allclose(
+        output_data['rs_1_2_3'], np.sum(average_list, axis=0),
+        rtol=1e-6, atol=0)
+
+
+def test_part3_two_by_two_as_before(tmp_path, part3_folders):
+    """Two repetitions of two slabs give exactly the outputs of the
+    pipeline before any number of repetitions and slabs was supported
+    (sums of pairs of volumes, then divisions)
+    """
+    slab_record_list, _, _ = write_registered_slabs(part3_folders, 2, 2)
+    [s1a, s1b, s2a, s2b] = [
+        (recombine.load_volume(record['float_path']),
+         recombine.load_volume(record['phantom_gap_path']))
+        for record in slab_record_list]
+    expected_data = {}
+    rs1_float = recombine.volume_addition(s1a[0], s1b[0])
+    rs2_float = recombine.volume_addition(s2a[0], s2b[0])
+    s1_phantom_gap = recombine.volume_addition(s1a[1], s1b[1])
+    s2_phantom_gap = recombine.volume_addition(s2a[1], s2b[1])
+    rs1 = recombine.volume_division(rs1_float, s1_phantom_gap)
+    rs2 = recombine.volume_division(rs2_float, s2_phantom_gap)
+    for output, volume in [
+            ('rs', recombine.volume_division(
+                recombine.volume_addition(rs1_float, rs2_float),
+                recombine.volume_addition(s1_phantom_gap, s2_phantom_gap))),
+            ('rs1', rs1),
+            ('rs2', rs2),
+            ('rs_1_2', recombine.volume_addition(rs1, rs2))]:
+        expected_data[output] = np.asarray(
+            recombine.expand_volume(volume).dataobj)
+
+    output_data = run_part3(tmp_path, slab_record_list)
+
+    assert sorted(output_data) == sorted(expected_data)
+    for output in expected_data:
+        assert np.array_equal(output_data[output], expected_data[output]), \
+            output
+
+
+def test_load_volume_sees_overwritten_file(tmp_path):
+    """A volume saved then overwritten by another tool (e.g., SPM) or
+    saved again with scaling is read back from its file, not from the
+    volume cache
+    """
+    volume_path = str(tmp_path / 'volume.nii.gz')
+    data = np.arange(60, dtype=np.float32).reshape((3, 4, 5))
+    recombine.save_volume(nib.Nifti1Image(data, np.eye(4)), volume_path)
+    assert recombine.load_volume(volume_path) is \
+        recombine.load_volume(volume_path)
+
+    nib.save(nib.Nifti1Image(data*2, np.eye(4)), volume_path)
+    file_stat = os.stat(volume_path)
+    os.utime(volume_path, ns=(file_stat.st_atime_ns,
+                              file_stat.st_mtime_ns+1000000))
+    assert np.array_equal(
+        np.asarray(recombine.load_volume(volume_path).dataobj), data*2)
+
+    # scaled on save: the data array does not match the file
+    scaled_volume = nib.Nifti1Image((data*6).astype(np.int16), np.eye(4))
+    scaled_volume.header.set_slope_inter(0.5, 0)
+    recombine.save_volume(scaled_volume, volume_path)
+    assert recombine.VOLUME_CACHE.get(volume_path) is None
+    assert np.allclose(
+        np.asarray(recombine.load_volume(volume_path).dataobj), data*3)
+
+
+def run_report(outdir_path):
+    """Read the run report of a run
+
+    Args:
+        outdir_path (string): output folder of the run
+
+    Returns:
+        report (dict): run report (see recombine.RUN_REPORT_FILENAME)
+    """
+    with open(os.path.join(
+            outdir_path, recombine.RUN_REPORT_FILENAME)) as report_file:
+        return json.load(report_file)
+
+
+def test_keep_intermediates_modes(tmp_path):
+    """Each retention policy keeps its own intermediary images, writes
+    less data than the previous one and gives the same final outputs
+    """
+    benchmark = pytest.importorskip('benchmark')
+    (tmp_path / 'inputs').mkdir()
+    input_path_list = benchmark.write_pipeline_inputs(
+        str(tmp_path / 'inputs'))
+    slab_list = ['1a', '1b', '2a', '2b']
+    bytes_written_list = []
+    for keep_intermediates in ['all', 'registered', 'none']:
+        outdir_path = str(tmp_path / keep_intermediates)
+        output = run_pipeline(
+            input_path_list, outdir_path,
+            ['--keep-intermediates', keep_intermediates])
+        assert 'Intermediate retention policy: {0}'.format(
+            keep_intermediates) in output
+        debugdir_path = os.path.join(outdir_path, 'debug')
+        debug_filename_list = sorted(os.listdir(debugdir_path)) \
+            if os.path.isdir(debugdir_path) else []
+        sum_filename_list = [
+            '{0}_float.nii.gz'.format(name) for name in ['rs', 'rs1', 'rs2']]
+        if keep_intermediates == 'all':
+            for filename in sum_filename_list + [
+                    os.path.join('debug', 's1a.nii.gz')]:
+                assert os.path.isfile(os.path.join(outdir_path, filename))
+        else:
+            for filename in sum_filename_list:
+                assert not os.path.exists(
+                    os.path.join(outdir_path, filename))
+        if keep_intermediates == 'registered':
+            assert debug_filename_list == sorted(
+                ['s{0}_float.nii.gz'.format(slab) for slab in slab_list] +
+                ['phantom_one_gap_s{0}.nii.gz'.format(slab)
+                 for slab in slab_list])
+        if keep_intermediates == 'none':
+            assert debug_filename_list == []
+        bytes_written_list.append(
+            run_report(outdir_path)['counters']['bytes_written'])
+        assert_same_outputs(
+            str(tmp_path / 'all'), outdir_path, FINAL_OUTPUT_FILENAMES)
+
+    assert bytes_written_list == sorted(bytes_written_list, reverse=True)
+    assert bytes_written_list[0] > bytes_written_list[-1]
+
+
+def test_outputs_needed_repetitions():
+    """Each final output only needs its own repetitions"""
+    repetition_list = ['1', '2', '3']
+    assert recombine.resolve_outputs(['rs_1_2_3', 'rs2'], repetition_list) \
+        == ['rs2', 'rs_1_2_3']
+    assert recombine.output_repetitions(['rs2'], repetition_list) == ['2']
+    assert recombine.output_repetitions(
+        ['rs3', 'rs1'], repetition_list) == ['1', '3']
+    for output in ['rs', 'rs_1_2_3']:
+        assert recombine.output_repetitions(
+            [output], repetition_list) == repetition_list
+    with pytest.raises(ValueError):
+        recombine.resolve_outputs(['rs_1_2'], repetition_list)
+
+
+def test_outputs_prune_the_pipeline(tmp_path):
+    """Only the requested final outputs are written, the repetitions
+    they do not need are not registered, and they are identical to the
+    outputs of a full run
+    """
+    benchmark = pytest.importorskip('benchmark')
+    (tmp_path / 'inputs').mkdir()
+    input_path_list = benchmark.write_pipeline_inputs(
+        str(tmp_path / 'inputs'))
+    full_outdir_path = str(tmp_path / 'full')
+    run_pipeline(input_path_list, full_outdir_path)
+
+    for output_list, registered_list in [
+            (['rs1'], ['1a', '1b']),
+            (['rs2', 'rs_1_2'], ['1a', '1b', '2a', '2b'])]:
+        outdir_path = str(tmp_path / '-'.join(output_list))
+        output = run_pipeline(
+            input_path_list, outdir_path,
+            ['--outputs', ','.join(output_list),
+             '--keep-intermediates', 'registered'])
+        assert ('Repetition 2 not needed by the outputs' in output) == \
+            ('2a' not in registered_list)
+        filename_list = [
+            '{0}_float_ponderated.nii.gz'.format(name)
+            for name in output_list]
+        assert sorted(
+            filename for filename in os.listdir(outdir_path)
+            if filename.endswith('.nii.gz')) == sorted(filename_list)
+        # registered slabs and phantoms
+        assert sorted(os.listdir(os.path.join(outdir_path, 'debug'))) == \
+            sorted(
+                ['s{0}_float.nii.gz'.format(slab)
+                 for slab in registered_list] +
+                ['phantom_one_gap_s{0}.nii.gz'.format(slab)
+                 for slab in registered_list])
+        assert_same_outputs(full_outdir_path, outdir_path, filename_list)
+
+
+@pytest.mark.parametrize('data_range', [
+    (0.0, 1000.0), (-3.5, 0.0), (-1e-3, 2e-3), (1e5, 2e5), (0.0, 0.0)])
+def test_int16_output_decodes_within_half_a_step(tmp_path, data_range):
+    """A final output stored as scaled int16 reads back within half a
+    scaling step of the computed values, with zero stored exactly and
+    the quantisation error it reports
+    """
+    rng = np.random.RandomState(0)
+    out_data = rng.uniform(data_range[0], data_range[1], (10, 12, 8))
+    out_data[0:3] = 0
+    out_volume = nib.Nifti1Image(out_data, np.eye(4))
+
+    encoded_volume, encoding = recombine.encode_output(out_volume, 'int16')
+    out_volume_path = str(tmp_path / 'rs_float_ponderated.nii.gz')
+    recombine.save_volume(encoded_volume, out_volume_path)
+
+    saved_volume = nib.load(out_volume_path)
+    assert saved_volume.get_data_dtype() == np.int16
+    # the scaling factors are stored exactly in the header
+    slope = float(saved_volume.dataobj.slope)
+    assert slope == encoding['scl_slope']
+    assert float(saved_volume.dataobj.inter) == encoding['scl_inter']
+    saved_data = np.asarray(saved_volume.dataobj, dtype=np.float64)
+    error = np.abs(saved_data-out_data)
+    assert error.max() <= slope/2
+    assert np.all(saved_data[0:3] == 0)
+    assert error.max() == pytest.approx(encoding['max_abs_error'])
+    assert np.sqrt(np.mean(error**2)) == pytest.approx(encoding['rms_error'])
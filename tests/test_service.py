@@ -0,0 +1,184 @@
+"""Tests of the recombination service (see service.py), with the stub
+registration backend (no Matlab needed)"""
+
+import json
+import os
+import threading
+import urllib.request
+
+import pytest
+
+import service
+
+
+@pytest.fixture
+def stub_service(tmp_path):
+    """Recombination service with the stub registration backend, on a
+    free TCP port of the local host
+
+    Args:
+        tmp_path (pathlib.Path): temporary folder of the test
+
+    Returns:
+        url (string): URL of the service
+    """
+    # the pipeline needs nipype
+    recombine = pytest.importorskip('recombine')
+    logdir_path = str(tmp_path / 'logs')
+    os.makedirs(logdir_path)
+    args, _ = recombine.read_serve_cli_args(
+        [logdir_path, '--registration', 'stub', '--port', '0',
+         '--scratch-dir', str(tmp_path)])
+    recombination_service = service.RecombinationService(
+        recombine.recombine_service_job, (args, None, logdir_path), 1)
+    recombination_service.start()
+    server = service.create_server(recombination_service, args.host, 0)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    host, port = server.server_address[:2]
+    try:
+        yield 'http://{0}:{1}'.format(host, port)
+    finally:
+        server.shutdown()
+        server.server_close()
+        recombination_service.shutdown()
+
+
+def post_job(url, request):
+    """Submit a job to the service
+
+    Args:
+        url (string): URL of the service
+        request (dict): job request (see service.JOB_REQUEST_KEYS)
+
+    Returns:
+        job (dict): submitted job
+    """
+    http_request = urllib.request.Request(
+        '{0}/jobs'.format(url),
+        data=json.dumps(request).encode('utf-8'),
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(http_request, timeout=60) as response:
+        assert response.status == 201
+        return json.loads(response.read().decode('utf-8'))
+
+
+def test_job_runs_and_streams_its_progress(stub_service, tmp_path):
+    """A job submitted over HTTP runs on the worker pool, its progress
+    is streamed until it completes and its outputs are written
+    """
+    recombine = pytest.importorskip('recombine')
+    benchmark = pytest.importorskip('benchmark')
+    inputdir_path = tmp_path / 'inputs'
+    inputdir_path.mkdir()
+    input_path_list = benchmark.write_pipeline_inputs(str(inputdir_path))
+    outdir_path = str(tmp_path / 'out')
+    request = {
+        'slabs': input_path_list[0:4], 'slabs_per_repetition': 2,
+        'lowres': input_path_list[4], 'outdir': outdir_path}
+    request['subject'] = 'sub-01'
+
+    job = post_job(stub_service, request)
+    assert job['status'] in ['queued', 'running']
+
+    # the progress stream ends when the job completes
+    with urllib.request.urlopen(
+            '{0}/jobs/{1}/progress'.format(stub_service, job['id']),
+            timeout=600) as response:
+        line_list = response.read().decode('utf-8').splitlines()
+    assert line_list[0] == '[service] job started'
+    assert line_list[-1] == '[service] job success'
+    assert 'Recombination code successfully run.' in line_list
+
+    with urllib.request.urlopen(
+            '{0}/jobs/{1}'.format(stub_service, job['id']),
+            timeout=60) as response:
+        job = json.loads(response.read().decode('utf-8'))
+    assert job['status'] == 'success'
+    for output in ['rs', 'rs1', 'rs2', 'rs_1_2']:
+        assert os.path.isfile(os.path.join(
+            outdir_path, '{0}_float_ponderated.nii.gz'.format(output)))
+    assert os.path.isfile(
+        os.path.join(outdir_path, recombine.RUN_REPORT_FILENAME))
+
+
+def exit_or_succeed(job, progress_queue):
+    """Job function: kill the worker process for the first job
+
+    Args:
+        job (dict): job
+        progress_queue (multiprocessing queue): progress queue
+
+    Returns:
+        result (dict): status and error message
+    """
+    if job['subject'] == 'killed':
+        os._exit(9)
+
+    return {'status': 'success', 'error': ''}
+
+
+def test_job_after_dead_worker_runs_on_new_pool():
+    """A job sent after a worker process died runs on a new pool
+    instead of being marked as failed
+    """
+    recombination_service = service.RecombinationService(exit_or_succeed)
+    recombination_service.start()
+    try:
+        request = dict((key, '-') for key in service.JOB_REQUEST_KEYS)
+        request['slabs'] = ['-']*4
+        killed_job = recombination_service.submit(
+            dict(request, subject='killed'))
+        for _ in range(200):
+            if recombination_service.job_summary(
+                    killed_job['id'])['status'] == 'failed':
+                break
+            threading.Event().wait(0.05)
+        job = recombination_service.submit(dict(request, subject='next'))
+        line_list = []
+        finished = False
+        while not finished:
+            new_line_list, finished = recombination_service.wait_progress(
+                job['id'], len(line_list))
+            line_list.extend(new_line_list)
+    finally:
+        recombination_service.shutdown()
+
+    assert recombination_service.job_summary(
+        killed_job['id'])['status'] == 'failed'
+    assert recombination_service.job_summary(job['id'])['status'] == \
+        'success'
+
+
+def test_job_slabs_of_any_grid():
+    """A job request gives its slabs as a list, of any number of
+    repetitions and slabs, or as one key rep[r]s[s] per slab
+    """
+    request = {'lowres': 'lowres', 'outdir': 'out'}
+    slab_path_list = ['rep{0}s{1}'.format(repetition, slab)
+                      for repetition in range(1, 4) for slab in range(1, 4)]
+    recombination_service = service.RecombinationService(exit_or_succeed)
+    recombination_service.start()
+    try:
+        job = recombination_service.submit(dict(
+            request, slabs=slab_path_list, slabs_per_repetition=3))
+        assert job['slabs'] == slab_path_list
+        assert job['slabs_per_repetition'] == 3
+        job = recombination_service.submit(dict(request, slabs=['a', 'b']))
+        assert job['slabs_per_repetition'] == \
+            service.DEFAULT_SLABS_PER_REPETITION
+        job = recombination_service.submit(dict(
+            request, rep1s1='a', rep1s2='b', rep2s1='c', rep2s2='d'))
+        assert job['slabs'] == ['a', 'b', 'c', 'd']
+        assert job['slabs_per_repetition'] == 2
+
+        for bad_request in [
+                dict(request, slabs=slab_path_list, slabs_per_repetition=2),
+                dict(request, slabs=[]),
+                dict(request, rep1s1='a', rep1s2='b', rep2s1='c'),
+                request]:
+            with pytest.raises(ValueError):
+                recombination_service.submit(bad_request)
+    finally:
+        recombination_service.shutdown()
@@ -0,0 +1,106 @@
+"""Tests of the in-memory cache of decoded volumes (see volume_cache.py)"""
+
+import os
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+import volume_cache
+
+
+def get_data_available():
+    """Whether nibabel volumes still have get_data (removed in nibabel
+    5), used by the cache to size the volumes
+
+    Args:
+        N/A
+
+    Returns:
+        available (Boolean): True if get_data can be called
+    """
+    try:
+        nib.Nifti1Image(np.zeros((1, 1, 1)), np.eye(4)).get_data()
+    except Exception:
+        return False
+
+    return True
+
+
+pytestmark = pytest.mark.skipif(
+    not get_data_available(), reason='needs nibabel < 5 (get_data)')
+
+
+def write_volume(volume_path, value, shape=(4, 4, 4)):
+    """Write a volume filled with a value
+
+    Args:
+        volume_path (string): path to the .nii file
+        value (float): value of all voxels
+        shape (tuple of int): shape of the volume
+
+    Returns:
+        volume (nibabel volume): volume written
+    """
+    volume = nib.Nifti1Image(
+        np.full(shape, value, dtype=np.float32), np.eye(4))
+    nib.save(volume, volume_path)
+
+    return volume
+
+
+def test_modified_file_is_read_again(tmp_path):
+    """An entry is dropped once its file is overwritten, removed or
+    invalidated, even if the new file has the same size
+    """
+    cache = volume_cache.VolumeCache(1024*1024)
+    volume_path = str(tmp_path / 'volume.nii')
+    cache.put(volume_path, write_volume(volume_path, 1.0))
+    assert cache.get(volume_path) is not None
+
+    # same size, other modification time (e.g., overwritten by SPM)
+    write_volume(volume_path, 2.0)
+    file_stat = os.stat(volume_path)
+    os.utime(volume_path, ns=(file_stat.st_atime_ns,
+                              file_stat.st_mtime_ns+1000000))
+    assert cache.get(volume_path) is None
+    assert cache.stats()['entries'] == 0
+
+    cache.put(volume_path, write_volume(volume_path, 3.0))
+    # same file through another path
+    os.symlink(volume_path, str(tmp_path / 'link.nii'))
+    assert np.all(
+        cache.get(str(tmp_path / 'link.nii')).get_fdata() == 3.0)
+    cache.invalidate(str(tmp_path / 'link.nii'))
+    assert cache.get(volume_path) is None
+
+    cache.put(volume_path, write_volume(volume_path, 4.0))
+    os.remove(volume_path)
+    assert cache.get(volume_path) is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_least_recently_used_volumes_are_evicted(tmp_path):
+    """The cache stays within its maximum size by evicting the least
+    recently used volumes, and does not keep volumes larger than it
+    """
+    # room for two 4x4x4 float32 volumes
+    cache = volume_cache.VolumeCache(2*4*4*4*4)
+    path_list = [
+        str(tmp_path / 'volume{0}.nii'.format(index)) for index in range(3)]
+    for index, volume_path in enumerate(path_list[0:2]):
+        cache.put(volume_path, write_volume(volume_path, index))
+    assert cache.get(path_list[0]) is not None
+    cache.put(path_list[2], write_volume(path_list[2], 2))
+
+    assert cache.get(path_list[1]) is None
+    assert cache.get(path_list[0]) is not None
+    assert cache.get(path_list[2]) is not None
+    assert cache.stats()['evictions'] == 1
+    large_path = str(tmp_path / 'large.nii')
+    cache.put(large_path, write_volume(large_path, 0, (8, 8, 8)))
+    assert cache.get(large_path) is None
+    assert cache.stats()['entries'] == 2
+
+    cache.set_max_bytes(0)
+    assert cache.stats()['entries'] == 0
@@ -0,0 +1,110 @@
+"""Tests of the work queue (see work_queue.py), with several worker
+processes and the stub registration backend (no Matlab needed)"""
+
+import csv
+import glob
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import work_queue
+
+
+RECOMBINE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'recombine.py')
+SUBJECT_NAMES = ['sub-01', 'sub-02', 'sub-03']
+
+
+def write_manifest(tmp_path):
+    """Write synthetic inputs and a manifest of subjects sharing them
+
+    Args:
+        tmp_path (pathlib.Path): temporary folder of the test
+
+    Returns:
+        manifest_path (string): path to the CSV manifest
+    """
+    benchmark = pytest.importorskip('benchmark')
+    inputdir_path = tmp_path / 'inputs'
+    inputdir_path.mkdir()
+    input_path_list = benchmark.write_pipeline_inputs(str(inputdir_path))
+    manifest_path = str(tmp_path / 'subjects.csv')
+    with open(manifest_path, 'w', newline='') as manifest_file:
+        writer = csv.writer(manifest_file)
+        writer.writerow(
+            ['subject', 'rep1s1', 'rep1s2', 'rep2s1', 'rep2s2', 'lowres'])
+        for subject_name in SUBJECT_NAMES:
+            writer.writerow([subject_name] + input_path_list)
+
+    return manifest_path
+
+
+def start_worker(queue_path, scratch_path):
+    """Start a worker process
+
+    Args:
+        queue_path (string): path to the queue folder
+        scratch_path (string): scratch folder of the worker
+
+    Returns:
+        process (subprocess.Popen): worker process
+    """
+    return subprocess.Popen(
+        [sys.executable, RECOMBINE_PATH, 'worker', queue_path,
+         '--registration', 'stub', '--lease-timeout', '2',
+         '--poll-interval', '0.5', '--keep-intermediates', 'none',
+         '--scratch-dir', scratch_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def test_killed_worker_job_is_done_once(tmp_path):
+    """The job of a killed worker is reclaimed and completed by another
+    worker: every job ends in the done folder exactly once, and no
+    staging folder is left behind
+    """
+    # the workers run the pipeline, which needs nipype
+    pytest.importorskip('nipype')
+    manifest_path = write_manifest(tmp_path)
+    queue_path = str(tmp_path / 'queue')
+    outroot_path = str(tmp_path / 'out')
+    subprocess.check_call(
+        [sys.executable, RECOMBINE_PATH, 'submit', queue_path,
+         manifest_path, outroot_path],
+        stdout=subprocess.DEVNULL)
+
+    process_list = [
+        start_worker(queue_path, str(tmp_path)) for _ in range(3)]
+    try:
+        # kill the first worker while it writes to its staging folder
+        killed_token = '{0}-{1}'.format(
+            socket.gethostname(), process_list[0].pid)
+        deadline = time.time()+120
+        while not glob.glob(os.path.join(
+                outroot_path, '*.{0}.partial'.format(killed_token))):
+            assert time.time() < deadline, 'the worker started no job'
+            assert process_list[0].poll() is None
+            time.sleep(0.01)
+        process_list[0].send_signal(signal.SIGKILL)
+        for process in process_list[1:]:
+            assert process.wait(timeout=600) == 0
+    finally:
+        for process in process_list:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    status = work_queue.queue_status(queue_path)
+    assert status == {'pending': 0, 'leases': 0, 'done': 3, 'failed': 0}
+    done_list = sorted(os.listdir(os.path.join(queue_path, 'done')))
+    assert done_list == [
+        '{0}.json'.format(subject_name) for subject_name in SUBJECT_NAMES]
+    assert sorted(os.listdir(outroot_path)) == SUBJECT_NAMES
+    for subject_name in SUBJECT_NAMES:
+        assert os.path.isfile(os.path.join(
+            outroot_path, subject_name, 'rs_float_ponderated.nii.gz'))
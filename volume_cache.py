@@ -0,0 +1,194 @@
+"""In-memory cache of decoded volumes
+
+The recombination pipeline often saves a volume and reads it back a few
+steps later. Each read of a .nii.gz file means decompressing the whole
+volume again. This module keeps the most recently used volumes in
+memory, up to a maximum number of bytes, so that they can be read back
+without touching the disk.
+
+Entries are keyed by the real path of the file and are only valid as
+long as the file has not been modified (same size and modification
+time), so files overwritten by external tools (e.g., SPM) are read
+again from disk.
+
+"""
+
+import collections
+import os
+import threading
+
+import instrumentation
+
+
+class VolumeCache(object):
+    """Least recently used cache of decoded volumes
+
+    Args:
+        max_bytes (int): maximum size of the cached data arrays, in
+            bytes. 0 disables the cache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        instrumentation.declare_counter('volume_cache_hits')
+        instrumentation.declare_counter('volume_cache_misses')
+        instrumentation.declare_counter('volume_cache_evictions')
+
+    @staticmethod
+    def file_key(path):
+        """Key and signature of a file
+
+        Args:
+            path (string): path to the file
+
+        Returns:
+            key (string): real path to the file
+            signature (tuple): size and modification time of the file.
+                None if the file does not exist.
+        """
+        key = os.path.realpath(path)
+        try:
+            file_stat = os.stat(key)
+        except OSError:
+            return key, None
+
+        return key, (file_stat.st_size, file_stat.st_mtime_ns)
+
+    def get(self, path):
+        """Get a volume from the cache
+
+        Args:
+            path (string): path to the volume file
+
+        Returns:
+            volume (nibabel volume): cached volume, None if the volume
+                is not in the cache or if the file has changed since it
+                was cached
+        """
+        key, signature = self.file_key(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] != signature:
+                # file modified since cached
+                self.remove_entry(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                instrumentation.increment_counter('volume_cache_misses')
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            instrumentation.increment_counter('volume_cache_hits')
+            return entry[1]
+
+    def put(self, path, volume):
+        """Store a volume in the cache
+
+        The file must already exist on disk with the content of volume.
+        The least recently used volumes are evicted until the cache fits
+        in its maximum size. Volumes larger than the maximum size are
+        not cached.
+
+        Args:
+            path (string): path to the volume file
+            volume (nibabel volume): volume whose data array is already
+                in memory
+
+        Returns:
+            N/A
+        """
+        key, signature = self.file_key(path)
+        nbytes = volume.get_data().nbytes
+        with self.lock:
+            if key in self.entries:
+                self.remove_entry(key)
+            if signature is None or nbytes > self.max_bytes:
+                return
+            self.entries[key] = (signature, volume, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                evicted_key = next(iter(self.entries))
+                self.remove_entry(evicted_key)
+                self.evictions += 1
+                instrumentation.increment_counter('volume_cache_evictions')
+
+    def invalidate(self, path):
+        """Remove a volume from the cache
+
+        Args:
+            path (string): path to the volume file
+
+        Returns:
+            N/A
+        """
+        key = os.path.realpath(path)
+        with self.lock:
+            if key in self.entries:
+                self.remove_entry(key)
+
+    def remove_entry(self, key):
+        """Remove an entry from the cache
+
+        Args:
+            key (string): key of the entry (real path to the file)
+
+        Returns:
+            N/A
+        """
+        entry = self.entries.pop(key)
+        self.current_bytes -= entry[2]
+
+    def set_max_bytes(self, max_bytes):
+        """Change the maximum size of the cache
+
+        Args:
+            max_bytes (int): maximum size of the cached data arrays, in
+                bytes. 0 disables the cache.
+
+        Returns:
+            N/A
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.current_bytes > self.max_bytes:
+                self.remove_entry(next(iter(self.entries)))
+                self.evictions += 1
+                instrumentation.increment_counter('volume_cache_evictions')
+
+    def clear(self):
+        """Remove all volumes from the cache
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """Cache statistics
+
+        Args:
+            N/A
+
+        Returns:
+            stats (dict): number of hits, misses and evictions, number
+                of cached volumes, current and maximum size in bytes
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes}
@@ -0,0 +1,158 @@
+"""Watch folder for incoming acquisitions
+
+Detects the inputs of each subject as they land in a folder, using a
+naming pattern, so that each input can be processed as soon as it is
+complete instead of waiting for the whole set.
+
+A file is considered complete once its size and modification time have
+not changed for a given time (e.g., the scanner or the transfer tool
+has stopped writing to it). Files are only reported once.
+
+"""
+
+import os
+import re
+import time
+
+import batch
+
+
+# roles of the inputs of a subject
+INPUT_ROLES = batch.MANIFEST_COLUMNS[1:]
+# default naming pattern of the inputs: [subject]_[role].nii(.gz)
+DEFAULT_NAME_PATTERN = \
+    r'^(?P<subject>.+)_(?P<role>rep1s1|rep1s2|rep2s1|rep2s2|lowres)' \
+    r'\.nii(\.gz)?$'
+# time (in seconds) during which a file must not change to be complete
+DEFAULT_STABLE_SECONDS = 10
+# time (in seconds) between two polls of the watched folder
+DEFAULT_POLL_INTERVAL = 2
+
+
+def compile_name_pattern(name_pattern):
+    """Compile the naming pattern of the inputs
+
+    Args:
+        name_pattern (string): regular expression matched against the
+            file names. Must define the named groups 'subject' and
+            'role' (one of INPUT_ROLES)
+
+    Returns:
+        name_regex (re.Pattern): compiled pattern
+    """
+    try:
+        name_regex = re.compile(name_pattern)
+    except re.error as exc:
+        raise ValueError('invalid naming pattern: {0}'.format(exc))
+    missing_groups = [
+        group for group in ['subject', 'role']
+        if group not in name_regex.groupindex]
+    if missing_groups:
+        raise ValueError(
+            'the naming pattern must define the groups {0}'.format(
+                ', '.join(missing_groups)))
+
+    return name_regex
+
+
+def match_input(filename, name_regex):
+    """Subject and role of an input file
+
+    Args:
+        filename (string): file name (without folder)
+        name_regex (re.Pattern): naming pattern of the inputs
+
+    Returns:
+        subject (string): subject name. None if the file is not an input
+        role (string): role of the input (see INPUT_ROLES). None if the
+            file is not an input
+    """
+    match = name_regex.match(filename)
+    if match is None or match.group('role') not in INPUT_ROLES:
+        return None, None
+
+    return match.group('subject'), match.group('role')
+
+
+class FolderWatcher(object):
+    """Report the input files of a folder once they are complete
+
+    Args:
+        watch_path (string): path to the watched folder
+        name_pattern (string): naming pattern of the inputs (see
+            compile_name_pattern)
+        stable_seconds (float): time (in seconds) during which the size
+            and modification time of a file must not change for the
+            file to be complete
+    """
+
+    def __init__(
+            self,
+            watch_path,
+            name_pattern=DEFAULT_NAME_PATTERN,
+            stable_seconds=DEFAULT_STABLE_SECONDS):
+        if not os.path.isdir(watch_path):
+            raise IOError('{0} is not a folder'.format(watch_path))
+        self.watch_path = watch_path
+        self.name_regex = compile_name_pattern(name_pattern)
+        self.stable_seconds = stable_seconds
+        # path -> ((size, modification time), time first seen as such)
+        self.observed = {}
+        # paths already reported
+        self.reported = set()
+
+    def poll(self):
+        """List the input files that became complete since the last poll
+
+        Args:
+            N/A
+
+        Returns:
+            input_list (list of tuples): (subject, role, path) of each
+                newly complete input, sorted by path
+        """
+        now = time.monotonic()
+        input_list = []
+        seen_path_set = set()
+        for filename in sorted(os.listdir(self.watch_path)):
+            subject, role = match_input(filename, self.name_regex)
+            if subject is None:
+                continue
+            file_path = os.path.join(self.watch_path, filename)
+            if file_path in self.reported:
+                continue
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                # removed or renamed in the meantime
+                continue
+            seen_path_set.add(file_path)
+            signature = (file_stat.st_size, file_stat.st_mtime)
+            observed = self.observed.get(file_path)
+            if observed is None or observed[0] != signature:
+                # new or still being written
+                self.observed[file_path] = (signature, now)
+                continue
+            if now-observed[1] < self.stable_seconds:
+                continue
+            del self.observed[file_path]
+            self.reported.add(file_path)
+            input_list.append((subject, role, file_path))
+
+        # forget files that disappeared before being complete
+        for file_path in list(self.observed):
+            if file_path not in seen_path_set:
+                del self.observed[file_path]
+
+        return input_list
+
+    def pending_count(self):
+        """Number of input files seen but not complete yet
+
+        Args:
+            N/A
+
+        Returns:
+            pending_count (int): number of files
+        """
+        return len(self.observed)
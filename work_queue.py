@@ -0,0 +1,538 @@
+"""Work queue on a shared file system
+
+Distributes the subjects of a cohort across several worker processes,
+possibly running on several nodes that share a file system, without a
+job broker. The queue is a folder with one subfolder per job state:
+    - pending: jobs waiting for a worker
+    - leases: jobs claimed by a worker
+    - done: completed jobs, with their result
+    - failed: failed jobs, with their result
+Each job is a JSON file that moves from one subfolder to another with
+atomic renames, so that a job is only ever claimed by one worker.
+
+A worker keeps the lease of its job alive by updating the modification
+time of the lease file. Leases that have not been updated for longer
+than the lease timeout (e.g., the worker crashed or its node went down)
+are put back in the pending folder by the other workers, up to a
+maximum number of attempts.
+
+Outputs are committed idempotently: each attempt writes to its own
+staging folder, renamed to the output folder at the end. If the output
+folder already exists (e.g., a worker whose lease had expired completed
+the job anyway), the attempt is discarded. The staging folders left by
+earlier attempts (e.g., the worker crashed) are removed when the job is
+started again, committed or failed.
+
+"""
+
+import os
+import glob
+import json
+import shutil
+import socket
+import threading
+import time
+
+
+# subfolders of the queue, one per job state
+QUEUE_SUBFOLDERS = ['pending', 'leases', 'done', 'failed']
+# time (in seconds) after which the lease of a silent worker expires
+DEFAULT_LEASE_TIMEOUT = 600
+# number of times a job is started before it is considered failed
+DEFAULT_MAX_ATTEMPTS = 3
+# time (in seconds) between two polls of the queue by an idle worker
+DEFAULT_POLL_INTERVAL = 10
+
+
+def worker_token():
+    """Identifier of the current worker process
+
+    Args:
+        N/A
+
+    Returns:
+        token (string): [host name]-[process id]
+    """
+    return '{0}-{1}'.format(socket.gethostname(), os.getpid())
+
+
+def prepare_queue(queue_path):
+    """Create the queue folder and its subfolders if they do not exist
+
+    Args:
+        queue_path (string): path to the queue folder
+
+    Returns:
+        N/A
+    """
+    for subfolder in QUEUE_SUBFOLDERS:
+        subfolder_path = os.path.join(queue_path, subfolder)
+        try:
+            os.makedirs(subfolder_path)
+        except OSError:
+            if not os.path.isdir(subfolder_path):
+                raise
+
+
+def job_path(queue_path, state, job_id):
+    """Path to the file of a job
+
+    Args:
+        queue_path (string): path to the queue folder
+        state (string): job state (subfolder of the queue)
+        job_id (string): job identifier
+
+    Returns:
+        job_path (string): path to the job file
+    """
+    return os.path.join(queue_path, state, '{0}.json'.format(job_id))
+
+
+def write_json_atomic(path, data):
+    """Write a JSON file atomically
+
+    The file is written next to its destination, then renamed, so that
+    readers never see a partial file.
+
+    Args:
+        path (string): path to the JSON file
+        data (dict): content of the file
+
+    Returns:
+        N/A
+    """
+    tmp_path = '{0}.{1}.tmp'.format(path, worker_token())
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=2, sort_keys=True)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.rename(tmp_path, path)
+
+
+def read_json(path):
+    """Read a JSON file
+
+    Args:
+        path (string): path to the JSON file
+
+    Returns:
+        data (dict): content of the file
+    """
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def job_state(queue_path, job_id):
+    """Current state of a job
+
+    Args:
+        queue_path (string): path to the queue folder
+        job_id (string): job identifier
+
+    Returns:
+        state (string): job state (subfolder of the queue). None if the
+            job is not in the queue.
+    """
+    for state in QUEUE_SUBFOLDERS:
+        if os.path.exists(job_path(queue_path, state, job_id)):
+            return state
+    # lease files are named after the job and the worker
+    leasedir_path = os.path.join(queue_path, 'leases')
+    for filename in os.listdir(leasedir_path):
+        if filename.endswith('.json') and filename.startswith(job_id+'.'):
+            try:
+                if read_json(os.path.join(leasedir_path, filename))['id'] \
+                        == job_id:
+                    return 'leases'
+            except (IOError, OSError):
+                # lease released in the meantime
+                continue
+
+    return None
+
+
+def submit_jobs(queue_path, subject_list):
+    """Add subjects to the queue
+
+    Subjects already in the queue (in any state) are not added again.
+
+    Args:
+        queue_path (string): path to the queue folder
+        subject_list (list of dict): subjects (see batch.read_manifest).
+            The subject name is the job identifier.
+
+    Returns:
+        submitted_count (int): number of jobs added to the queue
+    """
+    prepare_queue(queue_path)
+    submitted_count = 0
+    for subject in subject_list:
+        job_id = subject['subject']
+        if job_state(queue_path, job_id) is not None:
+            continue
+        job = dict(subject)
+        job['id'] = job_id
+        job['attempts'] = 0
+        write_json_atomic(job_path(queue_path, 'pending', job_id), job)
+        submitted_count += 1
+
+    return submitted_count
+
+
+def filesystem_time(queue_path):
+    """Current time according to the shared file system
+
+    Lease expiry is measured with the modification times set by the
+    file system, so that the clocks of the nodes do not need to be
+    synchronised.
+
+    Args:
+        queue_path (string): path to the queue folder
+
+    Returns:
+        now (float): current time of the file system, in seconds since
+            the epoch
+    """
+    clock_path = os.path.join(
+        queue_path, 'leases', '.clock.{0}'.format(worker_token()))
+    with open(clock_path, 'w'):
+        pass
+    now = os.stat(clock_path).st_mtime
+    os.remove(clock_path)
+
+    return now
+
+
+def reclaim_expired_leases(queue_path, lease_timeout, max_attempts):
+    """Put the jobs of silent workers back in the queue
+
+    Args:
+        queue_path (string): path to the queue folder
+        lease_timeout (float): time (in seconds) after which a lease
+            that has not been updated expires
+        max_attempts (int): number of times a job is started before it
+            is considered failed
+
+    Returns:
+        reclaimed_count (int): number of expired leases
+    """
+    leasedir_path = os.path.join(queue_path, 'leases')
+    now = filesystem_time(queue_path)
+    reclaimed_count = 0
+    for filename in sorted(os.listdir(leasedir_path)):
+        if not filename.endswith('.json'):
+            continue
+        lease_path = os.path.join(leasedir_path, filename)
+        try:
+            if now-os.stat(lease_path).st_mtime < lease_timeout:
+                continue
+            # only one worker wins the rename
+            expired_path = '{0}.{1}.expired'.format(
+                lease_path, worker_token())
+            os.rename(lease_path, expired_path)
+        except OSError:
+            # lease renewed, completed or reclaimed by another worker
+            continue
+        job = read_json(expired_path)
+        print('Lease of job {0} expired (worker {1})'.format(
+            job['id'], job.get('worker')))
+        if job['attempts'] >= max_attempts:
+            job['status'] = 'failed'
+            job['error'] = 'lease expired after {0} attempts'.format(
+                job['attempts'])
+            write_json_atomic(
+                job_path(queue_path, 'failed', job['id']), job)
+            remove_staging_dirs(job['outdir'])
+        else:
+            write_json_atomic(
+                job_path(queue_path, 'pending', job['id']), job)
+        os.remove(expired_path)
+        reclaimed_count += 1
+
+    return reclaimed_count
+
+
+def claim_job(queue_path):
+    """Claim the next pending job
+
+    Args:
+        queue_path (string): path to the queue folder
+
+    Returns:
+        job (dict): claimed job. None if there is no pending job.
+        lease_path (string): path to the lease file of the job
+    """
+    pendingdir_path = os.path.join(queue_path, 'pending')
+    for filename in sorted(os.listdir(pendingdir_path)):
+        if not filename.endswith('.json'):
+            continue
+        pending_path = os.path.join(pendingdir_path, filename)
+        # the lease file is named after the job and the worker, so that a
+        # worker whose lease was reclaimed never touches the lease of the
+        # next attempt
+        lease_path = os.path.join(
+            queue_path, 'leases',
+            '{0}.{1}.json'.format(filename[:-len('.json')], worker_token()))
+        try:
+            # only one worker wins the rename
+            os.rename(pending_path, lease_path)
+            # the lease starts now
+            os.utime(lease_path, None)
+        except OSError:
+            # claimed by another worker
+            continue
+        job = read_json(lease_path)
+        job['attempts'] += 1
+        job['worker'] = worker_token()
+        write_json_atomic(lease_path, job)
+        return job, lease_path
+
+    return None, None
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Thread that keeps the lease of a job alive
+
+    Updates the modification time of the lease file at regular
+    intervals until stopped.
+
+    Args:
+        lease_path (string): path to the lease file
+        interval (float): time (in seconds) between two updates
+    """
+
+    def __init__(self, lease_path, interval):
+        super(LeaseHeartbeat, self).__init__()
+        self.daemon = True
+        self.lease_path = lease_path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                os.utime(self.lease_path, None)
+            except OSError:
+                # lease reclaimed by another worker
+                self.lost = True
+                return
+
+    def stop(self):
+        """Stop updating the lease
+
+        Args:
+            N/A
+
+        Returns:
+            N/A
+        """
+        self.stop_event.set()
+        self.join()
+
+
+def staging_dir_path(outdir_path, token):
+    """Path to the staging folder of an attempt
+
+    Args:
+        outdir_path (string): path to the output folder of the job
+        token (string): identifier of the worker (see worker_token)
+
+    Returns:
+        staging_path (string): [output folder].[token].partial
+    """
+    return '{0}.{1}.partial'.format(outdir_path.rstrip(os.sep), token)
+
+
+def remove_staging_dirs(outdir_path):
+    """Remove the staging folders of all attempts of a job
+
+    Args:
+        outdir_path (string): path to the output folder of the job
+
+    Returns:
+        N/A
+    """
+    for staging_path in glob.glob(
+            staging_dir_path(glob.escape(outdir_path), '*')):
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+
+def commit_output_dir(staging_path, outdir_path):
+    """Rename a staging folder to the output folder
+
+    Args:
+        staging_path (string): path to the staging folder
+        outdir_path (string): path to the output folder
+
+    Returns:
+        committed (Boolean): False if the output folder already existed
+            (the staging folder is then removed)
+    """
+    try:
+        if os.path.exists(outdir_path):
+            raise OSError('{0} already exists'.format(outdir_path))
+        os.rename(staging_path, outdir_path)
+    except OSError:
+        if not os.path.exists(outdir_path):
+            raise
+        # committed by another attempt
+        shutil.rmtree(staging_path, ignore_errors=True)
+        return False
+
+    return True
+
+
+def complete_job(queue_path, job, lease_path, result):
+    """Record the result of a job and release its lease
+
+    Args:
+        queue_path (string): path to the queue folder
+        job (dict): job
+        lease_path (string): path to the lease file of the job
+        result (dict): result of the job. Its status ('failed' or not)
+            decides whether the job goes to the failed or done folder
+
+    Returns:
+        N/A
+    """
+    if result['status'] == 'failed' and not os.path.exists(lease_path):
+        # lease reclaimed by another worker: the job is back in the queue
+        # (or was failed by that worker), this attempt is not recorded
+        return
+    job = dict(job)
+    job.update(result)
+    if result['status'] == 'failed':
+        state = 'failed'
+    else:
+        state = 'done'
+    write_json_atomic(job_path(queue_path, state, job['id']), job)
+    try:
+        os.remove(lease_path)
+    except OSError:
+        # lease reclaimed by another worker: the job is back in the
+        # queue and will be skipped as already committed
+        pass
+
+
+def run_job(job, job_function, job_function_args):
+    """Run a claimed job
+
+    Args:
+        job (dict): claimed job
+        job_function (function): function run for the job, called as
+            job_function(job, staging_path, *job_function_args). Writes
+            the outputs to the staging folder and returns a result
+            dictionary with at least a status ('failed' or not)
+        job_function_args (tuple): other arguments of job_function
+
+    Returns:
+        result (dict): result of the job
+    """
+    outdir_path = job['outdir']
+    # staging folders left by earlier attempts (e.g., their worker
+    # crashed) are not needed anymore
+    remove_staging_dirs(outdir_path)
+    if os.path.exists(outdir_path):
+        # committed by a previous attempt
+        return {
+            'status': 'success',
+            'error': 'outputs already committed by a previous attempt',
+            'outdir': outdir_path}
+    staging_path = staging_dir_path(outdir_path, worker_token())
+
+    result = job_function(job, staging_path, *job_function_args)
+    if result['status'] == 'failed':
+        shutil.rmtree(staging_path, ignore_errors=True)
+        if os.path.exists(outdir_path):
+            # committed by another attempt while this one was running
+            # (the staging folder may have been removed by that attempt)
+            result['status'] = 'success'
+            result['error'] = 'outputs already committed by another attempt'
+    elif not commit_output_dir(staging_path, outdir_path):
+        result['error'] = 'outputs already committed by another attempt'
+    if os.path.exists(outdir_path):
+        # staging folders of attempts still running with an expired lease
+        remove_staging_dirs(outdir_path)
+    result['outdir'] = outdir_path
+
+    return result
+
+
+def run_worker(
+        queue_path,
+        job_function,
+        job_function_args=(),
+        lease_timeout=DEFAULT_LEASE_TIMEOUT,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        wait=False):
+    """Process jobs from the queue until it is empty
+
+    Args:
+        queue_path (string): path to the queue folder
+        job_function (function): function run for each job (see
+            run_job)
+        job_function_args (tuple): other arguments of job_function
+        lease_timeout (float): time (in seconds) after which a lease
+            that has not been updated expires
+        max_attempts (int): number of times a job is started before it
+            is considered failed
+        poll_interval (float): time (in seconds) between two polls of
+            the queue when no job is pending
+        wait (Boolean): keep polling the queue for new jobs once it is
+            empty, instead of stopping
+
+    Returns:
+        processed_count (int): number of jobs processed by this worker
+    """
+    prepare_queue(queue_path)
+    processed_count = 0
+    while True:
+        reclaim_expired_leases(queue_path, lease_timeout, max_attempts)
+        job, lease_path = claim_job(queue_path)
+        if job is None:
+            leases_left = [
+                filename
+                for filename in os.listdir(os.path.join(queue_path, 'leases'))
+                if filename.endswith('.json')]
+            if not wait and not leases_left:
+                # nothing left to do or to reclaim
+                return processed_count
+            time.sleep(poll_interval)
+            continue
+
+        print('Worker {0}: job {1} (attempt {2})'.format(
+            worker_token(), job['id'], job['attempts']))
+        heartbeat = LeaseHeartbeat(lease_path, lease_timeout/4.0)
+        heartbeat.start()
+        try:
+            result = run_job(job, job_function, job_function_args)
+        finally:
+            heartbeat.stop()
+        if heartbeat.lost:
+            print('Worker {0}: lease of job {1} was reclaimed'.format(
+                worker_token(), job['id']))
+        complete_job(queue_path, job, lease_path, result)
+        print('Worker {0}: job {1} {2}'.format(
+            worker_token(), job['id'], result['status']))
+        processed_count += 1
+
+
+def queue_status(queue_path):
+    """Number of jobs in each state
+
+    Args:
+        queue_path (string): path to the queue folder
+
+    Returns:
+        counts (dict): number of jobs, keyed by state
+    """
+    counts = {}
+    for state in QUEUE_SUBFOLDERS:
+        counts[state] = len([
+            filename
+            for filename in os.listdir(os.path.join(queue_path, state))
+            if filename.endswith('.json')])
+
+    return counts